@@ -0,0 +1,48 @@
+"""
+Compares the AsyncioServer with PurelySync (both are one thread with an event loop, so this is really comparing
+asyncio's loop and transports with our EventLoop and sockets). Every server runs in its own process and is loaded
+by client processes that keep a number of keep-alive connections busy, each connection sending its next request
+as soon as it got the previous response. Three workloads: a tiny response (health check), a static file and a
+proxied request to a backend (which runs in its own process too).
+
+The same comparison for every server type and more workloads is benchmarks/server_benchmark.py.
+
+run it from the root of the repo with: python -m benchmarks.asyncio_server_benchmark
+"""
+import argparse
+import sys
+
+sys.path.insert(0, '.')
+from benchmarks.harness import Workload, ServerUnderTest, benchmark_settings, measure, start_backends
+
+SERVER_TYPES = ['PurelySync', 'AsyncioServer']
+WORKLOADS = [
+    Workload('health_check', '/health/'),
+    Workload('static_file', '/static/templates/home.html'),
+    Workload('reverse_proxy', '/reverseproxy/'),
+]
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds each workload runs for')
+    parser.add_argument('--connections', type=int, default=64)
+    parser.add_argument('--client-processes', type=int, default=2)
+    args = parser.parse_args()
+
+    backends, backend_ports = start_backends(1)
+    settings = benchmark_settings(backend_ports)
+    print(f"{'server':<16}{'workload':<16}{'requests/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for server_type in SERVER_TYPES:
+        server = ServerUnderTest(server_type, settings)
+        for workload in WORKLOADS:
+            #a short warm up so that caches and pooled backend connections are there before measuring
+            measure(server.port, workload, 1, 4, 0.5)
+            result = measure(server.port, workload, args.client_processes, args.connections, args.duration)
+            latency = result['latency_ms']
+            print(f"{server_type:<16}{workload.name:<16}{result['requests_per_second']:>12.0f}{latency['p50']:>10.2f}{latency['p99']:>10.2f}")
+        server.stop()
+    for backend in backends:
+        backend.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Measures how much it costs the EventLoop to service one ready socket while lots of other
+coroutines are parked on sockets that never become ready (idle keep-alive clients, basically).
+If dispatch is readiness driven the cost per event should stay flat no matter how many idle
+coroutines there are.
+
+run it from the root of the repo with: python -m benchmarks.event_loop_benchmark
+"""
+import argparse
+import resource
+import socket
+import sys
+import time
+from typing import Generator, List, Tuple
+
+sys.path.insert(0, '.')
+from event_loop.event_loop import EventLoop, ResourceTask
+
+def idle_client(client_socket) -> Generator:
+    yield ResourceTask(client_socket, 'readable')
+
+def ping_pong(sender, receiver, rounds: int, timings: List[float]) -> Generator:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        sender.send(b'x')
+        yield ResourceTask(receiver, 'readable')
+        receiver.recv(1)
+    timings.append(time.perf_counter() - start)
+
+def max_idle_connections(wanted: int) -> int:
+    """
+    every idle connection is a socketpair (two file descriptors), so raise the soft limit
+    as far as we can and cap the number of idle connections to what fits.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    return min(wanted, (soft - 64) // 2)
+
+def run(idle_connections: int, rounds: int) -> Tuple[int, float]:
+    idle_connections = max_idle_connections(idle_connections)
+    event_loop = EventLoop()
+    pairs = [socket.socketpair() for _ in range(idle_connections)]
+    for parked_end, _ in pairs:
+        parked_end.setblocking(False)
+        event_loop.run_coroutine(idle_client, parked_end)
+
+    sender, receiver = socket.socketpair()
+    receiver.setblocking(False)
+    timings: List[float] = []
+    event_loop.run_coroutine(ping_pong, sender, receiver, rounds, timings)
+    # the idle coroutines never finish, so only loop until the ping pong coroutine is done.
+    while not timings:
+        event_loop.run_once()
+
+    for parked_end, other_end in pairs:
+        event_loop.deregister_resource(parked_end)
+        parked_end.close()
+        other_end.close()
+    sender.close()
+    receiver.close()
+    event_loop.resource_selector.close()
+    return idle_connections, timings[0] / rounds
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', '-r', type=int, default=20000)
+    parser.add_argument('--idle', '-i', type=int, nargs='+', default=[0, 100, 1000, 10000])
+    args = parser.parse_args()
+    print(f"{'idle connections':>18}  {'usec per event':>15}")
+    for idle_connections in args.idle:
+        actual_idle_connections, seconds_per_event = run(idle_connections, args.rounds)
+        print(f"{actual_idle_connections:>18}  {seconds_per_event * 1e6:>15.2f}")
+
+if __name__ == "__main__":
+    main()
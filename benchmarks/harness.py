@@ -0,0 +1,245 @@
+"""
+The pieces the server benchmarks are built from: stand-in backends for the proxying tasks, a way to run any of
+the server types (in a subprocess or in this process), and client processes that keep connections busy and
+record the latency of every response.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, '.')
+
+BACKEND_BODY = b'x' * 1024
+STATIC_ROOT = os.path.abspath('static') + '/'
+
+class Workload:
+    """
+    What the clients ask for. With a pipeline_depth above 1 every connection sends that many requests at once and
+    then reads the responses, the latency of a response is counted from when the batch was sent.
+    """
+    def __init__(self, name: str, path: str, pipeline_depth: int = 1):
+        self.name = name
+        self.path = path
+        self.pipeline_depth = pipeline_depth
+
+    def __repr__(self) -> str:
+        return f'Workload({self.name}, {self.path}, pipeline_depth={self.pipeline_depth})'
+
+def server_types() -> Dict[str, type]:
+    from server.thread_per_client_server import ThreadPerClient
+    from server.thread_per_request_server import ThreadPerRequest
+    from server.purely_sync_server import PurelySync
+    from server.asyncio_server import AsyncioServer
+    return {'ThreadPerClient': ThreadPerClient, 'ThreadPerRequest': ThreadPerRequest, 'PurelySync': PurelySync, 'AsyncioServer': AsyncioServer}
+
+def benchmark_settings(backend_ports: List[int]) -> Dict:
+    """
+    the first backend is the reverse proxy's, load balancing goes to all of them.
+    """
+    return {
+        "tasks": {
+            "serve_static": {"match_criteria": {"url": ["/static/"]}, "context": {"staticRoot": STATIC_ROOT}},
+            #the backends only let responses to /reverseproxy/cached/ be cached, anything else goes through the cache to the backend
+            "reverse_proxy": {"match_criteria": {"url": ["/reverseproxy/"]}, "context": {"send_to": ('127.0.0.1', backend_ports[0]), "cache": {}}},
+            "load_balance": {"match_criteria": {"url": ["/loadbalance/"]},
+                             "context": {"send_to": [('127.0.0.1', port) for port in backend_ports], "strategy": "round_robin"}},
+            "health_check": {"match_criteria": {"url": ["/health/"]}, "context": {}},
+        }
+    }
+
+def free_port() -> int:
+    with socket.socket() as probe_socket:
+        probe_socket.bind(('127.0.0.1', 0))
+        return probe_socket.getsockname()[1]
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'nothing is listening on port {port}')
+
+def run_backend(port: int) -> None:
+    """
+    a backend that answers every request with the same 1KB response, fast enough not to be what's measured. Requests
+    for /reverseproxy/cached/ get a response that can be cached for a minute.
+    """
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(BACKEND_BODY), BACKEND_BODY)
+    cacheable_response = b'HTTP/1.1 200 OK\r\nCache-Control: max-age=60\r\nContent-Length: %d\r\n\r\n%s' % (len(BACKEND_BODY), BACKEND_BODY)
+
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                writer.write(cacheable_response if head.startswith(b'GET /reverseproxy/cached/') else response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def serve() -> None:
+        backend = await asyncio.start_server(handle_connection, '127.0.0.1', port)
+        await backend.serve_forever()
+    asyncio.run(serve())
+
+def start_backends(count: int) -> Tuple[List[multiprocessing.Process], List[int]]:
+    backends, ports = [], []
+    for _ in range(count):
+        port = free_port()
+        backend = multiprocessing.Process(target=run_backend, args=(port,), daemon=True)
+        backend.start()
+        backends.append(backend)
+        ports.append(port)
+    for port in ports:
+        wait_for_port(port)
+    return backends, ports
+
+def run_server(server_type: str, port: int, settings: Dict) -> None:
+    logging.disable(logging.CRITICAL)
+    server_class = server_types()[server_type]
+    server_class(settings, host='127.0.0.1', port=port).start_loop()
+
+def memory_usage(pid: int) -> Dict[str, Optional[int]]:
+    """
+    current and peak resident memory of a process in KB, read from /proc so it only works on linux.
+    """
+    memory = {'rss_kb': None, 'peak_rss_kb': None}
+    try:
+        with open(f'/proc/{pid}/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    memory['rss_kb'] = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    memory['peak_rss_kb'] = int(line.split()[1])
+    except OSError:
+        pass
+    return memory
+
+class ServerUnderTest:
+    """
+    A server of the given type listening on a free port, either in a subprocess (the default, so that the clients
+    and the server don't share a GIL and the memory measured is the server's) or in a thread of this process, which
+    is handy with a profiler but then the memory measured includes the benchmark itself.
+    """
+    def __init__(self, server_type: str, settings: Dict, in_process: bool = False):
+        self.server_type = server_type
+        self.port = free_port()
+        self.process: Optional[multiprocessing.Process] = None
+        if in_process:
+            server_thread = threading.Thread(target=run_server, args=(server_type, self.port, settings), daemon=True)
+            server_thread.start()
+            self.pid = os.getpid()
+        else:
+            self.process = multiprocessing.Process(target=run_server, args=(server_type, self.port, settings), daemon=True)
+            self.process.start()
+            self.pid = self.process.pid
+        wait_for_port(self.port)
+
+    def memory_usage(self) -> Dict[str, Optional[int]]:
+        return memory_usage(self.pid)
+
+    def stop(self) -> None:
+        """
+        a server running in this process can't be stopped, it just stays around until the benchmark exits.
+        """
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+
+async def read_response(reader: asyncio.StreamReader) -> Tuple[int, bool]:
+    """
+    reads one response and returns its status code and whether the connection stays open. The servers always send
+    a Content-Length (so do the stand-in backends).
+    """
+    head = await reader.readuntil(b'\r\n\r\n')
+    #the servers leave the reason phrase out of the status line
+    status_code = int(head.split(b'\r\n', 1)[0].split(b' ')[1])
+    keep_alive = b'\r\nconnection: close' not in head.lower()
+    for header_line in head.split(b'\r\n'):
+        if header_line.lower().startswith(b'content-length:'):
+            await reader.readexactly(int(header_line.split(b':', 1)[1]))
+            return status_code, keep_alive
+    raise ValueError(f'response without Content-Length: {head!r}')
+
+async def keep_connection_busy(port: int, workload: Workload, deadline: float, latencies: List[float], errors: List[str]) -> None:
+    request = f'GET {workload.path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n'.encode()
+    batch = request * workload.pipeline_depth
+    while time.perf_counter() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=1024 * 1024)
+        except OSError as error:
+            errors.append(repr(error))
+            await asyncio.sleep(0.01)
+            continue
+        try:
+            keep_alive = True
+            while keep_alive and time.perf_counter() < deadline:
+                start = time.perf_counter()
+                writer.write(batch)
+                for _ in range(workload.pipeline_depth):
+                    status_code, keep_alive = await read_response(reader)
+                    if status_code >= 400:
+                        errors.append(f'status {status_code}')
+                    latencies.append(time.perf_counter() - start)
+                    if not keep_alive:
+                        #the server closes the connection after this response (max_requests_per_connection), the
+                        #rest of the batch is never answered
+                        break
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as error:
+            #the connection got closed on us (an idle timeout on the server for example), start a new one
+            errors.append(repr(error))
+        finally:
+            writer.close()
+
+def run_clients(port: int, workload: Workload, connections: int, duration: float, results: 'multiprocessing.Queue') -> None:
+    latencies: List[float] = []
+    errors: List[str] = []
+    async def run_connections() -> None:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(keep_connection_busy(port, workload, deadline, latencies, errors) for _ in range(connections)))
+    asyncio.run(run_connections())
+    results.put((latencies, errors))
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def measure(port: int, workload: Workload, client_processes: int, connections: int, duration: float) -> Dict:
+    """
+    Runs the workload against the server on port for duration seconds, the connections are split over client_processes
+    processes (one asyncio loop each) so that the clients aren't the bottleneck. Latencies are in milliseconds.
+    """
+    results: 'multiprocessing.Queue' = multiprocessing.Queue()
+    connections_per_process = max(1, connections // client_processes)
+    clients = [multiprocessing.Process(target=run_clients, args=(port, workload, connections_per_process, duration, results))
+               for _ in range(client_processes)]
+    for client in clients:
+        client.start()
+    latencies: List[float] = []
+    errors: List[str] = []
+    for _ in clients:
+        client_latencies, client_errors = results.get()
+        latencies.extend(client_latencies)
+        errors.extend(client_errors)
+    for client in clients:
+        client.join()
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': len(latencies) / duration,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'p999': percentile(latencies, 0.999) * 1000,
+        },
+    }
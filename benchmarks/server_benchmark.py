@@ -0,0 +1,99 @@
+"""
+Runs every workload against every server type and reports requests per second, p50/p99/p999 latency and the server's
+memory use, so that a server type can be picked per deployment and regressions can be caught by comparing the json
+output of two runs.
+
+Workloads:
+keep_alive: a tiny response (the health check) over keep-alive connections.
+pipelined: the same, but every connection sends --pipeline-depth requests at once.
+large_file: a 1.4MB static file.
+reverse_proxy: a 1KB response from a stand-in backend, one that can't be cached.
+cached_proxy: the same response, but cacheable so it comes from the proxy's response cache.
+load_balance: the same, round robin over two stand-in backends.
+
+run it from the root of the repo with: python -m benchmarks.server_benchmark --json results.json
+and only some of it with, for example: python -m benchmarks.server_benchmark --servers PurelySync AsyncioServer --workloads keep_alive
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+from typing import Dict, List, Optional
+
+sys.path.insert(0, '.')
+from benchmarks.harness import Workload, ServerUnderTest, benchmark_settings, measure, server_types, start_backends
+
+def workloads(pipeline_depth: int) -> List[Workload]:
+    return [
+        Workload('keep_alive', '/health/'),
+        Workload('pipelined', '/health/', pipeline_depth),
+        Workload('large_file', '/static/images/testimage.png'),
+        Workload('reverse_proxy', '/reverseproxy/'),
+        Workload('cached_proxy', '/reverseproxy/cached/'),
+        Workload('load_balance', '/loadbalance/'),
+    ]
+
+def current_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_header() -> None:
+    print(f"{'server':<18}{'workload':<15}{'requests/s':>11}{'p50 ms':>9}{'p99 ms':>9}{'p999 ms':>9}{'errors':>8}{'rss MB':>8}")
+
+def print_result(result: Dict) -> None:
+    latency = result['latency_ms']
+    rss_mb = f"{result['rss_kb'] / 1024:.0f}" if result['rss_kb'] is not None else '?'
+    print(f"{result['server']:<18}{result['workload']:<15}{result['requests_per_second']:>11.0f}{latency['p50']:>9.2f}"
+          f"{latency['p99']:>9.2f}{latency['p999']:>9.2f}{result['errors']:>8}{rss_mb:>8}", flush=True)
+
+def main() -> None:
+    all_workloads = [workload.name for workload in workloads(1)]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--servers', nargs='+', default=list(server_types()), choices=list(server_types()))
+    parser.add_argument('--workloads', nargs='+', default=all_workloads, choices=all_workloads)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds each workload runs for')
+    parser.add_argument('--connections', type=int, default=64)
+    parser.add_argument('--client-processes', type=int, default=2)
+    parser.add_argument('--pipeline-depth', type=int, default=8)
+    parser.add_argument('--in-process', action='store_true', help='run the servers in this process instead of subprocesses')
+    parser.add_argument('--json', help='where to write the results as json')
+    args = parser.parse_args()
+
+    backends, backend_ports = start_backends(2)
+    settings = benchmark_settings(backend_ports)
+    results = []
+    print_header()
+    for server_type in args.servers:
+        server = ServerUnderTest(server_type, settings, in_process=args.in_process)
+        for workload in workloads(args.pipeline_depth):
+            if workload.name not in args.workloads:
+                continue
+            #a short warm up so that caches and pooled backend connections are there before measuring
+            measure(server.port, workload, 1, 4, 0.5)
+            result = measure(server.port, workload, args.client_processes, args.connections, args.duration)
+            results.append({'server': server_type, 'workload': workload.name, **result, **server.memory_usage()})
+            print_result(results[-1])
+        server.stop()
+    for backend in backends:
+        backend.terminate()
+
+    if args.json:
+        report = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'commit': current_commit(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'parameters': {'duration': args.duration, 'connections': args.connections, 'client_processes': args.client_processes,
+                           'pipeline_depth': args.pipeline_depth, 'in_process': args.in_process},
+            'results': results,
+        }
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import selectors
-from typing import Callable, Union, Generator
-import datetime
+from typing import Any, Callable, Dict, Union, Generator, List, Tuple, Optional
+import heapq
+import itertools
+import time
 import socket
 
 class ResourceTask:
@@ -16,6 +18,9 @@ class ResourceTask:
 
     This ResourceTask class is never called explicitly by the coroutines, the coroutines use the 'resource_task' method on the 
     EventLoop class to create a ResourceTask which they then yield.
+
+    With a timeout, a coroutine whose resource isn't ready within timeout seconds is resumed with a socket.timeout
+    raised at its yield instead (waiting on a backend that stopped answering, for example).
     """
     EVENT_TO_SELECTORS_EVENT = {
         #selectors.EVENT_WRITE and EVENT_READ are just ints, but its better to use the variable names.
@@ -23,13 +28,14 @@ class ResourceTask:
         'readable':selectors.EVENT_READ 
     }
 
-    def __init__(self, resource, event: str):
+    def __init__(self, resource, event: str, timeout: Optional[float] = None):
         """
         a event such as writable or readable along with a resource such as a socket or a file is provided. The resource is registered
         with the event loop so that the event loop can store it in a Selector which it uses to monitor which resources are ready to give back
         to the coroutine that yielded them.
         """
         self.resource = resource
+        self.timeout = timeout
         
         try:
             self.event = self.EVENT_TO_SELECTORS_EVENT[event]
@@ -43,87 +49,219 @@ class TimedTask:
     """
     A TimedTask is simply used to pause a coroutine for the given delay. The coroutine that 
     yielded the TimedTask will be resumed after the timedtask is complete.
+    The deadline is taken from the monotonic clock so that changes to the wall clock
+    (ntp adjustments for example) can't make a timer fire early or late.
     """
-    def __init__(self, delay: int):
+    def __init__(self, delay: Union[int, float]):
         self.delay = delay
-        self.delay_time = datetime.timedelta(seconds=delay)
-        self.start_time = datetime.datetime.now()
-        self.end_time = self.start_time + self.delay_time
+        self.start_time = time.monotonic()
+        self.end_time = self.start_time + delay
         
     def __str__(self):
         return str(vars(self))
 
+class FutureTask:
+    """
+    A result that another coroutine will provide later (a response from a backend that several coroutines are waiting
+    for, for example). A coroutine yields the FutureTask to be paused until someone calls set_result on it and then
+    reads the result from it. A FutureTask that already has its result resumes the coroutine on the next loop iteration.
+    """
+    def __init__(self, event_loop: 'EventLoop'):
+        self.event_loop = event_loop
+        self.done = False
+        self.result = None
+        self.waiting_coroutines: List[Generator] = []
+
+    def set_result(self, result) -> None:
+        self.result = result
+        self.done = True
+        waiting_coroutines, self.waiting_coroutines = self.waiting_coroutines, []
+        for coroutine in waiting_coroutines:
+            self.event_loop.schedule_timer(TimedTask(0), coroutine)
+
+    def __str__(self):
+        return f'FutureTask(done={self.done}, {len(self.waiting_coroutines)} waiting)'
+
 class EventLoop:
     """
     The great event loop. This class is responsible for running coroutines, getting tasks from them, 
     checking whether the tasks are complete, and then resuming the coroutines and passing in 
     any resources the coroutines may need.
+
+    A coroutine waiting on a resource is stored directly in the 'data' field of its selector key, so when
+    the selector says a resource is ready the loop already knows which coroutine to resume and never has
+    to look at coroutines that are still waiting. Coroutines waiting on a TimedTask are kept in a heap ordered
+    by deadline, so the earliest deadline is always at the front and is used as the select() timeout. Coroutines
+    waiting on a FutureTask are kept by the FutureTask itself until it has its result.
+
+    The deadline of a ResourceTask with a timeout goes in the same heap. It isn't taken out when the resource gets
+    ready first (that would mean searching the heap), resource_deadlines says which ResourceTask is still being waited
+    on for a resource and the deadlines of the others are dead: they are skipped when they come up and counted in
+    dead_deadlines. Once dead deadlines outnumber the live timers the heap is rebuilt without them, so a busy loop
+    whose resources are always ready in time doesn't fill the heap with deadlines that are minutes away.
     """
 
     def __init__(self):
-        self.task_to_coroutine = {}
-        self.ready_resources = set()
         self.resource_selector = selectors.DefaultSelector()
+        self.timers: List[Tuple[float, int, TimedTask, Generator]] = []
+        # used to break ties in the heap between timers with the same deadline so that
+        # the heap never has to compare two coroutines.
+        self.timer_sequence = itertools.count()
+        self.resource_deadlines: Dict[Any, ResourceTask] = {}
+        self.dead_deadlines = 0
+        # set by the server to a utils.profiling.Profiler, while it's enabled the loop reports how long every
+        # coroutine waited between being ready and being resumed.
+        self.profiler = None
         
-    def register_resource(self, resource, event: int):
-        self.resource_selector.register(resource, event)
+    def register_resource(self, resource, event: int, coroutine: Generator) -> None:
+        self.resource_selector.register(resource, event, data=coroutine)
     
     def deregister_resource(self, resource) -> None:
-        for task in self.task_to_coroutine:
-            if task.resource == resource:
-                del self.task_to_coroutine[task]
-                break
+        """
+        Drops the coroutine waiting on the given resource (if there is one). 
+        """
+        self.drop_deadline(resource)
+        try:
+            self.resource_selector.unregister(resource)
+        except (KeyError, ValueError):
+            pass
 
-    def run_coroutine(self, func: Callable, *func_args):
-        coroutine = func(*func_args)
-        task = next(coroutine)
-        if task:
-            self.task_to_coroutine[task] = coroutine
-            if isinstance(task, ResourceTask):
-                self.register_resource(task.resource, task.event)
-    
-    def is_complete(self, task) -> bool:
+    def drop_deadline(self, resource) -> None:
+        """
+        the resource isn't waited on anymore, its deadline (if it has one) stays in the heap as a dead one.
+        """
+        if self.resource_deadlines.pop(resource, None) is None:
+            return
+        self.dead_deadlines += 1
+        if self.dead_deadlines > len(self.timers) - self.dead_deadlines:
+            self.compact_timers()
+
+    def is_dead(self, task) -> bool:
+        return isinstance(task, ResourceTask) and self.resource_deadlines.get(task.resource) is not task
+
+    def compact_timers(self) -> None:
+        #in place, run_due_timers may be in the middle of popping from it
+        self.timers[:] = [timer for timer in self.timers if not self.is_dead(timer[2])]
+        heapq.heapify(self.timers)
+        self.dead_deadlines = 0
+
+    def schedule_timer(self, timed_task: TimedTask, coroutine: Generator) -> None:
+        heapq.heappush(self.timers, (timed_task.end_time, next(self.timer_sequence), timed_task, coroutine))
+
+    def park(self, task, coroutine: Generator) -> None:
+        """
+        Stores the coroutine so that it can be found again when its task is complete.
+        """
         if isinstance(task, ResourceTask):
-            return self.is_resource_task_complete(task)
+            self.register_resource(task.resource, task.event, coroutine)
+            if task.timeout is not None:
+                self.drop_deadline(task.resource)
+                self.resource_deadlines[task.resource] = task
+                heapq.heappush(self.timers, (time.monotonic() + task.timeout, next(self.timer_sequence), task, coroutine))
         elif isinstance(task, TimedTask):
-            return self.is_timed_task_complete(task)
+            self.schedule_timer(task, coroutine)
+        elif isinstance(task, FutureTask):
+            if task.done:
+                self.schedule_timer(TimedTask(0), coroutine)
+            else:
+                task.waiting_coroutines.append(coroutine)
         else:
-            raise ValueError(f"task has to be either a resource task or a timed task, got {str(task)}")
-    
-    def is_resource_task_complete(self, resource_task: ResourceTask) -> bool:
-        return resource_task.resource in self.ready_resources
-    
-    def is_timed_task_complete(self, timed_task: TimedTask) -> bool:
-        return datetime.datetime.now() > timed_task.end_time
+            raise ValueError(f"task has to be a resource task, a timed task or a future task, got {str(task)}")
 
+    def run_coroutine(self, func: Callable, *func_args):
+        coroutine = func(*func_args)
+        try:
+            task = next(coroutine)
+        except StopIteration:
+            #it finished without having to wait for anything
+            return
+        if task:
+            self.park(task, coroutine)
     
-    def get_new_task(self, coroutine: Generator, task):
-        if isinstance(task, ResourceTask):
-            self.resource_selector.unregister(task.resource)
+    def get_new_task(self, coroutine: Generator):
         try:
             new_task = coroutine.send(True)
             return new_task
         except StopIteration:
             return None
 
+    def resume(self, coroutine: Generator) -> None:
+        new_task = self.get_new_task(coroutine)
+        if new_task:
+            self.park(new_task, coroutine)
+
+    def has_tasks(self) -> bool:
+        return len(self.timers) > self.dead_deadlines or bool(self.resource_selector.get_map())
+
+    def select_timeout(self) -> Optional[float]:
+        """
+        None makes select() block until a resource is ready, which is what we want when
+        nothing is waiting on a timer.
+        """
+        #a dead deadline at the front would only wake select() up for nothing
+        while self.timers and self.is_dead(self.timers[0][2]):
+            heapq.heappop(self.timers)
+            self.dead_deadlines -= 1
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - time.monotonic())
+
+    def run_due_timers(self, profiler=None) -> None:
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, _, task, coroutine = heapq.heappop(self.timers)
+            if isinstance(task, ResourceTask):
+                self.expire(task, coroutine)
+                continue
+            if profiler is not None:
+                profiler.observe_scheduling_delay(coroutine, time.monotonic() - deadline)
+            self.resume(coroutine)
+
+    def expire(self, resource_task: ResourceTask, coroutine: Generator) -> None:
+        """
+        the deadline of a ResourceTask came up: if the coroutine is still waiting for it, it stops waiting and gets a
+        socket.timeout.
+        """
+        if self.is_dead(resource_task):
+            self.dead_deadlines -= 1
+            return
+        del self.resource_deadlines[resource_task.resource]
+        self.deregister_resource(resource_task.resource)
+        try:
+            new_task = coroutine.throw(socket.timeout(f'waited more than {resource_task.timeout}s for the resource to be ready'))
+        except StopIteration:
+            return
+        if new_task:
+            self.park(new_task, coroutine)
+
+    def run_once(self) -> None:
+        """
+        Waits until at least one resource is ready or the earliest timer is due, and resumes 
+        only the coroutines whose tasks are complete.
+        """
+        ready_resources = self.resource_selector.select(self.select_timeout())
+        profiler = self.profiler if self.profiler is not None and self.profiler.enabled else None
+        ready_time = time.monotonic() if profiler is not None else 0.0
+        for resource_wrapper, event in ready_resources:
+            if self.resource_selector.get_map().get(resource_wrapper.fileobj) is not resource_wrapper:
+                #a coroutine resumed earlier in this batch already deregistered this resource
+                continue
+            coroutine = resource_wrapper.data
+            # the resource is unregistered before the coroutine is resumed because the coroutine
+            # might close it or yield a different resource/event to wait on.
+            self.resource_selector.unregister(resource_wrapper.fileobj)
+            self.drop_deadline(resource_wrapper.fileobj)
+            if profiler is not None:
+                profiler.observe_scheduling_delay(coroutine, time.monotonic() - ready_time)
+            self.resume(coroutine)
+        self.run_due_timers(profiler)
+
     def loop(self):
         """
         This is the meat of the event loop. 
         """
-        self.ready_resources = set(self.resource_selector.select(-1))
-        
         while True:
-            for task, coroutine in list(self.task_to_coroutine.items()):
-                if self.is_complete(task):
-                    new_task = self.get_new_task(coroutine, task)
-                    del self.task_to_coroutine[task]
-                    
-                    if new_task:
-                        self.task_to_coroutine[new_task] = coroutine
-                        if isinstance(task, ResourceTask):
-                            self.register_resource(new_task.resource, new_task.event)
-            if not self.task_to_coroutine:
+            if not self.has_tasks():
                 print("all tasks are over, exiting the loop")
                 break
-
-            self.ready_resources = set(resource_wrapper.fileobj for resource_wrapper, event in self.resource_selector.select(-1))
\ No newline at end of file
+            self.run_once()
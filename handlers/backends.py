@@ -0,0 +1,278 @@
+import errno
+import math
+import random
+import socket
+import threading
+import time
+import logging
+from typing import Dict, List, Generator
+from event_loop.event_loop import ResourceTask, TimedTask
+from utils.general_utils import Range
+from utils.http_parser import HttpResponseParser
+from utils.custom_exceptions import NotValidHttpFormat
+
+
+class Backend:
+    """
+    One of the servers in a load_balance task's send_to list along with what we know about its health.
+
+    A backend can be unavailable for two reasons: the active health checker found it unhealthy, or passive
+    outlier detection ejected it because too many real requests to it failed in a row. When it becomes available
+    again it starts out getting only a fraction of its share of traffic and ramps up over slow_start_time seconds,
+    so a backend that just restarted (cold caches, jit warming up...) isn't flooded right away.
+    """
+    def __init__(self, host: str, port: int, weight: float = 1.0):
+        self.host = host
+        self.port = int(port)
+        self.address = (host, int(port))
+        self.weight = weight
+        self.healthy = True
+        self.consecutive_check_results = 0 #positive is consecutive passed checks, negative is consecutive failed checks
+        self.consecutive_failures = 0
+        self.ejection_count = 0
+        self.ejected_until = 0.0
+        self.available_since = 0.0
+        #kept up to date by the load balancing handlers, read by the latency aware strategies
+        self.outstanding_requests = 0
+        self.ewma_latency = 0.0
+        self.last_latency_sample = time.monotonic()
+        self.counter_lock = threading.Lock()
+
+    def is_available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def start_request(self) -> None:
+        with self.counter_lock:
+            self.outstanding_requests += 1
+
+    def finish_request(self) -> None:
+        with self.counter_lock:
+            self.outstanding_requests -= 1
+
+    def observe_latency(self, latency: float, decay_time: float) -> None:
+        """
+        Peak EWMA: a latency above the average replaces it right away so a backend that suddenly gets slow stops getting
+        traffic quickly, while a latency below the average only pulls it down gradually. The older the previous sample is,
+        the less it counts (decay_time is how long it takes for a sample's weight to drop to about a third).
+        """
+        with self.counter_lock:
+            now = time.monotonic()
+            if latency > self.ewma_latency:
+                self.ewma_latency = latency
+            else:
+                previous_weight = math.exp(-(now - self.last_latency_sample) / decay_time)
+                self.ewma_latency = self.ewma_latency * previous_weight + latency * (1 - previous_weight)
+            self.last_latency_sample = now
+
+    def load(self) -> float:
+        return (self.outstanding_requests + 1) / self.weight
+
+    def peak_ewma_cost(self) -> float:
+        """
+        the expected time until a new request sent to this backend would be answered, a backend we have no samples
+        for costs nothing so that it gets tried.
+        """
+        return self.ewma_latency * (self.outstanding_requests + 1) / self.weight
+
+    def __repr__(self) -> str:
+        return f'Backend({self.host}:{self.port}, healthy={self.healthy}, ejected={time.monotonic() < self.ejected_until})'
+
+class BackendSet:
+    """
+    The backends of one load_balance task and the passive outlier detection for them. The settings come from the
+    'outlier_detection' block of the task's context:
+
+    consecutive_failures: how many failed requests (connection errors or 5xx responses) in a row eject a backend.
+    base_ejection_time: how long the first ejection lasts, every following ejection of the same backend lasts longer.
+    max_ejection_time: the longest an ejection can last.
+    slow_start_time: how long a backend that comes back takes to get its full share of traffic.
+    """
+    def __init__(self, backends: List[Backend], consecutive_failures: int = 5, base_ejection_time: float = 30.0,
+                 max_ejection_time: float = 300.0, slow_start_time: float = 10.0):
+        self.backends = backends
+        self.consecutive_failures_to_eject = consecutive_failures
+        self.base_ejection_time = base_ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.slow_start_time = slow_start_time
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_send_to(cls, send_to: List, outlier_settings: Dict) -> 'BackendSet':
+        """
+        send_to is either a list of (host, port) or, for the weighted strategy after settings_preparer ran,
+        a list of (host, port, Range).
+        """
+        backends = []
+        for host, port, *weight in send_to:
+            if weight and isinstance(weight[0], Range):
+                backends.append(Backend(host, port, weight[0].upper_bound - weight[0].lower_bound))
+            else:
+                backends.append(Backend(host, port, *weight))
+        return cls(backends, **outlier_settings)
+
+    def take_over(self, previous_set: 'BackendSet') -> None:
+        """
+        after a reload, keeps the Backend of previous_set for every backend that is still in send_to with the same
+        weight, so what we know about it (health, ejections, latency, requests in flight) isn't lost.
+        """
+        previous_backends = {(backend.address, backend.weight): backend for backend in previous_set.backends}
+        self.backends = [previous_backends.get((backend.address, backend.weight), backend) for backend in self.backends]
+
+    def slow_start_factor(self, backend: Backend, now: float) -> float:
+        if self.slow_start_time <= 0:
+            return 1.0
+        return min(1.0, (now - backend.available_since) / self.slow_start_time)
+
+    def admitted_backends(self) -> List[Backend]:
+        """
+        The backends a strategy can pick from. When none of them is admitted the request still has to go somewhere,
+        so all of them are returned.
+        """
+        admitted_backends = [backend for backend in self.backends if self.admits(backend)]
+        return admitted_backends or self.backends
+
+    def admits(self, backend: Backend) -> bool:
+        """
+        Whether a request picked by a strategy should really go to this backend. Backends in slow start are
+        admitted with a probability that grows from 10% to 100%.
+        """
+        now = time.monotonic()
+        if not backend.is_available(now):
+            return False
+        slow_start_factor = self.slow_start_factor(backend, now)
+        return slow_start_factor >= 1.0 or random.random() < max(slow_start_factor, 0.1)
+
+    def record_success(self, backend: Backend) -> None:
+        backend.consecutive_failures = 0
+
+    def record_failure(self, backend: Backend) -> None:
+        with self.lock:
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures < self.consecutive_failures_to_eject:
+                return
+            now = time.monotonic()
+            if now < backend.ejected_until:
+                return
+            backend.consecutive_failures = 0
+            backend.ejection_count += 1
+            ejection_time = min(self.base_ejection_time * backend.ejection_count, self.max_ejection_time)
+            backend.ejected_until = now + ejection_time
+            backend.available_since = backend.ejected_until
+            logging.getLogger("backends").warning(f'ejecting {backend.host}:{backend.port} for {ejection_time}s')
+
+    def record_check_result(self, backend: Backend, passed: bool, healthy_threshold: int, unhealthy_threshold: int) -> None:
+        with self.lock:
+            if passed:
+                backend.consecutive_check_results = max(backend.consecutive_check_results, 0) + 1
+                if not backend.healthy and backend.consecutive_check_results >= healthy_threshold:
+                    backend.healthy = True
+                    backend.available_since = max(time.monotonic(), backend.ejected_until)
+                    #a backend that passes health checks again has served its ejection as far as we're concerned
+                    backend.ejection_count = 0
+            else:
+                backend.consecutive_check_results = min(backend.consecutive_check_results, 0) - 1
+                if backend.healthy and -backend.consecutive_check_results >= unhealthy_threshold:
+                    backend.healthy = False
+                    logging.getLogger("backends").warning(f'{backend.host}:{backend.port} failed its health checks')
+
+class HealthChecker:
+    """
+    Actively probes every backend of a BackendSet with a GET request, independently of the real traffic, so that
+    a dead backend is noticed even if no requests are going to it and a backend that came back is noticed without
+    sending it real requests first. The settings come from the 'health_checks' block of a load_balance task's context:
+
+    path: what to request, a response with a status code under 400 passes the check.
+    interval: seconds between two rounds of checks.
+    timeout: seconds a probe can take before it counts as failed.
+    healthy_threshold/unhealthy_threshold: how many checks in a row have to pass/fail to change a backend's state.
+
+    run_forever is for servers that use threads (it's run in its own thread), async_run_forever is a coroutine
+    for the EventLoop. Both stop after the round they're in once stop is called (when a reload replaced the task).
+    """
+    def __init__(self, backend_set: BackendSet, path: str = '/', interval: float = 5.0, timeout: float = 2.0,
+                 healthy_threshold: int = 2, unhealthy_threshold: int = 2):
+        self.backend_set = backend_set
+        self.path = path
+        self.interval = interval
+        self.timeout = min(timeout, interval)
+        self.healthy_threshold = healthy_threshold
+        self.unhealthy_threshold = unhealthy_threshold
+        self.probes_in_flight: Dict[Backend, socket.socket] = {}
+        self.stopped = False
+
+    def probe_request(self, backend: Backend) -> bytes:
+        return f'GET {self.path} HTTP/1.1\r\nHost: {backend.host}:{backend.port}\r\nConnection: close\r\n\r\n'.encode()
+
+    def record(self, backend: Backend, passed: bool) -> None:
+        self.backend_set.record_check_result(backend, passed, self.healthy_threshold, self.unhealthy_threshold)
+
+    def probe(self, backend: Backend) -> bool:
+        try:
+            with socket.create_connection(backend.address, timeout=self.timeout) as probe_socket:
+                probe_socket.sendall(self.probe_request(backend))
+                response_parser = HttpResponseParser()
+                while response_parser.head is None:
+                    data = probe_socket.recv(1024 * 16)
+                    if not data:
+                        return False
+                    response_parser.feed(data)
+                return response_parser.status_code < 400
+        except (OSError, NotValidHttpFormat):
+            return False
+
+    def stop(self) -> None:
+        self.stopped = True
+
+    def run_forever(self) -> None:
+        while not self.stopped:
+            for backend in self.backend_set.backends:
+                self.record(backend, self.probe(backend))
+            time.sleep(self.interval)
+
+    def start_thread(self) -> None:
+        health_check_thread = threading.Thread(target=self.run_forever)
+        health_check_thread.daemon = True
+        health_check_thread.start()
+
+    def async_probe(self, backend: Backend) -> Generator:
+        probe_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe_socket.setblocking(False)
+        self.probes_in_flight[backend] = probe_socket
+        passed = False
+        try:
+            error_code = probe_socket.connect_ex(backend.address)
+            if error_code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                yield ResourceTask(probe_socket, 'writable')
+                error_code = probe_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if not error_code:
+                #the request is tiny, it fits in the socket's send buffer
+                probe_socket.send(self.probe_request(backend))
+                response_parser = HttpResponseParser()
+                while response_parser.head is None:
+                    yield ResourceTask(probe_socket, 'readable')
+                    data = probe_socket.recv(1024 * 16)
+                    if not data:
+                        break
+                    response_parser.feed(data)
+                passed = response_parser.head is not None and response_parser.status_code < 400
+        except (OSError, NotValidHttpFormat):
+            passed = False
+        del self.probes_in_flight[backend]
+        probe_socket.close()
+        self.record(backend, passed)
+
+    def async_run_forever(self, event_loop) -> Generator:
+        """
+        Starts a probe coroutine per backend, waits for the timeout and then cancels the probes that are still
+        running by dropping them from the event loop (the event loop has no other way of cancelling a coroutine).
+        """
+        while not self.stopped:
+            for backend in self.backend_set.backends:
+                event_loop.run_coroutine(self.async_probe, backend)
+            yield TimedTask(self.timeout)
+            for backend, probe_socket in list(self.probes_in_flight.items()):
+                event_loop.deregister_resource(probe_socket)
+                probe_socket.close()
+                del self.probes_in_flight[backend]
+                self.record(backend, False)
+            yield TimedTask(self.interval - self.timeout)
@@ -1,5 +1,6 @@
-from .http_handlers import HttpBaseHandler, StaticAssetHandler, ReverseProxyHandler, LoadBalancingHandler, HealthCheckHandler, AsyncReverseProxyHandler, AsyncLoadBalancingHandler
-from typing import Dict, Callable, List
+from .http_handlers import HttpBaseHandler, StaticAssetHandler, ReverseProxyHandler, LoadBalancingHandler, HealthCheckHandler, MetricsHandler, ProfilingHandler, AsyncReverseProxyHandler, AsyncLoadBalancingHandler, AsyncioReverseProxyHandler, AsyncioLoadBalancingHandler
+from .route_index import RouteIndex
+from typing import Dict, Callable, List, Optional
 
 class ManageHandlers:
     """
@@ -15,29 +16,53 @@ class ManageHandlers:
             'serve_static':StaticAssetHandler,
             'reverse_proxy':ReverseProxyHandler,
             'load_balance':LoadBalancingHandler,
-            'health_check':HealthCheckHandler}
+            'health_check':HealthCheckHandler,
+            'metrics':MetricsHandler,
+            'profiling':ProfilingHandler}
         
         self.sync_compatible = {
             'serve_static':StaticAssetHandler,
             'reverse_proxy':AsyncReverseProxyHandler,
             'load_balance':AsyncLoadBalancingHandler,
-            'health_check':HealthCheckHandler
+            'health_check':HealthCheckHandler,
+            'metrics':MetricsHandler,
+            'profiling':ProfilingHandler
+        }
+
+        self.asyncio_compatible = {
+            'serve_static':StaticAssetHandler,
+            'reverse_proxy':AsyncioReverseProxyHandler,
+            'load_balance':AsyncioLoadBalancingHandler,
+            'health_check':HealthCheckHandler,
+            'metrics':MetricsHandler,
+            'profiling':ProfilingHandler
         }
     
-    def prepare_handlers(self) -> List[HttpBaseHandler]:
+    def prepare_handlers(self, previous_handlers: Optional[RouteIndex] = None) -> RouteIndex:
         """
         Picks handlers based on the settings and the server type as the async server has some 
-        different handlers and not picking all the handlers also means less iterations through handlers
-        when checking which one is supposed to handle the incoming http request.
+        different handlers. The handlers are compiled into a RouteIndex by their match criteria so the server
+        doesn't have to ask every handler whether it should handle the incoming http request.
+        When the settings are reloaded, previous_handlers are the ones the server has been using and every new handler
+        can carry over the state of the previous handler of its task (see HttpBaseHandler.carry_over).
         """
-        compatible_handlers = self.sync_compatible if self.server_obj.get_type() == 'sync' else self.implemented_handlers
+        previous_handlers_by_task = {handler.task_name: handler for handler in previous_handlers or ()}
+        compatible_handlers = {
+            'sync':self.sync_compatible,
+            'asyncio':self.asyncio_compatible
+        }.get(self.server_obj.get_type(), self.implemented_handlers)
         task_handlers: List[HttpBaseHandler] = []
         for task_name, task_info in self.tasks.items():
             match_criteria = task_info['match_criteria']
             needed_context = task_info['context']
             if task_name in compatible_handlers:
                 handler_class = compatible_handlers[task_name]
-                task_handlers.append(handler_class(match_criteria, needed_context, self.server_obj))
+                handler = handler_class(match_criteria, needed_context, self.server_obj)
+                handler.task_name = task_name
+                previous_handler = previous_handlers_by_task.get(task_name)
+                if type(previous_handler) is handler_class:
+                    handler.carry_over(previous_handler)
+                task_handlers.append(handler)
             else:
                 raise NotImplementedError
-        return task_handlers
\ No newline at end of file
+        return RouteIndex(task_handlers)
\ No newline at end of file
@@ -1,12 +1,39 @@
 import pathlib
-from typing import Any, List, Dict, Union, Sequence, Tuple, Callable, Generator
+import os
+import gzip
+import secrets
+from typing import Any, List, Dict, Optional, Union, Sequence, Tuple, Callable, Generator
 import socket
 import time
 import random
-from utils.general_utils import HttpRequest, HttpResponse, Range, SocketTasks, read_all, send_all, async_send_all
+import bisect
+import asyncio
+import itertools
+import concurrent.futures
+from utils.general_utils import HttpRequest, HttpResponse, FileResponse, SerializedResponse, ProxiedResponse, Range, SocketTasks, read_all, send_all, async_send_all, http_date, is_not_modified, preferred_encoding, parse_range_header, if_range_matches, execute_in_new_thread
+from utils.file_cache import OpenFileCache, StaticAssetCache, CachedAsset, CachedFile, PrecompressedVariants
+from utils.http_parser import HttpResponseParser
+from utils.connection_pool import UpstreamConnection
+from utils.response_cache import ResponseCache, CacheLookup, CacheEntry
+from utils.single_flight import SingleFlight, FlightKey
+from utils.custom_exceptions import NotValidHttpFormat
+from utils.profiling import PROFILER
+from .backends import Backend, BackendSet, HealthChecker
 import selectors
 from abc import ABC, abstractmethod
-from event_loop.event_loop import ResourceTask
+from event_loop.event_loop import ResourceTask, TimedTask, FutureTask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#encodings static assets are precompressed with, in order of preference when the client accepts several equally. The
+#best levels are slow (hundreds of ms for a big file with brotli) so nothing is compressed on the request path (see
+#PrecompressedVariants), a file that changed is sent uncompressed until its variants are ready.
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+if brotli is not None:
+    COMPRESSORS = {'br': lambda data: brotli.compress(data, quality=11), **COMPRESSORS}
 
 
 class HttpBaseHandler(ABC):
@@ -14,6 +41,8 @@ class HttpBaseHandler(ABC):
         self.http_request_match_criteria = match_criteria
         self.context = context
         self.server_obj = server_obj
+        #the name of the task in the settings, set by ManageHandlers. Metrics are recorded per task.
+        self.task_name = type(self).__name__
 
     def should_handle(self, http_request: HttpRequest) -> bool:
         """ 
@@ -35,6 +64,32 @@ class HttpBaseHandler(ABC):
                     return False
         return True
     
+    def start_background_work(self) -> None:
+        """
+        Called once when the server starts. Handlers that have work to do outside of handling requests (like health
+        checking backends) start it here.
+        """
+        pass
+
+    def carry_over(self, previous_handler: 'HttpBaseHandler') -> None:
+        """
+        Called by ManageHandlers when the settings are reloaded, with the handler the same task had before (before
+        start_background_work). Handlers take over what is still good with the new settings (caches, what is known
+        about the backends) so that a reload doesn't leave them cold.
+        """
+        pass
+
+    def retire(self, successor: Optional['HttpBaseHandler']) -> None:
+        """
+        Called once a reload replaced the handler, with the handler that took its place (None if the task is gone).
+        Requests that were already in flight may still be using it, so it only stops its background work and lets go of
+        what its successor didn't take over.
+        """
+        pass
+
+    def same_context(self, previous_handler: 'HttpBaseHandler', *keys: str) -> bool:
+        return all(self.context.get(key) == previous_handler.context.get(key) for key in keys)
+
     @abstractmethod
     def handle_request(self, http_request: HttpRequest) -> HttpResponse:
         pass
@@ -43,11 +98,46 @@ class HealthCheckHandler(HttpBaseHandler):
     def handle_request(self, http_request: HttpRequest) -> HttpResponse:  
         return HttpResponse(body="I'm Healthy!")
 
+class MetricsHandler(HttpBaseHandler):
+    """
+    Serves the server's metrics (see utils/metrics.py) in the prometheus text format.
+    """
+    def handle_request(self, http_request: HttpRequest) -> HttpResponse:
+        server_stats = self.server_obj.stats.snapshot()
+        if self.server_obj.tls is not None:
+            server_stats.update(self.server_obj.tls.handshake_counts())
+        body = self.server_obj.metrics.render(server_stats)
+        return HttpResponse(body=body, additional_headers={'Content-Type':'text/plain; version=0.0.4; charset=utf-8'})
+
+class ProfilingHandler(HttpBaseHandler):
+    """
+    Turns the profiler (see utils/profiling.py) on and off while the server runs and serves what it recorded, by the
+    last part of the url:
+    .../start starts a new profile (the stacks are sampled every "sample_interval" seconds of the context, 0.005 by default)
+    .../stop stops it
+    .../stacks the sampled stacks in the collapsed format, for example: curl .../stacks | flamegraph.pl > flame.svg
+    anything else: how long parsing, routing, every task's handler and sending took, and the event loop's scheduling delays.
+    """
+    def handle_request(self, http_request: HttpRequest) -> HttpResponse:
+        action = http_request.requested_url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+        if action == 'start':
+            PROFILER.start(self.context.get('sample_interval'))
+        elif action == 'stop':
+            PROFILER.stop()
+        elif action == 'stacks':
+            return HttpResponse(body=PROFILER.collapsed_stacks(), additional_headers={'Content-Type':'text/plain; charset=utf-8'})
+        return HttpResponse(body=PROFILER.report(), additional_headers={'Content-Type':'text/plain; charset=utf-8'})
+
 class StaticAssetHandler(HttpBaseHandler):
     def __init__(self, match_criteria: Dict[str, List], context: Dict, server_obj):
         super().__init__(match_criteria, context, server_obj)
         self.static_directory_path = context['staticRoot']
         self.all_files = set(pathlib.Path(self.static_directory_path).glob('**/*')) #get all files in the static directory
+        self.open_files = OpenFileCache(context.get('openFileCacheSize', 1024))
+        #files up to assetCacheMaxFileBytes are kept in memory as ready to send responses, bigger ones are sent with sendfile
+        self.asset_cache = StaticAssetCache(context.get('assetCacheBytes', 1024 * 1024 * 64), context.get('assetCacheMaxFileBytes', 1024 * 256))
+        self.precompressed = PrecompressedVariants(COMPRESSORS, max_file_bytes=self.asset_cache.max_asset_bytes)
+        self.compressible_types = {'text/css','text/html','text/javascript','application/x-mpegURL', 'image/svg+xml', 'application/json'}
         self.file_extension_mime_type = {
             '.jpg':'image/jpeg',
             '.jpeg':'image/jpeg',
@@ -68,6 +158,25 @@ class StaticAssetHandler(HttpBaseHandler):
             '.wmv':'video/x-ms-wmv'
         }
 
+    def start_background_work(self) -> None:
+        """
+        compresses every compressible file with the best levels, files whose variants were carried over from before
+        a reload are skipped.
+        """
+        compressible_paths = [str(path) for path in self.all_files if self.content_type(str(path)) in self.compressible_types]
+        self.precompressed.compress_in_background(compressible_paths, self.asset_cache.invalidate)
+
+    def carry_over(self, previous_handler: 'StaticAssetHandler') -> None:
+        if self.same_context(previous_handler, 'staticRoot', 'openFileCacheSize', 'assetCacheBytes', 'assetCacheMaxFileBytes'):
+            self.open_files = previous_handler.open_files
+            self.asset_cache = previous_handler.asset_cache
+            self.precompressed = previous_handler.precompressed
+
+    def retire(self, successor: Optional['StaticAssetHandler']) -> None:
+        #files that are still being sent are only closed once they're released
+        if successor is None or successor.open_files is not self.open_files:
+            self.open_files.close()
+
     def not_found_error_response(self, absolute_path: str) -> str:
         return (f'<pre> the file requested was searched for in {absolute_path} and it does not exist.\n'
                 f'A proper request for a static resource is any of the strings the request should start with (as defined\n'
@@ -80,89 +189,698 @@ class StaticAssetHandler(HttpBaseHandler):
                 return http_request.requested_url[len(required_beginning):]
         raise Exception("somehow the requested url doesn't begin with the required beginning path")
         
+    def content_type(self, absolute_path: str) -> str:
+        file_extension = os.path.splitext(absolute_path)[1].lower()
+        return self.file_extension_mime_type.get(file_extension,'text/html') #get mime type and default to text/html
+
+    def validators(self, cached_file: CachedFile, content_type: str, encoding: str = '') -> Dict[str, str]:
+        """
+        The headers that identify this version of the file. Every encoding of a file is a different representation
+        so it gets its own ETag, and responses for compressible types have to say they vary on Accept-Encoding.
+        """
+        stat_result = cached_file.stat_result
+        etag_suffix = f'-{encoding}' if encoding else ''
+        validators = {
+            'ETag': f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}{etag_suffix}"',
+            'Last-Modified': http_date(stat_result.st_mtime),
+            'Accept-Ranges': 'bytes'
+        }
+        if content_type in self.compressible_types:
+            validators['Vary'] = 'Accept-Encoding'
+        if encoding:
+            validators['Content-Encoding'] = encoding
+        return validators
+
+    def not_modified_response(self, validators: Dict[str, str]) -> HttpResponse:
+        not_modified_response = HttpResponse(response_code=304, additional_headers=validators)
+        #a 304 never has a body, so it shouldn't describe one either
+        del not_modified_response.headers['Content-Type']
+        del not_modified_response.headers['Content-Length']
+        not_modified_response.headers.pop('Content-Encoding', None)
+        return not_modified_response
+
+    def serialize_asset(self, cached_file: CachedFile, content_type: str, body: bytes, encoding: str = '') -> CachedAsset:
+        validators = self.validators(cached_file, content_type, encoding)
+        full_response = HttpResponse(body=body, additional_headers={'Content-Type':content_type, **validators}).dump()
+        not_modified_response = self.not_modified_response(validators).dump()
+        return CachedAsset(cached_file.path, cached_file.stat_result, full_response, not_modified_response, validators['ETag'])
+
+    def cache_asset(self, cached_file: CachedFile, content_type: str) -> CachedAsset:
+        """
+        reads a small file once and serializes the full 200 and 304 responses for it so that later
+        requests don't do any header building at all. Compressible files get a variant for every encoding from
+        PrecompressedVariants, kept only if it is actually smaller. A file that changed since it was compressed is
+        cached without variants (still with Vary: Accept-Encoding) while they are made in the background, the asset
+        is dropped from the cache once they are ready so the next request picks them up.
+        """
+        file_contents = os.pread(cached_file.file_descriptor, cached_file.size, 0)
+        cached_asset = self.serialize_asset(cached_file, content_type, file_contents)
+        compressed_variants = None
+        is_compressible = content_type in self.compressible_types and len(file_contents) >= self.precompressed.min_file_bytes
+        if is_compressible:
+            compressed_variants = self.precompressed.get(cached_file.path, cached_file.stat_result)
+            for encoding, compressed_contents in (compressed_variants or {}).items():
+                if len(compressed_contents) < len(file_contents) * 0.9:
+                    cached_asset.variants[encoding] = self.serialize_asset(cached_file, content_type, compressed_contents, encoding)
+        self.asset_cache.put(cached_asset)
+        if is_compressible and compressed_variants is None:
+            #only once the asset is in the cache, so that the invalidation when the variants are ready comes after it
+            #(if another thread made them in the meantime, the asset is invalidated right away)
+            self.precompressed.compress_in_background([cached_file.path], self.asset_cache.invalidate)
+        return cached_asset
+
+    def acquire_compressed_sibling(self, http_request: HttpRequest, absolute_path: str) -> Union[CachedFile, None]:
+        """
+        Files too big to keep in memory are never compressed on the fly, but if a gzipped copy was put next to
+        the file ahead of time (style.css.gz next to style.css) it is sent to clients that accept gzip.
+        """
+        if preferred_encoding(http_request.get_header('Accept-Encoding'), ('gzip',)) != 'gzip':
+            return None
+        if pathlib.Path(absolute_path + '.gz') not in self.all_files:
+            return None
+        return self.open_files.acquire(absolute_path + '.gz')
+
+    def range_response(self, http_request: HttpRequest, cached_file: CachedFile, content_type: str, range_header: str) -> HttpResponse:
+        """
+        Range requests (a video player seeking for example) are always answered from the file on disk with sendfile,
+        never from the in memory or compressed versions, so only the requested bytes are ever read and each range is
+        sent in bounded sendfile calls. Several ranges are sent as a multipart/byteranges body.
+        """
+        size = cached_file.size
+        validators = self.validators(cached_file, content_type)
+        if is_not_modified(http_request, validators['ETag'], int(cached_file.stat_result.st_mtime)):
+            cached_file.release()
+            return self.not_modified_response(validators)
+
+        byte_ranges = None
+        if if_range_matches(http_request, validators['ETag'], validators['Last-Modified']):
+            byte_ranges = parse_range_header(range_header, size)
+        if byte_ranges is None:
+            return FileResponse(cached_file, additional_headers={'Content-Type':content_type, **validators})
+        if not byte_ranges:
+            cached_file.release()
+            return HttpResponse(response_code=416, additional_headers={'Content-Range':f'bytes */{size}'})
+
+        if len(byte_ranges) == 1:
+            first_byte, last_byte = byte_ranges[0]
+            range_headers = {'Content-Type':content_type, 'Content-Range':f'bytes {first_byte}-{last_byte}/{size}', **validators}
+            return FileResponse(cached_file, 206, range_headers, [(first_byte, last_byte - first_byte + 1)])
+
+        boundary = secrets.token_hex(16)
+        segments: List[Union[bytes, Tuple[int, int]]] = []
+        for first_byte, last_byte in byte_ranges:
+            part_headers = f'--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {first_byte}-{last_byte}/{size}\r\n\r\n'
+            segments += [part_headers.encode(), (first_byte, last_byte - first_byte + 1), b'\r\n']
+        segments.append(f'--{boundary}--\r\n'.encode())
+        multipart_headers = {'Content-Type':f'multipart/byteranges; boundary={boundary}', **validators}
+        return FileResponse(cached_file, 206, multipart_headers, segments)
+
     def handle_request(self, http_request: HttpRequest) -> HttpResponse:
-        file_extension = '.' + http_request.requested_url.split('.')[-1] #probably a better way
         absolute_path = self.static_directory_path + self.remove_url_prefix(http_request) 
-        content_type = self.file_extension_mime_type.get(file_extension,'text/html') #get mime type and default to text/html
-        if pathlib.Path(absolute_path) in self.all_files:
-            static_file_contents = open(absolute_path,'rb').read()
-            return HttpResponse(body=static_file_contents, additional_headers={'Content-Type':content_type})
-        else:
-            return HttpResponse(response_code=404, body=self.not_found_error_response(absolute_path))
+        range_header = http_request.get_header('Range') if http_request.request_type == 'GET' else None
+        cached_asset = self.asset_cache.get(absolute_path) if range_header is None else None
+        if cached_asset is None:
+            cached_file = None
+            if pathlib.Path(absolute_path) in self.all_files:
+                cached_file = self.open_files.acquire(absolute_path)
+            if cached_file is None:
+                return HttpResponse(response_code=404, body=self.not_found_error_response(absolute_path))
+
+            content_type = self.content_type(absolute_path)
+            if range_header is not None:
+                return self.range_response(http_request, cached_file, content_type, range_header)
+            if cached_file.size > self.asset_cache.max_asset_bytes:
+                encoding = ''
+                if content_type in self.compressible_types:
+                    compressed_file = self.acquire_compressed_sibling(http_request, absolute_path)
+                    if compressed_file is not None:
+                        cached_file.release()
+                        cached_file, encoding = compressed_file, 'gzip'
+                validators = self.validators(cached_file, content_type, encoding)
+                if is_not_modified(http_request, validators['ETag'], int(cached_file.stat_result.st_mtime)):
+                    cached_file.release()
+                    return self.not_modified_response(validators)
+                #the file isn't read here, the server sends it straight from the descriptor with sendfile
+                return FileResponse(cached_file, additional_headers={'Content-Type':content_type, **validators})
+            try:
+                cached_asset = self.cache_asset(cached_file, content_type)
+            finally:
+                cached_file.release()
+
+        if cached_asset.variants:
+            encoding = preferred_encoding(http_request.get_header('Accept-Encoding'), cached_asset.variants)
+            if encoding is not None:
+                cached_asset = cached_asset.variants[encoding]
+        if is_not_modified(http_request, cached_asset.etag, cached_asset.last_modified):
+            return SerializedResponse(cached_asset.not_modified_response, 304)
+        return SerializedResponse(cached_asset.full_response)
 
 class ReverseProxyHandler(HttpBaseHandler):
+    """
+    Sends requests to the backend in send_to. With a "cache" block in the context, responses the backend allows to be
+    cached are stored and served without asking the backend again (see utils/response_cache.py). With a "coalesce"
+    block, identical GETs that are in flight at the same time are sent to the backend once (see utils/single_flight.py).
+    The handlers of every server type fetch from the backend and wait for each other their own way (fetch,
+    coalesced_fetch) but go through the cache the same way.
+    """
     def __init__(self, match_criteria: Dict[str, List], context: Dict, server_obj):
         super().__init__(match_criteria, context, server_obj)
         self.remote_host, self.remote_port = context['send_to']
-        
+        self.connection_pool = server_obj.connection_pool
+        self.connection_pool.resolve_ahead([(self.remote_host, self.remote_port)])
+        self.response_cache = ResponseCache.from_context(context)
+        self.single_flight = SingleFlight.from_context(context)
+
+    def carry_over(self, previous_handler: 'ReverseProxyHandler') -> None:
+        """
+        what the backends answered is only still good if the task sends to the same backends.
+        """
+        if self.same_context(previous_handler, 'send_to', 'cache'):
+            self.response_cache = previous_handler.response_cache
+        if self.same_context(previous_handler, 'send_to', 'coalesce'):
+            self.single_flight = previous_handler.single_flight
+
+    def record_cache_result(self, lookup: CacheLookup) -> None:
+        self.server_obj.metrics.increment('pyrver_cache_requests_total', (('task', self.task_name), ('result', lookup.result)))
+
+    def record_coalesced(self) -> None:
+        self.server_obj.metrics.increment('pyrver_coalesced_requests_total', (('task', self.task_name),))
+
+    def record_upstream_error(self, remote_host: str, remote_port: int, error: Exception) -> None:
+        self.server_obj.metrics.record_upstream_error((remote_host, remote_port), error)
+
+    def bad_gateway_response(self, remote_host: str, remote_port: int, error: Exception) -> HttpResponse:
+        return HttpResponse(502, f'could not get a response from {remote_host}:{remote_port} ({error!r})')
+
+    def relaying_failed(self, proxied_response: ProxiedResponse, error: Exception) -> HttpResponse:
+        proxied_response.release()
+        remote_host, remote_port = proxied_response.connection.address
+        self.record_upstream_error(remote_host, remote_port, error)
+        return self.bad_gateway_response(remote_host, remote_port, error)
+
+    def finish_flight(self, key: FlightKey, future, http_response: Union[HttpResponse, None]) -> None:
+        """
+        hands the leader's response to the followers, None (the leader failed) makes them send their own request.
+        """
+        shared_response = None if http_response is None else self.single_flight.share(http_response)
+        self.single_flight.finish(key, future)
+        future.set_result(shared_response)
+
     def connect_and_send(self, remote_host: str, remote_port: int, http_request: HttpRequest) -> HttpResponse:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as remote_server:
-            remote_server.settimeout(15)
-            remote_server.connect((remote_host,int(remote_port)))
-            remote_server.sendall(http_request.raw_http_request)
-            data = remote_server.recv(1024)
-            http_response = HttpResponse.from_bytes(data)
-            return http_response
+        """
+        Sends the request over a pooled connection and returns as soon as the response's headers are in, the body
+        is relayed to the client by the server while it's being sent (see ProxiedResponse). A connection that sat 
+        in the pool can be closed by the backend right as we send on it, so if a reused connection fails before 
+        any of the response arrived, the request is tried once more (see should_retry).
+        """
+        address = (remote_host, int(remote_port))
+        retried = False
+        while True:
+            connection = self.connection_pool.acquire(address)
+            #releasing the connection counts the request as sent on it, so whether it was reused has to be known before
+            reused = connection.reused
+            proxied_response = ProxiedResponse(connection, self.connection_pool, HttpResponseParser(http_request.request_type))
+            try:
+                connection.socket.sendall(http_request.raw_http_request)
+                while not proxied_response.has_head:
+                    proxied_response.receive_head()
+            except (OSError, NotValidHttpFormat) as error:
+                proxied_response.release()
+                if self.should_retry(error, reused, retried, proxied_response):
+                    retried = True
+                    continue
+                raise
+            return proxied_response
+
+    def should_retry(self, error: Exception, reused: bool, retried: bool, proxied_response: ProxiedResponse) -> bool:
+        """
+        only a pooled connection the backend closed before answering anything is worth a second try, and only one. A
+        timeout means the backend has the request and is slow (or gone), sending it again would only double the wait.
+        """
+        return reused and not retried and not proxied_response.received and not isinstance(error, (socket.timeout, asyncio.TimeoutError))
+
+    def fetch(self, http_request: HttpRequest) -> HttpResponse:
+        try:
+            return self.connect_and_send(self.remote_host, self.remote_port, http_request)
+        except (OSError, NotValidHttpFormat) as error:
+            self.record_upstream_error(self.remote_host, self.remote_port, error)
+            return self.bad_gateway_response(self.remote_host, self.remote_port, error)
+
+    def coalesced_fetch(self, http_request: HttpRequest) -> HttpResponse:
+        """
+        fetch, unless the same GET is already being fetched for another client: then this thread waits for that
+        response and gets a copy of it.
+        """
+        key = None if self.single_flight is None else self.single_flight.key(http_request)
+        if key is None:
+            return self.fetch(http_request)
+        future, is_leader = self.single_flight.join(key, concurrent.futures.Future)
+        if not is_leader:
+            try:
+                shared_response = future.result(self.single_flight.wait_timeout)
+            except concurrent.futures.TimeoutError:
+                shared_response = None
+            if shared_response is None:
+                return self.fetch(http_request)
+            self.record_coalesced()
+            return shared_response.response()
+        http_response = None
+        try:
+            http_response = self.fetch(http_request)
+            if self.single_flight.wants_body(http_response):
+                try:
+                    while not http_response.complete and len(http_response.received) <= self.single_flight.max_response_bytes:
+                        http_response.head_received(http_response.receive())
+                except (OSError, NotValidHttpFormat) as error:
+                    http_response = self.relaying_failed(http_response, error)
+        finally:
+            self.finish_flight(key, future, http_response)
+        return http_response
 
     def handle_request(self, http_request: HttpRequest) -> HttpResponse:
-        return self.connect_and_send(self.remote_host, self.remote_port, http_request)
+        if self.response_cache is None:
+            return self.coalesced_fetch(http_request)
+        lookup = self.response_cache.lookup(http_request)
+        self.record_cache_result(lookup)
+        if lookup.response is not None:
+            if lookup.revalidate_in_background:
+                execute_in_new_thread(self.revalidate, (http_request, lookup))
+            return lookup.response
+        return self.response_cache.fetched(http_request, lookup, self.coalesced_fetch(lookup.upstream_request))
+
+    def revalidate(self, http_request: HttpRequest, lookup: CacheLookup) -> None:
+        """
+        refreshes a stale response that was sent to a client anyway, the new response is stored once it was read.
+        """
+        http_response = None
+        try:
+            http_response = self.response_cache.fetched(http_request, lookup, self.fetch(lookup.upstream_request))
+            if isinstance(http_response, ProxiedResponse):
+                while not http_response.complete:
+                    http_response.receive()
+        except (OSError, NotValidHttpFormat):
+            pass
+        finally:
+            if isinstance(http_response, ProxiedResponse):
+                http_response.release()
+            self.response_cache.finish_revalidation(lookup.entry)
 
 class LoadBalancingHandler(ReverseProxyHandler):
     def __init__(self, match_criteria: Dict[str, List], context: Dict, server_obj):
         HttpBaseHandler.__init__(self, match_criteria, context, server_obj)
+        self.connection_pool = server_obj.connection_pool
+        self.response_cache = ResponseCache.from_context(context)
+        self.single_flight = SingleFlight.from_context(context)
         self.strategy = self.context['strategy']
         self.remote_servers = self.context['send_to']
+        self.backends = BackendSet.from_send_to(self.remote_servers, self.context.get('outlier_detection', {}))
+        self.connection_pool.resolve_ahead([(backend.host, backend.port) for backend in self.backends.backends])
+        self.health_checker = None
+        if 'health_checks' in self.context:
+            self.health_checker = HealthChecker(self.backends, **self.context['health_checks'])
         self.server_index = 0
+        #cumulative_weights[i] is the sum of the weights of backends 0..i, a weighted pick is a binary search in it
+        self.cumulative_weights = list(itertools.accumulate(backend.weight for backend in self.backends.backends))
+        self.ewma_decay_time = self.context.get('ewma_decay_time', 10.0)
         self.strategy_mapping = {
             "round_robin":self.round_robin_strategy,
-            "weighted":self.weighted_strategy
+            "weighted":self.weighted_strategy,
+            "least_requests":self.least_requests_strategy,
+            "peak_ewma":self.peak_ewma_strategy,
+            "power_of_two_choices":self.power_of_two_choices_strategy
         }
+
+    def start_background_work(self) -> None:
+        if self.health_checker:
+            self.health_checker.start_thread()
+
+    def carry_over(self, previous_handler: 'LoadBalancingHandler') -> None:
+        """
+        the backends that are still there keep their state, the new health checker checks them along with the new ones.
+        """
+        super().carry_over(previous_handler)
+        self.backends.take_over(previous_handler.backends)
+
+    def retire(self, successor: Optional['LoadBalancingHandler']) -> None:
+        if self.health_checker:
+            self.health_checker.stop()
         
-    def round_robin_strategy(self) -> Tuple[str,int]:
-        server_to_send_to = self.remote_servers[self.server_index % len(self.remote_servers)]
-        self.server_index +=1
-        return server_to_send_to
+    def round_robin_strategy(self) -> Backend:
+        """
+        skips over backends that are down or in slow start (some of the time). If every backend is down, the requests
+        still have to go somewhere so the next one in line is picked anyway.
+        """
+        backends = self.backends.backends
+        for _ in range(len(backends)):
+            backend = backends[self.server_index % len(backends)]
+            self.server_index +=1
+            if self.backends.admits(backend):
+                return backend
+        return backends[self.server_index % len(backends)]
     
-    def weighted_strategy(self) -> Tuple[str,int]:
-        random_num = random.random()
-        for host, port, weight_range in self.remote_servers:
-            if random_num in weight_range:
-                return (host, port)
-        raise Exception("random number generated was not in any range")
+    def pick_weighted(self) -> Backend:
+        random_num = random.random() * self.cumulative_weights[-1]
+        backend_index = bisect.bisect_right(self.cumulative_weights, random_num)
+        #random() * total can round up to total itself
+        return self.backends.backends[min(backend_index, len(self.cumulative_weights) - 1)]
 
-    def handle_request(self, http_request: HttpRequest) -> HttpResponse:
+    def weighted_strategy(self) -> Backend:
+        for _ in range(len(self.backends.backends)):
+            backend = self.pick_weighted()
+            if self.backends.admits(backend):
+                return backend
+        return self.pick_weighted()
+
+    def least_requests_strategy(self) -> Backend:
+        """
+        picks the backend with the fewest requests in flight relative to its weight, ties are broken randomly so
+        that idle backends don't all get the same burst of requests in a fixed order.
+        """
+        backends = self.backends.admitted_backends()
+        lowest_load = min(backend.load() for backend in backends)
+        return random.choice([backend for backend in backends if backend.load() == lowest_load])
+
+    def peak_ewma_strategy(self) -> Backend:
+        """
+        picks the backend that is expected to answer soonest: its recent latency times the number of requests
+        in flight to it. Unlike least_requests this notices a backend that is slow but not (yet) piling up requests.
+        """
+        return min(self.backends.admitted_backends(), key=Backend.peak_ewma_cost)
+
+    def power_of_two_choices_strategy(self) -> Backend:
+        """
+        picks two backends at random and takes the one with the lower peak EWMA cost. This is nearly as good as
+        comparing every backend, but doesn't send every request to the same backend when the counters are stale
+        (they only change once responses come back) and doesn't get slower with more backends.
+        """
+        backends = self.backends.admitted_backends()
+        if len(backends) < 2:
+            return backends[0]
+        first_choice, second_choice = random.sample(backends, 2)
+        return min(first_choice, second_choice, key=Backend.peak_ewma_cost)
+
+    def record_outcome(self, backend: Backend, http_response: HttpResponse, request_start: float) -> None:
+        """
+        the latency sample is the time until the backend's response head arrived, the backend stays counted as
+        busy with the request until the body was relayed to the client and the response is released.
+        """
+        backend.observe_latency(time.monotonic() - request_start, self.ewma_decay_time)
+        if isinstance(http_response, ProxiedResponse):
+            http_response.on_release = backend.finish_request
+        else:
+            backend.finish_request()
+        if http_response.status_code >= 500:
+            self.backends.record_failure(backend)
+        else:
+            self.backends.record_success(backend)
+
+    def record_error(self, backend: Backend, error: Exception) -> None:
+        backend.finish_request()
+        self.backends.record_failure(backend)
+        self.record_upstream_error(backend.host, backend.port, error)
+
+    def fetch(self, http_request: HttpRequest) -> HttpResponse:
+        """
+        When a backend refuses the connection the request never reached it, so it's safe to try the next backend
+        instead of making the client pay for a backend that's restarting.
+        """
         strategy_func = self.strategy_mapping[self.strategy]
-        remote_host, remote_port = strategy_func()
-        return self.connect_and_send(remote_host, remote_port, http_request)    
+        for attempt in range(len(self.backends.backends)):
+            backend = strategy_func()
+            backend.start_request()
+            request_start = time.monotonic()
+            try:
+                http_response = self.connect_and_send(backend.host, backend.port, http_request)
+            except ConnectionRefusedError as error:
+                self.record_error(backend, error)
+                refused_error = error
+                continue
+            except (OSError, NotValidHttpFormat) as error:
+                self.record_error(backend, error)
+                return self.bad_gateway_response(backend.host, backend.port, error)
+            self.record_outcome(backend, http_response, request_start)
+            return http_response
+        return self.bad_gateway_response(backend.host, backend.port, refused_error)
 
 
 class AsyncReverseProxyHandler(ReverseProxyHandler):
 
     def connect_and_send(self, remote_host: str, remote_port: int, http_request: HttpRequest) -> Generator:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as remote_server:
-            remote_server.setblocking(False)
+        address = (remote_host, int(remote_port))
+        retried = False
+        while True:
+            connection = yield from self.connection_pool.acquire(address)
+            reused = connection.reused
+            proxied_response = ProxiedResponse(connection, self.connection_pool, HttpResponseParser(http_request.request_type))
             try:
-                remote_server.connect((remote_host,int(remote_port)))
-            except BlockingIOError:
-                yield ResourceTask(remote_server,'writable')
-            yield from async_send_all(remote_server, http_request.raw_http_request)
-            yield ResourceTask(remote_server, 'readable')
-            data = read_all(remote_server)
-            http_response = HttpResponse.from_bytes(data)
-            return http_response
+                yield from async_send_all(connection.socket, http_request.raw_http_request)
+                while not proxied_response.has_head:
+                    yield proxied_response.readable()
+                    proxied_response.receive_head()
+            except (OSError, NotValidHttpFormat) as error:
+                proxied_response.release()
+                if self.should_retry(error, reused, retried, proxied_response):
+                    retried = True
+                    continue
+                raise
+            return proxied_response
 
-    def handle_request(self, http_request: HttpRequest) -> Generator:
-        http_response = yield from self.connect_and_send(self.remote_host, self.remote_port, http_request)
+    def fetch(self, http_request: HttpRequest) -> Generator:
+        try:
+            http_response = yield from self.connect_and_send(self.remote_host, self.remote_port, http_request)
+        except (OSError, NotValidHttpFormat) as error:
+            self.record_upstream_error(self.remote_host, self.remote_port, error)
+            http_response = self.bad_gateway_response(self.remote_host, self.remote_port, error)
         return http_response
 
+    def coalesced_fetch(self, http_request: HttpRequest) -> Generator:
+        key = None if self.single_flight is None else self.single_flight.key(http_request)
+        if key is None:
+            return (yield from self.fetch(http_request))
+        event_loop = self.server_obj.event_loop
+        future, is_leader = self.single_flight.join(key, lambda: FutureTask(event_loop))
+        if not is_leader:
+            yield future
+            if future.result is None:
+                return (yield from self.fetch(http_request))
+            self.record_coalesced()
+            return future.result.response()
+        event_loop.run_coroutine(self.expire_flight, key, future)
+        http_response = None
+        try:
+            http_response = yield from self.fetch(http_request)
+            if self.single_flight.wants_body(http_response):
+                try:
+                    while not http_response.complete and len(http_response.received) <= self.single_flight.max_response_bytes:
+                        yield http_response.readable()
+                        http_response.head_received(http_response.receive())
+                except (OSError, NotValidHttpFormat) as error:
+                    http_response = self.relaying_failed(http_response, error)
+        finally:
+            self.finish_flight(key, future, http_response)
+        return http_response
+
+    def expire_flight(self, key: FlightKey, future: FutureTask) -> Generator:
+        """
+        the followers stop waiting after wait_timeout and send their own requests, like the threads' future.result(timeout).
+        """
+        yield TimedTask(self.single_flight.wait_timeout)
+        if not future.done:
+            self.single_flight.finish(key, future)
+            future.set_result(None)
+
+    def handle_request(self, http_request: HttpRequest) -> Generator:
+        if self.response_cache is None:
+            return (yield from self.coalesced_fetch(http_request))
+        lookup = self.response_cache.lookup(http_request)
+        self.record_cache_result(lookup)
+        if lookup.response is not None:
+            if lookup.revalidate_in_background:
+                self.server_obj.event_loop.run_coroutine(self.revalidate, http_request, lookup)
+            return lookup.response
+        http_response = yield from self.coalesced_fetch(lookup.upstream_request)
+        return self.response_cache.fetched(http_request, lookup, http_response)
+
+    def revalidate(self, http_request: HttpRequest, lookup: CacheLookup) -> Generator:
+        http_response = None
+        try:
+            http_response = yield from self.fetch(lookup.upstream_request)
+            http_response = self.response_cache.fetched(http_request, lookup, http_response)
+            if isinstance(http_response, ProxiedResponse):
+                while not http_response.complete:
+                    yield http_response.readable()
+                    http_response.receive()
+        except (OSError, NotValidHttpFormat):
+            pass
+        finally:
+            if isinstance(http_response, ProxiedResponse):
+                http_response.release()
+            self.response_cache.finish_revalidation(lookup.entry)
+
 class AsyncLoadBalancingHandler(AsyncReverseProxyHandler, LoadBalancingHandler):
     
     def __init__(self, match_criteria: Dict[str, List], context: Dict, server_obj):
         super().__init__(match_criteria, context, server_obj)
         LoadBalancingHandler.__init__(self, match_criteria, context, server_obj)
     
-    def handle_request(self, http_request: HttpRequest) -> Generator:
+    def start_background_work(self) -> None:
+        if self.health_checker:
+            event_loop = self.server_obj.event_loop
+            event_loop.run_coroutine(self.health_checker.async_run_forever, event_loop)
+
+    def fetch(self, http_request: HttpRequest) -> Generator:
         strategy_func = self.strategy_mapping[self.strategy]
-        remote_host, remote_port = strategy_func()
-        http_response = yield from self.connect_and_send(remote_host, remote_port, http_request)   
+        for attempt in range(len(self.backends.backends)):
+            backend = strategy_func()
+            backend.start_request()
+            request_start = time.monotonic()
+            try:
+                http_response = yield from self.connect_and_send(backend.host, backend.port, http_request)
+            except ConnectionRefusedError as error:
+                self.record_error(backend, error)
+                refused_error = error
+                continue
+            except (OSError, NotValidHttpFormat) as error:
+                self.record_error(backend, error)
+                return self.bad_gateway_response(backend.host, backend.port, error)
+            self.record_outcome(backend, http_response, request_start)
+            return http_response
+        return self.bad_gateway_response(backend.host, backend.port, refused_error)
+
+class AsyncioReverseProxyHandler(ReverseProxyHandler):
+    """
+    The reverse proxy for the AsyncioServer, the same as AsyncReverseProxyHandler but with coroutines for asyncio's
+    event loop. Waiting for the backend's response head is limited by the connection pool's connect_timeout, the
+    same limit the threaded servers' blocking sockets have.
+    """
+    def __init__(self, match_criteria: Dict[str, List], context: Dict, server_obj):
+        super().__init__(match_criteria, context, server_obj)
+        self.revalidations = set()
+
+    async def connect_and_send(self, remote_host: str, remote_port: int, http_request: HttpRequest) -> ProxiedResponse:
+        event_loop = asyncio.get_running_loop()
+        address = (remote_host, int(remote_port))
+        retried = False
+        while True:
+            connection = await self.connection_pool.acquire(address)
+            reused = connection.reused
+            proxied_response = ProxiedResponse(connection, self.connection_pool, HttpResponseParser(http_request.request_type))
+            try:
+                await event_loop.sock_sendall(connection.socket, http_request.raw_http_request)
+                while not proxied_response.has_head:
+                    data = await asyncio.wait_for(event_loop.sock_recv(connection.socket, ProxiedResponse.BUFFER_SIZE), self.connection_pool.connect_timeout)
+                    proxied_response.head_received(proxied_response.consume(data))
+            except (OSError, NotValidHttpFormat, asyncio.TimeoutError) as error:
+                proxied_response.release()
+                if self.should_retry(error, reused, retried, proxied_response):
+                    retried = True
+                    continue
+                raise
+            except asyncio.CancelledError:
+                #the client went away while we were waiting for the backend
+                proxied_response.release()
+                raise
+            return proxied_response
+
+    async def fetch(self, http_request: HttpRequest) -> HttpResponse:
+        try:
+            return await self.connect_and_send(self.remote_host, self.remote_port, http_request)
+        except (OSError, NotValidHttpFormat, asyncio.TimeoutError) as error:
+            self.record_upstream_error(self.remote_host, self.remote_port, error)
+            return self.bad_gateway_response(self.remote_host, self.remote_port, error)
+
+    async def coalesced_fetch(self, http_request: HttpRequest) -> HttpResponse:
+        key = None if self.single_flight is None else self.single_flight.key(http_request)
+        if key is None:
+            return await self.fetch(http_request)
+        event_loop = asyncio.get_running_loop()
+        future, is_leader = self.single_flight.join(key, event_loop.create_future)
+        if not is_leader:
+            try:
+                #shielded so that a follower giving up (or going away) doesn't cancel the future for everyone else
+                shared_response = await asyncio.wait_for(asyncio.shield(future), self.single_flight.wait_timeout)
+            except asyncio.TimeoutError:
+                shared_response = None
+            if shared_response is None:
+                return await self.fetch(http_request)
+            self.record_coalesced()
+            return shared_response.response()
+        http_response = None
+        try:
+            http_response = await self.fetch(http_request)
+            if self.single_flight.wants_body(http_response):
+                try:
+                    while not http_response.complete and len(http_response.received) <= self.single_flight.max_response_bytes:
+                        data = await asyncio.wait_for(event_loop.sock_recv(http_response.connection.socket, ProxiedResponse.BUFFER_SIZE),
+                                                      self.connection_pool.connect_timeout)
+                        http_response.head_received(http_response.consume(data))
+                except (OSError, NotValidHttpFormat, asyncio.TimeoutError) as error:
+                    http_response = self.relaying_failed(http_response, error)
+                except asyncio.CancelledError:
+                    http_response.release()
+                    raise
+        finally:
+            self.finish_flight(key, future, http_response)
         return http_response
+
+    async def handle_request(self, http_request: HttpRequest) -> HttpResponse:
+        if self.response_cache is None:
+            return await self.coalesced_fetch(http_request)
+        lookup = self.response_cache.lookup(http_request)
+        self.record_cache_result(lookup)
+        if lookup.response is not None:
+            if lookup.revalidate_in_background:
+                revalidation = asyncio.get_running_loop().create_task(self.revalidate(http_request, lookup))
+                #the loop only keeps a weak reference to its tasks
+                self.revalidations.add(revalidation)
+                revalidation.add_done_callback(self.revalidations.discard)
+            return lookup.response
+        return self.response_cache.fetched(http_request, lookup, await self.coalesced_fetch(lookup.upstream_request))
+
+    async def revalidate(self, http_request: HttpRequest, lookup: CacheLookup) -> None:
+        event_loop = asyncio.get_running_loop()
+        http_response = None
+        try:
+            http_response = self.response_cache.fetched(http_request, lookup, await self.fetch(lookup.upstream_request))
+            if isinstance(http_response, ProxiedResponse):
+                while not http_response.complete:
+                    data = await asyncio.wait_for(event_loop.sock_recv(http_response.connection.socket, ProxiedResponse.BUFFER_SIZE),
+                                                  self.connection_pool.connect_timeout)
+                    http_response.consume(data)
+        except (OSError, NotValidHttpFormat, asyncio.TimeoutError):
+            pass
+        finally:
+            if isinstance(http_response, ProxiedResponse):
+                http_response.release()
+            self.response_cache.finish_revalidation(lookup.entry)
+
+class AsyncioLoadBalancingHandler(AsyncioReverseProxyHandler, LoadBalancingHandler):
+    """
+    health checks run in a thread like for the threaded servers (see LoadBalancingHandler.start_background_work),
+    the backends' counters are protected by locks so that's fine.
+    """
+    def __init__(self, match_criteria: Dict[str, List], context: Dict, server_obj):
+        LoadBalancingHandler.__init__(self, match_criteria, context, server_obj)
+        self.revalidations = set()
+
+    async def fetch(self, http_request: HttpRequest) -> HttpResponse:
+        strategy_func = self.strategy_mapping[self.strategy]
+        for attempt in range(len(self.backends.backends)):
+            backend = strategy_func()
+            backend.start_request()
+            request_start = time.monotonic()
+            try:
+                http_response = await self.connect_and_send(backend.host, backend.port, http_request)
+            except ConnectionRefusedError as error:
+                self.record_error(backend, error)
+                refused_error = error
+                continue
+            except (OSError, NotValidHttpFormat, asyncio.TimeoutError) as error:
+                self.record_error(backend, error)
+                return self.bad_gateway_response(backend.host, backend.port, error)
+            except asyncio.CancelledError:
+                backend.finish_request()
+                raise
+            self.record_outcome(backend, http_response, request_start)
+            return http_response
+        return self.bad_gateway_response(backend.host, backend.port, refused_error)
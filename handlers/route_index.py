@@ -0,0 +1,118 @@
+from typing import Dict, List, Optional, Tuple, Iterator
+from utils.general_utils import HttpRequest
+from utils.profiling import PROFILER
+from .http_handlers import HttpBaseHandler
+
+#stands for "any host" or "any port" in the index's keys
+ANY = None
+
+class Route:
+    """
+    One url prefix of a task's match criteria. A task with several url prefixes gets one route per prefix, all pointing
+    to the same handler. Criteria other than host, port and url (headers) are rare, so they are just checked one by one
+    on the few routes that are left once the host, port and url matched.
+    """
+    def __init__(self, handler: HttpBaseHandler, url_prefix: str, header_criteria: Dict[str, List], order: int):
+        self.handler = handler
+        self.url_prefix = url_prefix
+        self.header_criteria = header_criteria
+        criteria = handler.http_request_match_criteria
+        #more specific routes win: the longest url prefix first, then a route for a specific host, then for a specific
+        #port, then the one with more header criteria. If all of that is equal, the task that comes first in the settings wins.
+        self.specificity = (len(url_prefix), 'host' in criteria, 'port' in criteria, len(header_criteria), -order)
+
+    def matches_headers(self, http_request: HttpRequest) -> bool:
+        for header_name, required_values in self.header_criteria.items():
+            if http_request.get_header(header_name) not in required_values:
+                return False
+        return True
+
+    def __repr__(self) -> str:
+        return f'Route({self.url_prefix!r} -> {type(self.handler).__name__})'
+
+class TrieNode:
+    def __init__(self):
+        self.children: Dict[str, 'TrieNode'] = {}
+        self.routes: List[Route] = []
+
+class UrlPrefixTrie:
+    """
+    Url prefixes stored character by character, so finding every prefix of a url only takes walking down the trie
+    along the url instead of trying each prefix. Matching is the same as str.startswith, '/stat' matches '/static/a'.
+    """
+    def __init__(self):
+        self.root = TrieNode()
+
+    def insert(self, route: Route) -> None:
+        node = self.root
+        for character in route.url_prefix:
+            node = node.children.setdefault(character, TrieNode())
+        node.routes.append(route)
+        node.routes.sort(key=lambda route: route.specificity, reverse=True)
+
+    def best_match(self, http_request: HttpRequest) -> Optional[Route]:
+        """
+        the deepest (longest prefix) route that also matches the request's headers. Routes on the same node are sorted
+        most specific first.
+        """
+        best_route = None
+        node = self.root
+        url = http_request.requested_url
+        position = 0
+        while True:
+            for route in node.routes:
+                if not route.header_criteria or route.matches_headers(http_request):
+                    best_route = route
+                    break
+            if position == len(url):
+                return best_route
+            node = node.children.get(url[position])
+            if node is None:
+                return best_route
+            position += 1
+
+class RouteIndex:
+    """
+    The handlers of every task compiled from their match criteria so that finding the handler for a request doesn't
+    depend on the number of tasks. Routes are first looked up by host and port in a dict, (host, port), (host, any port),
+    (any host, port) and (any host, any port), and each of those has a trie of url prefixes. The most specific match
+    wins no matter the order of the tasks in the settings (see Route for what most specific means).
+
+    Iterating over the index gives the handlers in settings order.
+    """
+    def __init__(self, handlers: List[HttpBaseHandler]):
+        self.handlers = handlers
+        self.tries: Dict[Tuple[Optional[str], Optional[str]], UrlPrefixTrie] = {}
+        for order, handler in enumerate(handlers):
+            self.add_handler(handler, order)
+
+    def add_handler(self, handler: HttpBaseHandler, order: int) -> None:
+        criteria = handler.http_request_match_criteria
+        header_criteria = {name: values for name, values in criteria.items() if name not in ('host', 'port', 'url')}
+        hosts = criteria.get('host', [ANY])
+        ports = [str(port) for port in criteria['port']] if 'port' in criteria else [ANY]
+        url_prefixes = criteria.get('url', [''])
+        for url_prefix in url_prefixes:
+            route = Route(handler, url_prefix, header_criteria, order)
+            for host in hosts:
+                for port in ports:
+                    self.tries.setdefault((host, port), UrlPrefixTrie()).insert(route)
+
+    def find_handler(self, http_request: HttpRequest) -> Optional[HttpBaseHandler]:
+        best_route = None
+        host, port = http_request.host, http_request.port
+        with PROFILER.span('route'):
+            for key in ((host, port), (host, ANY), (ANY, port), (ANY, ANY)):
+                trie = self.tries.get(key)
+                if trie is None:
+                    continue
+                route = trie.best_match(http_request)
+                if route is not None and (best_route is None or route.specificity > best_route.specificity):
+                    best_route = route
+        return best_route.handler if best_route else None
+
+    def __iter__(self) -> Iterator[HttpBaseHandler]:
+        return iter(self.handlers)
+
+    def __len__(self) -> int:
+        return len(self.handlers)
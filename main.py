@@ -2,37 +2,95 @@
 import logging
 import argparse
 import json
+import importlib
+import os
+import signal
+import time
+import settings as settings_module
 from server.thread_per_client_server import ThreadPerClient
 from server.thread_per_request_server import ThreadPerRequest
 from server.purely_sync_server import PurelySync
-from utils.general_utils import settings_analyzer,settings_preparer
+from server.asyncio_server import AsyncioServer
+from server.prefork import PreforkMaster
+from utils.general_utils import settings_analyzer,settings_preparer,execute_in_new_thread
 from settings import settings_map
 
 FORMAT = "%(asctime)s  %(levelname)s  %(name)s  %(funcName)s  %(message)s"
-logging.basicConfig(datefmt='%H:%M:%S',level=logging.DEBUG,format=FORMAT)
 parser = argparse.ArgumentParser()
 parser.add_argument('--settings','-s',type=int)
 parser.add_argument('--type','-t',type=str)
 parser.add_argument('--port','-p',type=int,default=9999)
+#0 runs the server in this process, anything else forks that many worker processes that each run the server
+parser.add_argument('--workers','-w',type=int,default=0)
+parser.add_argument('--reuse-port',action='store_true',help='every worker binds its own socket with SO_REUSEPORT instead of sharing one')
+parser.add_argument('--graceful-timeout',type=float,default=30)
+#SIGHUP reloads the settings, with this they are also reloaded whenever settings.py is saved
+parser.add_argument('--watch-settings',action='store_true')
+#logging every request at DEBUG costs a good part of the throughput, it's for debugging only
+parser.add_argument('--log-level',type=str,default='INFO',choices=['DEBUG','INFO','WARNING','ERROR'])
 args = parser.parse_args() 
+logging.basicConfig(datefmt='%H:%M:%S',level=args.log_level,format=FORMAT)
+
+def load_settings() -> dict:
+    """
+    used when the server reloads, so that changes made to settings.py since the server started are picked up.
+    """
+    importlib.reload(settings_module)
+    return settings_preparer(settings_analyzer(settings_module.settings_map[args.settings]))
+
+def reload_server(server) -> None:
+    """
+    runs in a thread of its own so that loading the settings and building the new handlers doesn't hold up the server.
+    """
+    try:
+        server.reload(load_settings())
+    except Exception:
+        logging.getLogger("main").exception('could not reload the settings, keeping the old ones')
+
+def watch_settings(interval: float = 1.0) -> None:
+    """
+    sends this process a SIGHUP whenever settings.py is modified, which reloads it the same way in both modes.
+    """
+    last_modified = os.stat(settings_module.__file__).st_mtime_ns
+    while True:
+        time.sleep(interval)
+        try:
+            modified = os.stat(settings_module.__file__).st_mtime_ns
+        except OSError:
+            #editors that save by replacing the file leave it missing for a moment
+            continue
+        if modified != last_modified:
+            last_modified = modified
+            os.kill(os.getpid(), signal.SIGHUP)
 
 def main() -> None:
     type_to_server_mapping = {
         '1':ThreadPerClient,
         '2':ThreadPerRequest,
         '3':PurelySync,
+        '4':AsyncioServer,
         'ThreadPerClient':ThreadPerClient,
         'ThreadPerRequest':ThreadPerRequest,
         'PurelySync':PurelySync,
+        'AsyncioServer':AsyncioServer,
         'tpc':ThreadPerClient,
         'tpr':ThreadPerRequest,
-        'ps':PurelySync
+        'ps':PurelySync,
+        'aio':AsyncioServer
     }
 
-    settings = settings_analyzer(settings_preparer(settings_map[args.settings]))
+    settings = settings_preparer(settings_analyzer(settings_map[args.settings]))
     server_impl = type_to_server_mapping[args.type]
     print(json.dumps(settings,default=str,sort_keys=True, indent=2))
+    if args.watch_settings:
+        execute_in_new_thread(watch_settings, ())
+    if args.workers:
+        master = PreforkMaster(server_impl, load_settings, port=args.port, workers=args.workers, 
+                               reuse_port=args.reuse_port, graceful_timeout=args.graceful_timeout)
+        master.run()
+        return
     server = server_impl(settings,port=args.port)
+    signal.signal(signal.SIGHUP, lambda signal_number, frame: execute_in_new_thread(reload_server, (server,)))
     try:
         server.start_loop()
     except KeyboardInterrupt:
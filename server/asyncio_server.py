@@ -0,0 +1,253 @@
+import asyncio
+import collections
+import socket
+import time
+from typing import Dict, Deque, Optional
+from .base_server import BaseServer
+from utils.general_utils import HttpRequest, HttpResponse, FileResponse, ProxiedResponse, file_blocks
+from utils.custom_exceptions import NotValidHttpFormat
+from utils.http_parser import HttpRequestParser
+from utils.connection_pool import AsyncioConnectionPool
+from utils.profiling import PROFILER
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+class HttpProtocol(asyncio.Protocol):
+    """
+    One client connection. asyncio calls data_received with whatever arrived, complete requests are queued and
+    answered one after the other by a task (responses to pipelined requests have to go out in order). The task only
+    exists while there are requests to answer.
+
+    Flow control goes both ways: when the client doesn't read its responses fast enough the transport calls
+    pause_writing and the task waits in drain, and when a client pipelines more requests than MAX_PENDING_REQUESTS we
+    stop reading from it until the task caught up.
+
+    While no request is being answered a timer closes the connection at the client's read deadline (see
+    BaseServer.read_deadline).
+    """
+    MAX_PENDING_REQUESTS = 64
+
+    def __init__(self, server: 'AsyncioServer'):
+        self.server = server
+        self.http_request_parser = HttpRequestParser()
+        self.pending_requests: Deque[HttpRequest] = collections.deque()
+        self.transport: Optional[asyncio.Transport] = None
+        self.responding_task: Optional[asyncio.Task] = None
+        self.drain_waiter: Optional[asyncio.Future] = None
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+        self.reading_paused = False
+        self.closed = False
+        self.rejected = False
+        self.requests_served = 0
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        if self.server.at_connection_limit():
+            #asyncio accepts by itself and can't be told to hold off, so past the limit connections are closed right away
+            self.rejected = True
+            transport.abort()
+            return
+        client_socket = transport.get_extra_info('socket')
+        if client_socket is not None:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.accepted_client()
+        self.reset_idle_timer()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.closed = True
+        if self.rejected:
+            return
+        self.server.stats.connection_closed()
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        if self.responding_task is not None:
+            #whatever the task is waiting on (a backend for example) is of no use anymore
+            self.responding_task.cancel()
+        self.wake_up_drain_waiter()
+
+    def reset_idle_timer(self) -> None:
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        delay = max(0.0, self.server.read_deadline(self.http_request_parser) - time.monotonic())
+        self.idle_timer = asyncio.get_running_loop().call_later(delay, self.close_if_idle)
+
+    def close_if_idle(self) -> None:
+        if self.responding_task is None:
+            self.transport.close()
+        else:
+            #a slow response isn't the client being idle
+            self.reset_idle_timer()
+
+    def data_received(self, data: bytes) -> None:
+        try:
+            self.pending_requests.extend(self.http_request_parser.feed(data))
+        except NotValidHttpFormat:
+            self.transport.close()
+            return
+        self.reset_idle_timer()
+        if len(self.pending_requests) > self.MAX_PENDING_REQUESTS and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+        if self.pending_requests and self.responding_task is None:
+            self.responding_task = asyncio.get_running_loop().create_task(self.respond())
+
+    def eof_received(self) -> bool:
+        #close once the responses to what the client already sent are out
+        if self.responding_task is None:
+            return False
+        self.responding_task.add_done_callback(lambda task: self.transport.close())
+        return True
+
+    def pause_writing(self) -> None:
+        self.drain_waiter = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self) -> None:
+        self.wake_up_drain_waiter()
+
+    def wake_up_drain_waiter(self) -> None:
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        self.drain_waiter = None
+
+    async def drain(self) -> None:
+        if self.closed:
+            raise ConnectionResetError("the client closed the connection")
+        if self.drain_waiter is not None:
+            await self.drain_waiter
+
+    async def respond(self) -> None:
+        try:
+            while self.pending_requests and not self.closed:
+                http_request = self.pending_requests.popleft()
+                if self.reading_paused and len(self.pending_requests) <= self.MAX_PENDING_REQUESTS // 2:
+                    self.reading_paused = False
+                    self.transport.resume_reading()
+                http_response = await self.server.handle_client_request(http_request)
+                self.requests_served += 1
+                keep_alive = self.server.keeps_connection_open(http_request, http_response, self.requests_served)
+                await self.send_response(http_response)
+                if not keep_alive:
+                    self.transport.close()
+                    self.pending_requests.clear()
+        except (ConnectionResetError, BrokenPipeError, asyncio.TimeoutError, OSError):
+            self.transport.close()
+        finally:
+            self.responding_task = None
+            if not self.closed:
+                #the keep-alive timeout starts once the responses are out
+                self.reset_idle_timer()
+
+    async def send_response(self, http_response: HttpResponse) -> None:
+        event_loop = asyncio.get_running_loop()
+        try:
+            with PROFILER.span('send'):
+                #uvloop (and asyncio from 3.12) write the buffers with one writev/sendmsg without joining them
+                self.transport.writelines(http_response.buffers())
+                await self.drain()
+                if isinstance(http_response, ProxiedResponse):
+                    upstream_socket = http_response.connection.socket
+                    while not http_response.complete:
+                        data = await asyncio.wait_for(event_loop.sock_recv(upstream_socket, ProxiedResponse.BUFFER_SIZE),
+                                                      http_response.connection_pool.connect_timeout)
+                        self.transport.write(http_response.consume(data))
+                        await self.drain()
+                    if http_response.closes_client_connection:
+                        self.transport.close()
+                        self.pending_requests.clear()
+                if isinstance(http_response, FileResponse):
+                    for segment in http_response.segments:
+                        if isinstance(segment, bytes):
+                            self.transport.write(segment)
+                            await self.drain()
+                        else:
+                            await self.send_file(http_response.cached_file.file_descriptor, *segment)
+        finally:
+            if isinstance(http_response, (FileResponse, ProxiedResponse)):
+                http_response.release()
+
+    async def send_file(self, file_descriptor: int, offset: int, count: int) -> None:
+        """
+        asyncio's own fallback for when the loop can't sendfile (uvloop can't) reads through the file's position, which
+        is shared by everyone sending the same cached descriptor, so the fallback here reads with pread instead. A TLS
+        transport can't sendfile at all (asyncio raises a RuntimeError rather than SendfileNotAvailableError for it).
+        """
+        BLOCK_SIZE = 1024 * 256
+        if self.server.tls is None:
+            #the file object is only a wrapper around the cached descriptor, closing it must not close the descriptor
+            with open(file_descriptor, 'rb', buffering=0, closefd=False) as file:
+                try:
+                    await asyncio.get_running_loop().sendfile(self.transport, file, offset, count, fallback=False)
+                    return
+                except asyncio.SendfileNotAvailableError:
+                    pass
+        for block in file_blocks(file_descriptor, offset, count, BLOCK_SIZE):
+            self.transport.write(block)
+            await self.drain()
+
+class AsyncioServer(BaseServer):
+    """
+    The same idea as PurelySync (one thread, an event loop, lots of connections) but on asyncio's event loop,
+    or uvloop's if it's installed. Connections are asyncio Protocols, the handlers are the same as for every other
+    server except for the proxying ones which have asyncio versions (see ManageHandlers).
+    """
+    def __init__(self, settings: Dict, host: str = '0.0.0.0', port: int = 9999):
+        super().__init__(settings, host, port)
+        #created here rather than in loop_forever because handlers may schedule background work on it before it runs
+        self.event_loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        self.asyncio_server: Optional[asyncio.base_events.Server] = None
+        self.stop_requested = asyncio.Event()
+
+    def create_connection_pool(self, pool_settings: Dict) -> AsyncioConnectionPool:
+        return AsyncioConnectionPool(**pool_settings)
+
+    def get_type(self) -> str:
+        return 'asyncio'
+
+    def init_master_socket(self) -> None:
+        super().init_master_socket()
+        self.master_socket.setblocking(False)
+
+    def loop_forever(self) -> None:
+        asyncio.set_event_loop(self.event_loop)
+        self.event_loop.run_until_complete(self.serve())
+
+    async def serve(self) -> None:
+        #asyncio does the TLS handshake before connection_made, the client's read deadline only starts after it
+        tls_context = self.tls.default_context if self.tls is not None else None
+        self.asyncio_server = await self.event_loop.create_server(lambda: HttpProtocol(self), sock=self.master_socket, backlog=1024,
+                                                                  ssl=tls_context, ssl_handshake_timeout=self.keep_alive_timeout if tls_context else None)
+        await self.stop_requested.wait()
+        #stops accepting, the connections that are open are served until they close
+        self.asyncio_server.close()
+        while self.stats.get('active_connections') > 0:
+            await asyncio.sleep(0.1)
+
+    def stop_accepting(self) -> None:
+        self.stopping = True
+        self.event_loop.call_soon_threadsafe(self.stop_requested.set)
+
+    def handle_client(self, client) -> None:
+        #clients are handled by HttpProtocol
+        pass
+
+    def accept_new_client(self, new_client) -> None:
+        #asyncio accepts the clients
+        pass
+
+    async def handle_client_request(self, http_request: HttpRequest) -> HttpResponse:
+        self.stats.request_handled()
+        start = time.perf_counter()
+        handler = self.request_handlers.find_handler(http_request)
+        if handler is not None:
+            with PROFILER.span(handler.task_name):
+                http_response = handler.handle_request(http_request)
+                if asyncio.iscoroutine(http_response):
+                    http_response = await http_response
+        else:
+            http_response = HttpResponse(400, 'No handler could handle your request, check the matching criteria in settings.py')
+        self.record_request(handler, http_request, http_response, start)
+        return http_response
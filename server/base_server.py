@@ -1,32 +1,160 @@
 
-from typing import Dict
+from typing import Dict, List, Optional
+import errno
+import resource
 import socket
+import threading
+import time
 from handlers.http_handlers import HttpBaseHandler, AsyncReverseProxyHandler
 from handlers.handler_manager import ManageHandlers
+from handlers.route_index import RouteIndex
 from utils.general_utils import HttpResponse, HttpRequest, handle_exceptions
+from utils.http_parser import HttpRequestParser
 from utils.custom_exceptions import ClientClosingConnection
+from utils.connection_pool import ConnectionPool
+from utils.metrics import Metrics
+from utils.tls import TlsTermination, certificates_by_host
+from utils.profiling import PROFILER
 from abc import ABC, abstractmethod
 import logging
 
 
+class ServerStats:
+    """
+    Counters about what a server has been doing. In pre-fork mode every worker sends its counters to the master,
+    which adds them up. They're updated on the hot path of every server (from many threads in the threaded servers),
+    so counting takes no lock: requests handled and connections closed are counted in the thread's own shard (see
+    utils/metrics.py) and connections accepted only by the thread that accepts them. The shards are added up when the
+    counters are read, active_connections is the connections accepted minus the ones closed.
+    """
+    def __init__(self):
+        self.shards = Metrics()
+        #only written by the thread that accepts connections
+        self.connections_accepted = 0
+        #the connections closed when the shards were last added up by at_connection_limit. It only grows, so the active
+        #connections worked out from it are never too few
+        self.connections_closed_seen = 0
+
+    def request_handled(self) -> None:
+        self.shards.increment('requests_handled', ())
+
+    def connection_accepted(self) -> None:
+        """
+        must be called by the thread that accepts connections.
+        """
+        self.connections_accepted += 1
+
+    def connection_closed(self) -> None:
+        self.shards.increment('connections_closed', ())
+
+    def active_connections_at_least(self, limit: int) -> bool:
+        """
+        must be called by the thread that accepts connections. Only adds the shards up when the last known count
+        reaches the limit, which doesn't happen for every connection.
+        """
+        if self.connections_accepted - self.connections_closed_seen < limit:
+            return False
+        self.connections_closed_seen = self.shards.snapshot().counters.get(('connections_closed', ()), 0)
+        return self.connections_accepted - self.connections_closed_seen >= limit
+
+    def get(self, counter_name: str) -> int:
+        return self.snapshot()[counter_name]
+
+    def snapshot(self) -> Dict[str, int]:
+        #closed before accepted: a connection closed since is then counted in both, never only as closed
+        counters = self.shards.snapshot().counters
+        connections_accepted = self.connections_accepted
+        return {'connections_accepted': connections_accepted,
+                'active_connections': connections_accepted - counters.get(('connections_closed', ()), 0),
+                'requests_handled': counters.get(('requests_handled', ()), 0)}
+
+def default_max_connections() -> int:
+    """
+    every client connection is a file descriptor, so are backend connections and open files. By default half of the
+    descriptors the process may have can be client connections.
+    """
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return 65536
+    return max(1, soft_limit // 2)
+
+#the settings a server only reads when it starts, the tasks are the only part of the settings a reload changes in place
+STARTUP_SETTINGS = ('connections', 'connection_pool', 'worker_pool', 'http2', 'tls')
+
+def settings_needing_restart(old_settings: Dict, new_settings: Dict) -> List[str]:
+    """
+    what changed between the two settings that only takes effect in a new server.
+    """
+    changed = [block_name for block_name in STARTUP_SETTINGS if old_settings.get(block_name) != new_settings.get(block_name)]
+    if certificates_by_host(old_settings) != certificates_by_host(new_settings):
+        changed.append('the certificates of the tasks')
+    return changed
 
 class BaseServer(ABC):
+    """
+    What all the server types share. How long connections stay open is configured by the "connections" block of the
+    settings:
+
+    keep_alive_timeout: a client that doesn't start a new request for this many seconds is disconnected.
+    request_timeout: a client gets this many seconds to send a whole request once it started sending it, so that a
+    client dripping a request a byte at a time (slowloris) can't hold on to a connection forever.
+    max_requests_per_connection: the connection is closed (with Connection: close) after this many requests, 0 for no limit.
+    max_connections: past this many open client connections new ones are left waiting in the listen backlog, trying
+    again after a backoff that doubles up to MAX_ACCEPT_BACKOFF. Half the process' file descriptor limit by default.
+
+    With a "tls" block in the settings clients connect with TLS (see utils/tls.py). The TLS handshake counts as the
+    start of the first request, a client has until its read deadline to get through it.
+
+    The tasks can be reloaded while the server runs (see reload), everything else in the settings is only read once.
+    """
     LOGGER = logging.getLogger("base server")
-    LOGGER.setLevel(logging.DEBUG)
+    MIN_ACCEPT_BACKOFF = 0.005
+    MAX_ACCEPT_BACKOFF = 0.5
+    #what accept fails with when the process or the system is out of file descriptors or memory, which is not a
+    #reason to stop accepting for good
+    ACCEPT_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
 
 
     def __init__(self, settings: Dict, host: str = '0.0.0.0', port: int = 9999):
         self.host = host
         self.port = port
+        #set by the pre-fork master before start_loop: either a listening socket created before forking that all the
+        #workers accept from, or reuse_port so that every worker binds its own socket to the same port.
+        self.inherited_master_socket: Optional[socket.socket] = None
+        self.reuse_port = False
+        #replaced by the pre-fork master's before start_loop, so that every worker has the same session ticket keys
+        self.tls = TlsTermination.from_settings(settings)
+        self.stopping = False
+        self.stats = ServerStats()
+        connection_settings = settings.get('connections', {})
+        self.keep_alive_timeout = connection_settings.get('keep_alive_timeout', 5)
+        self.request_timeout = connection_settings.get('request_timeout', 10)
+        self.max_requests_per_connection = connection_settings.get('max_requests_per_connection', 1000)
+        self.max_connections = connection_settings.get('max_connections') or default_max_connections()
+        self.accept_backoff = 0.0
+        self.metrics = Metrics()
+        #connections to backends are shared by every handler that proxies requests
+        self.connection_pool = self.create_connection_pool(settings.get('connection_pool', {}))
+        self.settings = settings
         self.request_handlers = ManageHandlers(settings,self).prepare_handlers()
+        self.reload_lock = threading.Lock()
         self.LOGGER.info(f'listening on port {self.port}')
     
+    def create_connection_pool(self, pool_settings: Dict) -> ConnectionPool:
+        return ConnectionPool(**pool_settings)
+
     def init_master_socket(self):
         """ 
         Every server will have some concept of a socket that listens for connections 
         """
+        if self.inherited_master_socket is not None:
+            self.master_socket = self.inherited_master_socket
+            return
         master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         master_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            #the kernel spreads incoming connections over every socket bound to the port with SO_REUSEPORT
+            master_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         master_socket.bind((self.host, self.port))
         master_socket.listen()
         self.master_socket = master_socket
@@ -37,23 +165,117 @@ class BaseServer(ABC):
         1. the client sends an empty message (when they disconnect)
         2. the client sends some data that should be parsed.    
         """
-        for handler in self.request_handlers:
-            if handler.should_handle(http_request):
+        self.stats.request_handled()
+        start = time.perf_counter()
+        handler = self.request_handlers.find_handler(http_request)
+        if handler is not None:
+            with PROFILER.span(handler.task_name):
                 http_response = handler.handle_request(http_request)
-                return http_response
-                
-        http_error_response = HttpResponse(400, 'No handler could handle your request, check the matching criteria in settings.py')
-        return http_error_response
+        else:
+            http_response = HttpResponse(400, 'No handler could handle your request, check the matching criteria in settings.py')
+        self.record_request(handler, http_request, http_response, start)
+        return http_response
+
+    def record_request(self, handler: Optional[HttpBaseHandler], http_request: HttpRequest, http_response: HttpResponse, start: float) -> None:
+        task_name = handler.task_name if handler is not None else 'unmatched'
+        self.metrics.record_request(task_name, http_response.status_code, time.perf_counter() - start,
+                                    len(http_request.raw_http_request), http_response.body_size())
         
     def start_loop(self) -> None:
         self.init_master_socket()
+        for handler in self.request_handlers:
+            handler.start_background_work()
         self.loop_forever()
     
+    def reload(self, settings: Dict) -> None:
+        """
+        Replaces the tasks with those of the (already analyzed and prepared) settings without stopping the server. It's
+        meant to be called from a thread of its own: the new handlers are built there, taking over the caches and
+        backends of the previous handler of their task where they still apply, and only then swapped in. A request looks
+        its handler up once, so the requests in flight finish with the old handlers and every request after the swap gets
+        a new one. The connection pool belongs to the server, it's kept as it is.
+        """
+        with self.reload_lock:
+            changed_settings = settings_needing_restart(self.settings, settings)
+            if changed_settings:
+                self.LOGGER.warning(f"{', '.join(changed_settings)} changed, that only takes effect when the server is restarted")
+            request_handlers = ManageHandlers(settings, self).prepare_handlers(self.request_handlers)
+            self.swap_handlers(request_handlers)
+            self.settings = settings
+        self.LOGGER.info(f'reloaded, serving {len(request_handlers)} tasks')
+
+    def swap_handlers(self, request_handlers: RouteIndex) -> None:
+        """
+        the new handlers start their background work before they get requests, the old ones stop theirs once they don't
+        get any more.
+        """
+        for handler in request_handlers:
+            handler.start_background_work()
+        previous_handlers, self.request_handlers = self.request_handlers, request_handlers
+        successors = {handler.task_name: handler for handler in request_handlers}
+        for handler in previous_handlers:
+            handler.retire(successors.get(handler.task_name))
+
     def stop_loop(self) -> None:
         self.master_socket.close()
+        self.connection_pool.close()
+
+    def stop_accepting(self) -> None:
+        """
+        The first step of a graceful shutdown: no new connections are accepted while the ones that are already open
+        are still served. Can be called from another thread than the one running loop_forever.
+        """
+        self.stopping = True
+        self.close_master_socket()
+
+    def close_master_socket(self) -> None:
+        if self.inherited_master_socket is None:
+            #closing a socket doesn't wake up a thread blocked in accept on it, shutting it down does. The inherited
+            #socket is shared with the other workers though, shutting it down would stop them from accepting too, so the
+            #servers that accept from it never block in accept for long (ThreadPerClient) or not at all (the others).
+            try:
+                self.master_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.master_socket.close()
+
+    def accepted_client(self) -> None:
+        self.accept_backoff = 0.0
+        self.stats.connection_accepted()
+
+    def at_connection_limit(self) -> bool:
+        return self.stats.active_connections_at_least(self.max_connections)
+
+    def next_accept_backoff(self) -> float:
+        """
+        how long to wait before accepting again when at the connection limit (or out of file descriptors), doubling
+        every time until a client is accepted.
+        """
+        self.accept_backoff = min(self.MAX_ACCEPT_BACKOFF, max(self.MIN_ACCEPT_BACKOFF, self.accept_backoff * 2))
+        return self.accept_backoff
+
+    def read_deadline(self, http_request_parser: HttpRequestParser) -> float:
+        """
+        when (on the monotonic clock) a client that is waited on for a request gets disconnected.
+        """
+        if http_request_parser.incomplete_since is not None:
+            return http_request_parser.incomplete_since + self.request_timeout
+        return time.monotonic() + self.keep_alive_timeout
+
+    def keeps_connection_open(self, http_request: HttpRequest, http_response: HttpResponse, requests_served: int) -> bool:
+        """
+        whether the client's connection can be used for another request after this response, if not the response
+        says Connection: close. When the server is stopping, connections are closed after the response they're on.
+        """
+        keep_alive = (http_request.wants_keep_alive() and not self.stopping
+                      and not (self.max_requests_per_connection and requests_served >= self.max_requests_per_connection))
+        if not keep_alive:
+            http_response.close_connection()
+        return keep_alive
     
     def close_client_connection(self, client_socket) -> None:
-        self.LOGGER.info('closing client connection')
+        self.LOGGER.debug('closing client connection')
+        self.stats.connection_closed()
         client_socket.close()
         
     @abstractmethod
@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Type
+from .base_server import BaseServer, settings_needing_restart
+from utils.tls import TlsTermination, certificate_file_versions
+
+
+class WorkerProcess:
+    """
+    What the master knows about one forked worker. The worker writes its stats as a line of json to the write end
+    of stats_pipe every STATS_INTERVAL seconds and the master keeps the last one it read.
+    """
+    def __init__(self, pid: int, slot: int, generation: int, stats_reader: int):
+        self.pid = pid
+        self.slot = slot
+        self.generation = generation
+        self.stats_reader = stats_reader
+        self.started_at = time.monotonic()
+        self.unread_stats = b''
+        self.last_stats: Dict[str, int] = {}
+
+    def __repr__(self) -> str:
+        return f'WorkerProcess(pid={self.pid}, slot={self.slot}, generation={self.generation})'
+
+class PreforkMaster:
+    """
+    Runs any of the server types in several processes so that more than one core is used (threads can't do that
+    because of the GIL, and PurelySync only has one thread to begin with). The master forks the workers, restarts
+    the ones that die and otherwise only waits for signals:
+
+    SIGTERM/SIGINT: graceful shutdown. Workers stop accepting, finish the connections they have (for at most
+    graceful_timeout seconds) and exit, then the master exits.
+    SIGHUP: reload. The settings are loaded again. If only the tasks changed, the workers are sent a SIGHUP and each
+    reloads its tasks in place (see BaseServer.reload), keeping its connections and caches. Otherwise a new generation
+    of workers is started with the new settings and the old generation is shut down gracefully.
+    SIGUSR1: logs the stats of all workers added up.
+
+    By default the master creates the listening socket and the workers inherit it. With reuse_port every worker binds
+    its own socket with SO_REUSEPORT instead, which spreads connections over the workers more evenly (with a shared
+    socket the workers that are least busy tend to win every accept) but connections still waiting in the queue of a
+    worker's socket are lost when that worker exits.
+    """
+    STATS_INTERVAL = 1.0
+    #a worker that dies sooner than this after starting probably dies on startup, so it's restarted with a delay
+    #that doubles every time (up to MAX_RESPAWN_DELAY) instead of being forked over and over again.
+    MIN_HEALTHY_LIFETIME = 5.0
+    MAX_RESPAWN_DELAY = 30.0
+
+    def __init__(self, server_class: Type[BaseServer], load_settings: Callable[[], Dict], host: str = '0.0.0.0', port: int = 9999,
+                 workers: int = os.cpu_count() or 1, reuse_port: bool = False, graceful_timeout: float = 30.0):
+        self.server_class = server_class
+        self.load_settings = load_settings
+        self.settings = load_settings()
+        #made before forking so that the workers share the keys session tickets are encrypted with
+        self.tls = TlsTermination.from_settings(self.settings)
+        self.certificate_versions = certificate_file_versions(self.settings)
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.reuse_port = reuse_port
+        self.graceful_timeout = graceful_timeout
+        self.master_socket: Optional[socket.socket] = None
+        self.generation = 0
+        self.workers: Dict[int, WorkerProcess] = {}
+        self.respawn_delays: Dict[int, float] = {}
+        self.pending_respawns: Dict[int, float] = {} #slot -> when to fork it again
+        self.retired_stats: Dict[str, int] = {}
+        self.stats_selector = selectors.DefaultSelector()
+        self.pending_signals: List[int] = []
+        self.shutting_down = False
+        self.shutdown_deadline = 0.0
+        self.logger = logging.getLogger("prefork master")
+
+    def create_master_socket(self) -> None:
+        master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        master_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        master_socket.bind((self.host, self.port))
+        master_socket.listen(1024)
+        self.master_socket = master_socket
+
+    def spawn_worker(self, slot: int) -> None:
+        stats_reader, stats_writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(stats_reader)
+            exit_code = 1
+            try:
+                self.run_worker(stats_writer)
+                exit_code = 0
+            except BaseException:
+                self.logger.exception(f'worker {os.getpid()} crashed')
+            finally:
+                #the child must never return into the master's code
+                os._exit(exit_code)
+        os.close(stats_writer)
+        os.set_blocking(stats_reader, False)
+        worker = WorkerProcess(pid, slot, self.generation, stats_reader)
+        self.workers[pid] = worker
+        self.stats_selector.register(stats_reader, selectors.EVENT_READ, data=worker)
+        self.logger.info(f'started worker {pid} (slot {slot}, generation {self.generation})')
+
+    def run_worker(self, stats_writer: int) -> None:
+        """
+        Runs in the forked child. The server runs in a thread so that the main thread is free to wait for
+        the master's signals and drain the server when told to stop.
+        """
+        master_pid = os.getppid()
+        stop_event = threading.Event()
+        reload_requested = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signal_number, frame: stop_event.set())
+        signal.signal(signal.SIGHUP, lambda signal_number, frame: reload_requested.set())
+        #ctrl-c reaches every process in the terminal's process group, the master decides what happens
+        for ignored_signal in (signal.SIGINT, signal.SIGUSR1):
+            signal.signal(ignored_signal, signal.SIG_IGN)
+        self.stats_selector.close()
+        for other_worker in self.workers.values():
+            os.close(other_worker.stats_reader)
+
+        server = self.server_class(self.settings, host=self.host, port=self.port)
+        server.inherited_master_socket = self.master_socket
+        server.reuse_port = self.reuse_port
+        server.tls = self.tls
+        server_thread = threading.Thread(target=server.start_loop)
+        server_thread.daemon = True
+        server_thread.start()
+
+        while not stop_event.wait(self.STATS_INTERVAL):
+            if os.getppid() != master_pid:
+                #the master died without stopping us, nobody would ever restart or stop this worker
+                break
+            try:
+                os.write(stats_writer, json.dumps(server.stats.snapshot()).encode() + b'\n')
+            except OSError:
+                break
+            if reload_requested.is_set():
+                reload_requested.clear()
+                self.reload_worker(server)
+
+        server.stop_accepting()
+        deadline = time.monotonic() + self.graceful_timeout
+        while server.stats.get('active_connections') > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        try:
+            os.write(stats_writer, json.dumps(server.stats.snapshot()).encode() + b'\n')
+        except OSError:
+            pass
+
+    def reload_worker(self, server: BaseServer) -> None:
+        """
+        runs in the worker's main thread, the server keeps serving from its own thread while the new handlers are built.
+        """
+        try:
+            server.reload(self.load_settings())
+        except Exception:
+            self.logger.exception(f'worker {os.getpid()} could not reload its tasks, keeping the old ones')
+
+    def read_stats(self, worker: WorkerProcess) -> None:
+        try:
+            data = os.read(worker.stats_reader, 1024 * 64)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.stats_selector.unregister(worker.stats_reader)
+            return
+        *complete_lines, worker.unread_stats = (worker.unread_stats + data).split(b'\n')
+        if complete_lines:
+            worker.last_stats = json.loads(complete_lines[-1])
+
+    def aggregate_stats(self) -> Dict[str, int]:
+        """
+        active_connections is only counted for running workers, the other counters also include the workers that exited.
+        """
+        aggregated_stats = dict(self.retired_stats)
+        for worker in self.workers.values():
+            for counter_name, value in worker.last_stats.items():
+                aggregated_stats[counter_name] = aggregated_stats.get(counter_name, 0) + value
+        aggregated_stats['workers'] = len(self.workers)
+        return aggregated_stats
+
+    def retire(self, worker: WorkerProcess) -> None:
+        if worker.stats_reader in self.stats_selector.get_map():
+            self.read_stats(worker)
+        if worker.stats_reader in self.stats_selector.get_map():
+            self.stats_selector.unregister(worker.stats_reader)
+        os.close(worker.stats_reader)
+        for counter_name, value in worker.last_stats.items():
+            if counter_name != 'active_connections':
+                self.retired_stats[counter_name] = self.retired_stats.get(counter_name, 0) + value
+
+    def reap_workers(self) -> None:
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            self.retire(worker)
+            if self.shutting_down or worker.generation != self.generation:
+                self.logger.info(f'worker {pid} exited')
+                continue
+            lifetime = time.monotonic() - worker.started_at
+            if lifetime < self.MIN_HEALTHY_LIFETIME:
+                respawn_delay = min(self.respawn_delays.get(worker.slot, 0.5) * 2, self.MAX_RESPAWN_DELAY)
+            else:
+                respawn_delay = 0.0
+            self.respawn_delays[worker.slot] = respawn_delay or 0.5
+            self.logger.warning(f'worker {pid} died with status {status}, restarting it in {respawn_delay}s')
+            self.pending_respawns[worker.slot] = time.monotonic() + respawn_delay
+
+    def respawn_due_workers(self) -> None:
+        now = time.monotonic()
+        for slot, respawn_time in list(self.pending_respawns.items()):
+            if respawn_time <= now:
+                del self.pending_respawns[slot]
+                self.spawn_worker(slot)
+
+    def signal_workers(self, signal_number: int, workers: List[WorkerProcess]) -> None:
+        for worker in workers:
+            try:
+                os.kill(worker.pid, signal_number)
+            except ProcessLookupError:
+                pass
+
+    def reload(self) -> None:
+        """
+        The workers load the settings themselves for an in-place reload (what the master loaded is only checked here
+        and used for the workers it forks from now on). For a new generation, the new workers are started before the
+        old ones are told to stop, so there is always someone accepting.
+        """
+        try:
+            settings = self.load_settings()
+            changed_settings = settings_needing_restart(self.settings, settings)
+            certificate_versions = certificate_file_versions(settings)
+            if certificate_versions != self.certificate_versions:
+                changed_settings.append('the certificate files')
+            #new workers read the certificates again, that's how they're renewed. New contexts come with new ticket keys,
+            #so the tickets clients got from the old workers don't resume anything anymore
+            tls = TlsTermination.from_settings(settings) if changed_settings else self.tls
+        except Exception:
+            self.logger.exception('could not load the new settings, keeping the old workers')
+            return
+        self.settings, self.tls, self.certificate_versions = settings, tls, certificate_versions
+        if not changed_settings:
+            self.signal_workers(signal.SIGHUP, list(self.workers.values()))
+            self.logger.info(f'only the tasks changed, {len(self.workers)} workers are reloading them in place')
+            return
+        self.logger.info(f"{', '.join(changed_settings)} changed, starting new workers")
+        old_workers = list(self.workers.values())
+        self.generation += 1
+        self.pending_respawns.clear()
+        for slot in range(self.worker_count):
+            self.spawn_worker(slot)
+        self.signal_workers(signal.SIGTERM, old_workers)
+        self.logger.info(f'reloaded, generation {self.generation} is starting and {len(old_workers)} old workers are stopping')
+
+    def begin_shutdown(self) -> None:
+        if self.shutting_down:
+            return
+        self.shutting_down = True
+        self.shutdown_deadline = time.monotonic() + self.graceful_timeout + 5
+        self.pending_respawns.clear()
+        self.signal_workers(signal.SIGTERM, list(self.workers.values()))
+        if self.master_socket is not None:
+            self.master_socket.close()
+        self.logger.info('shutting down')
+
+    def handle_pending_signals(self) -> None:
+        while self.pending_signals:
+            signal_number = self.pending_signals.pop(0)
+            if signal_number in (signal.SIGTERM, signal.SIGINT):
+                self.begin_shutdown()
+            elif signal_number == signal.SIGHUP and not self.shutting_down:
+                self.reload()
+            elif signal_number == signal.SIGUSR1:
+                self.logger.info(f'stats: {json.dumps(self.aggregate_stats(), sort_keys=True)}')
+
+    def run(self) -> None:
+        """
+        The signal handlers only record the signal, it is handled by the loop below. The select is there to read the
+        workers' stats, its timeout makes sure dead workers are noticed and pending signals are handled soon.
+        """
+        for handled_signal in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(handled_signal, lambda signal_number, frame: self.pending_signals.append(signal_number))
+        if not self.reuse_port:
+            self.create_master_socket()
+        for slot in range(self.worker_count):
+            self.spawn_worker(slot)
+
+        while self.workers or (self.pending_respawns and not self.shutting_down):
+            for key, events in self.stats_selector.select(timeout=0.5):
+                self.read_stats(key.data)
+            self.handle_pending_signals()
+            self.reap_workers()
+            if not self.shutting_down:
+                self.respawn_due_workers()
+            elif time.monotonic() > self.shutdown_deadline:
+                self.logger.warning('workers did not stop in time, killing them')
+                self.signal_workers(signal.SIGKILL, list(self.workers.values()))
+                self.shutdown_deadline = float('inf')
+        self.logger.info(f'all workers stopped, final stats: {json.dumps(self.aggregate_stats(), sort_keys=True)}')
@@ -1,20 +1,96 @@
 import socket
-from typing import Dict, Union, Generator
+import ssl
+import threading
+import time
+from typing import Dict, List, Optional, Union, Generator, Tuple
 import selectors
 from collections import namedtuple
 from handlers.handler_manager import ManageHandlers
+from handlers.route_index import RouteIndex
 from .base_server import BaseServer
 from handlers.http_handlers import HttpBaseHandler, AsyncReverseProxyHandler, AsyncLoadBalancingHandler
-from utils.general_utils import ClientInformation, HttpResponse, handle_exceptions, HttpRequest, SocketType, SocketTasks, async_send_all, read_all
-from utils.custom_exceptions import ClientClosingConnection, NotValidHttpFormat
-from event_loop.event_loop import EventLoop, ResourceTask
+from utils.general_utils import (ClientInformation, HttpResponse, handle_exceptions, HttpRequest, SocketType, SocketTasks, async_send_response,
+                                 read_all, async_send_all, file_blocks, FileResponse, ProxiedResponse)
+from utils.custom_exceptions import ClientClosingConnection, NotValidHttpFormat, Http2ConnectionError
+from utils.http_parser import HttpRequestParser, HttpResponseParser
+from utils.http2 import (Http2Connection, Http2Stream, PREFACE, PROTOCOL_ERROR, INTERNAL_ERROR, request_from_stream, response_headers,
+                         wants_h2c_upgrade, upgraded_request)
+from event_loop.event_loop import EventLoop, ResourceTask, TimedTask, FutureTask
+from utils.connection_pool import AsyncConnectionPool
+from utils.profiling import PROFILER
 
 
+SWITCHING_PROTOCOLS = b'HTTP/1.1 101 Switching Protocols\r\nConnection: Upgrade\r\nUpgrade: h2c\r\n\r\n'
+
+class Http2Client:
+    """
+    What the coroutines of an http/2 connection share: the reader (handle_http2_client), the writer (write_http2) and
+    a coroutine per stream. The event loop has one coroutine per socket, so the writer waits on a duplicate of the
+    client's socket. They wake each other up with FutureTasks: the writer waits for 'output' to send, a stream waits
+    for the client to open a 'window' or for the writer to have 'drained' what is already queued.
+    """
+    #streams stop queueing frames while this much is waiting to be sent
+    OUTBOUND_LIMIT = 1024 * 256
+    FILE_BLOCK_SIZE = 1024 * 64
+
+    def __init__(self, client_socket, connection: Http2Connection, event_loop: EventLoop):
+        self.socket = client_socket
+        self.write_socket = client_socket.dup()
+        self.connection = connection
+        self.event_loop = event_loop
+        self.events: Dict[str, FutureTask] = {}
+        self.running_streams = 0
+        #the connection is closed once the GOAWAY is sent, without waiting for the streams
+        self.failed = False
+        self.closed = False
+
+    @property
+    def incomplete_since(self) -> Optional[float]:
+        return self.connection.incomplete_since
+
+    def waiting_for(self, event: str) -> FutureTask:
+        future = self.events.get(event)
+        if future is None or future.done:
+            future = self.events[event] = FutureTask(self.event_loop)
+        return future
+
+    def notify(self, event: str) -> None:
+        future = self.events.pop(event, None)
+        if future is not None:
+            future.set_result(None)
+
+    @property
+    def finished(self) -> bool:
+        """
+        nothing more will happen on the connection once what's queued is sent.
+        """
+        return self.connection.goaway_sent and (self.failed or self.running_streams == 0)
+
 class PurelySync(BaseServer):
+    """
+    Every client is a coroutine on one event loop. With an "http2" block in the settings (see utils/http2.py) clients
+    can also speak http/2 without TLS (h2c), by starting the connection with the http/2 preface (prior knowledge) or by
+    asking for it with an Upgrade header. Every stream of an http/2 connection is handled by a coroutine of its own.
+    """
+    REAP_INTERVAL = 0.5
+
     def __init__(self, settings: Dict, host: str = '0.0.0.0', port: int = 9999):
-        super().__init__(settings, host, port)
+        #before the connection pool and the handlers are created, they use it
         self.event_loop = EventLoop()
+        super().__init__(settings, host, port)
+        #the read deadline of every client the server is waiting on for a request, and the client's parser (or its
+        #Http2Client, which has an incomplete_since like a parser)
+        self.client_deadlines: Dict[socket.socket, Tuple[float, Union[HttpRequestParser, Http2Client]]] = {}
+        self.http2_settings: Optional[Dict] = settings.get('http2')
+        self.event_loop.profiler = PROFILER
+        #a reload hands its new handlers to the event loop's thread through this pair of sockets, see swap_handlers
+        self.reload_reader, self.reload_writer = socket.socketpair()
+        self.reload_reader.setblocking(False)
+        self.pending_swaps: List[Tuple[RouteIndex, threading.Event]] = []
     
+    def create_connection_pool(self, pool_settings: Dict) -> AsyncConnectionPool:
+        return AsyncConnectionPool(self.event_loop, **pool_settings)
+
     def get_type(self) -> str:
         #so i don't have to import this class for type hinting in a file that this file imports.....
         return 'sync'
@@ -22,42 +98,362 @@ class PurelySync(BaseServer):
     def init_master_socket(self) -> None:
         super().init_master_socket()
         self.master_socket.setblocking(False)
+        #stop_accepting is called from another thread, it wakes up the event loop through this pair of sockets
+        self.stop_reader, self.stop_writer = socket.socketpair()
+        self.stop_reader.setblocking(False)
            
     def loop_forever(self) -> None:
         self.event_loop.run_coroutine(self.loop)
+        self.event_loop.run_coroutine(self.wait_for_stop)
+        self.event_loop.run_coroutine(self.close_idle_clients)
+        self.event_loop.run_coroutine(self.wait_for_reloads)
         self.event_loop.loop()
+
+    def stop_accepting(self) -> None:
+        self.stopping = True
+        self.stop_writer.send(b'\0')
+
+    def wait_for_stop(self) -> Generator:
+        """
+        The master socket has to be dropped from the event loop's selector before it's closed, and the selector
+        belongs to the event loop's thread, so stopping is done by this coroutine.
+        """
+        yield ResourceTask(self.stop_reader, 'readable')
+        self.event_loop.deregister_resource(self.master_socket)
+        self.event_loop.deregister_resource(self.reload_reader)
+        self.close_master_socket()
+        self.stop_reader.close()
+        self.stop_writer.close()
     
+    def swap_handlers(self, request_handlers: RouteIndex) -> None:
+        """
+        the handlers' background work runs on the event loop (health checks are coroutines) and only the event loop's
+        thread can touch it, so the swap is done by wait_for_reloads. The reloading thread waits for it.
+        """
+        swapped = threading.Event()
+        self.pending_swaps.append((request_handlers, swapped))
+        self.reload_writer.send(b'\0')
+        swapped.wait()
+
+    def wait_for_reloads(self) -> Generator:
+        while True:
+            yield ResourceTask(self.reload_reader, 'readable')
+            self.reload_reader.recv(1024)
+            while self.pending_swaps:
+                request_handlers, swapped = self.pending_swaps.pop(0)
+                super().swap_handlers(request_handlers)
+                swapped.set()
+
     def accept_new_client(self, new_client_socket):
         new_client_socket.setblocking(False)
 
     def loop(self) -> Generator:
-        while True:
+        while not self.stopping:
+            if self.at_connection_limit():
+                #the clients wait in the listen backlog until a connection closes
+                yield TimedTask(self.next_accept_backoff())
+                continue
             yield ResourceTask(self.master_socket, 'readable')
-            new_client_socket, addr = self.master_socket.accept()
+            try:
+                new_client_socket, addr = self.master_socket.accept()
+            except BlockingIOError:
+                #another worker process sharing the master socket accepted the connection first
+                continue
+            except OSError as error:
+                if error.errno not in self.ACCEPT_RESOURCE_ERRORS:
+                    raise
+                yield TimedTask(self.next_accept_backoff())
+                continue
+            self.accepted_client()
             self.accept_new_client(new_client_socket)
             self.event_loop.run_coroutine(self.handle_client, new_client_socket)
         
+    def close_idle_clients(self) -> Generator:
+        """
+        A single coroutine that wakes up every REAP_INTERVAL and checks the deadline of every connection, instead of
+        a TimedTask for each connection. The clients that are waited on for a request past their read deadline (see
+        BaseServer.read_deadline) are disconnected, and when the server is stopping the ones that are between requests
+        too, so a client can be disconnected up to REAP_INTERVAL after its deadline. Their coroutines are waiting on
+        the client socket, dropping it from the event loop drops them.
+        """
+        while not self.stopping or self.stats.get('active_connections') > 0:
+            yield TimedTask(self.REAP_INTERVAL)
+            now = time.monotonic()
+            for client_socket, (deadline, http_request_parser) in list(self.client_deadlines.items()):
+                if deadline <= now or (self.stopping and http_request_parser.incomplete_since is None):
+                    del self.client_deadlines[client_socket]
+                    self.event_loop.deregister_resource(client_socket)
+                    if isinstance(http_request_parser, Http2Client):
+                        self.close_http2_client(http_request_parser)
+                    else:
+                        self.close_client_connection(client_socket)
+
+    def tls_handshake(self, client_socket, http_request_parser: HttpRequestParser) -> Generator:
+        """
+        The handshake without blocking the loop: OpenSSL says whether it's waiting for the client to send something
+        or for the socket to be writable, and the coroutine waits for that in the event loop. Like a request, the
+        handshake has to be done by the client's read deadline.
+        """
+        self.client_deadlines[client_socket] = (self.read_deadline(http_request_parser), http_request_parser)
+        while True:
+            try:
+                client_socket.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                yield ResourceTask(client_socket, 'readable')
+            except ssl.SSLWantWriteError:
+                yield ResourceTask(client_socket, 'writable')
+        del self.client_deadlines[client_socket]
+
     def handle_client(self, client_socket) -> Generator:
+        http_request_parser = HttpRequestParser()
+        requests_served = 0
+        if self.tls is not None:
+            client_socket = self.tls.wrap(client_socket)
+            try:
+                yield from self.tls_handshake(client_socket, http_request_parser)
+            except (ssl.SSLError, OSError):
+                self.client_deadlines.pop(client_socket, None)
+                self.close_client_connection(client_socket)
+                return
         while True:
+            self.client_deadlines[client_socket] = (self.read_deadline(http_request_parser), http_request_parser)
             yield ResourceTask(client_socket, 'readable')
+            del self.client_deadlines[client_socket]
             try:
-                raw_client_request = read_all(client_socket)
-                http_request = HttpRequest.from_bytes(raw_client_request)
-                http_response = yield from self.handle_client_request(http_request)
-                yield from async_send_all(client_socket, http_response.dump())
-            except (ClientClosingConnection, socket.timeout, ConnectionResetError, TimeoutError,BrokenPipeError):
+                data = read_all(client_socket)
+                if self.sends_http2_preface(http_request_parser, data):
+                    http2_connection = Http2Connection(**self.http2_settings)
+                    http2_connection.initiate()
+                    yield from self.handle_http2_client(client_socket, http2_connection, data)
+                    return
+                for http_request in http_request_parser.feed(data):
+                    http2_connection = self.http2_upgrade(http_request)
+                    if http2_connection is not None:
+                        yield from async_send_all(client_socket, SWITCHING_PROTOCOLS)
+                        yield from self.handle_http2_client(client_socket, http2_connection, bytes(http_request_parser.buffer),
+                                                            upgraded_request(http_request))
+                        return
+                    http_response = yield from self.handle_client_request(http_request)
+                    requests_served += 1
+                    keep_alive = self.keeps_connection_open(http_request, http_response, requests_served)
+                    yield from async_send_response(client_socket, http_response)
+                    if not keep_alive:
+                        raise ClientClosingConnection("the connection is closed after this response")
+            except ssl.SSLWantReadError:
+                #only part of a TLS record has arrived, nothing was read
+                continue
+            except (ClientClosingConnection, NotValidHttpFormat, socket.timeout, ConnectionResetError, TimeoutError,BrokenPipeError, ssl.SSLError):
                 self.close_client_connection(client_socket)
                 break
 
     def handle_client_request(self, http_request: HttpRequest) -> Generator:
-        for handler in self.request_handlers:
-            if handler.should_handle(http_request):
+        self.stats.request_handled()
+        start = time.perf_counter()
+        handler = self.request_handlers.find_handler(http_request)
+        if handler is not None:
+            with PROFILER.span(handler.task_name):
                 if isinstance(handler, AsyncReverseProxyHandler) or isinstance(handler, AsyncLoadBalancingHandler):
                     http_response = yield from handler.handle_request(http_request)
                 else:
                     http_response = handler.handle_request(http_request)
+        else:
+            http_response = HttpResponse(400, 'No handler could handle your request, check the matching criteria in settings.py')
+        self.record_request(handler, http_request, http_response, start)
+        return http_response
+
+    def sends_http2_preface(self, http_request_parser: HttpRequestParser, data: bytes) -> bool:
+        """
+        a client that knows we speak h2c starts the connection with the http/2 preface instead of a request.
+        """
+        return (self.http2_settings is not None and self.tls is None and http_request_parser.requests_parsed == 0
+                and not http_request_parser.has_partial_request() and data.startswith(PREFACE[:16]))
+
+    def http2_upgrade(self, http_request: HttpRequest) -> Optional[Http2Connection]:
+        """
+        the http/2 connection for a client that asked to upgrade to h2c with the request, None to answer it in http/1.1
+        (which is what a server that doesn't want to upgrade does).
+        """
+        if self.http2_settings is None or self.tls is not None or not wants_h2c_upgrade(http_request):
+            return None
+        http2_connection = Http2Connection(**self.http2_settings)
+        try:
+            http2_connection.upgrade(http_request.get_header('HTTP2-Settings'))
+        except (NotValidHttpFormat, Http2ConnectionError):
+            return None
+        return http2_connection
+
+    def handle_http2_client(self, client_socket, http2_connection: Http2Connection, data: bytes = b'',
+                            http_request: Optional[HttpRequest] = None) -> Generator:
+        """
+        Reads the frames of an http/2 connection and starts a coroutine for every stream once its request is complete,
+        http_request is the request of an upgraded connection, which is stream 1. The client gets keep_alive_timeout
+        to start a stream when none are open, and request_timeout to finish a frame it started sending.
+        """
+        client = Http2Client(client_socket, http2_connection, self.event_loop)
+        self.event_loop.run_coroutine(self.write_http2, client)
+        if http_request is not None:
+            self.start_stream(client, http2_connection.streams[1], http_request)
+        try:
+            while True:
+                if data:
+                    self.receive_http2(client, data)
+                if client.finished:
+                    client.notify('output')
+                    return
+                if not http2_connection.streams:
+                    self.client_deadlines[client_socket] = (self.read_deadline(client), client)
+                yield ResourceTask(client_socket, 'readable')
+                self.client_deadlines.pop(client_socket, None)
+                data = read_all(client_socket)
+        except Http2ConnectionError:
+            #the writer closes the connection once the GOAWAY saying why is sent
+            client.failed = True
+            client.notify('output')
+        except (ClientClosingConnection, ConnectionResetError, TimeoutError, BrokenPipeError, OSError):
+            self.close_http2_client(client)
 
-                return http_response
-                
-        http_error_response = HttpResponse(400, 'No handler could handle your request, check the matching criteria in settings.py')
-        return http_error_response
+    def receive_http2(self, client: Http2Client, data: bytes) -> None:
+        http2_connection = client.connection
+        for stream in http2_connection.receive(data):
+            self.start_stream(client, stream)
+        if self.stopping or (self.max_requests_per_connection and http2_connection.streams_opened >= self.max_requests_per_connection):
+            #the streams the client already opened are still answered
+            http2_connection.close()
+        if http2_connection.windows_changed:
+            http2_connection.windows_changed = False
+            client.notify('window')
+        if http2_connection.outbound:
+            client.notify('output')
+
+    def write_http2(self, client: Http2Client) -> Generator:
+        http2_connection = client.connection
+        while not client.closed:
+            if not http2_connection.outbound:
+                client.notify('drained')
+                if client.finished:
+                    self.close_http2_client(client)
+                    return
+                yield client.waiting_for('output')
+                continue
+            try:
+                bytes_sent = client.write_socket.send(http2_connection.outbound)
+            except BlockingIOError:
+                yield ResourceTask(client.write_socket, 'writable')
+                continue
+            except OSError:
+                self.close_http2_client(client)
+                return
+            del http2_connection.outbound[:bytes_sent]
+            if len(http2_connection.outbound) < client.OUTBOUND_LIMIT:
+                client.notify('drained')
+
+    def close_http2_client(self, client: Http2Client) -> None:
+        if client.closed:
+            return
+        client.closed = True
+        self.client_deadlines.pop(client.socket, None)
+        self.event_loop.deregister_resource(client.socket)
+        self.event_loop.deregister_resource(client.write_socket)
+        client.write_socket.close()
+        #the streams waiting for something see that the connection is gone and stop
+        for event in list(client.events):
+            client.notify(event)
+        self.close_client_connection(client.socket)
+
+    def start_stream(self, client: Http2Client, stream: Http2Stream, http_request: Optional[HttpRequest] = None) -> None:
+        client.running_streams += 1
+        self.event_loop.run_coroutine(self.serve_stream, client, stream, http_request)
+
+    def serve_stream(self, client: Http2Client, stream: Http2Stream, http_request: Optional[HttpRequest]) -> Generator:
+        http2_connection = client.connection
+        http_response = None
+        try:
+            if http_request is None:
+                http_request = request_from_stream(stream)
+            http_response = yield from self.handle_client_request(http_request)
+            yield from self.send_http2_response(client, stream, http_request, http_response)
+        except NotValidHttpFormat:
+            http2_connection.reset_stream(stream.stream_id, PROTOCOL_ERROR)
+        except (ConnectionResetError, TimeoutError, BrokenPipeError, OSError):
+            #the client reset the stream or went away, or the backend the response was relayed from did
+            if not client.closed and not stream.reset:
+                http2_connection.reset_stream(stream.stream_id, INTERNAL_ERROR)
+        finally:
+            if isinstance(http_response, (FileResponse, ProxiedResponse)):
+                http_response.release()
+            client.running_streams -= 1
+            if not client.closed:
+                client.notify('output')
+                if not http2_connection.streams:
+                    #the reader is waiting for the next stream now, for keep_alive_timeout at most
+                    self.client_deadlines[client.socket] = (self.read_deadline(client), client)
+
+    def send_http2_response(self, client: Http2Client, stream: Http2Stream, http_request: HttpRequest, http_response: HttpResponse) -> Generator:
+        """
+        The handlers' responses are http/1.1 responses. They go through a response parser that takes them apart into
+        the head, which goes out as HEADERS, and the body without its framing, which goes out as DATA frames. Relayed
+        responses are relayed as they arrive and files are read a block at a time, like for an http/1.1 client.
+        """
+        response_parser = HttpResponseParser(http_request.request_type, keep_body=True)
+        with PROFILER.span('send'):
+            if isinstance(http_response, FileResponse):
+                yield from self.send_http2_part(client, stream, response_parser, http_response.buffers()[0])
+                for segment in http_response.segments:
+                    if isinstance(segment, bytes):
+                        yield from self.send_http2_part(client, stream, response_parser, segment)
+                        continue
+                    for block in file_blocks(http_response.cached_file.file_descriptor, *segment, client.FILE_BLOCK_SIZE):
+                        yield from self.send_http2_part(client, stream, response_parser, block)
+            else:
+                for buffer in http_response.buffers():
+                    yield from self.send_http2_part(client, stream, response_parser, buffer)
+                if isinstance(http_response, ProxiedResponse):
+                    while not http_response.complete:
+                        yield http_response.readable()
+                        yield from self.send_http2_part(client, stream, response_parser, http_response.receive())
+            if response_parser.head is None:
+                raise ConnectionResetError("the response ended before its head")
+            if not stream.response_complete:
+                #the body ended when the backend closed the connection
+                yield from self.send_http2_data(client, stream, b'', True)
+
+    def send_http2_part(self, client: Http2Client, stream: Http2Stream, response_parser: HttpResponseParser, data: bytes) -> Generator:
+        if not data:
+            return
+        response_parser.feed(data)
+        if response_parser.head is None:
+            return
+        body_parts, response_parser.body_parts = response_parser.body_parts, []
+        ending = response_parser.complete
+        if not stream.response_started:
+            if client.closed or stream.reset:
+                raise ConnectionResetError("the client reset the stream or closed the connection")
+            stream.response_started = True
+            client.connection.send_headers(stream, response_headers(response_parser.head), ending and not body_parts)
+            client.notify('output')
+        for index, body_part in enumerate(body_parts):
+            yield from self.send_http2_data(client, stream, body_part, ending and index == len(body_parts) - 1)
+
+    def send_http2_data(self, client: Http2Client, stream: Http2Stream, data: bytes, end_stream: bool) -> Generator:
+        """
+        Sends data in as many DATA frames as the windows and the client's frame size ask for, waiting for the client
+        to open the windows when they're closed and for the writer when a lot is queued already.
+        """
+        http2_connection = client.connection
+        view = memoryview(data)
+        while True:
+            if client.closed or stream.reset:
+                raise ConnectionResetError("the client reset the stream or closed the connection")
+            if len(http2_connection.outbound) >= client.OUTBOUND_LIMIT:
+                yield client.waiting_for('drained')
+                continue
+            size = http2_connection.sendable(stream)
+            if view and not size:
+                yield client.waiting_for('window')
+                continue
+            http2_connection.send_data(stream, view[:size], end_stream and len(view) <= size)
+            view = view[size:]
+            client.notify('output')
+            if not view:
+                return
@@ -1,7 +1,10 @@
 from .base_server import BaseServer
 from typing import Dict
 import socket
-from utils.general_utils import execute_in_new_thread, HttpRequest, read_all, send_all
+import ssl
+import time
+from utils.general_utils import execute_in_new_thread, HttpRequest, read_all, send_response
+from utils.http_parser import HttpRequestParser
 from utils.custom_exceptions import ClientClosingConnection,NotValidHttpFormat
 
 
@@ -11,27 +14,72 @@ class ThreadPerClient(BaseServer):
     the client is handled entirely within that thread. 
     """
 
+    #how often a thread waiting in accept on a master socket shared with other workers checks whether it should stop
+    ACCEPT_POLL_INTERVAL = 0.5
+
     def get_type(self) -> str:
         return 'threadperclient'
-   
+
+    def init_master_socket(self) -> None:
+        super().init_master_socket()
+        if self.inherited_master_socket is not None:
+            #the shared socket can't be shut down to wake this thread up (see close_master_socket), so it never waits
+            #in accept for long. Otherwise it could accept a connection after the worker stopped and leave it unanswered.
+            self.master_socket.settimeout(self.ACCEPT_POLL_INTERVAL)
+
     def loop_forever(self):
-        while True:
-            new_client, addr = self.master_socket.accept()
+        while not self.stopping:
+            if self.at_connection_limit():
+                #the clients wait in the listen backlog until a connection closes
+                time.sleep(self.next_accept_backoff())
+                continue
+            try:
+                new_client, addr = self.master_socket.accept()
+            except socket.timeout:
+                continue
+            except OSError as error:
+                if self.stopping:
+                    break
+                if error.errno in self.ACCEPT_RESOURCE_ERRORS:
+                    time.sleep(self.next_accept_backoff())
+                    continue
+                raise
+            self.accepted_client()
             self.accept_new_client(new_client)
             execute_in_new_thread(self.handle_client, (new_client,))
 
     def accept_new_client(self, new_client):
-        #if client is idle for this long, an error should be raised and should signal closing
-        #the connection
-        new_client.settimeout(3) 
+        #a client that doesn't read what is sent to it for this long is disconnected
+        new_client.settimeout(self.keep_alive_timeout)
         
     def handle_client(self, client):
+        """
+        The thread waits in recv with the socket's timeout set to whatever is left until the client's read deadline
+        (see read_deadline), a client that is too slow gets socket.timeout and is disconnected. With TLS the handshake
+        is done by the first recv, under the same deadline.
+        """
+        if self.tls is not None:
+            client = self.tls.wrap(client)
+        http_request_parser = HttpRequestParser()
+        requests_served = 0
         while True:
             try:
-                raw_client_request = read_all(client)
-                http_request = HttpRequest.from_bytes(raw_client_request)
-                http_response = self.handle_client_request(http_request)
-                send_all(client, http_response.dump())
-            except (ClientClosingConnection, NotValidHttpFormat, socket.timeout, ConnectionResetError, TimeoutError, BrokenPipeError):
+                client.settimeout(max(self.read_deadline(http_request_parser) - time.monotonic(), 0.001))
+                http_requests = http_request_parser.feed(read_all(client))
+                client.settimeout(self.keep_alive_timeout)
+                for http_request in http_requests:
+                    http_response = self.handle_client_request(http_request)
+                    requests_served += 1
+                    keep_alive = self.keeps_connection_open(http_request, http_response, requests_served)
+                    send_response(client, http_response)
+                    if not keep_alive:
+                        raise ClientClosingConnection("the connection is closed after this response")
+            except (ClientClosingConnection, NotValidHttpFormat, socket.timeout, ConnectionResetError, TimeoutError, BrokenPipeError, ssl.SSLError):
+                self.close_client_connection(client)
+                break
+            except Exception:
+                #a bug in a handler or an error nobody expected, the client still has to be let go of so that it doesn't
+                #count against max_connections forever
+                self.LOGGER.exception('unexpected error while serving a client, disconnecting it')
                 self.close_client_connection(client)
-                break
\ No newline at end of file
+                break
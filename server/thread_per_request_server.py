@@ -1,72 +1,228 @@
 import socket
-from typing import Dict
+import ssl
+import time
+from typing import Dict, Optional
 import selectors
 from handlers.handler_manager import ManageHandlers
 from .base_server import BaseServer
 from handlers.http_handlers import HttpBaseHandler
-from utils.general_utils import ClientInformation, HttpResponse, handle_exceptions, HttpRequest, SocketType, execute_in_new_thread, read_all, send_all
+from utils.general_utils import ClientInformation, HttpResponse, handle_exceptions, HttpRequest, SocketType, execute_in_new_thread, read_all, send_response
 from utils.custom_exceptions import ClientClosingConnection, NotValidHttpFormat
-from queue import Queue
+from utils.http_parser import HttpRequestParser
+from queue import Queue, SimpleQueue, Full
 import threading
 
 class ThreadPerRequest(BaseServer):
     """
     This implementation of the server uses a threadpool to respond to requests in a queue, but the clients
     themselves are not given their own threads.
+
+    A client socket is watched by the selector only while no thread is servicing it (one-shot): when it becomes readable
+    the main thread unregisters it and queues it, and the worker thread that serviced it hands it back to be registered
+    again. That way a client can never be queued twice and no state about which clients are being serviced has to be
+    shared between threads. The selector belongs to the main thread, so the worker threads put the sockets to re-arm
+    in a queue and wake the main thread up through a pair of sockets.
+
+    The pool is configured by the "worker_pool" block of the settings:
+
+    threads: how many worker threads service clients.
+    max_queue_depth: how many clients can wait for a worker thread. Past that, clients get a 503 right away instead
+    of waiting behind a queue that would take too long to get through anyway.
+
+    Clients waiting for a request don't hold a thread, their read deadlines (see BaseServer.read_deadline) are kept
+    by the main thread, which disconnects the ones past it every REAP_INTERVAL. At the connection limit the master
+    socket is taken out of the selector until the accept backoff is over.
     """
+    REAP_INTERVAL = 0.5
+    SERVICE_UNAVAILABLE_RESPONSE = HttpResponse(503, 'The server is overloaded, try again later', {'Connection':'close', 'Retry-After':'1'}).dump()
+
     def __init__(self, settings: Dict, host: str = '0.0.0.0', port: int = 9999):
         super().__init__(settings, host, port)
-        self.client_manager = selectors.KqueueSelector()
-        # The reason for this set is that every request is handled in its own thread but before
-        # the socket is able to be read, control is yeilded to the main thread which picks which sockets are to be read.
-        # Since the sub thread hasn't yet exhausted that client socket, the main thread thinks that socket needs to be serviced. 
-        # So this set prevents that by only servicing client sockets not currently in the set.
-        self.clients_currently_being_serviced = set() 
-        self.clients_to_be_serviced = Queue()
-    
+        worker_pool_settings = settings.get('worker_pool', {})
+        self.thread_count = worker_pool_settings.get('threads', 50)
+        self.client_manager = selectors.DefaultSelector()
+        self.clients_to_be_serviced: Queue = Queue(maxsize=worker_pool_settings.get('max_queue_depth', 256))
+        self.clients_to_rearm: SimpleQueue = SimpleQueue()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.client_manager.register(self.wakeup_reader, selectors.EVENT_READ, data=ClientInformation(SocketType.WAKEUP_SOCKET))
+        #only touched by the main thread: the read deadline of every client in the selector
+        self.client_deadlines: Dict[socket.socket, float] = {}
+        self.next_reap = 0.0
+        #when the master socket goes back in the selector, 0 while it's in there
+        self.accepting_paused_until = 0.0
+
     def get_type(self) -> str:
         return 'threadperrequest'
 
     def init_master_socket(self) -> None:
         super().init_master_socket()
+        #another worker process sharing the master socket may accept a connection first, accept mustn't wait then
+        self.master_socket.setblocking(False)
         self.client_manager.register(self.master_socket, selectors.EVENT_READ, data=ClientInformation(SocketType.MASTER_SOCKET))
-    
+
     def start_threads(self):
-        for _ in range(50):
-            threading.Thread(target=self.handle_client).start()
+        for _ in range(self.thread_count):
+            worker_thread = threading.Thread(target=self.handle_client)
+            worker_thread.daemon = True
+            worker_thread.start()
+
+    def wake_up(self) -> None:
+        try:
+            self.wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            #the main thread already has plenty of wake up calls waiting
+            pass
+
+    def stop_accepting(self) -> None:
+        self.stopping = True
+        self.wake_up()
 
     def loop_forever(self) -> None:
         self.start_threads()
         while True:
-            ready_sockets = self.client_manager.select()
+            ready_sockets = self.client_manager.select(self.select_timeout())
             for socket_wrapper, events in ready_sockets:
-                if socket_wrapper.data.socket_type == SocketType.MASTER_SOCKET:
-                    #wonder if i should put this in the queue too
-                    master_socket = socket_wrapper.fileobj
-                    new_client_socket, addr = master_socket.accept()
-                    self.accept_new_client(new_client_socket)
-                elif socket_wrapper.data.socket_type == SocketType.CLIENT_SOCKET:
+                socket_type = socket_wrapper.data.socket_type
+                if socket_type == SocketType.MASTER_SOCKET:
+                    self.accept_client()
+                elif socket_type == SocketType.CLIENT_SOCKET:
                     client_socket = socket_wrapper.fileobj
-                    if client_socket not in self.clients_currently_being_serviced and not client_socket._closed:
-                        self.clients_currently_being_serviced.add(client_socket)
-                        self.clients_to_be_serviced.put(client_socket)
-        
+                    self.client_manager.unregister(client_socket)
+                    del self.client_deadlines[client_socket]
+                    #the parser lives with the socket so that whichever thread services the client next can
+                    #pick up a partially received request where the previous thread left off
+                    try:
+                        self.clients_to_be_serviced.put_nowait((client_socket, socket_wrapper.data.context))
+                    except Full:
+                        self.shed_load(client_socket)
+                else:
+                    self.handle_wakeup()
+            self.run_timers()
+
+    def select_timeout(self) -> Optional[float]:
+        deadlines = []
+        if self.client_deadlines:
+            deadlines.append(self.next_reap)
+        if self.accepting_paused_until:
+            deadlines.append(self.accepting_paused_until)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def run_timers(self) -> None:
+        now = time.monotonic()
+        if self.accepting_paused_until and now >= self.accepting_paused_until:
+            self.accepting_paused_until = 0.0
+            if not self.stopping:
+                self.client_manager.register(self.master_socket, selectors.EVENT_READ, data=ClientInformation(SocketType.MASTER_SOCKET))
+        if now >= self.next_reap:
+            self.next_reap = now + self.REAP_INTERVAL
+            self.close_idle_clients(now)
+
+    def close_idle_clients(self, now: float) -> None:
+        """
+        disconnects the clients past their read deadline, and when stopping the ones that are between requests.
+        """
+        for client_socket, deadline in list(self.client_deadlines.items()):
+            http_request_parser = self.client_manager.get_key(client_socket).data.context
+            if deadline <= now or (self.stopping and http_request_parser.incomplete_since is None):
+                self.client_manager.unregister(client_socket)
+                del self.client_deadlines[client_socket]
+                self.close_client_connection(client_socket)
+
+    def accept_client(self) -> None:
+        if self.at_connection_limit():
+            self.pause_accepting()
+            return
+        try:
+            new_client_socket, addr = self.master_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as error:
+            if error.errno not in self.ACCEPT_RESOURCE_ERRORS:
+                raise
+            self.pause_accepting()
+            return
+        self.accepted_client()
+        self.accept_new_client(new_client_socket)
+
+    def pause_accepting(self) -> None:
+        self.client_manager.unregister(self.master_socket)
+        self.accepting_paused_until = time.monotonic() + self.next_accept_backoff()
+
+    def watch_client(self, client_socket, http_request_parser: HttpRequestParser) -> None:
+        self.client_manager.register(client_socket, selectors.EVENT_READ, data=ClientInformation(SocketType.CLIENT_SOCKET, context=http_request_parser))
+        self.client_deadlines[client_socket] = self.read_deadline(http_request_parser)
+
+    def handle_wakeup(self) -> None:
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while not self.clients_to_rearm.empty():
+            client_socket, http_request_parser = self.clients_to_rearm.get()
+            self.watch_client(client_socket, http_request_parser)
+        if self.stopping and self.master_socket.fileno() != -1:
+            if self.master_socket in self.client_manager.get_map():
+                self.client_manager.unregister(self.master_socket)
+            self.close_master_socket()
+            #the clients between requests can go now rather than when their keep-alive runs out
+            self.next_reap = 0.0
+
+    def shed_load(self, client_socket) -> None:
+        """
+        Answers with a 503 from the main thread, so it must never block: whatever the client sent is read (otherwise
+        closing the socket would reset the connection and the client might never see the response) and the response is
+        small enough to fit in the socket's send buffer.
+        """
+        #with a timeout set python waits for the socket even with MSG_DONTWAIT, it's closed right after anyway
+        client_socket.setblocking(False)
+        try:
+            while client_socket.recv(1024 * 64):
+                pass
+        except OSError:
+            pass
+        try:
+            client_socket.send(self.SERVICE_UNAVAILABLE_RESPONSE)
+        except OSError:
+            pass
+        self.metrics.increment('pyrver_shed_requests_total', ())
+        self.close_client_connection(client_socket)
+
     def accept_new_client(self, new_client) -> None:
-        self.client_manager.register(new_client, selectors.EVENT_READ, data = ClientInformation(socket_type=SocketType.CLIENT_SOCKET))
-    
+        #the worker threads only read when there is something to read, but a client that doesn't read what is sent
+        #to it could hold a worker forever without a timeout
+        new_client.settimeout(self.keep_alive_timeout)
+        if self.tls is not None:
+            #the handshake is done by the first worker thread that reads from the client, OpenSSL lets go of the GIL
+            #while it does the crypto so handshakes on several threads do run in parallel
+            new_client = self.tls.wrap(new_client)
+        self.watch_client(new_client, HttpRequestParser())
+
     def handle_client(self):
         while True:
-            client_socket = self.clients_to_be_serviced.get()
+            client_socket, http_request_parser = self.clients_to_be_serviced.get()
             try:
-                raw_client_request = read_all(client_socket)
-                http_request = HttpRequest.from_bytes(raw_client_request)
-                http_response = self.handle_client_request(http_request)
-                send_all(client_socket, http_response.dump())
-            except (ClientClosingConnection, socket.timeout, ConnectionResetError, TimeoutError, BrokenPipeError):
+                http_requests = http_request_parser.feed(read_all(client_socket))
+                requests_served = http_request_parser.requests_parsed - len(http_requests)
+                for http_request in http_requests:
+                    http_response = self.handle_client_request(http_request)
+                    requests_served += 1
+                    keep_alive = self.keeps_connection_open(http_request, http_response, requests_served)
+                    send_response(client_socket, http_response)
+                    if not keep_alive:
+                        raise ClientClosingConnection("the connection is closed after this response")
+            except (ClientClosingConnection, NotValidHttpFormat, socket.timeout, ConnectionResetError, TimeoutError, BrokenPipeError, ssl.SSLError):
                 self.close_client_connection(client_socket)
-    
-            self.clients_currently_being_serviced.remove(client_socket)
-
-    def close_client_connection(self, client_socket) -> None:
-        self.client_manager.unregister(client_socket)
-        client_socket.close()      
\ No newline at end of file
+                continue
+            except Exception:
+                #a bug in a handler or an error nobody expected: the client is dropped but the thread keeps serving the
+                #others, the pool has a fixed number of them
+                self.LOGGER.exception('unexpected error while servicing a client, disconnecting it')
+                self.close_client_connection(client_socket)
+                continue
+            self.clients_to_rearm.put((client_socket, http_request_parser))
+            self.wake_up()
@@ -1,13 +1,17 @@
 from typing import Dict
 
-#think about settings order, if there is a task with a unrestrictive match criteria and its before
-#another task with restrictive match criteria and there is overlap, the first task will swallow
-#all the requests even though thats not the user's intended behaviour. For example, lets say there are two
+#settings order doesn't matter when tasks overlap, the most specific match criteria wins. For example, lets say there are two
 #tasks: serve_static and reverse proxy. They both have matching criteria that includes a check for the 
 #host name which should be gooby.com. But serve static has an additional matching criteria which checks
-#for the url and it should be prefixed with /static/. If the reverse_proxy handler gets checked first, then
-#it will handle the request even if the url is prefixed with /static/ as long as the host is gooby.com. One easy
-#fix is to have some ordering where the handlers for tasks with the most restrictive criteria are checked first.
+#for the url and it should be prefixed with /static/. A request for gooby.com/static/a.png goes to serve_static
+#and any other request for gooby.com goes to the reverse proxy. A longer url prefix is more specific than a host,
+#which is more specific than a port (see handlers/route_index.py). Only when two tasks are exactly as specific
+#does the one that comes first win.
+
+#the tasks can be changed while the server runs: send it a SIGHUP (or start it with --watch-settings to reload whenever
+#this file is saved). The new settings are checked first (see settings_analyzer in utils/general_utils.py), requests in
+#flight finish with the old tasks and caches and backends carry over to the new ones where the backends didn't change.
+#The other blocks are only read when the server starts, in pre-fork mode changing them starts new workers.
 
 settings = {
     "tasks":{
@@ -26,7 +30,14 @@ settings = {
                 "url": ["/reverseproxy/"]
                 },
             "context": {
-                'send_to':('localhost',5000)
+                'send_to':('localhost',5000),
+                #optional (for load_balance too), stores what the backend allows to be cached (Cache-Control, Expires, Vary)
+                #and revalidates it with ETag/Last-Modified. See utils/response_cache.py for what each setting does.
+                # "cache": {"max_bytes": 64 * 1024 * 1024, "max_entry_bytes": 1024 * 1024, "stale_while_revalidate": 10,
+                #           "disk_directory": "/tmp/pyrver-cache", "disk_max_bytes": 1024 * 1024 * 1024}
+                #optional (for load_balance too), identical GETs in flight at the same time are sent to the backend once and
+                #every client gets a copy of the response. See utils/single_flight.py.
+                # "coalesce": {"max_response_bytes": 1024 * 1024, "wait_timeout": 30},
                 }
         },
 
@@ -37,7 +48,14 @@ settings = {
             "context": { 
                 'send_to':
                     [('localhost', 4000), ('localhost', 4500)],
-                "strategy":"round_robin"
+                #round_robin, weighted, least_requests, peak_ewma or power_of_two_choices. The last three look at how many
+                #requests each backend is busy with (and peak_ewma/power_of_two_choices at how fast it answered lately,
+                #averaged over about "ewma_decay_time" seconds, 10 by default).
+                "strategy":"round_robin",
+                #both of these are optional. health_checks probes every backend in the background, outlier_detection
+                #ejects a backend after consecutive failed requests. See handlers/backends.py for what each setting does.
+                # "health_checks": {"path": "/health/", "interval": 5, "timeout": 2, "healthy_threshold": 2, "unhealthy_threshold": 2},
+                # "outlier_detection": {"consecutive_failures": 5, "base_ejection_time": 30, "max_ejection_time": 300, "slow_start_time": 10}
                 }
         },
 
@@ -55,8 +73,63 @@ settings = {
         "health_check": {
             "match_criteria": {"url":['/health/']},
             "context":{}
-        }
-    }  
+        },
+
+        #request counts, latency histograms, bytes in and out and upstream errors per task, in the prometheus text format
+        "metrics": {
+            "match_criteria": {"url":['/metrics']},
+            "context":{}
+        },
+
+        #turns a sampling profiler on and off at runtime: /profile/start, /profile/stop, /profile/stacks (collapsed
+        #stacks for flame graphs) and /profile/ (time spent parsing, routing, in handlers and sending). Anyone who can
+        #reach it can slow the server down, so only enable it where that's fine.
+        # "profiling": {
+        #     "match_criteria": {"url":['/profile/']},
+        #     "context":{"sample_interval": 0.005}
+        # }
+    },
+
+    #how long client connections stay open and how many there can be, see server/base_server.py for what each one does.
+    "connections": {
+        "keep_alive_timeout": 5,
+        "request_timeout": 10,
+        "max_requests_per_connection": 1000,
+        # "max_connections": 10000,
+    },
+
+    #persistent connections to the servers in send_to (for reverse_proxy and load_balance), shared by all tasks.
+    "connection_pool": {
+        "max_idle_per_host": 16,
+        "max_per_host": 128,
+        "idle_timeout": 30,
+        "connect_timeout": 15
+    },
+
+    #clients connect with TLS, see utils/tls.py for what each setting does. A task can have a certificate of its own for
+    #the hosts in its match criteria with a "tls": {"certificate": ..., "key": ...} block in its context.
+    # "tls": {
+    #     "certificate": "/etc/pyrver/cert.pem",
+    #     "key": "/etc/pyrver/key.pem",
+    #     "session_tickets": True,
+    #     "tickets_per_handshake": 2,
+    #     "minimum_version": "TLSv1.2"
+    # },
+
+    #only for the PurelySync server and without tls: clients can speak http/2 (h2c), many requests at the same time on one
+    #connection. See utils/http2.py for what each setting does.
+    # "http2": {
+    #     "max_concurrent_streams": 100,
+    #     "initial_window_size": 1024 * 1024,
+    #     "max_frame_size": 16384,
+    #     "header_table_size": 4096
+    # },
+
+    #the threads of the ThreadPerRequest server and how many clients can wait for one before getting a 503
+    "worker_pool": {
+        "threads": 50,
+        "max_queue_depth": 256
+    }
 }
 #the diff between load_balance and reverse_proxy is that in reverse_proxy u can only specify one server as there is
 #no concept of reverse proxying to multiple servers at once. Furthermore, in load balancing u can specify types of load
@@ -0,0 +1,93 @@
+import socket
+import threading
+import time
+import unittest
+from tests.upstreams import FakeBackend, answer, read_request, start_server, get, server_types
+
+def answer_slowly(connection: socket.socket, connection_number: int) -> None:
+    while read_request(connection):
+        time.sleep(0.2)
+        answer(connection)
+    connection.close()
+
+def answer_in_trickles(connection: socket.socket, connection_number: int) -> None:
+    """
+    every read of the response is quick but the whole of it takes 0.3s.
+    """
+    while read_request(connection):
+        connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\n')
+        for _ in range(6):
+            time.sleep(0.05)
+            connection.sendall(b'.')
+    connection.close()
+
+class FreeConnectionWaitTest(unittest.TestCase):
+    """
+    at max_per_host the requests wait for a connection to be released and are handed it as soon as it is, one after
+    the other on the same connection.
+    """
+    def test_waiting_requests_get_released_connections(self):
+        for server_name, server_class in server_types().items():
+            with self.subTest(server=server_name):
+                backend = FakeBackend(answer_slowly)
+                self.addCleanup(backend.close)
+                tasks = {'reverse_proxy': {'match_criteria': {'url': ['/']}, 'context': {'send_to': backend.address}}}
+                server, port = start_server(server_class, tasks, max_per_host=1)
+                results = []
+                def send_request():
+                    results.append(get(port, '/'))
+                start = time.monotonic()
+                clients = [threading.Thread(target=send_request) for _ in range(3)]
+                for client in clients:
+                    client.start()
+                for client in clients:
+                    client.join()
+                self.assertEqual(results, [(200, b'ok')] * 3)
+                self.assertLess(time.monotonic() - start, 1.5)
+                self.assertEqual(backend.connection_count, 1)
+
+    def test_waiting_for_a_free_connection_times_out(self):
+        for server_name in ('PurelySync', 'AsyncioServer'):
+            with self.subTest(server=server_name):
+                backend = FakeBackend(answer_in_trickles)
+                self.addCleanup(backend.close)
+                tasks = {'reverse_proxy': {'match_criteria': {'url': ['/']}, 'context': {'send_to': backend.address}}}
+                server, port = start_server(server_types()[server_name], tasks, connect_timeout=0.1, max_per_host=1)
+                results = []
+                def send_request():
+                    results.append(get(port, '/')[0])
+                clients = [threading.Thread(target=send_request) for _ in range(2)]
+                for client in clients:
+                    client.start()
+                    time.sleep(0.02)
+                for client in clients:
+                    client.join()
+                #the first response takes 0.3s, the second request gives up waiting for the connection after 0.1s
+                self.assertEqual(sorted(results), [200, 502])
+
+class AsyncConnectionPoolTest(unittest.TestCase):
+    def test_waiter_is_only_resumed_when_a_connection_is_released(self):
+        from event_loop.event_loop import EventLoop
+        from utils.connection_pool import AsyncConnectionPool
+        backend = FakeBackend(answer_slowly)
+        self.addCleanup(backend.close)
+        event_loop = EventLoop()
+        pool = AsyncConnectionPool(event_loop, max_per_host=1)
+        pool.resolve_ahead([backend.address])
+        acquired = []
+        def acquire():
+            connection = yield from pool.acquire(backend.address)
+            acquired.append(connection)
+        event_loop.run_coroutine(acquire)
+        while not acquired:
+            event_loop.run_once()
+        event_loop.run_coroutine(acquire)
+        #parked on a FutureTask, nothing wakes the loop up before connect_timeout
+        self.assertEqual(len(acquired), 1)
+        self.assertGreater(event_loop.select_timeout(), 1)
+        #the deadline of the connection the first acquire waited on is gone, only the wait for a slot is left
+        self.assertEqual(len(event_loop.timers), 1)
+        pool.release(acquired[0], True)
+        event_loop.run_once()
+        self.assertEqual(acquired[1:], acquired[:1])
+        pool.release(acquired[1], True)
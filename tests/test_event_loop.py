@@ -0,0 +1,72 @@
+import socket
+import time
+import unittest
+from event_loop.event_loop import EventLoop, ResourceTask, TimedTask
+
+class ResourceTimeoutTests(unittest.TestCase):
+    def setUp(self):
+        self.event_loop = EventLoop()
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.results = []
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+
+    def wait_for_data(self, timeout: float):
+        try:
+            yield ResourceTask(self.reader, 'readable', timeout)
+            self.results.append(self.reader.recv(1024))
+        except socket.timeout:
+            self.results.append('timeout')
+
+    def test_resource_that_never_gets_ready_times_out(self):
+        start = time.monotonic()
+        self.event_loop.run_coroutine(self.wait_for_data, 0.1)
+        self.event_loop.loop()
+        self.assertEqual(self.results, ['timeout'])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertNotIn(self.reader, self.event_loop.resource_selector.get_map())
+
+    def test_resource_ready_in_time_is_not_timed_out_later(self):
+        def wait_twice():
+            yield from self.wait_for_data(0.1)
+            #the first wait's deadline comes up while this one is waiting on the same socket
+            yield from self.wait_for_data(0.5)
+
+        def send_twice():
+            self.writer.send(b'first')
+            yield TimedTask(0.2)
+            self.writer.send(b'second')
+
+        self.event_loop.run_coroutine(wait_twice)
+        self.event_loop.run_coroutine(send_twice)
+        self.event_loop.loop()
+        self.assertEqual(self.results, [b'first', b'second'])
+
+    def test_deadlines_of_resources_ready_in_time_do_not_pile_up(self):
+        def echo_many_times():
+            for _ in range(1000):
+                self.writer.send(b'ping')
+                yield from self.wait_for_data(60)
+
+        def tick():
+            #a live timer, so the heap isn't simply emptied
+            yield TimedTask(0.5)
+
+        start = time.monotonic()
+        self.event_loop.run_coroutine(tick)
+        self.event_loop.run_coroutine(echo_many_times)
+        while len(self.results) < 1000:
+            self.event_loop.run_once()
+            self.assertLessEqual(len(self.event_loop.timers), 3)
+        self.assertEqual(self.results, [b'ping'] * 1000)
+        #what's left waiting is the tick, not the deadlines a minute away
+        self.assertLessEqual(self.event_loop.select_timeout(), 0.5)
+        self.event_loop.loop()
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.event_loop.timers, [])
+
+if __name__ == '__main__':
+    unittest.main()
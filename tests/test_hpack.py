@@ -0,0 +1,107 @@
+import unittest
+from utils.custom_exceptions import HpackError
+from utils.hpack import HpackDecoder, HpackEncoder, encode_integer, huffman_decode, huffman_encode
+
+#rfc 7541 appendix C, every sequence is decoded one block after the other with the same decoder
+REQUESTS = [
+    ([(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com')], 57),
+    ([(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/'), (b':authority', b'www.example.com'),
+      (b'cache-control', b'no-cache')], 110),
+    ([(b':method', b'GET'), (b':scheme', b'https'), (b':path', b'/index.html'), (b':authority', b'www.example.com'),
+      (b'custom-key', b'custom-value')], 164),
+]
+REQUESTS_WITHOUT_HUFFMAN = ['828684410f7777772e6578616d706c652e636f6d',
+                            '828684be58086e6f2d6361636865',
+                            '828785bf400a637573746f6d2d6b65790c637573746f6d2d76616c7565']
+REQUESTS_WITH_HUFFMAN = ['828684418cf1e3c2e5f23a6ba0ab90f4ff',
+                         '828684be5886a8eb10649cbf',
+                         '828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf']
+RESPONSES = [
+    ([(b':status', b'302'), (b'cache-control', b'private'), (b'date', b'Mon, 21 Oct 2013 20:13:21 GMT'),
+      (b'location', b'https://www.example.com')], 222),
+    ([(b':status', b'307'), (b'cache-control', b'private'), (b'date', b'Mon, 21 Oct 2013 20:13:21 GMT'),
+      (b'location', b'https://www.example.com')], 222),
+    ([(b':status', b'200'), (b'cache-control', b'private'), (b'date', b'Mon, 21 Oct 2013 20:13:22 GMT'),
+      (b'location', b'https://www.example.com'), (b'content-encoding', b'gzip'),
+      (b'set-cookie', b'foo=ASDJKHQKBZXOQWEOPIUAXQWEOIU; max-age=3600; version=1')], 215),
+]
+RESPONSES_WITHOUT_HUFFMAN = [
+    '4803333032580770726976617465611d4d6f6e2c203231204f637420323031332032303a31333a323120474d546e1768747470733a2f2f'
+    '7777772e6578616d706c652e636f6d',
+    '4803333037c1c0bf',
+    '88c1611d4d6f6e2c203231204f637420323031332032303a31333a323220474d54c05a04677a69707738666f6f3d4153444a4b48514b425a'
+    '584f5157454f50495541585157454f49553b206d61782d6167653d333630303b2076657273696f6e3d31',
+]
+RESPONSES_WITH_HUFFMAN = [
+    '488264025885aec3771a4b6196d07abe941054d444a8200595040b8166e082a62d1bff6e919d29ad171863c78f0b97c8e9ae82ae43d3',
+    '4883640effc1c0bf',
+    '88c16196d07abe941054d444a8200595040b8166e084a62d1bffc05a839bd9ab77ad94e7821dd7f2e6c7b335dfdfcd5b3960d5af27087f'
+    '3672c1ab270fb5291f9587316065c003ed4ee5b1063d5007',
+]
+
+class HpackDecoderTest(unittest.TestCase):
+    def check_sequence(self, blocks, expected, max_table_size=4096):
+        decoder = HpackDecoder(max_table_size)
+        for block, (headers, table_size) in zip(blocks, expected):
+            self.assertEqual(decoder.decode(bytes.fromhex(block)), headers)
+            self.assertEqual(decoder.table_size, table_size)
+        return decoder
+
+    def test_header_field_representations(self):
+        decoder = HpackDecoder()
+        self.assertEqual(decoder.decode(bytes.fromhex('400a637573746f6d2d6b65790d637573746f6d2d686561646572')),
+                         [(b'custom-key', b'custom-header')])
+        self.assertEqual(decoder.table_size, 55)
+        self.assertEqual(decoder.decode(bytes.fromhex('040c2f73616d706c652f70617468')), [(b':path', b'/sample/path')])
+        self.assertEqual(decoder.decode(bytes.fromhex('100870617373776f726406736563726574')), [(b'password', b'secret')])
+        self.assertEqual(decoder.decode(bytes.fromhex('82')), [(b':method', b'GET')])
+        self.assertEqual(list(decoder.table), [(b'custom-key', b'custom-header')])
+
+    def test_requests(self):
+        self.check_sequence(REQUESTS_WITHOUT_HUFFMAN, REQUESTS)
+        decoder = self.check_sequence(REQUESTS_WITH_HUFFMAN, REQUESTS)
+        self.assertEqual(list(decoder.table), [(b'custom-key', b'custom-value'), (b'cache-control', b'no-cache'),
+                                               (b':authority', b'www.example.com')])
+
+    def test_responses_with_evictions(self):
+        self.check_sequence(RESPONSES_WITHOUT_HUFFMAN, RESPONSES, max_table_size=256)
+        decoder = self.check_sequence(RESPONSES_WITH_HUFFMAN, RESPONSES, max_table_size=256)
+        self.assertEqual([name for name, _ in decoder.table], [b'set-cookie', b'content-encoding', b'date'])
+
+    def test_invalid_blocks(self):
+        for block in ('be',                  #an index past the end of the dynamic table
+                      '3fe21f',              #a table size update bigger than the table allowed
+                      '823f00',              #a table size update after a header
+                      '04821fff',            #a huffman string with more than 7 bits of padding
+                      '0484ffffffff',        #a huffman string with EOS in it
+                      '0485616263'):         #a string longer than the block
+            with self.subTest(block=block), self.assertRaises(HpackError):
+                HpackDecoder().decode(bytes.fromhex(block))
+
+class HpackEncoderTest(unittest.TestCase):
+    def test_integers(self):
+        self.assertEqual(encode_integer(10, 5, 0), bytes.fromhex('0a'))
+        self.assertEqual(encode_integer(1337, 5, 0), bytes.fromhex('1f9a0a'))
+        self.assertEqual(encode_integer(42, 8, 0), bytes.fromhex('2a'))
+
+    def test_huffman(self):
+        self.assertEqual(huffman_encode(b'www.example.com'), bytes.fromhex('f1e3c2e5f23a6ba0ab90f4ff'))
+        self.assertEqual(huffman_encode(b'no-cache'), bytes.fromhex('a8eb10649cbf'))
+        every_byte = bytes(range(256))
+        self.assertEqual(huffman_decode(huffman_encode(every_byte)), every_byte)
+
+    def test_round_trip_keeps_the_tables_in_step(self):
+        encoder, decoder = HpackEncoder(256), HpackDecoder(256)
+        for headers, _ in RESPONSES * 3:
+            block = encoder.encode(headers)
+            self.assertEqual(decoder.decode(block), headers)
+        #headers already in the dynamic table are sent as one byte indexes
+        self.assertEqual(len(encoder.encode([(b'cache-control', b'private'), (b'content-encoding', b'gzip')])), 2)
+
+    def test_smaller_table_is_announced(self):
+        encoder, decoder = HpackEncoder(), HpackDecoder()
+        headers = [(b'x-custom', b'value')]
+        decoder.decode(encoder.encode(headers))
+        encoder.resize(0)
+        self.assertEqual(decoder.decode(encoder.encode(headers)), headers)
+        self.assertEqual((decoder.max_table_size, decoder.table_size), (0, 0))
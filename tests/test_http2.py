@@ -0,0 +1,212 @@
+import base64
+import socket
+import struct
+import threading
+import time
+import unittest
+from utils.custom_exceptions import Http2ConnectionError
+from utils.general_utils import settings_analyzer, settings_preparer
+from utils.hpack import HpackDecoder, HpackEncoder
+from utils.http2 import (Http2Connection, PREFACE, FRAME_HEADER, SETTING, frame, DATA, HEADERS, RST_STREAM, SETTINGS,
+                         GOAWAY, WINDOW_UPDATE, CONTINUATION, END_STREAM, END_HEADERS, ACK, PROTOCOL_ERROR,
+                         FLOW_CONTROL_ERROR, REFUSED_STREAM, STREAM_CLOSED, CANCEL, NO_ERROR, DEFAULT_WINDOW_SIZE,
+                         SETTINGS_INITIAL_WINDOW_SIZE)
+from tests.upstreams import free_port, server_types
+
+REQUEST_HEADERS = [(b':method', b'GET'), (b':scheme', b'http'), (b':path', b'/health/'), (b':authority', b'localhost')]
+
+def read_frames(data: bytes):
+    """
+    (type, flags, stream id, payload) of every frame in data, and what is left after the last whole one.
+    """
+    frames = []
+    while len(data) >= FRAME_HEADER.size:
+        length_high, length_low, frame_type, flags, stream_id = FRAME_HEADER.unpack_from(data)
+        frame_end = FRAME_HEADER.size + ((length_high << 16) | length_low)
+        if len(data) < frame_end:
+            break
+        frames.append((frame_type, flags, stream_id, data[FRAME_HEADER.size:frame_end]))
+        data = data[frame_end:]
+    return frames, data
+
+def window_update(stream_id: int, increment: int) -> bytes:
+    return frame(WINDOW_UPDATE, 0, stream_id, struct.pack('>L', increment))
+
+class Http2ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = Http2Connection(max_concurrent_streams=2, initial_window_size=DEFAULT_WINDOW_SIZE)
+        self.encoder = HpackEncoder()
+        self.connection.receive(PREFACE + frame(SETTINGS, 0, 0))
+        self.connection.outbound.clear()
+
+    def sent_frames(self):
+        frames, _ = read_frames(bytes(self.connection.outbound))
+        self.connection.outbound.clear()
+        return frames
+
+    def open_stream(self, stream_id: int, end_stream: bool = True):
+        flags = END_HEADERS | (END_STREAM if end_stream else 0)
+        return self.connection.receive(frame(HEADERS, flags, stream_id, self.encoder.encode(REQUEST_HEADERS)))
+
+    def test_header_block_in_continuation_frames(self):
+        block = self.encoder.encode(REQUEST_HEADERS)
+        self.assertEqual(self.connection.receive(frame(HEADERS, END_STREAM, 1, block[:3])), [])
+        self.assertEqual(self.connection.receive(frame(CONTINUATION, 0, 1, block[3:6])), [])
+        stream, = self.connection.receive(frame(CONTINUATION, END_HEADERS, 1, block[6:]))
+        self.assertEqual((stream.stream_id, stream.headers), (1, REQUEST_HEADERS))
+
+    def test_interrupted_header_block_ends_the_connection(self):
+        block = self.encoder.encode(REQUEST_HEADERS)
+        self.connection.receive(frame(HEADERS, END_STREAM, 1, block[:3]))
+        with self.assertRaises(Http2ConnectionError) as raised:
+            self.connection.receive(frame(HEADERS, END_STREAM | END_HEADERS, 3, block))
+        self.assertEqual(raised.exception.error_code, PROTOCOL_ERROR)
+        (frame_type, _, _, payload), = self.sent_frames()
+        self.assertEqual((frame_type, payload), (GOAWAY, struct.pack('>LL', 0, PROTOCOL_ERROR)))
+
+    def test_continuation_without_headers_ends_the_connection(self):
+        with self.assertRaises(Http2ConnectionError):
+            self.connection.receive(frame(CONTINUATION, END_HEADERS, 1, b''))
+
+    def test_response_headers_bigger_than_a_frame_go_on_in_continuation(self):
+        stream, = self.open_stream(1)
+        big_headers = [(b':status', b'200')] + [(b'x-header-%d' % number, b'v' * 1000) for number in range(40)]
+        self.connection.send_headers(stream, big_headers, end_stream=True)
+        frames = self.sent_frames()
+        self.assertEqual([frame_type for frame_type, *_ in frames], [HEADERS, CONTINUATION, CONTINUATION])
+        self.assertEqual([flags for _, flags, _, _ in frames], [END_STREAM, 0, END_HEADERS])
+        self.assertEqual(HpackDecoder().decode(b''.join(payload for *_, payload in frames)), big_headers)
+
+    def test_windows(self):
+        stream, = self.open_stream(1)
+        self.assertEqual(self.connection.sendable(stream), 16384)
+        self.connection.send_data(stream, b'x' * 16384, end_stream=False)
+        self.connection.send_data(stream, b'x' * 16384, end_stream=False)
+        self.connection.send_data(stream, b'x' * 16384, end_stream=False)
+        self.connection.send_data(stream, b'x' * 16383, end_stream=False)
+        self.assertEqual(self.connection.sendable(stream), 0)
+        #the stream's window opening isn't enough, the connection's is closed too
+        self.connection.receive(window_update(1, 100))
+        self.assertEqual(self.connection.sendable(stream), 0)
+        self.connection.receive(window_update(0, 50))
+        self.assertEqual(self.connection.sendable(stream), 50)
+        #a smaller initial window takes as much off the streams' windows
+        self.connection.receive(frame(SETTINGS, 0, 0, SETTING.pack(SETTINGS_INITIAL_WINDOW_SIZE, DEFAULT_WINDOW_SIZE - 90)))
+        self.assertEqual(stream.send_window, 10)
+        self.assertEqual(self.connection.sendable(stream), 10)
+
+    def test_invalid_window_updates(self):
+        stream, = self.open_stream(1)
+        self.connection.receive(window_update(1, 0))
+        self.assertTrue(stream.reset)
+        (frame_type, _, stream_id, payload), = self.sent_frames()
+        self.assertEqual((frame_type, stream_id, payload), (RST_STREAM, 1, struct.pack('>L', PROTOCOL_ERROR)))
+        with self.assertRaises(Http2ConnectionError) as raised:
+            self.connection.receive(window_update(0, 2 ** 31 - 1))
+        self.assertEqual(raised.exception.error_code, FLOW_CONTROL_ERROR)
+
+    def test_received_data_is_acknowledged_once_half_the_window_is_used(self):
+        self.open_stream(1, end_stream=False)
+        self.connection.receive(frame(DATA, 0, 1, b'x' * 16384))
+        self.assertEqual(self.sent_frames(), [])
+        self.connection.receive(frame(DATA, 0, 1, b'x' * 16384))
+        self.assertEqual(sorted(self.sent_frames()), [(WINDOW_UPDATE, 0, 0, struct.pack('>L', 32768)),
+                                                      (WINDOW_UPDATE, 0, 1, struct.pack('>L', 32768))])
+        stream, = self.connection.receive(frame(DATA, END_STREAM, 1, b'end'))
+        self.assertEqual(len(stream.body), 32771)
+
+    def test_rst_stream(self):
+        self.open_stream(1, end_stream=False)
+        stream = self.connection.streams[1]
+        self.connection.receive(frame(RST_STREAM, 0, 1, struct.pack('>L', CANCEL)))
+        self.assertTrue(stream.reset)
+        self.assertNotIn(1, self.connection.streams)
+        #DATA that crossed the reset gets the stream closed error, not the whole connection
+        self.connection.receive(frame(DATA, END_STREAM, 1, b'late'))
+        self.assertIn((RST_STREAM, 0, 1, struct.pack('>L', STREAM_CLOSED)), self.sent_frames())
+        with self.assertRaises(Http2ConnectionError):
+            self.connection.receive(frame(RST_STREAM, 0, 7, struct.pack('>L', CANCEL)))
+
+    def test_streams_past_the_limit_are_refused(self):
+        self.open_stream(1, end_stream=False)
+        self.open_stream(3, end_stream=False)
+        self.assertEqual(self.open_stream(5), [])
+        self.assertEqual(self.sent_frames(), [(RST_STREAM, 0, 5, struct.pack('>L', REFUSED_STREAM))])
+
+    def test_goaway(self):
+        self.open_stream(1, end_stream=False)
+        self.connection.receive(frame(GOAWAY, 0, 0, struct.pack('>LL', 0, NO_ERROR)))
+        self.assertTrue(self.connection.goaway_received)
+        self.connection.close()
+        self.connection.close()
+        self.assertEqual(self.sent_frames(), [(GOAWAY, 0, 0, struct.pack('>LL', 1, NO_ERROR))])
+        #streams the client opens after our GOAWAY aren't handled
+        self.assertEqual(self.open_stream(3), [])
+        self.assertNotIn(3, self.connection.streams)
+
+class H2cTest(unittest.TestCase):
+    """
+    a whole exchange with the PurelySync server, with a client that already knows it speaks h2c and with one that
+    upgrades an http/1.1 request.
+    """
+    def setUp(self):
+        settings = settings_preparer(settings_analyzer({'tasks': {'health_check': {'match_criteria': {}, 'context': {}}},
+                                                        'http2': {}}))
+        server = server_types()['PurelySync'](settings, host='127.0.0.1', port=free_port())
+        threading.Thread(target=server.start_loop, daemon=True).start()
+        self.client = None
+        deadline = time.monotonic() + 5
+        while self.client is None and time.monotonic() < deadline:
+            try:
+                self.client = socket.create_connection(('127.0.0.1', server.port), timeout=5)
+            except OSError:
+                time.sleep(0.02)
+        self.addCleanup(self.client.close)
+        self.decoder = HpackDecoder()
+
+    def read_responses(self, stream_ids, data: bytes = b''):
+        """
+        the decoded headers and the body of the response on every one of the streams, SETTINGS from the server are
+        acknowledged.
+        """
+        responses = {stream_id: [None, b''] for stream_id in stream_ids}
+        ended = set()
+        while True:
+            frames, data = read_frames(data)
+            for frame_type, flags, stream_id, payload in frames:
+                if frame_type == SETTINGS and not flags & ACK:
+                    self.client.sendall(frame(SETTINGS, ACK, 0))
+                elif frame_type == HEADERS:
+                    responses[stream_id][0] = self.decoder.decode(payload)
+                elif frame_type == DATA:
+                    responses[stream_id][1] += payload
+                if frame_type in (HEADERS, DATA) and flags & END_STREAM:
+                    ended.add(stream_id)
+            if ended == set(stream_ids):
+                return {stream_id: tuple(response) for stream_id, response in responses.items()}
+            received = self.client.recv(65536)
+            self.assertTrue(received, 'the server closed the connection')
+            data += received
+
+    def test_prior_knowledge(self):
+        encoder = HpackEncoder()
+        self.client.sendall(PREFACE + frame(SETTINGS, 0, 0) +
+                            frame(HEADERS, END_HEADERS | END_STREAM, 1, encoder.encode(REQUEST_HEADERS)) +
+                            frame(HEADERS, END_HEADERS | END_STREAM, 3, encoder.encode(REQUEST_HEADERS)))
+        responses = self.read_responses([1, 3])
+        for stream_id in (1, 3):
+            headers, body = responses[stream_id]
+            self.assertEqual((headers[0], body), ((b':status', b'200'), b"I'm Healthy!"))
+
+    def test_upgrade(self):
+        http2_settings = base64.urlsafe_b64encode(SETTING.pack(SETTINGS_INITIAL_WINDOW_SIZE, 65535)).rstrip(b'=')
+        self.client.sendall(b'GET /health/ HTTP/1.1\r\nHost: localhost\r\nConnection: Upgrade, HTTP2-Settings\r\n'
+                            b'Upgrade: h2c\r\nHTTP2-Settings: ' + http2_settings + b'\r\n\r\n')
+        data = b''
+        while b'\r\n\r\n' not in data:
+            data += self.client.recv(65536)
+        head, data = data.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.1 101 Switching Protocols'))
+        self.client.sendall(PREFACE + frame(SETTINGS, 0, 0))
+        headers, body = self.read_responses([1], data)[1]
+        self.assertEqual((headers[0], body), ((b':status', b'200'), b"I'm Healthy!"))
@@ -0,0 +1,86 @@
+import unittest
+from utils.custom_exceptions import NotValidHttpFormat
+from utils.http_parser import HttpRequestParser
+
+GET = b'GET /a HTTP/1.1\r\nHost: example.com\r\n\r\n'
+POST = b'POST /form HTTP/1.1\r\nHost: example.com\r\nContent-Length: 5\r\n\r\nhello'
+CHUNKED = (b'POST /upload HTTP/1.1\r\nHost: example.com\r\nTransfer-Encoding: chunked\r\n\r\n'
+           b'5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nChecksum: abc\r\nExpires: never\r\n\r\n')
+
+class HttpRequestParserTest(unittest.TestCase):
+    def test_head_split_across_feeds(self):
+        parser = HttpRequestParser()
+        for byte_number in range(len(GET) - 1):
+            self.assertEqual(parser.feed(GET[byte_number:byte_number + 1]), [])
+        self.assertIsNotNone(parser.incomplete_since)
+        http_request, = parser.feed(GET[-1:])
+        self.assertEqual((http_request.request_type, http_request.requested_url), ('GET', '/a'))
+        self.assertEqual(http_request.get_header('host'), 'example.com')
+        self.assertIsNone(parser.incomplete_since)
+
+    def test_pipelined_requests_in_one_buffer(self):
+        parser = HttpRequestParser()
+        http_requests = parser.feed(GET + POST + b'\r\n' + CHUNKED + GET[:10])
+        self.assertEqual([http_request.requested_url for http_request in http_requests], ['/a', '/form', '/upload'])
+        self.assertEqual(http_requests[1].body, b'hello')
+        self.assertEqual(http_requests[1].raw_http_request, POST)
+        self.assertTrue(parser.has_partial_request())
+        self.assertEqual([http_request.requested_url for http_request in parser.feed(GET[10:])], ['/a'])
+        self.assertEqual(parser.requests_parsed, 4)
+
+    def test_body_split_across_feeds(self):
+        parser = HttpRequestParser()
+        self.assertEqual(parser.feed(POST[:-2]), [])
+        http_request, = parser.feed(POST[-2:])
+        self.assertEqual(http_request.body, b'hello')
+
+    def test_chunked_body_with_extensions_and_trailers(self):
+        for split_at in range(1, len(CHUNKED)):
+            parser = HttpRequestParser()
+            http_requests = parser.feed(CHUNKED[:split_at]) + parser.feed(CHUNKED[split_at:])
+            self.assertEqual(len(http_requests), 1)
+            self.assertEqual(http_requests[0].body, b'hello world')
+            self.assertEqual(http_requests[0].raw_http_request, CHUNKED)
+
+    def test_chunked_body_without_trailers(self):
+        without_trailers = CHUNKED[:CHUNKED.index(b'0\r\n')] + b'0\r\n\r\n'
+        chunked_request, next_request = HttpRequestParser().feed(without_trailers + GET)
+        self.assertEqual(chunked_request.body, b'hello world')
+        self.assertEqual(next_request.requested_url, '/a')
+
+    def test_head_over_max_header_bytes_is_rejected(self):
+        parser = HttpRequestParser()
+        parser.feed(b'GET / HTTP/1.1\r\n')
+        with self.assertRaises(NotValidHttpFormat):
+            parser.feed(b'X-Padding: ' + b'a' * HttpRequestParser.MAX_HEADER_BYTES + b'\r\n')
+
+    def test_content_length_over_max_body_bytes_is_rejected(self):
+        with self.assertRaises(NotValidHttpFormat):
+            HttpRequestParser().feed(b'POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % (HttpRequestParser.MAX_BODY_BYTES + 1))
+
+    def test_chunks_over_max_body_bytes_are_rejected(self):
+        parser = HttpRequestParser()
+        parser.feed(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n')
+        with self.assertRaises(NotValidHttpFormat):
+            parser.feed(b'%x\r\n' % (HttpRequestParser.MAX_BODY_BYTES + 1))
+
+    def test_negative_or_invalid_content_length_is_rejected(self):
+        for content_length in (b'-1', b'12abc'):
+            with self.subTest(content_length=content_length), self.assertRaises(NotValidHttpFormat):
+                HttpRequestParser().feed(b'POST / HTTP/1.1\r\nContent-Length: ' + content_length + b'\r\n\r\n')
+
+    def test_content_length_with_transfer_encoding_is_rejected(self):
+        for head in (b'POST / HTTP/1.1\r\nContent-Length: 5\r\nTransfer-Encoding: chunked\r\n\r\n',
+                     b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\nContent-Length: 5\r\n\r\n',
+                     b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked, gzip\r\n\r\n'):
+            with self.subTest(head=head), self.assertRaises(NotValidHttpFormat):
+                HttpRequestParser().feed(head + b'0\r\n\r\n')
+
+    def test_malformed_chunk_size_is_rejected(self):
+        for chunk in (b'zz\r\nhello\r\n', b'\r\nhello\r\n', b'5\r\nhelloXX', b'a' * 2048):
+            with self.subTest(chunk=chunk), self.assertRaises(NotValidHttpFormat):
+                HttpRequestParser().feed(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' + chunk)
+
+    def test_malformed_request_line_is_rejected(self):
+        with self.assertRaises(NotValidHttpFormat):
+            HttpRequestParser().feed(b'GET /\r\n\r\n')
@@ -0,0 +1,32 @@
+import unittest
+from utils.general_utils import HttpRequest, if_range_matches
+
+ETAG = '"17e4f-2a"'
+LAST_MODIFIED = 'Tue, 15 Oct 2024 08:12:31 GMT'
+
+def range_request(if_range: str = None) -> HttpRequest:
+    headers = b'Range: bytes=0-99\r\n' + (b'If-Range: %s\r\n' % if_range.encode() if if_range is not None else b'')
+    return HttpRequest.from_bytes(b'GET /video.mp4 HTTP/1.1\r\nHost: localhost\r\n' + headers + b'\r\n')
+
+class IfRangeTest(unittest.TestCase):
+    """
+    the range is only sent if what the client has is still current, judged by a strong comparison.
+    """
+    def test_range_without_if_range_is_sent(self):
+        self.assertTrue(if_range_matches(range_request(), ETAG, LAST_MODIFIED))
+
+    def test_same_strong_etag_matches(self):
+        self.assertTrue(if_range_matches(range_request(ETAG), ETAG, LAST_MODIFIED))
+        self.assertFalse(if_range_matches(range_request('"17e4f-2b"'), ETAG, LAST_MODIFIED))
+
+    def test_weak_etags_never_match(self):
+        self.assertFalse(if_range_matches(range_request('W/' + ETAG), ETAG, LAST_MODIFIED))
+        self.assertFalse(if_range_matches(range_request('W/' + ETAG), 'W/' + ETAG, LAST_MODIFIED))
+        self.assertFalse(if_range_matches(range_request(ETAG), 'W/' + ETAG, LAST_MODIFIED))
+
+    def test_dates_have_to_match_exactly(self):
+        self.assertTrue(if_range_matches(range_request(LAST_MODIFIED), ETAG, LAST_MODIFIED))
+        self.assertFalse(if_range_matches(range_request('Tue, 15 Oct 2024 08:12:32 GMT'), ETAG, LAST_MODIFIED))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import http.client
+import time
+import unittest
+from tests.upstreams import FakeBackend, start_server, get, answer_forever, close_right_away, never_answer, server_types
+
+class OutlierEjectionTests(unittest.TestCase):
+    """
+    Passive health checking: a backend whose requests fail consecutive_failures times in a row is ejected and the
+    traffic goes to the other backends.
+    """
+    CONSECUTIVE_FAILURES = 2
+
+    def check_ejection(self, server_class, failing_behavior):
+        healthy_backend = FakeBackend(answer_forever)
+        failing_backend = FakeBackend(failing_behavior)
+        server, port = start_server(server_class, {'load_balance': {'match_criteria': {'url': ['/']}, 'context': {
+            'send_to': [healthy_backend.address, failing_backend.address],
+            'strategy': 'round_robin',
+            'outlier_detection': {'consecutive_failures': self.CONSECUTIVE_FAILURES, 'base_ejection_time': 30, 'slow_start_time': 0}}}},
+            connect_timeout=0.2)
+        client_connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        responses = []
+        for _ in range(12):
+            try:
+                responses.append(get(port, '/', client_connection))
+            except (http.client.HTTPException, OSError):
+                client_connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                responses.append((None, b''))
+        self.assertEqual(sum(status != 200 for status, _ in responses), self.CONSECUTIVE_FAILURES)
+        self.assertEqual(responses[-6:], [(200, b'backend %d' % healthy_backend.address[1])] * 6)
+        load_balancer = next(handler for handler in server.request_handlers if handler.task_name == 'load_balance')
+        failing = next(backend for backend in load_balancer.backends.backends if backend.address == failing_backend.address)
+        self.assertGreater(failing.ejected_until, time.monotonic())
+        healthy_backend.close()
+        failing_backend.close()
+
+    def test_backend_that_closes_connections_is_ejected(self):
+        for name, server_class in server_types().items():
+            with self.subTest(name):
+                self.check_ejection(server_class, close_right_away)
+
+    def test_backend_that_never_answers_is_ejected(self):
+        for name, server_class in server_types().items():
+            with self.subTest(name):
+                self.check_ejection(server_class, never_answer)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import http.client
+import unittest
+from tests.upstreams import FakeBackend, start_server, get, read_request, answer, answer_forever, close_right_away, server_types
+
+def answer_once_then(behavior):
+    """
+    the first connection gets one answer and is then closed by the backend when the next request comes in on it, the
+    way a backend closes a keep-alive connection that sat in our pool. The other connections get behavior.
+    """
+    def first_connection_answers_once(connection, connection_number):
+        if connection_number > 0:
+            return behavior(connection, connection_number)
+        if read_request(connection):
+            answer(connection)
+        read_request(connection)
+        connection.close()
+    return first_connection_answers_once
+
+class ProxyRetryTests(unittest.TestCase):
+    """
+    A request is sent again only when a pooled connection failed before any of the response came in, and only once.
+    """
+    def proxy_to(self, server_class, backend: FakeBackend) -> int:
+        _, port = start_server(server_class, {'reverse_proxy': {'match_criteria': {'url': ['/']}, 'context': {'send_to': backend.address}}})
+        return port
+
+    def test_new_connection_closed_by_the_backend_is_not_retried(self):
+        for name, server_class in server_types().items():
+            with self.subTest(name):
+                backend = FakeBackend(close_right_away)
+                status, _ = get(self.proxy_to(server_class, backend), '/')
+                self.assertEqual(status, 502)
+                self.assertEqual(backend.connection_count, 1)
+                backend.close()
+
+    def test_stale_pooled_connection_is_retried_on_a_new_one(self):
+        for name, server_class in server_types().items():
+            with self.subTest(name):
+                backend = FakeBackend(answer_once_then(answer_forever))
+                port = self.proxy_to(server_class, backend)
+                client_connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                self.assertEqual(get(port, '/', client_connection)[0], 200)
+                self.assertEqual(get(port, '/', client_connection)[0], 200)
+                self.assertEqual(backend.connection_count, 2)
+                backend.close()
+
+    def test_retry_happens_at_most_once(self):
+        for name, server_class in server_types().items():
+            with self.subTest(name):
+                backend = FakeBackend(answer_once_then(close_right_away))
+                port = self.proxy_to(server_class, backend)
+                client_connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                self.assertEqual(get(port, '/', client_connection)[0], 200)
+                self.assertEqual(get(port, '/', client_connection)[0], 502)
+                self.assertEqual(backend.connection_count, 2)
+                backend.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import copy
+import time
+import unittest
+from typing import Dict
+from utils.custom_exceptions import MalformedSettings
+from utils.general_utils import settings_analyzer, settings_preparer
+from tests.upstreams import RecordingBackend, response, free_port, start_server, server_types
+
+PROXY_TASK = {'match_criteria': {'url': ['/']}, 'context': {'send_to': ('127.0.0.1', 4000)}}
+LOAD_BALANCE_TASK = {'match_criteria': {'url': ['/']},
+                     'context': {'send_to': [('127.0.0.1', 4000), ('127.0.0.1', 4001)], 'strategy': 'round_robin'}}
+
+def with_task(task_name: str, task: Dict, **settings) -> Dict:
+    return {'tasks': {task_name: task}, **settings}
+
+def changed(task: Dict, **context) -> Dict:
+    task = copy.deepcopy(task)
+    task['context'].update(context)
+    return task
+
+class SettingsAnalyzerTest(unittest.TestCase):
+    """
+    everything that's wrong with the settings is refused before a handler is built from them.
+    """
+    MALFORMED_SETTINGS = {
+        'no tasks': ({'worker_pool': {}}, 'the settings need a "tasks" dict'),
+        'unknown settings block': (with_task('health_check', {'match_criteria': {}, 'context': {}}, workers={}),
+                                   "unknown settings block 'workers'"),
+        'settings block that is not a dict': (with_task('health_check', {'match_criteria': {}, 'context': {}}, worker_pool=4),
+                                              'the worker_pool block has to be a dict'),
+        'tls without a key': (with_task('health_check', {'match_criteria': {}, 'context': {}}, tls={'certificate': 'cert.pem'}),
+                              'the tls block needs a certificate and a key'),
+        'unknown task': (with_task('serve_everything', {'match_criteria': {}, 'context': {}}), "unknown task 'serve_everything'"),
+        'task without a context': (with_task('health_check', {'match_criteria': {}}), 'a task needs a match_criteria dict and a context dict'),
+        'match criteria that are not a list': (with_task('health_check', {'match_criteria': {'url': '/health'}, 'context': {}}),
+                                               'the match criteria for url have to be a list'),
+        'missing context': (with_task('reverse_proxy', {'match_criteria': {}, 'context': {}}), 'send_to missing from the context'),
+        'context block that is not a dict': (with_task('reverse_proxy', changed(PROXY_TASK, cache=True)), 'cache has to be a dict'),
+        'task tls without a certificate': (with_task('reverse_proxy', changed(PROXY_TASK, tls={'key': 'key.pem'})),
+                                           'reverse_proxy: the tls block needs a certificate and a key'),
+        'proxy to something that is not an address': (with_task('reverse_proxy', changed(PROXY_TASK, send_to='localhost:4000')),
+                                                      "send_to has to be a (host, port), not 'localhost:4000'"),
+        'load balance to no backends': (with_task('load_balance', changed(LOAD_BALANCE_TASK, send_to=[])),
+                                        'send_to has to be a list of (host, port)'),
+        'unknown strategy': (with_task('load_balance', changed(LOAD_BALANCE_TASK, strategy='random')), "unknown strategy 'random'"),
+        'backend that is not an address': (with_task('load_balance', changed(LOAD_BALANCE_TASK, send_to=[('127.0.0.1',)])),
+                                           "('127.0.0.1',) in send_to is not a (host, port) or (host, port, weight)"),
+        'weight under 0': (with_task('load_balance', changed(LOAD_BALANCE_TASK, send_to=[('127.0.0.1', 4000, -1)])),
+                           'the weight of 127.0.0.1:4000 has to be a number over 0'),
+        'weighted backend without a weight': (with_task('load_balance', changed(LOAD_BALANCE_TASK, strategy='weighted',
+                                                                                send_to=[('127.0.0.1', 4000, 1), ('127.0.0.1', 4001)])),
+                                              'every backend needs a weight with the weighted strategy'),
+        'weights not adding up to 1': (with_task('load_balance', changed(LOAD_BALANCE_TASK, strategy='weighted',
+                                                                         send_to=[('127.0.0.1', 4000, 0.5), ('127.0.0.1', 4001, 0.6)])),
+                                       'the weights add up to 1.1 instead of 1'),
+    }
+
+    def test_every_malformed_setting_is_refused(self):
+        for case, (settings, problem) in self.MALFORMED_SETTINGS.items():
+            with self.subTest(case):
+                with self.assertRaises(MalformedSettings) as raised:
+                    settings_analyzer(settings)
+                self.assertIn(problem, str(raised.exception))
+
+    def test_all_the_problems_are_reported_together(self):
+        settings = {'tasks': {'reverse_proxy': changed(PROXY_TASK, send_to=4000), 'serve_everything': {'match_criteria': {}, 'context': {}}},
+                    'workers': {}}
+        with self.assertRaises(MalformedSettings) as raised:
+            settings_analyzer(settings)
+        for problem in ("unknown settings block 'workers'", "unknown task 'serve_everything'", 'send_to has to be a (host, port)'):
+            self.assertIn(problem, str(raised.exception))
+
+    def test_well_formed_settings_are_returned_as_they_are(self):
+        settings = {'tasks': {'load_balance': changed(LOAD_BALANCE_TASK, cache={}, coalesce={}),
+                              'health_check': {'match_criteria': {'url': ['/health/']}, 'context': {}}},
+                    'worker_pool': {'threads': 4}, 'connection_pool': {'connect_timeout': 1}}
+        self.assertIs(settings_analyzer(settings), settings)
+
+class CarryOverTest(unittest.TestCase):
+    """
+    a reload keeps what the previous handler of a task knew as long as the settings it depends on didn't change.
+    """
+    def server_with(self, task_name: str, task: Dict):
+        settings = settings_preparer(settings_analyzer(with_task(task_name, copy.deepcopy(task))))
+        return server_types()['ThreadPerClient'](settings, host='127.0.0.1', port=free_port())
+
+    def reload(self, server, task_name: str, task: Dict):
+        previous_handler = self.handler(server)
+        server.reload(settings_preparer(settings_analyzer(with_task(task_name, copy.deepcopy(task)))))
+        return previous_handler, self.handler(server)
+
+    def handler(self, server):
+        return next(iter(server.request_handlers))
+
+    def test_cache_and_flights_are_kept_while_their_settings_are_unchanged(self):
+        task = changed(PROXY_TASK, cache={'max_bytes': 1024 * 1024}, coalesce={'wait_timeout': 5})
+        server = self.server_with('reverse_proxy', task)
+        rerouted_task = dict(task, match_criteria={'url': ['/api/']})
+        previous_handler, handler = self.reload(server, 'reverse_proxy', rerouted_task)
+        self.assertIsNot(handler, previous_handler)
+        self.assertIs(handler.response_cache, previous_handler.response_cache)
+        self.assertIs(handler.single_flight, previous_handler.single_flight)
+
+    def test_cache_is_dropped_when_its_settings_change(self):
+        task = changed(PROXY_TASK, cache={'max_bytes': 1024 * 1024}, coalesce={'wait_timeout': 5})
+        server = self.server_with('reverse_proxy', task)
+        previous_handler, handler = self.reload(server, 'reverse_proxy', changed(task, cache={'max_bytes': 2048 * 1024}))
+        self.assertIsNot(handler.response_cache, previous_handler.response_cache)
+        self.assertEqual(handler.response_cache.max_bytes, 2048 * 1024)
+        self.assertIs(handler.single_flight, previous_handler.single_flight)
+
+    def test_flights_are_dropped_when_their_settings_change(self):
+        task = changed(PROXY_TASK, cache={'max_bytes': 1024 * 1024}, coalesce={'wait_timeout': 5})
+        server = self.server_with('reverse_proxy', task)
+        previous_handler, handler = self.reload(server, 'reverse_proxy', changed(task, coalesce={'wait_timeout': 1}))
+        self.assertIs(handler.response_cache, previous_handler.response_cache)
+        self.assertIsNot(handler.single_flight, previous_handler.single_flight)
+        self.assertEqual(handler.single_flight.wait_timeout, 1)
+
+    def test_nothing_is_kept_for_other_backends(self):
+        task = changed(PROXY_TASK, cache={}, coalesce={})
+        server = self.server_with('reverse_proxy', task)
+        previous_handler, handler = self.reload(server, 'reverse_proxy', changed(task, send_to=('127.0.0.1', 4002)))
+        self.assertIsNot(handler.response_cache, previous_handler.response_cache)
+        self.assertIsNot(handler.single_flight, previous_handler.single_flight)
+
+    def test_backends_still_sent_to_keep_their_state(self):
+        server = self.server_with('load_balance', LOAD_BALANCE_TASK)
+        previous_handler, handler = self.reload(server, 'load_balance',
+                                                changed(LOAD_BALANCE_TASK, send_to=[('127.0.0.1', 4001), ('127.0.0.1', 4002)]))
+        previous_backends = {backend.address: backend for backend in previous_handler.backends.backends}
+        backends = {backend.address: backend for backend in handler.backends.backends}
+        self.assertIs(backends[('127.0.0.1', 4001)], previous_backends[('127.0.0.1', 4001)])
+        self.assertNotIn(('127.0.0.1', 4002), previous_backends)
+        self.assertNotIn(('127.0.0.1', 4000), backends)
+
+    def test_retired_handler_stops_its_health_checker(self):
+        task = changed(LOAD_BALANCE_TASK, health_checks={'interval': 60})
+        server = self.server_with('load_balance', task)
+        previous_handler, handler = self.reload(server, 'load_balance', changed(task, health_checks={'interval': 30}))
+        self.assertTrue(previous_handler.health_checker.stopped)
+        self.assertFalse(handler.health_checker.stopped)
+        _, handler_without_checks = self.reload(server, 'load_balance', LOAD_BALANCE_TASK)
+        self.assertTrue(handler.health_checker.stopped)
+        self.assertIsNone(handler_without_checks.health_checker)
+
+class HealthCheckerRetirementTest(unittest.TestCase):
+    """
+    the backends stop getting the probes of a health checker once a reload replaced its task, on every server type.
+    """
+    def test_probes_stop_after_a_reload(self):
+        for name, server_class in server_types().items():
+            with self.subTest(server=name):
+                backend = RecordingBackend(lambda request, number: response(b'fine'))
+                self.addCleanup(backend.close)
+                probed_task = changed(LOAD_BALANCE_TASK, send_to=[backend.address],
+                                      health_checks={'path': '/probe', 'interval': 0.05, 'timeout': 0.05})
+                server, _ = start_server(server_class, {'load_balance': probed_task})
+                probes = lambda: sum(1 for request_line, _ in backend.requests if request_line.startswith('GET /probe'))
+                deadline = time.monotonic() + 5
+                while probes() < 2 and time.monotonic() < deadline:
+                    time.sleep(0.02)
+                self.assertGreaterEqual(probes(), 2)
+
+                server.reload(settings_preparer(settings_analyzer(with_task('load_balance', changed(LOAD_BALANCE_TASK, send_to=[backend.address])))))
+                #a round that had already started when the checker was stopped still finishes
+                time.sleep(0.2)
+                probes_after_reload = probes()
+                time.sleep(0.3)
+                self.assertEqual(probes(), probes_after_reload)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import http.client
+import os
+import tempfile
+import time
+import unittest
+from typing import Callable, Dict, Tuple
+from tests.upstreams import RecordingBackend, response, start_server, server_types
+
+def request(port: int, path: str = '/', method: str = 'GET', body: bytes = None, **headers) -> Tuple[int, Dict[str, str], bytes]:
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request(method, path, body=body, headers={name.replace('_', '-'): value for name, value in headers.items()})
+    http_response = connection.getresponse()
+    result = http_response.status, {name.lower(): value for name, value in http_response.getheaders()}, http_response.read()
+    connection.close()
+    return result
+
+def wait_for(condition, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+def is_stored(cache, url: str, *vary_values) -> bool:
+    """
+    a response is stored once it has been relayed, which may be just after the client has it
+    """
+    with cache.lock:
+        return any(key[0][1] == url and tuple(value for _, value in key[1]) == vary_values for key in cache.entries)
+
+class ResponseCacheTest(unittest.TestCase):
+    """
+    the cache in front of a reverse_proxy task, on every server type: what it answers by itself, what it asks the
+    backend about and what it asks the backend for again.
+    """
+    def cached_proxy_to(self, server_class, backend: RecordingBackend, **cache_settings):
+        """
+        the port of a server proxying to backend with a cache, and the cache
+        """
+        tasks = {'reverse_proxy': {'match_criteria': {'url': ['/']}, 'context': {'send_to': backend.address, 'cache': cache_settings}}}
+        server, port = start_server(server_class, tasks)
+        return port, next(handler.response_cache for handler in server.request_handlers if getattr(handler, 'response_cache', None))
+
+    def for_each_server_type(self, test: Callable[[type], None]) -> None:
+        for name, server_class in server_types().items():
+            with self.subTest(server=name):
+                test(server_class)
+
+    def test_fresh_response_is_served_without_asking_the_backend(self):
+        def test(server_class):
+            backend = RecordingBackend(lambda request, number: response(b'response %d' % number, Cache_Control='max-age=60'))
+            self.addCleanup(backend.close)
+            port, cache = self.cached_proxy_to(server_class, backend)
+            first_status, first_headers, first_body = request(port, '/fresh')
+            self.assertEqual((first_status, first_body), (200, b'response 0'))
+            self.assertNotIn('age', first_headers)
+            self.assertTrue(wait_for(lambda: is_stored(cache, '/fresh')))
+            status, headers, body = request(port, '/fresh')
+            self.assertEqual((status, body), (200, b'response 0'))
+            self.assertIn('age', headers)
+            #a client that wants it checked gets it checked, there's nothing to revalidate with so it's fetched again
+            self.assertEqual(request(port, '/fresh', Cache_Control='no-cache')[2], b'response 1')
+            self.assertEqual(len(backend.requests), 2)
+        self.for_each_server_type(test)
+
+    def test_responses_are_kept_apart_by_the_headers_they_vary_on(self):
+        def test(server_class):
+            def respond(request, number):
+                language = request[1].get('accept-language', 'none')
+                return response(f'{language} {number}'.encode(), Cache_Control='max-age=60', Vary='Accept-Language')
+            backend = RecordingBackend(respond)
+            self.addCleanup(backend.close)
+            port, cache = self.cached_proxy_to(server_class, backend)
+            self.assertEqual(request(port, '/greeting', Accept_Language='en')[2], b'en 0')
+            self.assertTrue(wait_for(lambda: is_stored(cache, '/greeting', 'en')))
+            self.assertEqual(request(port, '/greeting', Accept_Language='fr')[2], b'fr 1')
+            self.assertTrue(wait_for(lambda: is_stored(cache, '/greeting', 'fr')))
+            self.assertEqual(request(port, '/greeting', Accept_Language='en')[2], b'en 0')
+            self.assertEqual(request(port, '/greeting', Accept_Language='fr')[2], b'fr 1')
+            self.assertEqual(len(backend.requests), 2)
+        self.for_each_server_type(test)
+
+    def test_stale_response_is_revalidated_and_a_304_refreshes_it(self):
+        def test(server_class):
+            def respond(request, number):
+                if request[1].get('if-none-match') == '"v1"':
+                    return response(b'', '304 Not Modified', ETag='"v1"', Cache_Control='max-age=0')
+                return response(b'version 1', ETag='"v1"', Cache_Control='max-age=0')
+            backend = RecordingBackend(respond)
+            self.addCleanup(backend.close)
+            port, cache = self.cached_proxy_to(server_class, backend)
+            self.assertEqual(request(port, '/document')[2], b'version 1')
+            self.assertTrue(wait_for(lambda: is_stored(cache, '/document')))
+            status, headers, body = request(port, '/document')
+            self.assertEqual((status, body, headers['etag']), (200, b'version 1', '"v1"'))
+            self.assertEqual(len(backend.requests), 2)
+            self.assertEqual(backend.requests[1][1].get('if-none-match'), '"v1"')
+            #the client's own conditional is answered by the cache from the refreshed response
+            self.assertEqual(request(port, '/document', If_None_Match='"v1"')[0], 304)
+        self.for_each_server_type(test)
+
+    def test_stale_response_is_sent_while_it_is_revalidated_in_the_background(self):
+        def test(server_class):
+            def respond(request, number):
+                return response(b'version %d' % number, ETag=f'"v{number}"', Cache_Control='max-age=0, stale-while-revalidate=60')
+            backend = RecordingBackend(respond)
+            self.addCleanup(backend.close)
+            port, cache = self.cached_proxy_to(server_class, backend)
+            self.assertEqual(request(port, '/document')[2], b'version 0')
+            self.assertTrue(wait_for(lambda: is_stored(cache, '/document')))
+            #stale already, but within stale-while-revalidate: the stored response goes out and the backend is asked after
+            self.assertEqual(request(port, '/document')[2], b'version 0')
+            self.assertTrue(wait_for(lambda: len(backend.requests) == 2))
+            self.assertEqual(backend.requests[1][1].get('if-none-match'), '"v0"')
+            self.assertTrue(wait_for(lambda: request(port, '/document')[2] == b'version 1'))
+        self.for_each_server_type(test)
+
+    def test_unsafe_method_invalidates_the_stored_response(self):
+        def test(server_class):
+            def respond(request, number):
+                if request[0].startswith('POST'):
+                    return response(b'posted')
+                return response(b'response %d' % number, Cache_Control='max-age=60')
+            backend = RecordingBackend(respond)
+            self.addCleanup(backend.close)
+            port, cache = self.cached_proxy_to(server_class, backend)
+            self.assertEqual(request(port, '/resource')[2], b'response 0')
+            self.assertTrue(wait_for(lambda: is_stored(cache, '/resource')))
+            self.assertEqual(request(port, '/resource')[2], b'response 0')
+            self.assertEqual(request(port, '/resource', 'POST', b'new content')[2], b'posted')
+            self.assertEqual(request(port, '/resource')[2], b'response 2')
+            self.assertEqual([request_line.split()[0] for request_line, _ in backend.requests], ['GET', 'POST', 'GET'])
+        self.for_each_server_type(test)
+
+    def test_entries_pushed_out_of_memory_are_served_from_the_disk_tier(self):
+        def test(server_class):
+            body = b'x' * 2000
+            backend = RecordingBackend(lambda request, number: response(body, Cache_Control='max-age=60'))
+            self.addCleanup(backend.close)
+            disk_directory = tempfile.mkdtemp()
+            #room for one of the responses in memory, not two
+            port, cache = self.cached_proxy_to(server_class, backend, max_bytes=3000, disk_directory=disk_directory)
+            self.assertEqual(request(port, '/first')[2], body)
+            self.assertTrue(wait_for(lambda: is_stored(cache, '/first')))
+            self.assertEqual(request(port, '/second')[2], body)
+            disk_tiers = [os.path.join(disk_directory, name) for name in os.listdir(disk_directory)]
+            self.assertEqual(len(disk_tiers), 1)
+            self.assertTrue(wait_for(lambda: len(os.listdir(disk_tiers[0])) == 1))
+            self.assertFalse(is_stored(cache, '/first'))
+            #back from disk, which pushes /second out to it
+            self.assertEqual(request(port, '/first')[2], body)
+            self.assertEqual(request(port, '/second')[2], body)
+            self.assertEqual(len(backend.requests), 2)
+        self.for_each_server_type(test)
+
+if __name__ == '__main__':
+    unittest.main()
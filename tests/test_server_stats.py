@@ -0,0 +1,30 @@
+import threading
+import unittest
+from server.base_server import ServerStats
+
+class ServerStatsTest(unittest.TestCase):
+    def test_counts_from_every_thread_add_up(self):
+        stats = ServerStats()
+        for _ in range(10):
+            stats.connection_accepted()
+        def serve_and_close():
+            for _ in range(100):
+                stats.request_handled()
+            stats.connection_closed()
+        threads = [threading.Thread(target=serve_and_close) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stats.snapshot(), {'connections_accepted': 10, 'active_connections': 6, 'requests_handled': 400})
+
+    def test_connection_limit_sees_connections_closed_by_other_threads(self):
+        stats = ServerStats()
+        for _ in range(3):
+            stats.connection_accepted()
+        self.assertTrue(stats.active_connections_at_least(3))
+        closing_thread = threading.Thread(target=stats.connection_closed)
+        closing_thread.start()
+        closing_thread.join()
+        self.assertFalse(stats.active_connections_at_least(3))
+        self.assertTrue(stats.active_connections_at_least(2))
@@ -0,0 +1,69 @@
+import concurrent.futures
+import time
+import unittest
+from tests.upstreams import RecordingBackend, response, start_server, get, server_types
+
+CLIENTS = 5
+
+def slowly(seconds: float, *args, **headers):
+    """
+    a backend response that takes seconds to come, long enough for all the clients' requests to be in flight at once
+    """
+    def respond(request, number):
+        time.sleep(seconds)
+        return response(*args, **headers)
+    return respond
+
+class SingleFlightTest(unittest.TestCase):
+    """
+    identical GETs in flight at the same time reach the backend once, on every server type, unless the response can't
+    be shared or doesn't come in time: then every client gets a response of its own.
+    """
+    def coalescing_proxy_to(self, server_class, backend: RecordingBackend, **coalesce_settings) -> int:
+        tasks = {'reverse_proxy': {'match_criteria': {'url': ['/']}, 'context': {'send_to': backend.address, 'coalesce': coalesce_settings}}}
+        _, port = start_server(server_class, tasks)
+        return port
+
+    def get_all_at_once(self, port: int, path: str = '/popular') -> list:
+        with concurrent.futures.ThreadPoolExecutor(CLIENTS) as executor:
+            return list(executor.map(lambda _: get(port, path), range(CLIENTS)))
+
+    def assert_backend_requests(self, respond, expected_requests: int, **coalesce_settings) -> None:
+        for name, server_class in server_types().items():
+            with self.subTest(server=name):
+                backend = RecordingBackend(respond)
+                self.addCleanup(backend.close)
+                port = self.coalescing_proxy_to(server_class, backend, **coalesce_settings)
+                responses = self.get_all_at_once(port)
+                self.assertEqual([status for status, _ in responses], [200] * CLIENTS)
+                self.assertEqual(len({body for _, body in responses}), 1)
+                self.assertEqual(len(backend.requests), expected_requests)
+
+    def test_identical_requests_reach_the_backend_once(self):
+        self.assert_backend_requests(slowly(0.3, b'shared'), 1)
+
+    def test_different_urls_are_not_coalesced(self):
+        for name, server_class in server_types().items():
+            with self.subTest(server=name):
+                backend = RecordingBackend(slowly(0.2, b'response'))
+                self.addCleanup(backend.close)
+                port = self.coalescing_proxy_to(server_class, backend)
+                with concurrent.futures.ThreadPoolExecutor(CLIENTS) as executor:
+                    responses = list(executor.map(lambda number: get(port, f'/page/{number}'), range(CLIENTS)))
+                self.assertEqual([status for status, _ in responses], [200] * CLIENTS)
+                self.assertEqual(len(backend.requests), CLIENTS)
+
+    def test_response_setting_a_cookie_is_not_shared(self):
+        self.assert_backend_requests(slowly(0.3, b'personal', Set_Cookie='session=1'), CLIENTS)
+
+    def test_no_store_response_is_not_shared(self):
+        self.assert_backend_requests(slowly(0.3, b'personal', Cache_Control='no-store'), CLIENTS)
+
+    def test_response_bigger_than_max_response_bytes_is_not_shared(self):
+        self.assert_backend_requests(slowly(0.3, b'x' * 1000), CLIENTS, max_response_bytes=100)
+
+    def test_followers_send_their_own_request_after_wait_timeout(self):
+        self.assert_backend_requests(slowly(0.3, b'late'), CLIENTS, wait_timeout=0.05)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import http.client
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from handlers.http_handlers import COMPRESSORS, StaticAssetHandler
+from tests.upstreams import start_server, server_types
+
+STYLESHEET = b''.join(b'.rule-%d { color: #%06x; margin: %dpx; }\n' % (number, number * 7919, number % 40) for number in range(2000))
+
+def slow_gzip(data: bytes) -> bytes:
+    #so the request is sure to come before the variants are ready
+    time.sleep(0.2)
+    return COMPRESSORS['gzip'](data)
+
+def get_gzipped(port: int, path: str):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+    response = connection.getresponse()
+    return response.status, response.getheader('Content-Encoding'), response.read()
+
+def wait_for(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+class StaticCompressionTest(unittest.TestCase):
+    """
+    the best (slow) compression levels are only used outside the request path, by the time a request comes the
+    variant is already there.
+    """
+    def setUp(self):
+        self.static_root = tempfile.mkdtemp()
+        self.stylesheet_path = os.path.join(self.static_root, 'site.css')
+        with open(self.stylesheet_path, 'wb') as stylesheet:
+            stylesheet.write(STYLESHEET)
+        tasks = {'serve_static': {'match_criteria': {'url': ['/static/']}, 'context': {'staticRoot': self.static_root + '/'}}}
+        self.server, self.port = start_server(server_types()['PurelySync'], tasks)
+        self.handler = next(handler for handler in self.server.request_handlers if isinstance(handler, StaticAssetHandler))
+
+    def test_variants_are_compressed_when_the_server_starts(self):
+        self.assertTrue(wait_for(lambda: self.handler.precompressed.get(self.stylesheet_path, os.stat(self.stylesheet_path))))
+        status, encoding, body = get_gzipped(self.port, '/static/site.css')
+        self.assertEqual((status, encoding), (200, 'gzip'))
+        self.assertEqual(body, COMPRESSORS['gzip'](STYLESHEET))
+
+    def test_changed_file_is_sent_uncompressed_until_its_variants_are_ready(self):
+        self.assertTrue(wait_for(lambda: self.handler.precompressed.get(self.stylesheet_path, os.stat(self.stylesheet_path))))
+        #the change is noticed on the next request instead of up to a second later
+        self.handler.open_files.stat_ttl = self.handler.asset_cache.stat_ttl = 0
+        changed_stylesheet = STYLESHEET + b'.changed { color: red; }\n'
+        with open(self.stylesheet_path, 'wb') as stylesheet:
+            stylesheet.write(changed_stylesheet)
+
+        with mock.patch.dict(self.handler.precompressed.compressors, {'gzip': slow_gzip}):
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+            connection.request('GET', '/static/site.css', headers={'Accept-Encoding': 'gzip'})
+            response = connection.getresponse()
+            self.assertEqual((response.status, response.getheader('Content-Encoding')), (200, None))
+            self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+            self.assertEqual(response.read(), changed_stylesheet)
+        self.assertTrue(wait_for(lambda: get_gzipped(self.port, '/static/site.css')[2] == COMPRESSORS['gzip'](changed_stylesheet)))
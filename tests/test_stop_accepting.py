@@ -0,0 +1,46 @@
+import socket
+import threading
+import time
+import unittest
+from utils.general_utils import settings_analyzer, settings_preparer
+from tests.upstreams import server_types
+
+class StopAcceptingInheritedSocketTest(unittest.TestCase):
+    """
+    a pre-fork worker accepts from a socket it shares with the other workers, so stopping it can't shut that socket
+    down. Its accepting thread must still stop, without taking a connection that another worker should answer.
+    """
+    def test_worker_stops_accepting_from_shared_socket(self):
+        for server_name in ('ThreadPerClient', 'ThreadPerRequest'):
+            with self.subTest(server=server_name):
+                shared_socket = socket.socket()
+                shared_socket.bind(('127.0.0.1', 0))
+                shared_socket.listen(16)
+                #what the other workers accept from, it stays open after this worker closes its copy
+                other_worker_socket = shared_socket.dup()
+                self.addCleanup(other_worker_socket.close)
+                port = shared_socket.getsockname()[1]
+
+                settings = settings_preparer(settings_analyzer({'tasks': {'health_check': {'match_criteria': {}, 'context': {}}}}))
+                server = server_types()[server_name](settings, host='127.0.0.1', port=port)
+                server.inherited_master_socket = shared_socket
+                server_thread = threading.Thread(target=server.start_loop, daemon=True)
+                server_thread.start()
+                time.sleep(0.1)
+
+                server.stop_accepting()
+                if server_name == 'ThreadPerClient':
+                    server_thread.join(timeout=2)
+                    self.assertFalse(server_thread.is_alive())
+                else:
+                    #its main thread keeps serving the clients it has, it only lets go of the socket
+                    deadline = time.monotonic() + 2
+                    while server.master_socket.fileno() != -1 and time.monotonic() < deadline:
+                        time.sleep(0.02)
+
+                client = socket.create_connection(('127.0.0.1', port), timeout=2)
+                self.addCleanup(client.close)
+                other_worker_socket.settimeout(2)
+                accepted_client, _ = other_worker_socket.accept()
+                accepted_client.close()
+                self.assertEqual(server.stats.get('connections_accepted'), 0)
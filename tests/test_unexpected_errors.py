@@ -0,0 +1,40 @@
+import http.client
+import logging
+import threading
+import time
+import unittest
+from utils.general_utils import settings_analyzer, settings_preparer
+from tests.upstreams import free_port, get, server_types
+
+class UnexpectedErrorTest(unittest.TestCase):
+    """
+    an error no one planned for (a bug in a handler here) drops the client it happened on, and only that client: the
+    connection is closed and stops counting against max_connections, and the thread keeps serving.
+    """
+    def test_client_is_dropped_and_the_server_keeps_serving(self):
+        for server_name in ('ThreadPerClient', 'ThreadPerRequest'):
+            with self.subTest(server=server_name):
+                settings = settings_preparer(settings_analyzer({'tasks': {'health_check': {'match_criteria': {}, 'context': {}}},
+                                                                'worker_pool': {'threads': 1}}))
+                server = server_types()[server_name](settings, host='127.0.0.1', port=free_port())
+                handle_client_request = server.handle_client_request
+                def fail_on_boom(http_request):
+                    if http_request.requested_url == '/boom':
+                        raise RuntimeError('a bug in a handler')
+                    return handle_client_request(http_request)
+                server.handle_client_request = fail_on_boom
+                threading.Thread(target=server.start_loop, daemon=True).start()
+                time.sleep(0.1)
+
+                logging.disable(logging.ERROR)
+                try:
+                    for _ in range(3):
+                        with self.assertRaises((http.client.RemoteDisconnected, ConnectionResetError)):
+                            get(server.port, '/boom')
+                finally:
+                    logging.disable(logging.NOTSET)
+                self.assertEqual(get(server.port, '/health/')[0], 200)
+                deadline = time.monotonic() + 2
+                while server.stats.get('active_connections') > 0 and time.monotonic() < deadline:
+                    time.sleep(0.02)
+                self.assertEqual(server.stats.get('active_connections'), 0)
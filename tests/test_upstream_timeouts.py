@@ -0,0 +1,40 @@
+import http.client
+import time
+import unittest
+from server.purely_sync_server import PurelySync
+from tests.upstreams import FakeBackend, start_server, get, read_request, never_answer
+
+class PurelySyncUpstreamTimeoutTests(unittest.TestCase):
+    """
+    A backend that doesn't answer gets the connection pool's connect_timeout on PurelySync too, like on the other
+    server types, and counts as an upstream error.
+    """
+    def test_backend_that_never_answers_gets_a_502_after_connect_timeout(self):
+        backend = FakeBackend(never_answer)
+        server, port = start_server(PurelySync, {'reverse_proxy': {'match_criteria': {'url': ['/']}, 'context': {'send_to': backend.address}}},
+                                    connect_timeout=0.3)
+        start = time.monotonic()
+        status, _ = get(port, '/')
+        self.assertEqual(status, 502)
+        self.assertLess(time.monotonic() - start, 2)
+        upstream_errors = [value for (metric_name, labels), value in server.metrics.snapshot().counters.items()
+                           if metric_name == 'pyrver_upstream_errors_total']
+        self.assertEqual(upstream_errors, [1])
+        backend.close()
+
+    def test_backend_that_stops_in_the_middle_of_the_body_is_cut_off(self):
+        def send_half_a_body(connection, connection_number):
+            read_request(connection)
+            connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nhalf')
+
+        backend = FakeBackend(send_half_a_body)
+        _, port = start_server(PurelySync, {'reverse_proxy': {'match_criteria': {'url': ['/']}, 'context': {'send_to': backend.address}}},
+                               connect_timeout=0.3)
+        start = time.monotonic()
+        with self.assertRaises(http.client.IncompleteRead):
+            get(port, '/')
+        self.assertLess(time.monotonic() - start, 2)
+        backend.close()
+
+if __name__ == '__main__':
+    unittest.main()
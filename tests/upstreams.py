@@ -0,0 +1,155 @@
+"""
+What the tests need to run a server against backends that misbehave: a backend that does whatever a test tells it
+to with every connection, and a server of any type running in a thread on a free port.
+"""
+import http.client
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+from utils.general_utils import settings_analyzer, settings_preparer
+
+def free_port() -> int:
+    with socket.socket() as probe_socket:
+        probe_socket.bind(('127.0.0.1', 0))
+        return probe_socket.getsockname()[1]
+
+class FakeBackend:
+    """
+    Accepts connections and hands each one to behavior (in a thread of its own) along with how many connections came
+    before it. Connections the behavior doesn't close are kept open until the backend is closed.
+    """
+    def __init__(self, behavior: Callable[[socket.socket, int], None]):
+        self.behavior = behavior
+        self.connections: List[socket.socket] = []
+        self.listening_socket = socket.socket()
+        self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listening_socket.bind(('127.0.0.1', 0))
+        self.listening_socket.listen(128)
+        self.address = self.listening_socket.getsockname()
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+
+    def accept_forever(self) -> None:
+        while True:
+            try:
+                connection, _ = self.listening_socket.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+            threading.Thread(target=self.behavior, args=(connection, len(self.connections) - 1), daemon=True).start()
+
+    @property
+    def connection_count(self) -> int:
+        return len(self.connections)
+
+    def close(self) -> None:
+        self.listening_socket.close()
+        for connection in self.connections:
+            connection.close()
+
+def read_request(connection: socket.socket) -> bytes:
+    data = b''
+    while b'\r\n\r\n' not in data:
+        received = connection.recv(1024 * 16)
+        if not received:
+            return b''
+        data += received
+    return data
+
+def answer(connection: socket.socket, body: bytes = b'ok') -> None:
+    connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+
+def close_right_away(connection: socket.socket, connection_number: int) -> None:
+    connection.close()
+
+def never_answer(connection: socket.socket, connection_number: int) -> None:
+    read_request(connection)
+
+def answer_forever(connection: socket.socket, connection_number: int) -> None:
+    while read_request(connection):
+        answer(connection, b'backend %d' % connection.getsockname()[1])
+    connection.close()
+
+#what the backend saw: the request line and the headers (names lowercased)
+ReceivedRequest = Tuple[str, Dict[str, str]]
+
+def read_whole_request(connection: socket.socket) -> Optional[ReceivedRequest]:
+    data = b''
+    while b'\r\n\r\n' not in data:
+        received = connection.recv(1024 * 16)
+        if not received:
+            return None
+        data += received
+    head, _, body = data.partition(b'\r\n\r\n')
+    request_line, *lines = head.decode('latin-1').split('\r\n')
+    headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in lines)}
+    content_length = int(headers.get('content-length', 0))
+    while len(body) < content_length:
+        received = connection.recv(1024 * 16)
+        if not received:
+            return None
+        body += received
+    return request_line, headers
+
+def response(body: bytes, status: str = '200 OK', **headers) -> bytes:
+    """
+    response(b'hi', Cache_Control='max-age=60') -> a response with a "Cache-Control: max-age=60" header
+    """
+    head = [f'HTTP/1.1 {status}', f'Content-Length: {len(body)}'] + [f"{name.replace('_', '-')}: {value}" for name, value in headers.items()]
+    return '\r\n'.join(head).encode('latin-1') + b'\r\n\r\n' + body
+
+class RecordingBackend(FakeBackend):
+    """
+    A backend that answers every request with what respond makes of it (and of the requests before it) and keeps the
+    requests it got, so a test can tell which requests never made it past the server.
+    """
+    def __init__(self, respond: Callable[[ReceivedRequest, int], bytes]):
+        self.respond = respond
+        self.requests: List[ReceivedRequest] = []
+        self.requests_lock = threading.Lock()
+        super().__init__(self.answer_requests)
+
+    def answer_requests(self, connection: socket.socket, connection_number: int) -> None:
+        while True:
+            try:
+                request = read_whole_request(connection)
+                if request is None:
+                    connection.close()
+                    return
+                with self.requests_lock:
+                    self.requests.append(request)
+                    request_number = len(self.requests) - 1
+                connection.sendall(self.respond(request, request_number))
+            except OSError:
+                #closed by the test when it's done with the backend
+                return
+
+def start_server(server_class, tasks: Dict, connect_timeout: float = 2.0, **pool_settings):
+    """
+    the server and its port, the server runs until the test process exits.
+    """
+    connection_pool_settings = {'connect_timeout': connect_timeout, **pool_settings}
+    settings = settings_preparer(settings_analyzer({'tasks': tasks, 'connection_pool': connection_pool_settings}))
+    server = server_class(settings, host='127.0.0.1', port=free_port())
+    threading.Thread(target=server.start_loop, daemon=True).start()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', server.port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.02)
+    return server, server.port
+
+def get(port: int, path: str, connection: http.client.HTTPConnection = None) -> Tuple[int, bytes]:
+    connection = connection or http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+def server_types() -> Dict[str, type]:
+    from server.thread_per_client_server import ThreadPerClient
+    from server.thread_per_request_server import ThreadPerRequest
+    from server.purely_sync_server import PurelySync
+    from server.asyncio_server import AsyncioServer
+    return {'ThreadPerClient': ThreadPerClient, 'ThreadPerRequest': ThreadPerRequest, 'PurelySync': PurelySync, 'AsyncioServer': AsyncioServer}
@@ -0,0 +1,320 @@
+import asyncio
+import errno
+import os
+import select
+import socket
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Deque, Iterable, Tuple, Generator, Optional
+from event_loop.event_loop import EventLoop, ResourceTask, TimedTask, FutureTask
+
+Address = Tuple[str, int]
+#what getaddrinfo found for an address: the socket family and the address to connect to
+ResolvedAddress = Tuple[socket.AddressFamily, Any]
+
+class UpstreamConnection:
+    """
+    A connection to a backend server that can be used for more than one request.
+    """
+    def __init__(self, address: Address, upstream_socket: socket.socket):
+        self.address = address
+        self.socket = upstream_socket
+        self.last_used = time.monotonic()
+        self.requests_sent = 0
+
+    @property
+    def reused(self) -> bool:
+        return self.requests_sent > 0
+
+    def close(self) -> None:
+        self.socket.close()
+
+    def __repr__(self) -> str:
+        return f'UpstreamConnection({self.address}, requests_sent={self.requests_sent})'
+
+class ConnectionPool:
+    """
+    Keeps persistent connections to backends around so that proxying a request doesn't need a new tcp handshake
+    (and a new ephemeral port) every time. Connections are kept per backend address and limited by:
+
+    max_idle_per_host: how many unused connections are kept open to one backend.
+    max_per_host: how many connections (in use + idle) one backend can have. Anyone asking for a connection
+    past that waits for one to be released.
+    idle_timeout: connections that weren't used for this long are closed instead of being reused, backends
+    usually close idle keep-alive connections on their own after a while anyway.
+
+    This version is for the servers that use threads, the PurelySync server uses AsyncConnectionPool.
+    """
+    def __init__(self, max_idle_per_host: int = 16, max_per_host: int = 128, idle_timeout: float = 30.0, connect_timeout: float = 15.0):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.idle_connections: Dict[Address, Deque[UpstreamConnection]] = {}
+        self.connections_in_use: Dict[Address, int] = {}
+        self.condition = threading.Condition()
+
+    def is_usable(self, connection: UpstreamConnection) -> bool:
+        """
+        A connection that has been sitting in the pool may have been closed by the backend in the meantime. An idle
+        connection should have nothing to read, so if polling it (without waiting) says it's readable then either the
+        backend closed it or sent something we didn't ask for, and it can't be used.
+        A recv with MSG_PEEK isn't used because on a socket with a timeout python waits for it to be readable first.
+        """
+        if time.monotonic() - connection.last_used > self.idle_timeout:
+            return False
+        try:
+            poller = select.poll()
+            poller.register(connection.socket.fileno(), select.POLLIN | select.POLLPRI)
+            return not poller.poll(0)
+        except (OSError, ValueError):
+            return False
+
+    def take_idle_connection(self, address: Address) -> Optional[UpstreamConnection]:
+        """
+        must be called while holding the condition's lock. Returns None if there is no usable idle connection.
+        The most recently used connection is handed out first since it's the least likely to have been closed.
+        """
+        idle_connections = self.idle_connections.get(address)
+        while idle_connections:
+            connection = idle_connections.pop()
+            if self.is_usable(connection):
+                return connection
+            connection.close()
+        return None
+
+    def total_connections(self, address: Address) -> int:
+        return self.connections_in_use.get(address, 0) + len(self.idle_connections.get(address, ()))
+
+    def acquire(self, address: Address) -> UpstreamConnection:
+        deadline = time.monotonic() + self.connect_timeout
+        with self.condition:
+            while True:
+                connection = self.take_idle_connection(address)
+                if connection is not None:
+                    self.connections_in_use[address] = self.connections_in_use.get(address, 0) + 1
+                    return connection
+                if self.total_connections(address) < self.max_per_host:
+                    #reserve the slot before connecting outside of the lock
+                    self.connections_in_use[address] = self.connections_in_use.get(address, 0) + 1
+                    break
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    raise socket.timeout(f"timed out waiting for a free connection to {address}")
+                self.condition.wait(remaining_time)
+
+        try:
+            upstream_socket = socket.create_connection(address, timeout=self.connect_timeout)
+        except OSError:
+            self.release_slot(address)
+            raise
+        upstream_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return UpstreamConnection(address, upstream_socket)
+
+    def release(self, connection: UpstreamConnection, reusable: bool) -> None:
+        """
+        Gives a connection back. It is only kept if the response on it was read completely and the backend
+        didn't ask to close it, otherwise the next request on it would read garbage.
+        """
+        connection.requests_sent += 1
+        connection.last_used = time.monotonic()
+        with self.condition:
+            idle_connections = self.idle_connections.setdefault(connection.address, deque())
+            if reusable and len(idle_connections) < self.max_idle_per_host:
+                idle_connections.append(connection)
+            else:
+                connection.close()
+            self.release_slot(connection.address)
+
+    def release_slot(self, address: Address) -> None:
+        with self.condition:
+            self.connections_in_use[address] -= 1
+            self.condition.notify()
+
+    def resolve_ahead(self, addresses: Iterable[Address]) -> None:
+        """
+        Called by the proxying handlers when they're created, with the backends they send to. The threaded servers
+        connect with blocking sockets, they look the host up when they connect.
+        """
+        pass
+
+    def close(self) -> None:
+        with self.condition:
+            for idle_connections in self.idle_connections.values():
+                while idle_connections:
+                    idle_connections.pop().close()
+
+def resolve(address: Address) -> ResolvedAddress:
+    family, _, _, _, socket_address = socket.getaddrinfo(address[0], address[1], type=socket.SOCK_STREAM)[0]
+    return family, socket_address
+
+class AsyncConnectionPool(ConnectionPool):
+    """
+    The same pool for coroutines running on the EventLoop. Everything runs on the event loop's thread so the
+    condition's lock is never contended, and waiting (to connect or for a free connection) is done by yielding tasks.
+    Connecting is limited by connect_timeout like for the blocking sockets of the threaded servers.
+
+    At max_per_host the coroutines wait for a FutureTask each, in the order they came. Releasing a connection wakes
+    the first of them up.
+
+    Looking a host up blocks, so it's done by resolve_ahead, outside of the event loop: when the server starts and
+    when a reload creates new handlers (which also picks up a backend whose address changed). Only an address nobody
+    resolved ahead is looked up on the event loop.
+    """
+    def __init__(self, event_loop: EventLoop, **pool_settings):
+        super().__init__(**pool_settings)
+        self.event_loop = event_loop
+        self.waiters: Dict[Address, Deque[FutureTask]] = {}
+        self.resolved_addresses: Dict[Address, ResolvedAddress] = {}
+
+    def resolve_ahead(self, addresses: Iterable[Address]) -> None:
+        for address in addresses:
+            address = (address[0], int(address[1]))
+            try:
+                self.resolved_addresses[address] = resolve(address)
+            except OSError:
+                #the backend may only be up later, connecting to it will try again
+                pass
+
+    def resolved_address(self, address: Address) -> ResolvedAddress:
+        resolved_address = self.resolved_addresses.get(address)
+        if resolved_address is None:
+            resolved_address = self.resolved_addresses[address] = resolve(address)
+        return resolved_address
+
+    def acquire(self, address: Address) -> Generator:
+        deadline = time.monotonic() + self.connect_timeout
+        woken_up = False
+        while True:
+            connection = self.take_idle_connection(address)
+            if connection is not None:
+                self.connections_in_use[address] = self.connections_in_use.get(address, 0) + 1
+                return connection
+            if self.total_connections(address) < self.max_per_host:
+                break
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                raise socket.timeout(f"timed out waiting for a free connection to {address}")
+            free_connection = FutureTask(self.event_loop)
+            waiters = self.waiters.setdefault(address, deque())
+            #a coroutine that was woken up but beaten to the connection keeps its place in the line
+            if woken_up:
+                waiters.appendleft(free_connection)
+            else:
+                waiters.append(free_connection)
+            self.event_loop.run_coroutine(self.stop_waiting, address, free_connection, remaining_time)
+            yield free_connection
+            woken_up = free_connection.result
+
+        self.connections_in_use[address] = self.connections_in_use.get(address, 0) + 1
+        try:
+            family, socket_address = self.resolved_address(address)
+            upstream_socket = socket.socket(family, socket.SOCK_STREAM)
+        except BaseException:
+            self.release_slot(address)
+            raise
+        upstream_socket.setblocking(False)
+        try:
+            error_code = upstream_socket.connect_ex(socket_address)
+            if error_code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                yield ResourceTask(upstream_socket, 'writable', self.connect_timeout)
+                error_code = upstream_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error_code:
+                #OSError picks the matching subclass (ConnectionRefusedError for example) from the error code
+                raise OSError(error_code, os.strerror(error_code))
+        except BaseException:
+            upstream_socket.close()
+            self.release_slot(address)
+            raise
+        upstream_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return UpstreamConnection(address, upstream_socket)
+
+    def stop_waiting(self, address: Address, free_connection: FutureTask, timeout: float) -> Generator:
+        """
+        a coroutine still waiting for a free connection after timeout is woken up without one, acquire then raises.
+        """
+        yield TimedTask(timeout)
+        if not free_connection.done:
+            self.waiters[address].remove(free_connection)
+            free_connection.set_result(False)
+
+    def release_slot(self, address: Address) -> None:
+        super().release_slot(address)
+        self.wake_up_waiter(address)
+
+    def wake_up_waiter(self, address: Address) -> None:
+        waiters = self.waiters.get(address)
+        if waiters:
+            waiters.popleft().set_result(True)
+
+class AsyncioConnectionPool(ConnectionPool):
+    """
+    The same pool for the AsyncioServer, acquire is a coroutine for asyncio's event loop. The sockets are non blocking
+    so they can be used with the event loop's sock_* methods. At max_per_host the coroutines wait for a future each,
+    in the order they came, and releasing a connection wakes the first of them up. Hosts are looked up with the event
+    loop's getaddrinfo, which doesn't block it.
+    """
+    def __init__(self, **pool_settings):
+        super().__init__(**pool_settings)
+        self.waiters: Dict[Address, Deque[asyncio.Future]] = {}
+
+    async def acquire(self, address: Address) -> UpstreamConnection:
+        deadline = time.monotonic() + self.connect_timeout
+        event_loop = asyncio.get_running_loop()
+        woken_up = False
+        while True:
+            connection = self.take_idle_connection(address)
+            if connection is not None:
+                self.connections_in_use[address] = self.connections_in_use.get(address, 0) + 1
+                return connection
+            if self.total_connections(address) < self.max_per_host:
+                break
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                raise socket.timeout(f"timed out waiting for a free connection to {address}")
+            free_connection = event_loop.create_future()
+            waiters = self.waiters.setdefault(address, deque())
+            #a coroutine that was woken up but beaten to the connection keeps its place in the line
+            if woken_up:
+                waiters.appendleft(free_connection)
+            else:
+                waiters.append(free_connection)
+            try:
+                await asyncio.wait_for(asyncio.shield(free_connection), remaining_time)
+            except asyncio.TimeoutError:
+                if not free_connection.done():
+                    waiters.remove(free_connection)
+                    raise socket.timeout(f"timed out waiting for a free connection to {address}")
+            except BaseException:
+                #cancelled: a connection released for this coroutine goes to the next one in line
+                if free_connection.done():
+                    self.wake_up_waiter(address)
+                else:
+                    waiters.remove(free_connection)
+                raise
+            woken_up = True
+
+        self.connections_in_use[address] = self.connections_in_use.get(address, 0) + 1
+        upstream_socket = None
+        try:
+            family, _, _, _, socket_address = (await event_loop.getaddrinfo(address[0], address[1], type=socket.SOCK_STREAM))[0]
+            upstream_socket = socket.socket(family, socket.SOCK_STREAM)
+            upstream_socket.setblocking(False)
+            await asyncio.wait_for(event_loop.sock_connect(upstream_socket, socket_address), self.connect_timeout)
+        except BaseException:
+            if upstream_socket is not None:
+                upstream_socket.close()
+            self.release_slot(address)
+            raise
+        upstream_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return UpstreamConnection(address, upstream_socket)
+
+    def release_slot(self, address: Address) -> None:
+        super().release_slot(address)
+        self.wake_up_waiter(address)
+
+    def wake_up_waiter(self, address: Address) -> None:
+        waiters = self.waiters.get(address)
+        if waiters:
+            waiters.popleft().set_result(True)
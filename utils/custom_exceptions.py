@@ -8,4 +8,25 @@ class NotValidHttpFormat(Exception):
     """
     This exception is thrown when a client sends over bytes that
     don't follow the http spec.
-    """
\ No newline at end of file
+    """
+
+class HpackError(Exception):
+    """
+    This exception is thrown when an http/2 header block can't be decoded. The compression state of the connection
+    is lost then, so the whole connection has to be closed.
+    """
+
+class Http2ConnectionError(Exception):
+    """
+    This exception is thrown when an http/2 client breaks the protocol in a way that ends the whole connection,
+    the error code is sent to the client in a GOAWAY frame before the connection is closed.
+    """
+    def __init__(self, error_code: int, message: str):
+        super().__init__(message)
+        self.error_code = error_code
+
+class MalformedSettings(Exception):
+    """
+    This exception is thrown by settings_analyzer when the settings can't work (an unknown task, a load_balance
+    task without backends, weights that don't add up to 1...). The message lists everything that is wrong.
+    """
@@ -0,0 +1,268 @@
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Callable, List, Set, Tuple
+
+
+class CachedFile:
+    """
+    An open file descriptor along with the result of fstat on it. Responses that are in the middle of sending
+    the file hold a reference to it, so the descriptor is only closed once it has been evicted from the cache
+    AND nobody is sending from it anymore.
+    """
+    def __init__(self, path: str, file_descriptor: int, stat_result: os.stat_result):
+        self.path = path
+        self.file_descriptor = file_descriptor
+        self.stat_result = stat_result
+        self.size = stat_result.st_size
+        self.last_validated = time.monotonic()
+        self.references = 0
+        self.evicted = False
+
+    def release(self) -> None:
+        """
+        called by whoever acquired the file from the cache once they are done sending it.
+        """
+        with OpenFileCache.LOCK:
+            self.references -= 1
+            should_close = self.evicted and self.references == 0
+        if should_close:
+            os.close(self.file_descriptor)
+
+    def __repr__(self) -> str:
+        return f'CachedFile({self.path}, fd={self.file_descriptor}, size={self.size})'
+
+class OpenFileCache:
+    """
+    A bounded LRU cache of open file descriptors. Opening and fstat-ing a file on every request is a couple
+    of syscalls that don't need to happen for files that are requested over and over again, and since
+    the descriptor is only used with os.sendfile (which takes an explicit offset) many requests can
+    share the same descriptor at the same time.
+
+    A cached entry is re-validated against the file on disk once it is older than stat_ttl seconds so that
+    a file replaced on disk is eventually picked up.
+    """
+    #the lock is shared by every cache because a CachedFile can outlive the cache that evicted it
+    LOCK = threading.Lock()
+
+    def __init__(self, max_open_files: int = 1024, stat_ttl: float = 1.0):
+        self.max_open_files = max_open_files
+        self.stat_ttl = stat_ttl
+        self.open_files: 'OrderedDict[str, CachedFile]' = OrderedDict()
+
+    def acquire(self, path: str) -> Optional[CachedFile]:
+        """
+        Returns the cached file for the path with its reference count incremented or None if the path
+        isn't a regular file. The caller has to call release on the returned file when it is done with it.
+        """
+        with self.LOCK:
+            cached_file = self.open_files.get(path)
+            if cached_file is not None:
+                if time.monotonic() - cached_file.last_validated < self.stat_ttl:
+                    self.open_files.move_to_end(path)
+                    cached_file.references += 1
+                    return cached_file
+
+        if cached_file is not None and self.is_still_valid(cached_file):
+            with self.LOCK:
+                cached_file.last_validated = time.monotonic()
+                if not cached_file.evicted:
+                    self.open_files.move_to_end(path)
+                    cached_file.references += 1
+                    return cached_file
+
+        new_file = self.open(path)
+        if new_file is None:
+            return None
+        with self.LOCK:
+            previous_file = self.open_files.pop(path, None)
+            if previous_file is not None:
+                self.evict(previous_file)
+            self.open_files[path] = new_file
+            new_file.references += 1
+            while len(self.open_files) > self.max_open_files:
+                _, least_recently_used = self.open_files.popitem(last=False)
+                self.evict(least_recently_used)
+        return new_file
+
+    def is_still_valid(self, cached_file: CachedFile) -> bool:
+        try:
+            current_stat = os.stat(cached_file.path)
+        except OSError:
+            return False
+        cached_stat = cached_file.stat_result
+        return (current_stat.st_ino == cached_stat.st_ino and current_stat.st_mtime_ns == cached_stat.st_mtime_ns
+                and current_stat.st_size == cached_stat.st_size)
+
+    def open(self, path: str) -> Optional[CachedFile]:
+        try:
+            file_descriptor = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        stat_result = os.fstat(file_descriptor)
+        if not stat.S_ISREG(stat_result.st_mode):
+            os.close(file_descriptor)
+            return None
+        return CachedFile(path, file_descriptor, stat_result)
+
+    def evict(self, cached_file: CachedFile) -> None:
+        """
+        must be called while holding the lock.
+        """
+        cached_file.evicted = True
+        if cached_file.references == 0:
+            os.close(cached_file.file_descriptor)
+
+    def close(self) -> None:
+        with self.LOCK:
+            while self.open_files:
+                _, cached_file = self.open_files.popitem()
+                self.evict(cached_file)
+
+class CachedAsset:
+    """
+    A small static file kept in memory as a fully serialized http response (status line + headers + body), so
+    serving it is just handing those bytes to the socket. The 304 response for it is serialized too.
+    """
+    def __init__(self, path: str, stat_result: os.stat_result, full_response: bytes, not_modified_response: bytes, etag: str,
+                 variants: Optional[Dict[str, 'CachedAsset']] = None):
+        self.path = path
+        self.mtime_ns = stat_result.st_mtime_ns
+        self.size = stat_result.st_size
+        self.last_modified = int(stat_result.st_mtime)
+        self.full_response = full_response
+        self.not_modified_response = not_modified_response
+        self.etag = etag
+        #content encoding (gzip for example) -> the same asset compressed with that encoding, compressed once when cached
+        self.variants = variants or {}
+        self.last_validated = time.monotonic()
+
+    def memory_used(self) -> int:
+        return (len(self.full_response) + len(self.not_modified_response) 
+                + sum(variant.memory_used() for variant in self.variants.values()))
+
+    def __repr__(self) -> str:
+        return f'CachedAsset({self.path}, size={self.size}, etag={self.etag})'
+
+class StaticAssetCache:
+    """
+    A LRU cache of CachedAssets that is bounded by the total number of bytes it holds rather than the number
+    of entries. Entries are checked against the file's mtime and size once they are older than stat_ttl seconds
+    and dropped if the file changed.
+    """
+    def __init__(self, max_bytes: int = 1024 * 1024 * 64, max_asset_bytes: int = 1024 * 256, stat_ttl: float = 1.0):
+        self.max_bytes = max_bytes
+        self.max_asset_bytes = max_asset_bytes
+        self.stat_ttl = stat_ttl
+        self.bytes_used = 0
+        self.assets: 'OrderedDict[str, CachedAsset]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: str) -> Optional[CachedAsset]:
+        with self.lock:
+            cached_asset = self.assets.get(path)
+            if cached_asset is None:
+                return None
+            self.assets.move_to_end(path)
+            if time.monotonic() - cached_asset.last_validated < self.stat_ttl:
+                return cached_asset
+
+        try:
+            current_stat = os.stat(path)
+            still_valid = current_stat.st_mtime_ns == cached_asset.mtime_ns and current_stat.st_size == cached_asset.size
+        except OSError:
+            still_valid = False
+        with self.lock:
+            if still_valid:
+                cached_asset.last_validated = time.monotonic()
+                return cached_asset
+            if self.assets.get(path) is cached_asset:
+                self.remove(path)
+        return None
+
+    def put(self, cached_asset: CachedAsset) -> None:
+        if cached_asset.memory_used() > self.max_bytes:
+            return
+        with self.lock:
+            if cached_asset.path in self.assets:
+                self.remove(cached_asset.path)
+            self.assets[cached_asset.path] = cached_asset
+            self.bytes_used += cached_asset.memory_used()
+            while self.bytes_used > self.max_bytes:
+                least_recently_used_path = next(iter(self.assets))
+                self.remove(least_recently_used_path)
+
+    def invalidate(self, path: str) -> None:
+        with self.lock:
+            if path in self.assets:
+                self.remove(path)
+
+    def remove(self, path: str) -> None:
+        """
+        must be called while holding the lock.
+        """
+        cached_asset = self.assets.pop(path)
+        self.bytes_used -= cached_asset.memory_used()
+
+class PrecompressedVariants:
+    """
+    The compressed versions of small static files made with the slow but best compression levels, always outside of
+    the request path: in a thread when the server starts (for every file) and again in a thread for a file that changed.
+    Each one is kept with the mtime and size of the file it was made from and is only used for that version of the file.
+    They are kept apart from the StaticAssetCache so that an asset it evicts doesn't need compressing again.
+    Files under min_file_bytes aren't worth compressing, files over max_file_bytes are sent with sendfile instead.
+    """
+    def __init__(self, compressors: Dict[str, Callable[[bytes], bytes]], min_file_bytes: int = 256, max_file_bytes: int = 1024 * 256):
+        self.compressors = compressors
+        self.min_file_bytes = min_file_bytes
+        self.max_file_bytes = max_file_bytes
+        #path -> (mtime_ns, size, {encoding: compressed contents})
+        self.variants: Dict[str, Tuple[int, int, Dict[str, bytes]]] = {}
+        self.pending: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def get(self, path: str, stat_result: os.stat_result) -> Optional[Dict[str, bytes]]:
+        with self.lock:
+            entry = self.variants.get(path)
+        if entry is None or entry[:2] != (stat_result.st_mtime_ns, stat_result.st_size):
+            return None
+        return entry[2]
+
+    def compress(self, path: str) -> None:
+        try:
+            with open(path, 'rb') as file:
+                stat_result = os.fstat(file.fileno())
+                if not stat.S_ISREG(stat_result.st_mode) or not self.min_file_bytes <= stat_result.st_size <= self.max_file_bytes:
+                    return
+                if self.get(path, stat_result) is not None:
+                    return
+                contents = file.read()
+        except OSError:
+            return
+        compressed_variants = {encoding: compress(contents) for encoding, compress in self.compressors.items()}
+        with self.lock:
+            self.variants[path] = (stat_result.st_mtime_ns, stat_result.st_size, compressed_variants)
+
+    def compress_in_background(self, paths: List[str], on_compressed: Callable[[str], None]) -> None:
+        """
+        compresses the files in a thread (unless another thread already is), on_compressed is called with the path of
+        every file that was.
+        """
+        with self.lock:
+            paths = [path for path in paths if path not in self.pending]
+            self.pending.update(paths)
+        if paths:
+            compressing_thread = threading.Thread(target=self.compress_all, args=(paths, on_compressed))
+            compressing_thread.daemon = True
+            compressing_thread.start()
+
+    def compress_all(self, paths: List[str], on_compressed: Callable[[str], None]) -> None:
+        for path in paths:
+            try:
+                self.compress(path)
+            finally:
+                with self.lock:
+                    self.pending.discard(path)
+            on_compressed(path)
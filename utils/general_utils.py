@@ -1,17 +1,25 @@
 from enum import Enum
-from typing import Union, Dict, List, Any, Generator
+from typing import Union, Dict, List, Any, Generator, Tuple, Callable
 import logging
 import datetime
+import email.utils
 import json
 import threading
-from .custom_exceptions import NotValidHttpFormat, ClientClosingConnection
+import os
+import re
+import select
+import socket
+import ssl
+from .custom_exceptions import NotValidHttpFormat, ClientClosingConnection, MalformedSettings
 from collections import namedtuple
 from event_loop.event_loop import ResourceTask
+from .profiling import PROFILER
 
 
 class SocketType(Enum):
     MASTER_SOCKET = 1
     CLIENT_SOCKET = 2
+    WAKEUP_SOCKET = 3
 
 class ClientInformation:
     def __init__(self, socket_type: SocketType, addr: Union[str, int, None] ="", context= None):
@@ -19,24 +27,106 @@ class ClientInformation:
         self.socket_type = socket_type
         self.context = context
 
+#a header line without a colon. The lookahead and backreference keep the regex from backtracking through every
+#well formed line (what an atomic group would do)
+MALFORMED_HEADER_LINE = re.compile(rb'\n(?=([^:\r]*))\1(?!:)')
+
 class HttpRequest:
-    def __init__(self, request_type: str, requested_url: str, headers: Dict, payload: str):
+    """
+    A request is its raw bytes plus where its head ends. Only the request line is parsed up front, a header is
+    looked up in the head when a handler or matcher asks for it (the parser asks for the framing headers, the router
+    for Host and the server for Connection) and the headers are only split up into a dict if someone wants all of
+    them. The body stays bytes and is only decoded if someone asks for the payload, a proxied request is forwarded
+    as raw_http_request and nobody ever does.
+    """
+    __slots__ = ('raw_http_request', 'head_length', 'request_type', 'http_version', 'requested_url', 'parsed_headers',
+                 'body', 'decoded_payload')
+
+    def __init__(self, request_type: str, requested_url: str, headers: Union[Dict, None], payload: Union[str, bytes]):
         """ 
         Making this a class because I may want extend it later such that just using a dict would be inconvenient
         The reason the host and port are extracted whereas the other headers aren't is because those peices of info
         are needed often and they don't exist seperately in the dictionary meaning i cant just do headers['port']. 
-        So whenever someone wants just the port or just the host the splitting logic has to be done. So, might as well do it 
-        in here to begin with. 
+        So whenever someone wants just the port or just the host the splitting logic has to be done, the host and port
+        properties do it. 
         """
         self.raw_http_request = b""
+        #the request line and header lines (without the empty line that ends them) are raw_http_request[:head_length]
+        self.head_length = 0
         self.request_type = request_type 
+        self.http_version = 'HTTP/1.1'
         self.requested_url = requested_url
-        self.port = ''
-        self.host = ''
-        if 'Host' in headers:
-            self.host,self.port = headers['Host'].split(':') #host is something like gooby.com:3333
-        self.headers = headers
-        self.payload = payload
+        #lowercased header name -> value, None until someone wants all the headers
+        self.parsed_headers = None if headers is None else {name.lower(): value for name, value in headers.items()}
+        self.body = payload.encode() if isinstance(payload, str) else payload
+        self.decoded_payload = payload if isinstance(payload, str) else None
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """
+        the header names are lowercased, like http/2 has them.
+        """
+        if self.parsed_headers is None:
+            parsed_headers = {}
+            for header_line in self.raw_http_request[:self.head_length].decode('latin-1').split('\r\n')[1:]:
+                header_name, _, header_value = header_line.partition(':')
+                parsed_headers[header_name.strip().lower()] = header_value.strip()
+            self.parsed_headers = parsed_headers
+        return self.parsed_headers
+
+    @property
+    def payload(self) -> str:
+        if self.decoded_payload is None:
+            self.decoded_payload = self.body.decode(errors='replace')
+        return self.decoded_payload
+
+    @property
+    def host(self) -> str:
+        return self.host_and_port()[0]
+
+    @property
+    def port(self) -> str:
+        return self.host_and_port()[1]
+
+    def host_and_port(self) -> Tuple[str, str]:
+        """
+        host is something like gooby.com:3333, but the port can be left out (it's the default port of the scheme then,
+        port is '') and an ipv6 address has colons of its own, like [::1]:3333.
+        """
+        host = self.get_header('Host', '')
+        name, separator, port = host.rpartition(':')
+        if not separator or not port.isdigit() or (name.startswith('[') and not name.endswith(']')):
+            return host, ''
+        return name, port
+
+    def wants_keep_alive(self) -> bool:
+        """
+        http/1.1 connections stay open unless the client says otherwise, http/1.0 ones only if the client asks.
+        """
+        connection = (self.get_header('Connection') or '').lower()
+        if self.http_version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    def get_header(self, header_name: str, default: Any = None) -> Any:
+        """
+        header names are case insensitive, so look the header up without caring about the case the
+        client used. Until someone wanted all the headers the one header is searched for in the head, which is a
+        couple of searches in C instead of splitting every header line up in python.
+        """
+        if self.parsed_headers is not None:
+            return self.parsed_headers.get(header_name.lower(), default)
+        lowercase_head = self.raw_http_request[:self.head_length].lower()
+        #the request line comes first, so every header line starts after a line break. With the same header more than
+        #once the last one wins, like it does in the dict.
+        name_start = lowercase_head.rfind(b'\r\n' + header_name.lower().encode('latin-1') + b':')
+        if name_start == -1:
+            return default
+        value_start = name_start + len(header_name) + 3
+        value_end = lowercase_head.find(b'\r\n', value_start)
+        if value_end == -1:
+            value_end = self.head_length
+        return self.raw_http_request[value_start:value_end].decode('latin-1').strip()
 
     def __getitem__(self, request_part):
         """ 
@@ -51,7 +141,10 @@ class HttpRequest:
         elif request_part == 'host':
             return self.host
         else:
-            return self.headers[request_part]
+            header_value = self.get_header(request_part)
+            if header_value is None:
+                raise KeyError(request_part)
+            return header_value
     
     @classmethod
     def from_bytes(cls, raw_http_request: bytes) -> 'HttpRequest':
@@ -59,16 +152,171 @@ class HttpRequest:
         Acts like an alternate constructor. I thought it would be better to have the constructor have
         informative arguments while this method could just take bytes and parse them.
         """
-        http_request_lines = raw_http_request.decode().split('\r\n')
-        method, requested_url, request_type = http_request_lines[0].split()
-        headers = {header.split(': ')[0]:header.split(': ')[1] for header in http_request_lines[1:-2]}
-        payload = http_request_lines[-1]
-        http_request = cls(method, requested_url, headers, payload)
+        head, separator, body = raw_http_request.partition(b'\r\n\r\n')
+        if not separator:
+            raise NotValidHttpFormat("the request does not have an empty line after its headers")
+        http_request = cls.from_head(head, body)
+        #the head is the start of it, so head_length is still right
         http_request.raw_http_request = raw_http_request
         return http_request
+
+    @classmethod
+    def from_head(cls, head: bytes, body: bytes = b'') -> 'HttpRequest':
+        """
+        Builds a request from the request line + headers (without the empty line that ends them) and an 
+        already de-framed body. This is what the incremental parser uses since it has already found where the 
+        headers end and where the body starts, so there is no need to search for them again. The head is the
+        request's raw_http_request until the parser has the whole request.
+        """
+        request_line_end = head.find(b'\r\n')
+        request_line = (head if request_line_end == -1 else head[:request_line_end]).decode('latin-1')
+        try:
+            method, requested_url, request_type = request_line.split()
+        except ValueError:
+            raise NotValidHttpFormat(f"malformed request line: {request_line!r}")
+        malformed_header_line = MALFORMED_HEADER_LINE.search(head)
+        if malformed_header_line is not None:
+            raise NotValidHttpFormat(f"malformed header line: {malformed_header_line.group(1)!r}")
+        http_request = cls(method, requested_url, None, body)
+        http_request.http_version = request_type
+        http_request.raw_http_request = head
+        http_request.head_length = len(head)
+        return http_request
     
     def __repr__(self) -> str:
-        return str(vars(self))
+        return f'<{self.request_type} {self.requested_url} {self.http_version} {self.headers}>'
+
+#encoded status and header lines, by line. Bounded so that header values that are different in every response
+#(Content-Length, Date, ETag...) can't make it grow forever, once it's full new lines just aren't cached.
+ENCODED_LINES: Dict[str, bytes] = {}
+MAX_ENCODED_LINES = 4096
+
+def encoded_line(line: str) -> bytes:
+    encoded = ENCODED_LINES.get(line)
+    if encoded is None:
+        encoded = f'{line}\r\n'.encode()
+        if len(ENCODED_LINES) < MAX_ENCODED_LINES:
+            ENCODED_LINES[line] = encoded
+    return encoded
+
+def encoded_header_line(header_name: str, value: str) -> bytes:
+    if header_name == 'Content-Length':
+        #different for almost every response, caching it would only fill the cache up
+        return f'Content-Length: {value}\r\n'.encode()
+    return encoded_line(f'{header_name}: {value}')
+
+def with_connection_close(raw_http_response: bytes) -> bytes:
+    """
+    the same response with the Connection (and Keep-Alive) headers of its head replaced by Connection: close.
+    """
+    head, separator, rest = raw_http_response.partition(b'\r\n\r\n')
+    status_line, *header_lines = head.split(b'\r\n')
+    header_lines = [header_line for header_line in header_lines
+                    if header_line.split(b':', 1)[0].strip().lower() not in (b'connection', b'keep-alive')]
+    return b'\r\n'.join([status_line, *header_lines, b'Connection: close']) + separator + rest
+
+def http_date(timestamp: float) -> str:
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def preferred_encoding(accept_encoding: Union[str, None], available_encodings) -> Union[str, None]:
+    """
+    Picks the content encoding to respond with given the client's Accept-Encoding header, like 
+    "gzip, deflate, br;q=0.8". Returns None when the response shouldn't be encoded at all. When the client
+    doesn't prefer one of the available encodings over another, the first one in available_encodings wins.
+    """
+    if not accept_encoding or not available_encodings:
+        return None
+    qualities = {}
+    for accepted in accept_encoding.split(','):
+        encoding, _, parameters = accepted.partition(';')
+        quality = 1.0
+        parameter_name, _, parameter_value = parameters.strip().partition('=')
+        if parameter_name.strip() == 'q':
+            try:
+                quality = float(parameter_value)
+            except ValueError:
+                quality = 0.0
+        qualities[encoding.strip().lower()] = quality
+
+    best_encoding, best_quality = None, 0.0
+    for encoding in available_encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+    return best_encoding
+
+def is_not_modified(http_request: HttpRequest, etag: str, last_modified: int) -> bool:
+    """
+    Checks the conditional headers of a GET request against the current validators of a resource. If-None-Match
+    wins over If-Modified-Since when both are present (rfc 7232 section 6).
+    """
+    if_none_match = http_request.get_header('If-None-Match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        #weak comparison, W/"x" matches "x"
+        candidate_etags = (candidate.strip().removeprefix('W/') for candidate in if_none_match.split(','))
+        return etag.removeprefix('W/') in candidate_etags
+
+    if_modified_since = http_request.get_header('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            modified_since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return last_modified <= modified_since
+    return False
+
+def parse_range_header(range_header: str, size: int, max_ranges: int = 16) -> Union[List[Tuple[int, int]], None]:
+    """
+    Turns a Range header like "bytes=0-499, -500, 9000-" into a list of (first byte, last byte) pairs clamped
+    to the size of the resource. Returns None when the header should be ignored (it isn't a bytes range, is 
+    malformed, or asks for an abusive number of ranges) and an empty list when none of the ranges can be
+    satisfied, which is a 416.
+    """
+    unit, _, range_set = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not range_set:
+        return None
+    byte_ranges = []
+    for range_spec in range_set.split(','):
+        first, dash, last = range_spec.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                #suffix range, "-500" is the last 500 bytes
+                suffix_length = int(last)
+                if suffix_length <= 0 or size == 0:
+                    continue
+                byte_ranges.append((max(size - suffix_length, 0), size - 1))
+                continue
+            first_byte = int(first)
+            last_byte = int(last) if last else first_byte
+        except ValueError:
+            return None
+        if last_byte < first_byte:
+            return None
+        if not last:
+            last_byte = size - 1
+        if first_byte < size:
+            byte_ranges.append((first_byte, min(last_byte, size - 1)))
+    if len(byte_ranges) > max_ranges:
+        return None
+    return byte_ranges
+
+def if_range_matches(http_request: HttpRequest, etag: str, last_modified: str) -> bool:
+    """
+    If-Range makes a Range request conditional: the client only wants the range if what it already has is still current,
+    otherwise it wants the whole thing. ETags have to match strongly (rfc 9110 section 13.1.5), so a weak ETag on either
+    side never matches and the whole thing is sent. Dates have to match exactly.
+    """
+    if_range = http_request.get_header('If-Range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return not if_range.startswith('W/') and not etag.startswith('W/') and if_range == etag
+    return if_range == last_modified
 
 def settings_parser() -> Dict:
     with open("settings.json",'r') as settings:
@@ -92,6 +340,7 @@ def handle_exceptions(exception: Exception) -> None:
         log_debug_info("time out error, disconnecting")
 
 class HttpResponse:
+    __slots__ = ('status_line', 'body', 'parsed_headers', 'raw_http_response')
     
     def __init__(self, response_code :int=200, body: Union[str,bytes] = '', additional_headers: Dict = {}):
         """ 
@@ -102,26 +351,79 @@ class HttpResponse:
 
         self.status_line = f'HTTP/1.1 {response_code}'
         self.body = body.encode() if isinstance(body,str) else body
-        self.headers = {'Content-Type':'text/html; charset=UTF-8','Content-Length':f'{len(body)}'}
+        self.headers = {'Content-Type':'text/html; charset=UTF-8','Content-Length':f'{len(self.body)}'}
         self.headers.update(additional_headers)
         self.raw_http_response = b""
-    
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """
+        a response made from_bytes only parses its header lines if someone asks for them, a relayed response usually
+        goes out as the raw bytes without anyone looking.
+        """
+        if self.parsed_headers is None:
+            head_end = self.raw_http_response.find(b'\r\n\r\n')
+            parsed_headers = {}
+            for header_line in self.raw_http_response[:head_end].decode('latin-1').split('\r\n')[1:]:
+                header_name, _, header_value = header_line.partition(':')
+                parsed_headers[header_name.strip()] = header_value.strip()
+            self.parsed_headers = parsed_headers
+        return self.parsed_headers
+
+    @headers.setter
+    def headers(self, headers: Dict[str, str]) -> None:
+        self.parsed_headers = headers
+
+    def head(self) -> bytes:
+        """
+        The status line and the headers. Most header lines are the same from one response to the next (the content
+        type, the server's own headers...), so their encoded form is cached instead of being formatted every time.
+        """
+        header_lines = [encoded_line(self.status_line)]
+        for header_name, value in self.headers.items():
+            header_lines.append(encoded_header_line(header_name, value))
+        header_lines.append(b'\r\n') #needs to be two new lines characters after headers
+        return b''.join(header_lines)
+
+    def buffers(self) -> List[bytes]:
+        """
+        The response as a list of buffers to send one after the other with send_buffers, the body is never copied
+        into the same bytes as the head. If the HttpResponse object was created based on already existing http 
+        response (when receiving a response from another server during reverse proxying/load balancing for example),
+        it will already have a raw http response in it, which is sent as it is.
+        """
+        if self.raw_http_response:
+            return [self.raw_http_response]
+        return [self.head(), self.body]
         
     def dump(self) -> bytes:
         """
-        Turns an HttpResponse object into bytes that i can transfer over a socket. If the HttpResponse
-        object was created based on already existing http response (when receiving a response from another
-        server during reverse proxying/load balancing for example), it will already have a raw http response
-        in it. In that case, don't go through the dumping process, just return the raw http response contained in
-        the field.
-        """
-        if not self.raw_http_response:
-            status_line = self.status_line + '\r\n'
-            header_list = [f'{header_name}: {value}' for header_name, value in self.headers.items()]
-            header_lines = '\r\n'.join(header_list) + '\r\n\r\n' #needs to be two new lines characters after headers
-            return status_line.encode() + header_lines.encode() + self.body
+        Turns an HttpResponse object into bytes that i can transfer over a socket. Sending it doesn't need that
+        (see buffers), it's for when the response is kept around as bytes (cached static assets for example).
+        """
+        return b''.join(self.buffers())
+
+    def body_size(self) -> int:
+        """
+        for metrics, without having to serialize the response.
+        """
+        return len(self.body) if not self.raw_http_response else len(self.raw_http_response)
+
+    def close_connection(self) -> None:
+        """
+        tells the client that the connection is closed after this response.
+        """
+        if self.raw_http_response:
+            self.raw_http_response = with_connection_close(self.raw_http_response)
         else:
-            return self.raw_http_response
+            self.headers['Connection'] = 'close'
+
+    @property
+    def status_code(self) -> int:
+        try:
+            return int(self.status_line.split()[1])
+        except (IndexError, ValueError):
+            return 0
     
     @classmethod
     def from_bytes(cls, raw_http_response: bytes) -> "HttpResponse":
@@ -130,18 +432,244 @@ class HttpResponse:
         another server will return an already fully formed http response and I want to create an
         HttpResponse object from it - to alter it for example.
         """
-        http_response_lines = raw_http_response.decode().split('\r\n')
-        status_line_components = http_response_lines[0].split()
-        protocol_version, status_code, *status_text = status_line_components
-        headers = {header.split(': ')[0]:header.split(': ')[1] for header in http_response_lines[1:-2]}
-        payload = http_response_lines[-1]
-        http_response = cls(int(status_code), payload, headers)
+        head_end = raw_http_response.find(b'\r\n\r\n')
+        if head_end == -1:
+            raise NotValidHttpFormat("the response does not have an empty line after its headers")
+        status_line_end = raw_http_response.find(b'\r\n', 0, head_end)
+        status_line = raw_http_response[:head_end if status_line_end == -1 else status_line_end].decode('latin-1')
+        try:
+            protocol_version, status_code, *status_text = status_line.split()
+            int(status_code)
+        except ValueError:
+            raise NotValidHttpFormat(f"malformed status line: {status_line!r}")
+        http_response = cls.__new__(cls)
+        http_response.status_line = status_line
+        #the body stays as bytes, it could be an image or anything else that isn't text. A memoryview so that it
+        #isn't copied out of the raw response
+        http_response.body = memoryview(raw_http_response)[head_end + 4:]
+        http_response.parsed_headers = None
         http_response.raw_http_response = raw_http_response
         return http_response
 
     def __repr__(self) -> str:
         return self.dump().decode()
 
+class SerializedResponse(HttpResponse):
+    """
+    A response that was already turned into bytes ahead of time (a cached static asset for example). Building
+    one doesn't do any header work at all, dump just returns the bytes.
+    """
+    __slots__ = ()
+
+    def __init__(self, raw_http_response: bytes, response_code: int = 200):
+        self.status_line = f'HTTP/1.1 {response_code}'
+        self.headers = {}
+        self.body = b''
+        self.raw_http_response = raw_http_response
+
+class CachedResponse(HttpResponse):
+    """
+    A response kept as its head and its body (a backend's response stored by the proxy cache for example). They go out
+    as two buffers, so putting a different head (with an up to date Age) in front of the body never copies the body.
+    """
+    __slots__ = ('cached_head',)
+
+    def __init__(self, head: bytes, body: bytes, response_code: int = 200):
+        self.status_line = f'HTTP/1.1 {response_code}'
+        self.headers = {}
+        self.body = body
+        self.raw_http_response = b''
+        self.cached_head = head
+
+    def buffers(self) -> List[bytes]:
+        return [self.cached_head, self.body]
+
+    def close_connection(self) -> None:
+        self.cached_head = with_connection_close(self.cached_head)
+
+    def __repr__(self) -> str:
+        return self.cached_head.decode('latin-1') + f'<{len(self.body)} bytes from the cache>'
+
+class FileResponse(HttpResponse):
+    """
+    A response whose body is (part of) a file that is sent straight from the file descriptor to the socket
+    with os.sendfile, so the file contents never have to be read into memory. dump() only returns the status
+    line and headers, use send_response/async_send_response to send the whole thing.
+
+    The body is a list of segments, each one either some bytes or an (offset, count) piece of the file. A normal
+    response is just [(0, file size)], a multipart/byteranges response interleaves the part headers (bytes) with
+    the requested pieces of the file.
+    """
+    __slots__ = ('cached_file', 'segments', 'count')
+
+    def __init__(self, cached_file, response_code: int = 200, additional_headers: Dict = {}, 
+                 segments: Union[List[Union[bytes, Tuple[int, int]]], None] = None):
+        super().__init__(response_code, b'', additional_headers)
+        self.cached_file = cached_file
+        self.segments = [(0, cached_file.size)] if segments is None else segments
+        self.count = sum(len(segment) if isinstance(segment, bytes) else segment[1] for segment in self.segments)
+        self.headers['Content-Length'] = f'{self.count}'
+
+    def body_size(self) -> int:
+        return self.count
+
+    def buffers(self) -> List[bytes]:
+        #the body is in the segments
+        return [self.head()]
+
+    def release(self) -> None:
+        self.cached_file.release()
+
+    def __repr__(self) -> str:
+        return self.dump().decode() + f'<{self.count} bytes of {self.cached_file.path}>'
+
+class ProxiedResponse(HttpResponse):
+    """
+    A response that is still coming in from a backend. Only the status line and headers (and whatever part of the
+    body came with them) have been read when the handler returns it. The rest is relayed to the client as it arrives
+    by send_response/async_send_response, one buffer at a time, so memory use doesn't depend on the size of the
+    response. The client socket provides the backpressure: nothing more is read from the backend until
+    the previous buffer has been sent to the client.
+    """
+    __slots__ = ('connection', 'connection_pool', 'response_parser', 'received', 'released', 'on_release', 'captured',
+                 'captured_bytes', 'capture_limit', 'on_captured')
+    BUFFER_SIZE = 1024 * 64
+
+    def __init__(self, connection, connection_pool, response_parser):
+        self.connection = connection
+        self.connection_pool = connection_pool
+        self.response_parser = response_parser
+        self.received = b''
+        self.status_line = ''
+        self.headers = {}
+        self.body = b''
+        self.raw_http_response = b''
+        self.released = False
+        #called once the response was relayed (or relaying it failed), used by load balancing to track outstanding requests
+        self.on_release: Union[Callable[[], None], None] = None
+        #what was relayed so far when someone (the proxy cache) wants a copy of the whole response, see capture
+        self.captured: Union[List[bytes], None] = None
+        self.captured_bytes = 0
+        self.capture_limit = 0
+        self.on_captured: Union[Callable[[bytes], None], None] = None
+
+    def receive(self) -> bytes:
+        """
+        Reads whatever the backend has sent and returns the part of it that belongs to this response. 
+        """
+        try:
+            data = self.connection.socket.recv(self.BUFFER_SIZE)
+        except BlockingIOError:
+            return b''
+        return self.consume(data)
+
+    def consume(self, data: bytes) -> bytes:
+        """
+        Takes data read from the backend by someone else (the asyncio server reads it itself) and returns the part
+        of it that belongs to this response, no data means the backend closed the connection.
+        """
+        if not data:
+            self.response_parser.finish_on_close()
+            return b''
+        bytes_used = self.response_parser.feed(data)
+        if bytes_used < len(data):
+            #the backend sent more than one response's worth of bytes, don't trust this connection again
+            self.response_parser.keep_alive = False
+            data = data[:bytes_used]
+        if self.captured is not None:
+            self.keep_captured(data)
+        return data
+
+    def capture(self, limit: int, on_captured: Callable[[bytes], None]) -> None:
+        """
+        Keeps a copy of the response (as the backend sent it) while it's relayed, on_captured gets it once the whole
+        response was relayed. Called once the head is in, a response bigger than limit bytes isn't kept.
+        """
+        self.captured = []
+        self.captured_bytes = 0
+        self.capture_limit = limit
+        self.on_captured = on_captured
+        self.keep_captured(self.received)
+
+    def keep_captured(self, data: bytes) -> None:
+        self.captured_bytes += len(data)
+        if self.captured_bytes > self.capture_limit:
+            self.captured = None
+        else:
+            self.captured.append(data)
+
+    def readable(self) -> ResourceTask:
+        """
+        what a coroutine on the EventLoop yields to wait for more of the response. The backend gets the pool's
+        connect_timeout to send something, like the blocking sockets of the threaded servers.
+        """
+        return ResourceTask(self.connection.socket, 'readable', self.connection_pool.connect_timeout)
+
+    def receive_head(self) -> None:
+        self.head_received(self.receive())
+
+    def head_received(self, data: bytes) -> None:
+        """
+        data is what receive or consume returned. It's kept with the head, the leader of a flight (see
+        utils/single_flight.py) keeps the whole response this way before sending it.
+        """
+        self.received += data
+        if self.response_parser.head is not None:
+            self.status_line = self.response_parser.head.split(b'\r\n', 1)[0].decode('latin-1')
+            self.headers = self.response_parser.headers
+
+    @property
+    def status_code(self) -> int:
+        return self.response_parser.status_code
+
+    @property
+    def has_head(self) -> bool:
+        return self.response_parser.head is not None or self.response_parser.complete
+
+    @property
+    def complete(self) -> bool:
+        return self.response_parser.complete
+
+    @property
+    def closes_client_connection(self) -> bool:
+        """
+        A body that ends when the backend closes the connection can only be relayed the same way: the client
+        knows the response is over when we close its connection.
+        """
+        return self.response_parser.framing == 'close'
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            if self.captured is not None and self.complete:
+                self.on_captured(b''.join(self.captured))
+            self.captured = None
+            self.connection_pool.release(self.connection, reusable=self.complete and self.response_parser.keep_alive)
+            if self.on_release is not None:
+                self.on_release()
+
+    def body_size(self) -> int:
+        """
+        the body is still on its way, so this is what the backend says it will be (if it says).
+        """
+        for header_name, value in self.headers.items():
+            if header_name.lower() == 'content-length' and value.isdigit():
+                return int(value)
+        return len(self.received)
+
+    def close_connection(self) -> None:
+        #the backend's head is relayed as it is, the only place to say it is in there
+        self.received = with_connection_close(self.received)
+
+    def buffers(self) -> List[bytes]:
+        return [self.received]
+
+    def dump(self) -> bytes:
+        return self.received
+
+    def __repr__(self) -> str:
+        return f'<{self.status_line} relayed from {self.connection.address}>'
+
 class Range:
     def __init__(self, lower_bound: Union[float,int], upper_bound: Union[float,int]):
         self.lower_bound = lower_bound
@@ -153,6 +681,12 @@ class Range:
     def __repr__(self):
         return f'Range({self.lower_bound}, {self.upper_bound})'
 
+    def __eq__(self, other):
+        return isinstance(other, Range) and (self.lower_bound, self.upper_bound) == (other.lower_bound, other.upper_bound)
+
+    def __hash__(self):
+        return hash((self.lower_bound, self.upper_bound))
+
 def create_weight_ranges(server_and_weights: List):
         """
         Is called when the the user wants to load balance using the weighted strategy. The purpose of this method
@@ -189,12 +723,98 @@ def settings_preparer(settings: Dict) -> Dict:
                 task_info['context']['send_to'] = create_weight_ranges(task_info['context']['send_to'])
     return settings
 
-#TODO
+#the tasks there are handlers for (see ManageHandlers) and what has to be in their context
+TASK_REQUIRED_CONTEXT = {
+    'serve_static': ('staticRoot',),
+    'reverse_proxy': ('send_to',),
+    'load_balance': ('send_to', 'strategy'),
+    'health_check': (),
+    'metrics': (),
+    'profiling': (),
+}
+LOAD_BALANCING_STRATEGIES = ('round_robin', 'weighted', 'least_requests', 'peak_ewma', 'power_of_two_choices')
+#the blocks of the settings besides tasks, they are all passed to something as keyword arguments
+SETTINGS_BLOCKS = ('connections', 'connection_pool', 'tls', 'http2', 'worker_pool')
+#the blocks of a task's context that are passed to something as keyword arguments
+CONTEXT_BLOCKS = ('cache', 'coalesce', 'health_checks', 'outlier_detection', 'tls')
+
+def is_address(address) -> bool:
+    if not isinstance(address, (tuple, list)) or len(address) != 2 or not isinstance(address[0], str):
+        return False
+    try:
+        int(address[1])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+def load_balancing_problems(task_name: str, context: Dict) -> List[str]:
+    send_to = context['send_to']
+    if not isinstance(send_to, (tuple, list)) or not send_to:
+        return [f'{task_name}: send_to has to be a list of (host, port) or, for the weighted strategy, (host, port, weight)']
+    problems = []
+    if context['strategy'] not in LOAD_BALANCING_STRATEGIES:
+        problems.append(f"{task_name}: unknown strategy {context['strategy']!r}, it has to be one of {', '.join(LOAD_BALANCING_STRATEGIES)}")
+    weights = []
+    for backend in send_to:
+        if not isinstance(backend, (tuple, list)) or len(backend) not in (2, 3) or not is_address(tuple(backend[:2])):
+            problems.append(f'{task_name}: {backend!r} in send_to is not a (host, port) or (host, port, weight)')
+        elif len(backend) == 3:
+            if not isinstance(backend[2], (int, float)) or backend[2] <= 0:
+                problems.append(f'{task_name}: the weight of {backend[0]}:{backend[1]} has to be a number over 0')
+            else:
+                weights.append(backend[2])
+    if context['strategy'] == 'weighted':
+        if len(weights) != len(send_to):
+            problems.append(f'{task_name}: every backend needs a weight with the weighted strategy')
+        elif abs(sum(weights) - 1) > 1e-9:
+            problems.append(f'{task_name}: the weights add up to {sum(weights)} instead of 1')
+    return problems
+
 def settings_analyzer(settings: Dict) -> Dict:
     """ 
     Analyzes the settings to see if there is anything malformed such as weights in the load balancing block with 
-    the weighted strategy adding up to more than 1 
+    the weighted strategy adding up to more than 1. Everything that's wrong is collected and raised together as
+    MalformedSettings, so a reload with bad settings is refused before anything is built from them. It looks at the
+    settings as they are written in settings.py, so it runs before settings_preparer.
     """
+    problems = []
+    tasks = settings.get('tasks')
+    if not isinstance(tasks, dict):
+        raise MalformedSettings('the settings need a "tasks" dict')
+    for block_name in settings:
+        if block_name != 'tasks' and block_name not in SETTINGS_BLOCKS:
+            problems.append(f'unknown settings block {block_name!r}')
+        elif block_name != 'tasks' and not isinstance(settings[block_name], dict):
+            problems.append(f'the {block_name} block has to be a dict')
+    if isinstance(settings.get('tls'), dict) and not {'certificate', 'key'} <= settings['tls'].keys():
+        problems.append('the tls block needs a certificate and a key')
+
+    for task_name, task_info in tasks.items():
+        if task_name not in TASK_REQUIRED_CONTEXT:
+            problems.append(f"unknown task {task_name!r}, it has to be one of {', '.join(TASK_REQUIRED_CONTEXT)}")
+            continue
+        if not isinstance(task_info, dict) or not isinstance(task_info.get('match_criteria'), dict) or not isinstance(task_info.get('context'), dict):
+            problems.append(f'{task_name}: a task needs a match_criteria dict and a context dict')
+            continue
+        for attribute, required_values in task_info['match_criteria'].items():
+            if not isinstance(required_values, (list, tuple)):
+                problems.append(f'{task_name}: the match criteria for {attribute} have to be a list')
+        context = task_info['context']
+        missing_context = [key for key in TASK_REQUIRED_CONTEXT[task_name] if key not in context]
+        if missing_context:
+            problems.append(f"{task_name}: {', '.join(missing_context)} missing from the context")
+            continue
+        for block_name in CONTEXT_BLOCKS:
+            if block_name in context and not isinstance(context[block_name], dict):
+                problems.append(f'{task_name}: {block_name} has to be a dict')
+        if isinstance(context.get('tls'), dict) and not {'certificate', 'key'} <= context['tls'].keys():
+            problems.append(f'{task_name}: the tls block needs a certificate and a key')
+        if task_name == 'reverse_proxy' and not is_address(context['send_to']):
+            problems.append(f"{task_name}: send_to has to be a (host, port), not {context['send_to']!r}")
+        elif task_name == 'load_balance':
+            problems.extend(load_balancing_problems(task_name, context))
+    if problems:
+        raise MalformedSettings('malformed settings:\n' + '\n'.join(problems))
     return settings
 
 def execute_in_new_thread(func, args):
@@ -214,34 +834,224 @@ class SocketTasks:
     def set_writing_task(self,callback, args=()):
         self.writing_task = self.task(callback, args)
 
+#how many buffers go into one sendmsg, the kernel takes at most IOV_MAX (1024 on linux)
+MAX_BUFFERS_PER_SEND = 64
+#tells the kernel more data follows right away so the head and the start of a sendfile can share packets
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+#a TLS socket has no sendmsg and can't sendfile (the kernel would send the file unencrypted), what goes out on it is
+#encrypted a record at a time in userspace anyway. Buffers that add up to less than this are joined and sent together.
+TLS_WRITE_SIZE = 1024 * 64
+
+def tls_writes(buffers: List[bytes]) -> List[bytes]:
+    """
+    what to write to a TLS socket for the buffers: a head and a small body go out in one record and one send instead
+    of one each, bigger buffers are written as they are.
+    """
+    if sum(len(buffer) for buffer in buffers) <= TLS_WRITE_SIZE:
+        return [b''.join(buffers)]
+    return buffers
+
+def sent_buffers_dropped(buffers: List[memoryview], bytes_sent: int) -> List[memoryview]:
+    """
+    what is left to send after bytes_sent bytes of buffers were sent. The buffer that was only partly sent is
+    sliced, which with a memoryview doesn't copy anything.
+    """
+    sent_buffers = 0
+    while sent_buffers < len(buffers) and bytes_sent >= len(buffers[sent_buffers]):
+        bytes_sent -= len(buffers[sent_buffers])
+        sent_buffers += 1
+    buffers = buffers[sent_buffers:]
+    if bytes_sent:
+        buffers[0] = buffers[0][bytes_sent:]
+    return buffers
+
+def send_buffers(client_socket, buffers: List[bytes], flags: int = 0) -> None:
+    """ 
+    Sends the buffers one after the other with sendmsg, so a head and a body go out in one system call without
+    having been joined into one bytes first. sendmsg may send only part of it (as much as fits in the socket's send
+    buffer), what's left is tracked with memoryviews instead of slicing the bytes, which would copy the rest of them
+    every time.
+    """
+    if isinstance(client_socket, ssl.SSLSocket):
+        for buffer in tls_writes(buffers):
+            client_socket.sendall(buffer)
+        return
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while buffers:
+        bytes_sent = client_socket.sendmsg(buffers[:MAX_BUFFERS_PER_SEND], (), flags)
+        buffers = sent_buffers_dropped(buffers, bytes_sent)
+
 def send_all(client_socket, response: bytes) -> None:
     """ 
     I can't just use the sendall method on the socket object because it throws an error when it can't send
     all the bytes for whatever reason (typically other socket isn't ready for reading i guess) and you can't just catch
-    the error and try again because you have no clue how many bytes were actually written. However, using the send
-    method gives you much finer control as it returns how many bytes were written, so if all the bytes couldn't be written
-    you can truncate your message accordingly and repeat.  
-    """
-    BUFFER_SIZE = 1024 * 16
-    while response:
-        bytes_sent = client_socket.send(response[:BUFFER_SIZE])
-        response = response[bytes_sent:]
+    the error and try again because you have no clue how many bytes were actually written.
+    """
+    send_buffers(client_socket, [response])
             
-def read_all(client_socket) -> bytes:
-    #will change this later, keeping it simple for now
-    data = client_socket.recv(1024)
+def wait_until_writable(client_socket) -> None:
+    """
+    A socket with a timeout is non blocking at the os level, so os.sendfile raises BlockingIOError on it
+    instead of blocking. This waits (at most the socket's timeout) for it to be writable again.
+    """
+    poller = select.poll()
+    poller.register(client_socket.fileno(), select.POLLOUT)
+    timeout = client_socket.gettimeout()
+    if not poller.poll(None if timeout is None else timeout * 1000):
+        raise socket.timeout("timed out waiting for the socket to be writable")
+
+def file_blocks(file_descriptor: int, offset: int, count: int, block_size: int) -> Generator[bytes, None, None]:
+    """
+    the file read block by block with pread, for sockets sendfile can't send to. pread doesn't move the descriptor's
+    position, which is shared by everyone sending the same cached descriptor.
+    """
+    while count > 0:
+        block = os.pread(file_descriptor, min(count, block_size), offset)
+        if not block:
+            raise BrokenPipeError("file was truncated while it was being sent")
+        yield block
+        offset += len(block)
+        count -= len(block)
+
+def send_file(client_socket, file_descriptor: int, offset: int, count: int) -> None:
+    """
+    sends count bytes of the file starting at offset without copying the file into userspace. 
+    """
+    BLOCK_SIZE = 1024 * 1024
+    if isinstance(client_socket, ssl.SSLSocket):
+        for block in file_blocks(file_descriptor, offset, count, TLS_WRITE_SIZE):
+            client_socket.sendall(block)
+        return
+    while count > 0:
+        try:
+            bytes_sent = os.sendfile(client_socket.fileno(), file_descriptor, offset, min(count, BLOCK_SIZE))
+        except BlockingIOError:
+            wait_until_writable(client_socket)
+            continue
+        if bytes_sent == 0:
+            #the file got shorter than what we told the client in Content-Length
+            raise BrokenPipeError("file was truncated while it was being sent")
+        offset += bytes_sent
+        count -= bytes_sent
+
+def send_response(client_socket, http_response: HttpResponse) -> None:
+    try:
+        with PROFILER.span('send'):
+            if isinstance(http_response, FileResponse):
+                #the head and the bytes segments before a piece of the file go out together
+                buffers = http_response.buffers()
+                for segment in http_response.segments:
+                    if isinstance(segment, bytes):
+                        buffers.append(segment)
+                    else:
+                        send_buffers(client_socket, buffers, MSG_MORE if segment[1] else 0)
+                        buffers = []
+                        send_file(client_socket, http_response.cached_file.file_descriptor, *segment)
+                send_buffers(client_socket, buffers)
+                return
+            send_buffers(client_socket, http_response.buffers())
+            if isinstance(http_response, ProxiedResponse):
+                while not http_response.complete:
+                    send_all(client_socket, http_response.receive())
+                if http_response.closes_client_connection:
+                    raise ClientClosingConnection("the relayed response ends when the connection is closed")
+    finally:
+        if isinstance(http_response, (FileResponse, ProxiedResponse)):
+            http_response.release()
+
+def read_all(client_socket, buffer_size: int = 1024 * 64) -> bytes:
+    """
+    Returns whatever is currently available on the socket (up to buffer_size). This doesn't try to read a
+    whole request, feed the result to an HttpRequestParser which keeps track of where the request boundaries are.
+    """
+    data = client_socket.recv(buffer_size)
     if not data:
         raise ClientClosingConnection("client is closing its side of the connection, clean up connection")
+    if isinstance(client_socket, ssl.SSLSocket):
+        #a recv returns at most one TLS record, the rest of what was decrypted waits in OpenSSL where a selector
+        #can't see it, the socket wouldn't become readable for it
+        while client_socket.pending():
+            data += client_socket.recv(buffer_size)
     return data
 
+def async_send_buffers(client_socket, buffers: List[bytes], flags: int = 0) -> Generator:
+    """
+    send_buffers for a non blocking socket, waits in the event loop until the socket is writable again.
+    """
+    if isinstance(client_socket, ssl.SSLSocket):
+        yield from async_send_tls(client_socket, buffers)
+        return
+    buffers = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while buffers:
+        try:
+            bytes_sent = client_socket.sendmsg(buffers[:MAX_BUFFERS_PER_SEND], (), flags)
+        except BlockingIOError:
+            yield ResourceTask(client_socket, 'writable')
+            continue
+        buffers = sent_buffers_dropped(buffers, bytes_sent)
+
+def async_send_tls(client_socket, buffers: List[bytes]) -> Generator:
+    """
+    OpenSSL says what a write is waiting for, usually the socket being writable. A write that has to wait must be
+    tried again with the same bytes, so a buffer is sent TLS_WRITE_SIZE at a time and only moved on from once sent.
+    """
+    for buffer in tls_writes(buffers):
+        view = memoryview(buffer).cast('B')
+        while view:
+            try:
+                bytes_sent = client_socket.send(view[:TLS_WRITE_SIZE])
+            except ssl.SSLWantWriteError:
+                yield ResourceTask(client_socket, 'writable')
+                continue
+            except ssl.SSLWantReadError:
+                yield ResourceTask(client_socket, 'readable')
+                continue
+            view = view[bytes_sent:]
+
 def async_send_all(client_socket, response: bytes) -> Generator:
-    BUFFER_SIZE = 1024 * 16
-    while response:
+    yield from async_send_buffers(client_socket, [response])
+
+def async_send_file(client_socket, file_descriptor: int, offset: int, count: int) -> Generator:
+    BLOCK_SIZE = 1024 * 256
+    if isinstance(client_socket, ssl.SSLSocket):
+        for block in file_blocks(file_descriptor, offset, count, TLS_WRITE_SIZE):
+            yield from async_send_tls(client_socket, [block])
+        return
+    while count > 0:
         try:
-            bytes_sent = client_socket.send(response[:BUFFER_SIZE])
-            response = response[bytes_sent:]
+            bytes_sent = os.sendfile(client_socket.fileno(), file_descriptor, offset, min(count, BLOCK_SIZE))
         except BlockingIOError:
             yield ResourceTask(client_socket, 'writable')
+            continue
+        if bytes_sent == 0:
+            raise BrokenPipeError("file was truncated while it was being sent")
+        offset += bytes_sent
+        count -= bytes_sent
+
+def async_send_response(client_socket, http_response: HttpResponse) -> Generator:
+    try:
+        with PROFILER.span('send'):
+            if isinstance(http_response, FileResponse):
+                buffers = http_response.buffers()
+                for segment in http_response.segments:
+                    if isinstance(segment, bytes):
+                        buffers.append(segment)
+                    else:
+                        yield from async_send_buffers(client_socket, buffers, MSG_MORE if segment[1] else 0)
+                        buffers = []
+                        yield from async_send_file(client_socket, http_response.cached_file.file_descriptor, *segment)
+                yield from async_send_buffers(client_socket, buffers)
+                return
+            yield from async_send_buffers(client_socket, http_response.buffers())
+            if isinstance(http_response, ProxiedResponse):
+                while not http_response.complete:
+                    yield http_response.readable()
+                    yield from async_send_all(client_socket, http_response.receive())
+                if http_response.closes_client_connection:
+                    raise ClientClosingConnection("the relayed response ends when the connection is closed")
+    finally:
+        if isinstance(http_response, (FileResponse, ProxiedResponse)):
+            http_response.release()
 
 def async_read_all():
     pass
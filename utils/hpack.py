@@ -0,0 +1,321 @@
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from .custom_exceptions import HpackError
+
+Header = Tuple[bytes, bytes]
+
+#rfc 7541 appendix A, index 1 is the first entry
+STATIC_TABLE: List[Header] = [
+    (b':authority', b''), (b':method', b'GET'), (b':method', b'POST'), (b':path', b'/'), (b':path', b'/index.html'),
+    (b':scheme', b'http'), (b':scheme', b'https'), (b':status', b'200'), (b':status', b'204'), (b':status', b'206'),
+    (b':status', b'304'), (b':status', b'400'), (b':status', b'404'), (b':status', b'500'), (b'accept-charset', b''),
+    (b'accept-encoding', b'gzip, deflate'), (b'accept-language', b''), (b'accept-ranges', b''), (b'accept', b''),
+    (b'access-control-allow-origin', b''), (b'age', b''), (b'allow', b''), (b'authorization', b''),
+    (b'cache-control', b''), (b'content-disposition', b''), (b'content-encoding', b''), (b'content-language', b''),
+    (b'content-length', b''), (b'content-location', b''), (b'content-range', b''), (b'content-type', b''),
+    (b'cookie', b''), (b'date', b''), (b'etag', b''), (b'expect', b''), (b'expires', b''), (b'from', b''),
+    (b'host', b''), (b'if-match', b''), (b'if-modified-since', b''), (b'if-none-match', b''), (b'if-range', b''),
+    (b'if-unmodified-since', b''), (b'last-modified', b''), (b'link', b''), (b'location', b''), (b'max-forwards', b''),
+    (b'proxy-authenticate', b''), (b'proxy-authorization', b''), (b'range', b''), (b'referer', b''), (b'refresh', b''),
+    (b'retry-after', b''), (b'server', b''), (b'set-cookie', b''), (b'strict-transport-security', b''),
+    (b'transfer-encoding', b''), (b'user-agent', b''), (b'vary', b''), (b'via', b''), (b'www-authenticate', b''),
+]
+STATIC_INDEX = {header: index for index, header in reversed(list(enumerate(STATIC_TABLE, 1)))}
+STATIC_NAME_INDEX = {name: index for index, (name, _) in reversed(list(enumerate(STATIC_TABLE, 1)))}
+
+#the length in bits of the huffman code of every byte and of EOS (256), rfc 7541 appendix B. The code is canonical
+#(shorter codes first, symbols in order within a length), so the codes themselves follow from the lengths.
+HUFFMAN_CODE_LENGTHS = bytes.fromhex(
+    '0d171c1c1c1c1c1c1c181e1c1c1e1c1c1c1c1c1c1c1c1e1c1c1c1c1c1c1c1c1c060a0a0c0d06080b0a0a080b08060606050505060606060606'
+    '0607080f060c0a0d06070707070707070707070707070707070707070707070807080d130d0e060f05060506050606060507070606060506'
+    '070605050607070707070f0b0e0d1c141614141616161716171717171718171818161718171717171516171617171816151416161717151716'
+    '161815161717151516151716171714161616171616171a1a1413161716191a1a1a1b1b1a181913151a1b1b1a1b1815151a1a1c1b1b1b1418'
+    '1415161515171616191918181a171a1b1a1a1b1b1b1b1b1c1b1b1b1b1b1a1e')
+EOS = 256
+
+def huffman_codes() -> List[Tuple[int, int]]:
+    codes = [(0, 0)] * len(HUFFMAN_CODE_LENGTHS)
+    code = previous_length = 0
+    for symbol in sorted(range(len(HUFFMAN_CODE_LENGTHS)), key=lambda symbol: (HUFFMAN_CODE_LENGTHS[symbol], symbol)):
+        length = HUFFMAN_CODE_LENGTHS[symbol]
+        code <<= length - previous_length
+        codes[symbol] = (code, length)
+        code += 1
+        previous_length = length
+    return codes
+
+HUFFMAN_CODES = huffman_codes()
+
+def huffman_decoding_table() -> Tuple[List[Tuple[int, Optional[bytes]]], List[bool]]:
+    """
+    Decoding a bit at a time is slow in python, so the code tree is turned into a state machine that eats 4 bits at a
+    time: for every inner node of the tree (a state) and every nibble, the state it ends up in and the bytes decoded
+    on the way there (None if that's EOS, which is an error). A string may only end in a state reached by up to 7 one
+    bits from the root, the padding, the second list says which states those are.
+    """
+    children: List[List[int]] = [[-1, -1]]
+    leaves: Dict[Tuple[int, int], int] = {}
+    for symbol, (code, length) in enumerate(HUFFMAN_CODES):
+        node = 0
+        for bit_index in range(length - 1, 0, -1):
+            bit = (code >> bit_index) & 1
+            if children[node][bit] == -1:
+                children[node][bit] = len(children)
+                children.append([-1, -1])
+            node = children[node][bit]
+        leaves[(node, code & 1)] = symbol
+
+    accepting = [False] * len(children)
+    node = 0
+    for _ in range(8):
+        accepting[node] = True
+        node = children[node][1]
+
+    transitions: List[Tuple[int, Optional[bytes]]] = []
+    for state in range(len(children)):
+        for nibble in range(16):
+            node, decoded = state, bytearray()
+            for bit_index in (3, 2, 1, 0):
+                bit = (nibble >> bit_index) & 1
+                symbol = leaves.get((node, bit))
+                if symbol is None:
+                    node = children[node][bit]
+                elif symbol == EOS:
+                    decoded = None
+                    break
+                else:
+                    decoded.append(symbol)
+                    node = 0
+            transitions.append((node, None if decoded is None else bytes(decoded)))
+    return transitions, accepting
+
+HUFFMAN_TRANSITIONS, HUFFMAN_ACCEPTING = huffman_decoding_table()
+
+def huffman_decode(data: bytes) -> bytes:
+    decoded = []
+    state = 0
+    for byte in data:
+        for nibble in (byte >> 4, byte & 0x0f):
+            state, symbols = HUFFMAN_TRANSITIONS[state * 16 + nibble]
+            if symbols is None:
+                raise HpackError("huffman encoded string contains EOS")
+            decoded.append(symbols)
+    if not HUFFMAN_ACCEPTING[state]:
+        raise HpackError("huffman encoded string has invalid padding")
+    return b''.join(decoded)
+
+def huffman_encode(data: bytes) -> bytes:
+    bits = length = 0
+    for byte in data:
+        code, code_length = HUFFMAN_CODES[byte]
+        bits = (bits << code_length) | code
+        length += code_length
+    padding = -length % 8
+    #padded with the most significant bits of EOS, which are all ones
+    return ((bits << padding) | ((1 << padding) - 1)).to_bytes((length + padding) // 8, 'big')
+
+def encode_integer(value: int, prefix_bits: int, first_byte: int) -> bytes:
+    """
+    an integer with an N bit prefix, rfc 7541 section 5.1. first_byte has the bits before the prefix.
+    """
+    prefix_max = (1 << prefix_bits) - 1
+    if value < prefix_max:
+        return bytes([first_byte | value])
+    encoded = bytearray([first_byte | prefix_max])
+    value -= prefix_max
+    while value >= 128:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def encode_string(value: bytes) -> bytes:
+    huffman_encoded = huffman_encode(value)
+    if len(huffman_encoded) < len(value):
+        return encode_integer(len(huffman_encoded), 7, 0x80) + huffman_encoded
+    return encode_integer(len(value), 7, 0) + value
+
+def entry_size(name: bytes, value: bytes) -> int:
+    return len(name) + len(value) + 32
+
+class HpackDecoder:
+    """
+    Decodes header blocks (rfc 7541). The dynamic table lives as long as the connection and every header block
+    changes it, so every block a client sends has to be decoded, even for a stream that is refused.
+    """
+    def __init__(self, max_table_size: int = 4096):
+        #what we told the client in SETTINGS_HEADER_TABLE_SIZE, the client can use a smaller table than that
+        self.max_allowed_size = max_table_size
+        self.max_table_size = max_table_size
+        self.table: Deque[Header] = deque()
+        self.table_size = 0
+
+    def entry(self, index: int) -> Header:
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        dynamic_index = index - len(STATIC_TABLE) - 1
+        if index <= 0 or dynamic_index >= len(self.table):
+            raise HpackError(f"header index {index} is not in the table")
+        return self.table[dynamic_index]
+
+    def add(self, name: bytes, value: bytes) -> None:
+        size = entry_size(name, value)
+        while self.table and self.table_size + size > self.max_table_size:
+            evicted_name, evicted_value = self.table.pop()
+            self.table_size -= entry_size(evicted_name, evicted_value)
+        #an entry bigger than the whole table empties it and isn't added
+        if size <= self.max_table_size:
+            self.table.appendleft((name, value))
+            self.table_size += size
+
+    def resize(self, max_table_size: int) -> None:
+        if max_table_size > self.max_allowed_size:
+            raise HpackError(f"table size update to {max_table_size} is bigger than the allowed {self.max_allowed_size}")
+        self.max_table_size = max_table_size
+        while self.table_size > max_table_size:
+            evicted_name, evicted_value = self.table.pop()
+            self.table_size -= entry_size(evicted_name, evicted_value)
+
+    def decode(self, block: bytes) -> List[Header]:
+        headers = []
+        position = 0
+        block_length = len(block)
+        while position < block_length:
+            first_byte = block[position]
+            if first_byte & 0x80:
+                #indexed header field
+                index, position = self.decode_integer(block, position, 7)
+                headers.append(self.entry(index))
+            elif first_byte & 0x40:
+                #literal with incremental indexing
+                name, value, position = self.decode_literal(block, position, 6)
+                self.add(name, value)
+                headers.append((name, value))
+            elif first_byte & 0x20:
+                #dynamic table size update, only allowed before the first header of a block
+                if headers:
+                    raise HpackError("dynamic table size update after a header")
+                max_table_size, position = self.decode_integer(block, position, 5)
+                self.resize(max_table_size)
+            else:
+                #literal without indexing or never indexed (the 0x10 bit), the same for a decoder
+                name, value, position = self.decode_literal(block, position, 4)
+                headers.append((name, value))
+        return headers
+
+    def decode_literal(self, block: bytes, position: int, prefix_bits: int) -> Tuple[bytes, bytes, int]:
+        index, position = self.decode_integer(block, position, prefix_bits)
+        if index:
+            name = self.entry(index)[0]
+        else:
+            name, position = self.decode_string(block, position)
+        value, position = self.decode_string(block, position)
+        return name, value, position
+
+    def decode_integer(self, block: bytes, position: int, prefix_bits: int) -> Tuple[int, int]:
+        prefix_max = (1 << prefix_bits) - 1
+        value = block[position] & prefix_max
+        position += 1
+        if value < prefix_max:
+            return value, position
+        shift = 0
+        while True:
+            if position >= len(block):
+                raise HpackError("header block ends in the middle of an integer")
+            byte = block[position]
+            position += 1
+            value += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value, position
+            if shift > 28:
+                raise HpackError("integer in header block is too big")
+
+    def decode_string(self, block: bytes, position: int) -> Tuple[bytes, int]:
+        if position >= len(block):
+            raise HpackError("header block ends before a string")
+        huffman_encoded = block[position] & 0x80
+        length, position = self.decode_integer(block, position, 7)
+        end = position + length
+        if end > len(block):
+            raise HpackError("string is longer than the rest of the header block")
+        value = bytes(block[position:end])
+        return (huffman_decode(value) if huffman_encoded else value), end
+
+class HpackEncoder:
+    """
+    Encodes our response headers. A header that is already in the static or the dynamic table is sent as its index
+    (one byte, usually), any other header is sent once and added to the dynamic table, so the headers that are the
+    same in every response (content-type, server, cache-control...) cost a byte or two from the second response on.
+    Values that are different in every response would only push those out of the table, NOT_INDEXED headers aren't
+    added to it.
+    """
+    NOT_INDEXED = {b'content-length', b'date', b'age', b'etag', b'last-modified', b'expires', b'content-range',
+                   b'set-cookie', b'location'}
+
+    def __init__(self, max_table_size: int = 4096):
+        self.max_table_size = max_table_size
+        self.table: Deque[Tuple[Header, int]] = deque()
+        self.table_size = 0
+        #the dynamic table as dicts, to the number of the entry (how many entries were added before it) so that the
+        #dicts don't have to change when entries are added in front of it
+        self.inserted = 0
+        self.header_entries: Dict[Header, int] = {}
+        self.name_entries: Dict[bytes, int] = {}
+        #the client made the table smaller, the next block starts with a table size update
+        self.pending_resize: Optional[int] = None
+
+    def resize(self, max_table_size: int) -> None:
+        self.max_table_size = max_table_size
+        self.pending_resize = max_table_size if self.pending_resize is None else min(self.pending_resize, max_table_size)
+        self.evict(0)
+
+    def evict(self, room_needed: int) -> None:
+        while self.table and self.table_size + room_needed > self.max_table_size:
+            (name, value), number = self.table.pop()
+            self.table_size -= entry_size(name, value)
+            if self.header_entries.get((name, value)) == number:
+                del self.header_entries[(name, value)]
+            if self.name_entries.get(name) == number:
+                del self.name_entries[name]
+
+    def add(self, name: bytes, value: bytes) -> None:
+        size = entry_size(name, value)
+        self.evict(size)
+        if size <= self.max_table_size:
+            self.table.appendleft(((name, value), self.inserted))
+            self.header_entries[(name, value)] = self.inserted
+            self.name_entries[name] = self.inserted
+            self.inserted += 1
+            self.table_size += size
+
+    def dynamic_index(self, number: int) -> int:
+        return len(STATIC_TABLE) + self.inserted - number
+
+    def encode(self, headers: List[Header]) -> bytes:
+        encoded = []
+        if self.pending_resize is not None:
+            if self.pending_resize < self.max_table_size:
+                #made smaller and then bigger again, the smallest size has to be said first
+                encoded.append(encode_integer(self.pending_resize, 5, 0x20))
+            encoded.append(encode_integer(self.max_table_size, 5, 0x20))
+            self.pending_resize = None
+        for name, value in headers:
+            index = STATIC_INDEX.get((name, value))
+            if index is None and (name, value) in self.header_entries:
+                index = self.dynamic_index(self.header_entries[(name, value)])
+            if index is not None:
+                encoded.append(encode_integer(index, 7, 0x80))
+                continue
+            name_index = STATIC_NAME_INDEX.get(name)
+            if name_index is None and name in self.name_entries:
+                name_index = self.dynamic_index(self.name_entries[name])
+            if name in self.NOT_INDEXED:
+                encoded.append(encode_integer(name_index or 0, 4, 0))
+            else:
+                encoded.append(encode_integer(name_index or 0, 6, 0x40))
+                self.add(name, value)
+            if not name_index:
+                encoded.append(encode_string(name))
+            encoded.append(encode_string(value))
+        return b''.join(encoded)
@@ -0,0 +1,543 @@
+import base64
+import struct
+import time
+from typing import Dict, List, Optional
+from .general_utils import HttpRequest
+from .custom_exceptions import HpackError, Http2ConnectionError, NotValidHttpFormat
+from .hpack import HpackDecoder, HpackEncoder, Header
+from .http_parser import HttpRequestParser
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+DATA = 0x0
+HEADERS = 0x1
+PRIORITY = 0x2
+RST_STREAM = 0x3
+SETTINGS = 0x4
+PUSH_PROMISE = 0x5
+PING = 0x6
+GOAWAY = 0x7
+WINDOW_UPDATE = 0x8
+CONTINUATION = 0x9
+
+END_STREAM = 0x1
+ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+
+SETTINGS_HEADER_TABLE_SIZE = 0x1
+SETTINGS_ENABLE_PUSH = 0x2
+SETTINGS_MAX_CONCURRENT_STREAMS = 0x3
+SETTINGS_INITIAL_WINDOW_SIZE = 0x4
+SETTINGS_MAX_FRAME_SIZE = 0x5
+SETTINGS_MAX_HEADER_LIST_SIZE = 0x6
+
+NO_ERROR = 0x0
+PROTOCOL_ERROR = 0x1
+INTERNAL_ERROR = 0x2
+FLOW_CONTROL_ERROR = 0x3
+STREAM_CLOSED = 0x5
+FRAME_SIZE_ERROR = 0x6
+REFUSED_STREAM = 0x7
+CANCEL = 0x8
+COMPRESSION_ERROR = 0x9
+ENHANCE_YOUR_CALM = 0xb
+
+DEFAULT_WINDOW_SIZE = 65535
+MAX_WINDOW_SIZE = 2 ** 31 - 1
+MIN_FRAME_SIZE = 16384
+MAX_FRAME_SIZE = 2 ** 24 - 1
+
+#the length is 24 bits, split into its top byte and the rest
+FRAME_HEADER = struct.Struct('>BHBBL')
+SETTING = struct.Struct('>HL')
+
+#about the http/1.1 connection, they mean nothing (and aren't allowed) in http/2
+CONNECTION_HEADERS = {b'connection', b'keep-alive', b'proxy-connection', b'transfer-encoding', b'upgrade'}
+UPGRADE_HEADERS = CONNECTION_HEADERS | {b'http2-settings', b'content-length'}
+
+def frame(frame_type: int, flags: int, stream_id: int, payload: bytes = b'') -> bytes:
+    return FRAME_HEADER.pack(len(payload) >> 16, len(payload) & 0xffff, frame_type, flags, stream_id) + payload
+
+class Http2Stream:
+    """
+    A request and its response on an http/2 connection. The request is collected until the client ended its side
+    of the stream (headers and body, like the http/1.1 parser collects a whole request), then it's handled.
+    """
+    __slots__ = ('stream_id', 'headers', 'body', 'request_complete', 'response_started', 'response_complete', 'reset',
+                 'send_window', 'unacknowledged_bytes')
+
+    def __init__(self, stream_id: int, send_window: int):
+        self.stream_id = stream_id
+        self.headers: List[Header] = []
+        self.body = bytearray()
+        self.request_complete = False
+        self.response_started = False
+        self.response_complete = False
+        #the client reset the stream (or we did), nothing more is sent on it
+        self.reset = False
+        #how many bytes of DATA the client lets us send on the stream
+        self.send_window = send_window
+        #body bytes received that we haven't given the client a WINDOW_UPDATE for yet
+        self.unacknowledged_bytes = 0
+
+    @property
+    def closed(self) -> bool:
+        return self.reset or (self.request_complete and self.response_complete)
+
+    def __repr__(self) -> str:
+        return f'<Http2Stream {self.stream_id} {len(self.body)} bytes of body>'
+
+class Http2Connection:
+    """
+    The http/2 protocol (rfc 9113) for one client connection, without any of the I/O: receive takes the bytes read
+    from the client and returns the streams whose request is complete, what has to be sent to the client is
+    collected in outbound. The server reads and writes the socket and runs a coroutine per stream. Configured by the
+    "http2" block of the settings:
+    max_concurrent_streams: requests a client can have going on at the same time on a connection, more are refused.
+    initial_window_size: how many bytes of request body a client can send on a stream (and on the whole connection)
+    before we acknowledge them, bigger windows let an upload go faster on a connection with a lot of latency.
+    max_frame_size: the biggest frame we accept, 16KB to 16MB.
+    header_table_size: the size of the HPACK dynamic table the client compresses its headers with. Bigger means more
+    headers that are sent as an index, but it's memory for every connection.
+
+    Request bodies are collected like the http/1.1 parser collects them, so the windows are opened again as soon
+    as the body arrives, up to HttpRequestParser.MAX_BODY_BYTES per stream.
+    """
+    MAX_HEADER_BLOCK_BYTES = HttpRequestParser.MAX_HEADER_BYTES
+
+    def __init__(self, max_concurrent_streams: int = 100, initial_window_size: int = 1024 * 1024,
+                 max_frame_size: int = MIN_FRAME_SIZE, header_table_size: int = 4096):
+        self.max_concurrent_streams = max_concurrent_streams
+        self.initial_window_size = initial_window_size
+        self.max_frame_size = max_frame_size
+        self.decoder = HpackDecoder(header_table_size)
+        #the client's table size for what we send is its own setting, 4096 until it says otherwise
+        self.encoder = HpackEncoder()
+        self.header_table_size = header_table_size
+        self.buffer = bytearray()
+        self.outbound = bytearray()
+        #like the http/1.1 parser's, when the first bytes of a frame that isn't complete yet arrived
+        self.incomplete_since: Optional[float] = None
+        self.preface_received = False
+        self.settings_received = False
+        self.streams: Dict[int, Http2Stream] = {}
+        #the highest stream the client opened, every stream below it that isn't in streams is closed
+        self.last_stream_id = 0
+        self.streams_opened = 0
+        #stream id and what came in so far of a header block that goes on in CONTINUATION frames
+        self.continued_stream_id: Optional[int] = None
+        self.continued_flags = 0
+        self.continued_block = bytearray()
+        #what the client lets us send: connection wide and, for new streams, per stream
+        self.send_window = DEFAULT_WINDOW_SIZE
+        self.peer_initial_window_size = DEFAULT_WINDOW_SIZE
+        self.peer_max_frame_size = MIN_FRAME_SIZE
+        self.unacknowledged_bytes = 0
+        #streams could be waiting on a window that the client opened (or on a stream the client reset)
+        self.windows_changed = False
+        self.goaway_sent = False
+        self.goaway_received = False
+        self.completed_streams: List[Http2Stream] = []
+
+    def initiate(self) -> None:
+        """
+        our preface, it's sent right away without waiting for the client's.
+        """
+        settings = [(SETTINGS_MAX_CONCURRENT_STREAMS, self.max_concurrent_streams),
+                    (SETTINGS_INITIAL_WINDOW_SIZE, self.initial_window_size),
+                    (SETTINGS_MAX_FRAME_SIZE, self.max_frame_size),
+                    (SETTINGS_HEADER_TABLE_SIZE, self.header_table_size),
+                    (SETTINGS_MAX_HEADER_LIST_SIZE, self.MAX_HEADER_BLOCK_BYTES),
+                    (SETTINGS_ENABLE_PUSH, 0)]
+        self.outbound += frame(SETTINGS, 0, 0, b''.join(SETTING.pack(*setting) for setting in settings))
+        #the connection's window starts at the default whatever the settings say, only a WINDOW_UPDATE makes it bigger
+        if self.initial_window_size > DEFAULT_WINDOW_SIZE:
+            self.outbound += frame(WINDOW_UPDATE, 0, 0, struct.pack('>L', self.initial_window_size - DEFAULT_WINDOW_SIZE))
+
+    def upgrade(self, http2_settings: str) -> Http2Stream:
+        """
+        For a client that asked for h2c with an Upgrade header on an http/1.1 request: that request becomes stream 1,
+        which the client already ended its side of. HTTP2-Settings is the client's SETTINGS payload in base64url.
+        """
+        try:
+            payload = base64.urlsafe_b64decode(http2_settings + '=' * (-len(http2_settings) % 4))
+        except ValueError:
+            raise NotValidHttpFormat(f"HTTP2-Settings is not base64url: {http2_settings!r}")
+        self.initiate()
+        self.apply_settings(payload)
+        stream = Http2Stream(1, self.peer_initial_window_size)
+        stream.request_complete = True
+        self.streams[1] = stream
+        self.last_stream_id = 1
+        self.streams_opened = 1
+        return stream
+
+    def receive(self, data: bytes) -> List[Http2Stream]:
+        """
+        Raises Http2ConnectionError when the connection has to be closed, the GOAWAY saying why is in outbound then.
+        """
+        self.buffer += data
+        self.completed_streams = []
+        position = 0
+        try:
+            if not self.preface_received:
+                if len(self.buffer) < len(PREFACE):
+                    if not PREFACE.startswith(self.buffer):
+                        raise Http2ConnectionError(PROTOCOL_ERROR, "the client's connection preface is invalid")
+                    return []
+                if not self.buffer.startswith(PREFACE):
+                    raise Http2ConnectionError(PROTOCOL_ERROR, "the client's connection preface is invalid")
+                self.preface_received = True
+                position = len(PREFACE)
+            while len(self.buffer) - position >= FRAME_HEADER.size:
+                length_high, length_low, frame_type, flags, stream_id = FRAME_HEADER.unpack_from(self.buffer, position)
+                length = (length_high << 16) | length_low
+                if length > self.max_frame_size:
+                    raise Http2ConnectionError(FRAME_SIZE_ERROR, f"frame of {length} bytes is bigger than {self.max_frame_size}")
+                frame_end = position + FRAME_HEADER.size + length
+                if frame_end > len(self.buffer):
+                    break
+                payload = bytes(self.buffer[position + FRAME_HEADER.size:frame_end])
+                position = frame_end
+                self.receive_frame(frame_type, flags, stream_id & MAX_WINDOW_SIZE, payload)
+        except HpackError as error:
+            raise self.connection_error(Http2ConnectionError(COMPRESSION_ERROR, str(error)))
+        except Http2ConnectionError as error:
+            raise self.connection_error(error)
+        finally:
+            del self.buffer[:position]
+        if not self.buffer:
+            self.incomplete_since = None
+        elif self.incomplete_since is None:
+            self.incomplete_since = time.monotonic()
+        return self.completed_streams
+
+    def connection_error(self, error: Http2ConnectionError) -> Http2ConnectionError:
+        self.close(error.error_code)
+        return error
+
+    def receive_frame(self, frame_type: int, flags: int, stream_id: int, payload: bytes) -> None:
+        if self.continued_stream_id is not None and (frame_type != CONTINUATION or stream_id != self.continued_stream_id):
+            raise Http2ConnectionError(PROTOCOL_ERROR, "a header block was interrupted by another frame")
+        if not self.settings_received and frame_type != SETTINGS:
+            raise Http2ConnectionError(PROTOCOL_ERROR, "the client's preface doesn't start with SETTINGS")
+        if frame_type == DATA:
+            self.receive_data(flags, stream_id, payload)
+        elif frame_type == HEADERS:
+            self.receive_headers(flags, stream_id, payload)
+        elif frame_type == CONTINUATION:
+            if self.continued_stream_id is None:
+                raise Http2ConnectionError(PROTOCOL_ERROR, "CONTINUATION without a header block to continue")
+            self.continue_header_block(flags, payload)
+        elif frame_type == SETTINGS:
+            self.receive_settings(flags, stream_id, payload)
+        elif frame_type == WINDOW_UPDATE:
+            self.receive_window_update(stream_id, payload)
+        elif frame_type == RST_STREAM:
+            if stream_id == 0 or len(payload) != 4:
+                raise Http2ConnectionError(PROTOCOL_ERROR if stream_id == 0 else FRAME_SIZE_ERROR, "invalid RST_STREAM")
+            if stream_id > self.last_stream_id:
+                raise Http2ConnectionError(PROTOCOL_ERROR, f"RST_STREAM for stream {stream_id} that was never opened")
+            stream = self.streams.pop(stream_id, None)
+            if stream is not None:
+                stream.reset = True
+                self.windows_changed = True
+        elif frame_type == PING:
+            if stream_id != 0 or len(payload) != 8:
+                raise Http2ConnectionError(PROTOCOL_ERROR if stream_id else FRAME_SIZE_ERROR, "invalid PING")
+            if not flags & ACK:
+                self.outbound += frame(PING, ACK, 0, payload)
+        elif frame_type == PRIORITY:
+            #we answer streams in the order their requests are complete, priorities are only advice
+            if stream_id == 0:
+                raise Http2ConnectionError(PROTOCOL_ERROR, "PRIORITY for stream 0")
+            if len(payload) != 5:
+                self.reset_stream(stream_id, FRAME_SIZE_ERROR)
+        elif frame_type == GOAWAY:
+            #the client won't open new streams, the ones going on are still answered
+            self.goaway_received = True
+        elif frame_type == PUSH_PROMISE:
+            raise Http2ConnectionError(PROTOCOL_ERROR, "clients can't push")
+        #frames of unknown types are ignored
+
+    def without_padding(self, flags: int, payload: bytes) -> bytes:
+        if not flags & PADDED:
+            return payload
+        if not payload or payload[0] >= len(payload):
+            raise Http2ConnectionError(PROTOCOL_ERROR, "padding is longer than the frame")
+        return payload[1:len(payload) - payload[0]]
+
+    def receive_data(self, flags: int, stream_id: int, payload: bytes) -> None:
+        if stream_id == 0:
+            raise Http2ConnectionError(PROTOCOL_ERROR, "DATA on stream 0")
+        if stream_id > self.last_stream_id:
+            raise Http2ConnectionError(PROTOCOL_ERROR, f"DATA on stream {stream_id} that was never opened")
+        #padding counts for flow control, so the whole frame is acknowledged
+        self.acknowledge(None, len(payload))
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.request_complete:
+            self.reset_stream(stream_id, STREAM_CLOSED)
+            return
+        data = self.without_padding(flags, payload)
+        stream.body += data
+        if len(stream.body) > HttpRequestParser.MAX_BODY_BYTES:
+            self.reset_stream(stream_id, CANCEL)
+            return
+        if flags & END_STREAM:
+            self.complete(stream)
+        else:
+            self.acknowledge(stream, len(payload))
+
+    def acknowledge(self, stream: Optional[Http2Stream], received: int) -> None:
+        """
+        opens the window again for what was received, once half of it is used up so that a WINDOW_UPDATE isn't
+        sent for every frame.
+        """
+        owner = stream if stream is not None else self
+        owner.unacknowledged_bytes += received
+        if owner.unacknowledged_bytes >= self.initial_window_size // 2:
+            self.outbound += frame(WINDOW_UPDATE, 0, stream.stream_id if stream is not None else 0,
+                                   struct.pack('>L', owner.unacknowledged_bytes))
+            owner.unacknowledged_bytes = 0
+
+    def receive_headers(self, flags: int, stream_id: int, payload: bytes) -> None:
+        if stream_id == 0 or stream_id % 2 == 0:
+            raise Http2ConnectionError(PROTOCOL_ERROR, f"client opened stream {stream_id}, client streams are odd")
+        block = self.without_padding(flags, payload)
+        if flags & PRIORITY_FLAG:
+            if len(block) < 5:
+                raise Http2ConnectionError(FRAME_SIZE_ERROR, "HEADERS too short for its priority")
+            block = block[5:]
+        self.continued_stream_id = stream_id
+        self.continued_flags = flags
+        self.continued_block = bytearray(block)
+        if flags & END_HEADERS:
+            self.header_block_received()
+
+    def continue_header_block(self, flags: int, payload: bytes) -> None:
+        self.continued_block += payload
+        if len(self.continued_block) > self.MAX_HEADER_BLOCK_BYTES:
+            raise Http2ConnectionError(ENHANCE_YOUR_CALM, f"header block bigger than {self.MAX_HEADER_BLOCK_BYTES} bytes")
+        if flags & END_HEADERS:
+            self.header_block_received()
+
+    def header_block_received(self) -> None:
+        stream_id, flags = self.continued_stream_id, self.continued_flags
+        self.continued_stream_id = None
+        #decoded whatever happens to the stream, the block changes the dynamic table
+        headers = self.decoder.decode(bytes(self.continued_block))
+        self.continued_block = bytearray()
+        stream = self.streams.get(stream_id)
+        if stream is not None:
+            #trailers, they have to end the stream. Nobody needs them, the request is complete without them
+            if stream.request_complete:
+                self.reset_stream(stream_id, STREAM_CLOSED)
+            elif not flags & END_STREAM:
+                self.reset_stream(stream_id, PROTOCOL_ERROR)
+            else:
+                self.complete(stream)
+            return
+        if stream_id <= self.last_stream_id:
+            #a stream we closed (or refused), a client can send trailers on one before it knows
+            self.reset_stream(stream_id, STREAM_CLOSED)
+            return
+        self.last_stream_id = stream_id
+        if self.goaway_sent:
+            #streams after the GOAWAY are ignored, the client knows they weren't handled
+            return
+        if len(self.streams) >= self.max_concurrent_streams:
+            self.reset_stream(stream_id, REFUSED_STREAM)
+            return
+        stream = self.streams[stream_id] = Http2Stream(stream_id, self.peer_initial_window_size)
+        stream.headers = headers
+        self.streams_opened += 1
+        if flags & END_STREAM:
+            self.complete(stream)
+
+    def complete(self, stream: Http2Stream) -> None:
+        stream.request_complete = True
+        self.completed_streams.append(stream)
+
+    def receive_settings(self, flags: int, stream_id: int, payload: bytes) -> None:
+        if stream_id != 0:
+            raise Http2ConnectionError(PROTOCOL_ERROR, "SETTINGS on a stream")
+        if flags & ACK:
+            if payload:
+                raise Http2ConnectionError(FRAME_SIZE_ERROR, "SETTINGS ACK with a payload")
+            return
+        self.settings_received = True
+        self.apply_settings(payload)
+        self.outbound += frame(SETTINGS, ACK, 0)
+
+    def apply_settings(self, payload: bytes) -> None:
+        if len(payload) % SETTING.size:
+            raise Http2ConnectionError(FRAME_SIZE_ERROR, "SETTINGS payload isn't a whole number of settings")
+        for offset in range(0, len(payload), SETTING.size):
+            identifier, value = SETTING.unpack_from(payload, offset)
+            if identifier == SETTINGS_HEADER_TABLE_SIZE:
+                #the table we compress our headers with, we don't use more than the default however much is allowed
+                self.encoder.resize(min(value, 4096))
+            elif identifier == SETTINGS_ENABLE_PUSH and value > 1:
+                raise Http2ConnectionError(PROTOCOL_ERROR, f"SETTINGS_ENABLE_PUSH of {value}")
+            elif identifier == SETTINGS_INITIAL_WINDOW_SIZE:
+                if value > MAX_WINDOW_SIZE:
+                    raise Http2ConnectionError(FLOW_CONTROL_ERROR, f"SETTINGS_INITIAL_WINDOW_SIZE of {value}")
+                #changes the window of every stream by the difference, even if that makes it negative
+                for stream in self.streams.values():
+                    stream.send_window += value - self.peer_initial_window_size
+                self.peer_initial_window_size = value
+                self.windows_changed = True
+            elif identifier == SETTINGS_MAX_FRAME_SIZE:
+                if not MIN_FRAME_SIZE <= value <= MAX_FRAME_SIZE:
+                    raise Http2ConnectionError(PROTOCOL_ERROR, f"SETTINGS_MAX_FRAME_SIZE of {value}")
+                self.peer_max_frame_size = value
+            #the client's max concurrent streams only limits streams we'd push, and we don't push
+
+    def receive_window_update(self, stream_id: int, payload: bytes) -> None:
+        if len(payload) != 4:
+            raise Http2ConnectionError(FRAME_SIZE_ERROR, "WINDOW_UPDATE payload isn't 4 bytes")
+        increment = struct.unpack('>L', payload)[0] & MAX_WINDOW_SIZE
+        if stream_id == 0:
+            if increment == 0 or self.send_window + increment > MAX_WINDOW_SIZE:
+                raise Http2ConnectionError(PROTOCOL_ERROR if increment == 0 else FLOW_CONTROL_ERROR,
+                                           f"invalid connection WINDOW_UPDATE of {increment}")
+            self.send_window += increment
+            self.windows_changed = True
+            return
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            #can cross a stream being closed
+            return
+        if increment == 0 or stream.send_window + increment > MAX_WINDOW_SIZE:
+            self.reset_stream(stream_id, PROTOCOL_ERROR if increment == 0 else FLOW_CONTROL_ERROR)
+            return
+        stream.send_window += increment
+        self.windows_changed = True
+
+    def reset_stream(self, stream_id: int, error_code: int) -> None:
+        self.outbound += frame(RST_STREAM, 0, stream_id, struct.pack('>L', error_code))
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None:
+            stream.reset = True
+            self.windows_changed = True
+
+    def close(self, error_code: int = NO_ERROR) -> None:
+        """
+        tells the client that no stream after the last one it opened will be handled, the ones going on still are.
+        """
+        if not self.goaway_sent:
+            self.goaway_sent = True
+            self.outbound += frame(GOAWAY, 0, 0, struct.pack('>LL', self.last_stream_id, error_code))
+
+    def send_headers(self, stream: Http2Stream, headers: List[Header], end_stream: bool) -> None:
+        block = self.encoder.encode(headers)
+        flags = END_STREAM if end_stream else 0
+        frame_type = HEADERS
+        while True:
+            fragment, block = block[:self.peer_max_frame_size], block[self.peer_max_frame_size:]
+            self.outbound += frame(frame_type, flags | (0 if block else END_HEADERS), stream.stream_id, fragment)
+            if not block:
+                break
+            frame_type, flags = CONTINUATION, 0
+        if end_stream:
+            self.response_sent(stream)
+
+    def sendable(self, stream: Http2Stream) -> int:
+        """
+        how much of the body can go in the next DATA frame on the stream, 0 when one of the windows is closed.
+        """
+        return max(0, min(self.send_window, stream.send_window, self.peer_max_frame_size))
+
+    def send_data(self, stream: Http2Stream, data: bytes, end_stream: bool) -> None:
+        """
+        data has to fit in what sendable allows.
+        """
+        self.send_window -= len(data)
+        stream.send_window -= len(data)
+        self.outbound += frame(DATA, END_STREAM if end_stream else 0, stream.stream_id, data)
+        if end_stream:
+            self.response_sent(stream)
+
+    def response_sent(self, stream: Http2Stream) -> None:
+        stream.response_complete = True
+        if stream.closed:
+            self.streams.pop(stream.stream_id, None)
+
+def request_from_stream(stream: Http2Stream) -> HttpRequest:
+    """
+    The stream's request as the http/1.1 request the handlers know: :authority becomes Host and a body gets a
+    Content-Length. The proxying handlers send raw_http_request to the backends as it is, and the backends speak
+    http/1.1. Raises NotValidHttpFormat for a malformed request, that's a stream error.
+    """
+    pseudo_headers: Dict[bytes, bytes] = {}
+    header_lines = []
+    cookies = []
+    has_host = False
+    content_length = None
+    for name, value in stream.headers:
+        if b'\r' in value or b'\n' in value or b'\0' in value or name.lower() != name:
+            raise NotValidHttpFormat(f"invalid header {name!r}")
+        if name.startswith(b':'):
+            if header_lines or cookies or name in pseudo_headers:
+                raise NotValidHttpFormat(f"pseudo header {name!r} after the regular ones or repeated")
+            pseudo_headers[name] = value
+        elif name in CONNECTION_HEADERS or (name == b'te' and value != b'trailers'):
+            raise NotValidHttpFormat(f"connection specific header {name!r}")
+        elif name == b'cookie':
+            #a client can split the cookies up to compress them better, http/1.1 has them in one line
+            cookies.append(value)
+        else:
+            has_host = has_host or name == b'host'
+            if name == b'content-length':
+                content_length = value
+            header_lines.append(b'%s: %s' % (name, value))
+    method, path = pseudo_headers.get(b':method'), pseudo_headers.get(b':path')
+    if not method or not path or b':scheme' not in pseudo_headers or b' ' in path:
+        raise NotValidHttpFormat("request without :method, :scheme or a valid :path")
+    if not has_host and b':authority' in pseudo_headers:
+        header_lines.insert(0, b'host: ' + pseudo_headers[b':authority'])
+    if cookies:
+        header_lines.append(b'cookie: ' + b'; '.join(cookies))
+    if content_length is None:
+        if stream.body or method in (b'POST', b'PUT', b'PATCH'):
+            header_lines.append(b'content-length: %d' % len(stream.body))
+    elif content_length != str(len(stream.body)).encode():
+        raise NotValidHttpFormat(f"content-length {content_length!r} but {len(stream.body)} bytes of body")
+    head = b'\r\n'.join([b'%s %s HTTP/1.1' % (method, path)] + header_lines)
+    return HttpRequest.from_bytes(head + b'\r\n\r\n' + bytes(stream.body))
+
+def response_headers(head: bytes) -> List[Header]:
+    """
+    the headers of an http/2 response from the head of an http/1.1 one.
+    """
+    status_line, *header_lines = head.rstrip(b'\r\n').split(b'\r\n')
+    headers = [(b':status', status_line.split()[1])]
+    for header_line in header_lines:
+        name, _, value = header_line.partition(b':')
+        name = name.strip().lower()
+        if name not in CONNECTION_HEADERS:
+            headers.append((name, value.strip()))
+    return headers
+
+def upgraded_request(http_request: HttpRequest) -> HttpRequest:
+    """
+    the request a client asked to upgrade with, as stream 1 gets it: without the headers about the upgrade, which a
+    backend it's proxied to shouldn't see, and with its body de-chunked like on any http/2 stream.
+    """
+    head_lines = bytes(http_request.raw_http_request[:http_request.head_length]).split(b'\r\n')
+    kept_lines = [head_lines[0]] + [line for line in head_lines[1:] if line.split(b':', 1)[0].strip().lower()
+                                    not in UPGRADE_HEADERS]
+    if http_request.body:
+        kept_lines.append(b'content-length: %d' % len(http_request.body))
+    return HttpRequest.from_bytes(b'\r\n'.join(kept_lines) + b'\r\n\r\n' + http_request.body)
+
+def wants_h2c_upgrade(http_request: HttpRequest) -> bool:
+    """
+    an http/1.1 request that asks to go on in http/2 over the same connection (rfc 7540 section 3.2).
+    """
+    upgrade = [token.strip().lower() for token in (http_request.get_header('Upgrade') or '').split(',')]
+    connection = [token.strip().lower() for token in (http_request.get_header('Connection') or '').split(',')]
+    return 'h2c' in upgrade and 'upgrade' in connection and 'http2-settings' in connection and \
+        http_request.get_header('HTTP2-Settings') is not None
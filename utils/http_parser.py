@@ -0,0 +1,352 @@
+import time
+from typing import List, Optional, Dict
+from .general_utils import HttpRequest
+from .custom_exceptions import NotValidHttpFormat
+from .profiling import PROFILER
+
+
+class HttpRequestParser:
+    """
+    An incremental http/1.1 request parser. A server keeps one of these per client connection and feeds it
+    whatever bytes it read from the socket. The parser keeps the bytes that don't form a complete request yet
+    and returns every complete request it found, so a chunk that contains the end of one request and two
+    pipelined requests after it gives back all three requests.
+
+    Nothing is scanned twice: when looking for the end of the headers (or the end of a chunk size line) the
+    parser remembers how far it already searched and continues from there when more bytes arrive.
+    """
+    MAX_HEADER_BYTES = 1024 * 64
+    MAX_BODY_BYTES = 1024 * 1024 * 16
+
+    READING_HEAD = 1
+    READING_BODY = 2
+    READING_CHUNK_SIZE = 3
+    READING_CHUNK_DATA = 4
+    READING_TRAILERS = 5
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.position = 0 #where the message currently being parsed starts in the buffer
+        #when the first bytes of the request that isn't complete yet arrived (monotonic clock), None between requests.
+        #the servers use it to give a client a limited time to send a whole request.
+        self.incomplete_since: Optional[float] = None
+        #how many requests came out of this parser, that is how many the connection carried
+        self.requests_parsed = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.state = self.READING_HEAD
+        self.cursor = 0 #where the next piece (body, chunk size line, chunk data, trailers) starts relative to self.position
+        self.scanned_up_to = 0 #how far (relative to self.position) we've already searched for a delimiter
+        self.body_start = 0
+        self.body_length = 0
+        self.current_request: Optional[HttpRequest] = None
+        self.chunks: List[bytes] = []
+        self.remaining_chunk_bytes = 0
+
+    def feed(self, data: bytes) -> List[HttpRequest]:
+        """
+        Adds data to the buffer and returns all the requests that are now complete (possibly none).
+        Raises NotValidHttpFormat if the bytes can't be a valid request.
+        """
+        self.buffer += data
+        complete_requests = []
+        with PROFILER.span('parse'):
+            while True:
+                http_request = self.parse_next()
+                if http_request is None:
+                    break
+                complete_requests.append(http_request)
+        #get rid of the bytes of the requests that were already handed out once per feed rather than once per request
+        if self.position:
+            del self.buffer[:self.position]
+            self.position = 0
+        if complete_requests or not self.buffer:
+            self.incomplete_since = None
+        if self.buffer and self.incomplete_since is None:
+            self.incomplete_since = time.monotonic()
+        return complete_requests
+
+    def find(self, delimiter: bytes, limit: int) -> int:
+        """
+        Searches for the delimiter starting at the cursor, or where the previous search left off if that is further
+        along, and returns its offset relative to the start of the current message or -1. 
+        """
+        search_start = self.position + max(self.cursor, self.scanned_up_to - len(delimiter) + 1)
+        index = self.buffer.find(delimiter, search_start)
+        if index == -1:
+            self.scanned_up_to = len(self.buffer) - self.position
+            if self.scanned_up_to - self.cursor > limit:
+                raise NotValidHttpFormat(f"could not find {delimiter!r} in the first {limit} bytes")
+            return -1
+        self.scanned_up_to = 0
+        return index - self.position
+
+    def parse_next(self) -> Optional[HttpRequest]:
+        if self.state == self.READING_HEAD:
+            if not self.parse_head():
+                return None
+        if self.state == self.READING_BODY:
+            return self.parse_body()
+        while self.state in (self.READING_CHUNK_SIZE, self.READING_CHUNK_DATA):
+            if self.state == self.READING_CHUNK_SIZE and not self.parse_chunk_size():
+                return None
+            if self.state == self.READING_CHUNK_DATA and not self.parse_chunk_data():
+                return None
+        if self.state == self.READING_TRAILERS:
+            return self.parse_trailers()
+        return None
+
+    def parse_head(self) -> bool:
+        #tolerate empty lines between pipelined requests (rfc 7230 section 3.5)
+        while self.buffer.startswith(b'\r\n', self.position):
+            self.position += 2
+            self.scanned_up_to = 0
+        head_end = self.find(b'\r\n\r\n', self.MAX_HEADER_BYTES)
+        if head_end == -1:
+            return False
+        head = bytes(self.buffer[self.position:self.position + head_end])
+        self.current_request = HttpRequest.from_head(head)
+        self.body_start = head_end + 4
+        self.cursor = self.body_start
+        transfer_encoding = self.current_request.get_header('Transfer-Encoding')
+        if transfer_encoding is not None:
+            #proxied requests are sent on as they came, a backend that went by the other header would see the end of
+            #the request somewhere else (request smuggling). Without chunked last there is no telling where it ends
+            #at all (rfc 9112 section 6.1)
+            if self.current_request.get_header('Content-Length') is not None:
+                raise NotValidHttpFormat("a request can't have both Content-Length and Transfer-Encoding")
+            if not transfer_encoding.lower().endswith('chunked'):
+                raise NotValidHttpFormat(f"the last transfer coding of a request must be chunked, got {transfer_encoding}")
+            self.state = self.READING_CHUNK_SIZE
+        else:
+            content_length = self.current_request.get_header('Content-Length', '0')
+            try:
+                self.body_length = int(content_length)
+            except ValueError:
+                raise NotValidHttpFormat(f"invalid content length {content_length}")
+            if self.body_length < 0 or self.body_length > self.MAX_BODY_BYTES:
+                raise NotValidHttpFormat(f"content length of {self.body_length} is not allowed")
+            self.state = self.READING_BODY
+        return True
+
+    def parse_body(self) -> Optional[HttpRequest]:
+        message_end = self.body_start + self.body_length
+        if len(self.buffer) - self.position < message_end:
+            return None
+        body = bytes(self.buffer[self.position + self.body_start:self.position + message_end])
+        return self.finish_request(body, message_end)
+
+    def parse_chunk_size(self) -> bool:
+        line_end = self.find(b'\r\n', 1024)
+        if line_end == -1:
+            return False
+        size_line = self.buffer[self.position + self.cursor:self.position + line_end]
+        try:
+            #chunk extensions (;name=value) are allowed after the size, ignore them
+            chunk_size = int(bytes(size_line).split(b';')[0].strip(), 16)
+        except ValueError:
+            raise NotValidHttpFormat(f"invalid chunk size line {bytes(size_line)!r}")
+        self.cursor = line_end + 2
+        if chunk_size == 0:
+            self.state = self.READING_TRAILERS
+        else:
+            self.body_length += chunk_size
+            if self.body_length > self.MAX_BODY_BYTES:
+                raise NotValidHttpFormat(f"chunked body is larger than {self.MAX_BODY_BYTES} bytes")
+            self.remaining_chunk_bytes = chunk_size
+            self.state = self.READING_CHUNK_DATA
+        return True
+
+    def parse_chunk_data(self) -> bool:
+        chunk_start = self.cursor
+        chunk_end = chunk_start + self.remaining_chunk_bytes
+        if len(self.buffer) - self.position < chunk_end + 2:
+            return False
+        if self.buffer[self.position + chunk_end:self.position + chunk_end + 2] != b'\r\n':
+            raise NotValidHttpFormat("chunk data is not followed by CRLF")
+        self.chunks.append(bytes(self.buffer[self.position + chunk_start:self.position + chunk_end]))
+        self.cursor = chunk_end + 2
+        self.state = self.READING_CHUNK_SIZE
+        return True
+
+    def parse_trailers(self) -> Optional[HttpRequest]:
+        trailers_start = self.cursor
+        if self.buffer.startswith(b'\r\n', self.position + trailers_start):
+            return self.finish_request(b''.join(self.chunks), trailers_start + 2)
+        trailers_end = self.find(b'\r\n\r\n', self.MAX_HEADER_BYTES)
+        if trailers_end == -1:
+            return None
+        return self.finish_request(b''.join(self.chunks), trailers_end + 4)
+
+    def finish_request(self, body: bytes, message_end: int) -> HttpRequest:
+        http_request = self.current_request
+        http_request.body = body
+        http_request.raw_http_request = bytes(self.buffer[self.position:self.position + message_end])
+        self.position += message_end
+        self.requests_parsed += 1
+        self.reset()
+        return http_request
+
+    def has_partial_request(self) -> bool:
+        return len(self.buffer) > self.position
+
+class HttpResponseParser:
+    """
+    An incremental parser for a response coming back from an upstream server. Unlike the request parser it
+    doesn't keep the body around or undo the chunked encoding: it only tracks where the response ends so that the
+    raw bytes can be passed along untouched and so that we know whether the connection can be reused afterwards.
+
+    feed returns how many of the given bytes belong to this response, anything after that is not part of it
+    (which for an upstream that we only send one request at a time to means the connection can't be trusted).
+
+    With keep_body the body (without the chunked framing) is collected in body_parts as it goes by, for http/2
+    clients which get the body in DATA frames instead. Whoever reads them empties the list.
+    """
+    MAX_HEADER_BYTES = 1024 * 64
+
+    CHUNK_SIZE = 1
+    CHUNK_DATA = 2
+    CHUNK_DATA_END = 3
+    CHUNK_TRAILERS = 4
+
+    def __init__(self, request_method: str = 'GET', keep_body: bool = False):
+        self.request_method = request_method
+        self.body_parts: Optional[List[bytes]] = [] if keep_body else None
+        self.head_buffer = bytearray()
+        self.head: Optional[bytes] = None
+        self.status_code = 0
+        self.headers: Dict[str, str] = {}
+        self.keep_alive = False
+        self.framing = ''
+        self.remaining_bytes = 0
+        self.chunk_state = self.CHUNK_SIZE
+        self.line_buffer = bytearray()
+        self.complete = False
+
+    def feed(self, data: bytes) -> int:
+        position = 0
+        while position < len(data) and not self.complete:
+            if self.head is None:
+                position = self.feed_head(data, position)
+            elif self.framing == 'length':
+                taken = min(self.remaining_bytes, len(data) - position)
+                if self.body_parts is not None and taken:
+                    self.body_parts.append(data[position:position + taken])
+                self.remaining_bytes -= taken
+                position += taken
+                self.complete = self.remaining_bytes == 0
+            elif self.framing == 'chunked':
+                position = self.feed_chunked(data, position)
+            else:
+                if self.body_parts is not None and self.framing == 'close':
+                    self.body_parts.append(data[position:])
+                position = len(data)
+        return position
+
+    def feed_head(self, data: bytes, position: int) -> int:
+        already_buffered = len(self.head_buffer)
+        self.head_buffer += data[position:]
+        head_end = self.head_buffer.find(b'\r\n\r\n', max(already_buffered - 3, 0))
+        if head_end == -1:
+            if len(self.head_buffer) > self.MAX_HEADER_BYTES:
+                raise NotValidHttpFormat(f"upstream response headers are bigger than {self.MAX_HEADER_BYTES} bytes")
+            return len(data)
+        head_end += 4
+        consumed = position + head_end - already_buffered
+        self.parse_head(bytes(self.head_buffer[:head_end]))
+        self.head_buffer = bytearray()
+        if 100 <= self.status_code < 200 and self.status_code != 101:
+            #an interim response (100 continue), the real response head follows it
+            self.head = None
+        return consumed
+
+    def parse_head(self, head: bytes) -> None:
+        status_line, *header_lines = head[:-4].decode('latin-1').split('\r\n')
+        try:
+            protocol_version, status_code, *status_text = status_line.split()
+            self.status_code = int(status_code)
+        except ValueError:
+            raise NotValidHttpFormat(f"malformed upstream status line: {status_line!r}")
+        self.head = head
+        self.headers = {}
+        lowercase_headers = {}
+        for header_line in header_lines:
+            header_name, separator, header_value = header_line.partition(':')
+            if not separator:
+                raise NotValidHttpFormat(f"malformed upstream header line: {header_line!r}")
+            self.headers[header_name.strip()] = header_value.strip()
+            lowercase_headers[header_name.strip().lower()] = header_value.strip()
+
+        connection_tokens = [token.strip().lower() for token in lowercase_headers.get('connection', '').split(',')]
+        if protocol_version == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in connection_tokens
+        else:
+            self.keep_alive = 'close' not in connection_tokens
+
+        if self.request_method == 'HEAD' or self.status_code in (204, 304) or 100 <= self.status_code < 200:
+            self.framing = 'none'
+            self.complete = not (100 <= self.status_code < 200) or self.status_code == 101
+        elif lowercase_headers.get('transfer-encoding', '').lower().endswith('chunked'):
+            self.framing = 'chunked'
+        elif 'content-length' in lowercase_headers:
+            try:
+                self.remaining_bytes = int(lowercase_headers['content-length'])
+            except ValueError:
+                raise NotValidHttpFormat(f"invalid upstream content length {lowercase_headers['content-length']}")
+            self.framing = 'length'
+            self.complete = self.remaining_bytes == 0
+        else:
+            #the body ends when the upstream closes the connection, so it can't be reused
+            self.framing = 'close'
+            self.keep_alive = False
+
+    def feed_chunked(self, data: bytes, position: int) -> int:
+        if self.chunk_state == self.CHUNK_DATA:
+            taken = min(self.remaining_bytes, len(data) - position)
+            if self.body_parts is not None:
+                self.body_parts.append(data[position:position + taken])
+            self.remaining_bytes -= taken
+            if self.remaining_bytes == 0:
+                self.chunk_state = self.CHUNK_DATA_END
+                self.remaining_bytes = 2
+            return position + taken
+        if self.chunk_state == self.CHUNK_DATA_END:
+            taken = min(self.remaining_bytes, len(data) - position)
+            self.remaining_bytes -= taken
+            if self.remaining_bytes == 0:
+                self.chunk_state = self.CHUNK_SIZE
+            return position + taken
+
+        #the chunk size line and the trailers are lines, collect bytes until the end of the line
+        line_end = data.find(b'\n', position)
+        if line_end == -1:
+            self.line_buffer += data[position:]
+            if len(self.line_buffer) > self.MAX_HEADER_BYTES:
+                raise NotValidHttpFormat("upstream chunk size line or trailers are too long")
+            return len(data)
+        line = bytes(self.line_buffer + data[position:line_end])
+        self.line_buffer = bytearray()
+        if self.chunk_state == self.CHUNK_SIZE:
+            try:
+                chunk_size = int(line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise NotValidHttpFormat(f"invalid upstream chunk size line {line!r}")
+            if chunk_size == 0:
+                self.chunk_state = self.CHUNK_TRAILERS
+            else:
+                self.chunk_state = self.CHUNK_DATA
+                self.remaining_bytes = chunk_size
+        elif not line.strip():
+            self.complete = True
+        return line_end + 1
+
+    def finish_on_close(self) -> None:
+        """
+        called when the upstream closed the connection. That's only a proper end of the response
+        if the response is delimited by the connection closing.
+        """
+        if self.head is not None and self.framing == 'close':
+            self.complete = True
+        else:
+            raise ConnectionResetError("upstream closed the connection before the response was complete")
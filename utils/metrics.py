@@ -0,0 +1,230 @@
+import threading
+import weakref
+from typing import Dict, List, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class LatencyHistogram:
+    """
+    A histogram in the style of HdrHistogram: every power of two (in microseconds) is split into SUB_BUCKETS buckets
+    of equal width, so every value is recorded with the same relative precision (about 3%) from a microsecond up to
+    an hour, in a fixed number of buckets. Recording is finding the bucket with a couple of bit operations and
+    incrementing it.
+    """
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+    MAX_MICROSECONDS = 3600 * 1000 * 1000
+    BUCKET_COUNT = SUB_BUCKETS + (MAX_MICROSECONDS.bit_length() - SUB_BUCKET_BITS) * HALF_SUB_BUCKETS
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKET_COUNT
+        self.count = 0
+        self.sum_microseconds = 0
+
+    @classmethod
+    def bucket_index(cls, microseconds: int) -> int:
+        if microseconds < cls.SUB_BUCKETS:
+            return microseconds
+        #keep the top SUB_BUCKET_BITS bits of the value, the rest only says which power of two it's in
+        shift = microseconds.bit_length() - cls.SUB_BUCKET_BITS
+        return cls.SUB_BUCKETS + (shift - 1) * cls.HALF_SUB_BUCKETS + (microseconds >> shift) - cls.HALF_SUB_BUCKETS
+
+    @classmethod
+    def bucket_upper_bound(cls, index: int) -> int:
+        """
+        the smallest value in microseconds that is too big for the bucket.
+        """
+        if index < cls.SUB_BUCKETS:
+            return index + 1
+        shift, sub_bucket = divmod(index - cls.SUB_BUCKETS, cls.HALF_SUB_BUCKETS)
+        return (cls.HALF_SUB_BUCKETS + sub_bucket + 1) << (shift + 1)
+
+    def record(self, microseconds: int) -> None:
+        self.counts[self.bucket_index(min(microseconds, self.MAX_MICROSECONDS))] += 1
+        self.count += 1
+        self.sum_microseconds += microseconds
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        for index, count in enumerate(list(other.counts)):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.sum_microseconds += other.sum_microseconds
+
+    def percentile(self, fraction: float) -> float:
+        """
+        in seconds, the upper bound of the bucket the percentile falls in.
+        """
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return self.bucket_upper_bound(index) / 1e6
+        return 0.0
+
+    def cumulative_counts(self, bounds_in_seconds: List[float]) -> List[int]:
+        """
+        how many values are at or under each bound, what a prometheus histogram's buckets are.
+        """
+        cumulative_counts = []
+        index = 0
+        seen = 0
+        for bound in bounds_in_seconds:
+            bound_microseconds = bound * 1e6
+            while index < self.BUCKET_COUNT and self.bucket_upper_bound(index) <= bound_microseconds:
+                seen += self.counts[index]
+                index += 1
+            cumulative_counts.append(seen)
+        return cumulative_counts
+
+class MetricsShard:
+    """
+    The metrics recorded by one thread. Only that thread ever writes to it, so recording doesn't take a lock.
+    """
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], int] = {}
+        self.histograms: Dict[str, LatencyHistogram] = {}
+
+    def merge(self, other: 'MetricsShard') -> None:
+        #copying first so that the other shard's thread can keep adding to it while it's being read
+        for key, value in dict(other.counters).items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for task_name, histogram in dict(other.histograms).items():
+            self.histograms.setdefault(task_name, LatencyHistogram()).merge(histogram)
+
+class Metrics:
+    """
+    Request metrics for one server: per task request counts (by status code), latency histograms, request and
+    response bytes, plus upstream errors for the proxying handlers. Served in the prometheus text format by the
+    MetricsHandler (the 'metrics' task).
+
+    Every thread records into its own MetricsShard, so threads never wait on each other to record. The shards are
+    only added up when the metrics are read. The shard of a thread that exited is folded into retired so that the
+    ThreadPerClient server (a thread per connection) doesn't pile up shards.
+
+    In pre-fork mode every worker has its own metrics, a scrape only sees the worker that answered it.
+    """
+    LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+    QUANTILES = [0.5, 0.9, 0.99, 0.999]
+    DESCRIPTIONS = {
+        'pyrver_requests_total': ('counter', 'Requests handled by task and status code.'),
+        'pyrver_request_bytes_total': ('counter', 'Bytes of requests (head and body) by task.'),
+        'pyrver_response_bytes_total': ('counter', 'Bytes of response bodies by task.'),
+        'pyrver_upstream_errors_total': ('counter', 'Failed attempts to get a response from a backend by backend and error.'),
+        'pyrver_shed_requests_total': ('counter', 'Requests answered with a 503 because every worker was busy.'),
+        'pyrver_coalesced_requests_total': ('counter', 'Requests to proxy tasks answered with a copy of a response another request fetched at the same time, by task.'),
+        'pyrver_cache_requests_total': ('counter', 'Requests to cached proxy tasks by task and what the cache did (hit, stale, miss, revalidated, expired, bypass).'),
+    }
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards: List[MetricsShard] = []
+        self.retired = MetricsShard()
+        self.lock = threading.Lock()
+
+    def shard(self) -> MetricsShard:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = MetricsShard()
+            self.local.shard = shard
+            with self.lock:
+                self.shards.append(shard)
+            weakref.finalize(threading.current_thread(), self.retire, shard)
+            return shard
+
+    def retire(self, shard: MetricsShard) -> None:
+        with self.lock:
+            self.shards.remove(shard)
+            self.retired.merge(shard)
+
+    def increment(self, metric_name: str, labels: Labels, amount: int = 1) -> None:
+        counters = self.shard().counters
+        key = (metric_name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def record_request(self, task_name: str, status_code: int, seconds: float, request_bytes: int, response_bytes: int) -> None:
+        shard = self.shard()
+        counters = shard.counters
+        task_labels = (('task', task_name),)
+        for key, amount in ((('pyrver_requests_total', (('task', task_name), ('code', str(status_code)))), 1),
+                            (('pyrver_request_bytes_total', task_labels), request_bytes),
+                            (('pyrver_response_bytes_total', task_labels), response_bytes)):
+            counters[key] = counters.get(key, 0) + amount
+        histogram = shard.histograms.get(task_name)
+        if histogram is None:
+            histogram = shard.histograms[task_name] = LatencyHistogram()
+        histogram.record(int(seconds * 1e6))
+
+    def observe(self, histogram_name: str, seconds: float) -> None:
+        histograms = self.shard().histograms
+        histogram = histograms.get(histogram_name)
+        if histogram is None:
+            histogram = histograms[histogram_name] = LatencyHistogram()
+        histogram.record(int(seconds * 1e6))
+
+    def record_upstream_error(self, address: Tuple[str, int], error: Exception) -> None:
+        self.increment('pyrver_upstream_errors_total', (('upstream', f'{address[0]}:{address[1]}'), ('error', type(error).__name__)))
+
+    def snapshot(self) -> MetricsShard:
+        total = MetricsShard()
+        with self.lock:
+            total.merge(self.retired)
+            for shard in self.shards:
+                total.merge(shard)
+        return total
+
+    def render(self, server_stats: Dict[str, int]) -> str:
+        """
+        the prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        counters_by_name: Dict[str, List[Tuple[Labels, int]]] = {}
+        for (metric_name, labels), value in sorted(snapshot.counters.items()):
+            counters_by_name.setdefault(metric_name, []).append((labels, value))
+        for metric_name, samples in counters_by_name.items():
+            metric_type, description = self.DESCRIPTIONS.get(metric_name, ('counter', ''))
+            lines.append(f'# HELP {metric_name} {description}')
+            lines.append(f'# TYPE {metric_name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{metric_name}{format_labels(labels)} {value}')
+
+        lines.append('# HELP pyrver_request_duration_seconds Time from the request being parsed to the response being ready, by task.')
+        lines.append('# TYPE pyrver_request_duration_seconds histogram')
+        for task_name, histogram in sorted(snapshot.histograms.items()):
+            for bound, cumulative_count in zip(self.LATENCY_BUCKETS, histogram.cumulative_counts(self.LATENCY_BUCKETS)):
+                lines.append(f'pyrver_request_duration_seconds_bucket{format_labels((("task", task_name), ("le", str(bound))))} {cumulative_count}')
+            lines.append(f'pyrver_request_duration_seconds_bucket{format_labels((("task", task_name), ("le", "+Inf")))} {histogram.count}')
+            lines.append(f'pyrver_request_duration_seconds_sum{format_labels((("task", task_name),))} {histogram.sum_microseconds / 1e6}')
+            lines.append(f'pyrver_request_duration_seconds_count{format_labels((("task", task_name),))} {histogram.count}')
+
+        lines.append('# HELP pyrver_request_duration_quantile_seconds Latency percentiles from the full resolution histograms, by task.')
+        lines.append('# TYPE pyrver_request_duration_quantile_seconds gauge')
+        for task_name, histogram in sorted(snapshot.histograms.items()):
+            for quantile in self.QUANTILES:
+                lines.append(f'pyrver_request_duration_quantile_seconds{format_labels((("task", task_name), ("quantile", str(quantile))))} {histogram.percentile(quantile)}')
+
+        lines.append('# HELP pyrver_connections_accepted_total Client connections accepted.')
+        lines.append('# TYPE pyrver_connections_accepted_total counter')
+        lines.append(f"pyrver_connections_accepted_total {server_stats.get('connections_accepted', 0)}")
+        lines.append('# HELP pyrver_active_connections Client connections currently open.')
+        lines.append('# TYPE pyrver_active_connections gauge')
+        lines.append(f"pyrver_active_connections {server_stats.get('active_connections', 0)}")
+        if 'tls_full_handshakes' in server_stats:
+            lines.append('# HELP pyrver_tls_handshakes_total TLS handshakes completed, by whether a session was resumed.')
+            lines.append('# TYPE pyrver_tls_handshakes_total counter')
+            lines.append(f"pyrver_tls_handshakes_total{format_labels((('resumed', 'false'),))} {server_stats['tls_full_handshakes']}")
+            lines.append(f"pyrver_tls_handshakes_total{format_labels((('resumed', 'true'),))} {server_stats['tls_resumed_handshakes']}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped_labels = []
+    for name, value in labels:
+        escaped_value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped_labels.append(f'{name}="{escaped_value}"')
+    return '{' + ','.join(escaped_labels) + '}'
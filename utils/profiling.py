@@ -0,0 +1,143 @@
+import os
+import sys
+import threading
+import time
+from typing import Dict, Generator, Optional
+from .metrics import Metrics
+
+class Span:
+    """
+    Times the code in a with block and records it with the profiler under the span's name. In a generator the time
+    the generator spent suspended (waiting on a socket for example) is part of the span.
+    """
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.profiler.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+class NoSpan:
+    """
+    what the profiler hands out while it's off, so a span costs next to nothing when nobody is profiling.
+    """
+    def __enter__(self) -> 'NoSpan':
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+NO_SPAN = NoSpan()
+
+class Profiler:
+    """
+    A profiler that can be turned on and off while the server runs (see the 'profiling' task). While it's on:
+
+    1. a thread samples the stack of every other thread every sample_interval seconds. The stacks are counted in the
+    collapsed format ('outermost;...;innermost count' per line) that flamegraph.pl, speedscope and most other flame
+    graph tools read. Sampling is wall clock, threads waiting in select or recv show up too.
+    2. the spans around parsing, routing, running the handler and sending the response record how long they took,
+    into the same histograms the metrics use (thread local shards, so recording doesn't take a lock).
+    3. the PurelySync server's event loop records how long every coroutine waited between being ready (its socket
+    became readable/writable, its timer was due) and being resumed, by coroutine.
+
+    There is one profiler per process, in pre-fork mode every worker has its own and a request to the 'profiling'
+    task only reaches one of them.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sample_interval = 0.005
+        self.durations = Metrics()
+        self.stack_counts: Dict[str, int] = {}
+        self.samples_taken = 0
+        self.sampler: Optional[threading.Thread] = None
+        self.frame_labels: Dict = {}
+        self.lock = threading.Lock()
+
+    def start(self, sample_interval: Optional[float] = None) -> None:
+        """
+        starts a new profile, whatever was recorded by the previous one is dropped.
+        """
+        with self.lock:
+            if self.enabled:
+                return
+            if sample_interval is not None:
+                self.sample_interval = sample_interval
+            self.durations = Metrics()
+            self.stack_counts = {}
+            self.samples_taken = 0
+            self.enabled = True
+            self.sampler = threading.Thread(target=self.sample_stacks, name='profiler', daemon=True)
+            self.sampler.start()
+
+    def stop(self) -> None:
+        """
+        stops recording, what was recorded stays around until the next start.
+        """
+        with self.lock:
+            self.enabled = False
+            sampler, self.sampler = self.sampler, None
+        if sampler is not None and sampler is not threading.current_thread():
+            sampler.join()
+
+    def span(self, name: str):
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name)
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.durations.observe(name, seconds)
+
+    def observe_scheduling_delay(self, coroutine: Generator, seconds: float) -> None:
+        self.durations.observe(f'scheduling delay {getattr(coroutine, "__qualname__", "?")}', seconds)
+
+    def sample_stacks(self) -> None:
+        sampler_id = threading.get_ident()
+        while self.enabled:
+            time.sleep(self.sample_interval)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = self.collapse(frame)
+                self.stack_counts[stack] = self.stack_counts.get(stack, 0) + 1
+            self.samples_taken += 1
+
+    def collapse(self, frame) -> str:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self.frame_labels.get(code)
+            if label is None:
+                #semicolons separate the frames in the collapsed format
+                label = f'{code.co_name} ({os.path.basename(code.co_filename)})'.replace(';', ':')
+                self.frame_labels[code] = label
+            labels.append(label)
+            frame = frame.f_back
+        labels.reverse()
+        return ';'.join(labels)
+
+    def collapsed_stacks(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(dict(self.stack_counts).items()))
+
+    def report(self) -> str:
+        """
+        a table of the spans and scheduling delays, in milliseconds (the percentiles are the upper bounds of the
+        histogram's buckets).
+        """
+        lines = [f"profiler is {'on' if self.enabled else 'off'}, {self.samples_taken} stack samples taken every {self.sample_interval * 1000:g}ms",
+                 f"{'name':<60}{'count':>10}{'total':>12}{'mean':>10}{'p50':>10}{'p99':>10}{'max':>10}"]
+        for name, histogram in sorted(self.durations.snapshot().histograms.items()):
+            if not histogram.count:
+                continue
+            total = histogram.sum_microseconds / 1000
+            lines.append(f"{name:<60}{histogram.count:>10}{total:>12.1f}{total / histogram.count:>10.3f}"
+                         f"{histogram.percentile(0.5) * 1000:>10.3f}{histogram.percentile(0.99) * 1000:>10.3f}{histogram.percentile(1.0) * 1000:>10.3f}")
+        return '\n'.join(lines) + '\n'
+
+PROFILER = Profiler()
@@ -0,0 +1,451 @@
+import atexit
+import email.utils
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from .general_utils import HttpRequest, HttpResponse, CachedResponse, ProxiedResponse, is_not_modified
+
+#(host, url) of a request
+PrimaryKey = Tuple[str, str]
+#the primary key plus the values of the request headers the response varies on
+CacheKey = Tuple[PrimaryKey, Tuple[Tuple[str, Optional[str]], ...]]
+
+#responses with these status codes can be stored without the backend saying so explicitly (rfc 9111 section 3),
+#anything else needs a max-age, s-maxage or Expires
+CACHEABLE_BY_DEFAULT = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+#hop by hop headers are about the connection the response came in on, and Age is recomputed every time it's served
+UNSTORED_HEADERS = {'connection', 'keep-alive', 'age'}
+#the headers a 304 can't change because they describe the stored body
+HEADERS_KEPT_ON_REVALIDATION = {'content-length', 'transfer-encoding', 'content-encoding', 'content-range'}
+#the headers a 304 sent from the cache repeats from the stored response
+NOT_MODIFIED_HEADERS = {'cache-control', 'content-location', 'date', 'etag', 'expires', 'last-modified', 'vary'}
+
+def parse_cache_control(cache_control: Optional[str]) -> Dict[str, Optional[str]]:
+    """
+    "max-age=60, no-cache" -> {'max-age': '60', 'no-cache': None}
+    """
+    directives = {}
+    if not cache_control:
+        return directives
+    for directive in cache_control.split(','):
+        name, separator, argument = directive.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"') if separator else None
+    return directives
+
+def seconds_directive(directives: Dict[str, Optional[str]], name: str) -> Optional[int]:
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def http_timestamp(http_date: Optional[str]) -> Optional[float]:
+    if not http_date:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(http_date).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def header_lines(head: bytes) -> list:
+    """
+    the header lines of a head (status line and the empty line at the end left out) as (lowercased name, line) pairs.
+    """
+    return [(line.split(b':', 1)[0].strip().lower().decode('latin-1'), line) for line in head.rstrip(b'\r\n').split(b'\r\n')[1:]]
+
+class CacheEntry:
+    """
+    A response from a backend as it was received (head and body, the body still framed the way the backend framed it)
+    with what is needed to tell whether it's still fresh. Entries are never changed once made, a revalidation makes a
+    new one, so a response that is being sent from an entry doesn't have to worry about it changing.
+    """
+    def __init__(self, key: CacheKey, status_code: int, head: bytes, body: bytes, stored_at: float, initial_age: float = 0.0):
+        self.key = key
+        self.status_code = status_code
+        self.head = head
+        self.body = body
+        #wall clock, so that an entry read back from the disk tier is still aged correctly
+        self.stored_at = stored_at
+        self.initial_age = initial_age
+        self.headers = {name: line.split(b':', 1)[1].strip().decode('latin-1') for name, line in header_lines(head)}
+        self.etag = self.headers.get('etag')
+        self.last_modified = http_timestamp(self.headers.get('last-modified'))
+        directives = parse_cache_control(self.headers.get('cache-control'))
+        self.freshness_lifetime = self.explicit_freshness_lifetime(directives) or 0
+        if 'no-cache' in directives:
+            self.freshness_lifetime = 0
+        self.must_revalidate = 'must-revalidate' in directives or 'proxy-revalidate' in directives
+        #None means the cache's default applies
+        self.stale_while_revalidate = seconds_directive(directives, 'stale-while-revalidate')
+
+    def explicit_freshness_lifetime(self, directives: Dict[str, Optional[str]]) -> Optional[float]:
+        for directive in ('s-maxage', 'max-age'):
+            lifetime = seconds_directive(directives, directive)
+            if lifetime is not None:
+                return lifetime
+        if 'expires' in self.headers:
+            expires = http_timestamp(self.headers['expires'])
+            #an Expires that can't be parsed means already expired
+            if expires is None:
+                return 0
+            return max(0.0, expires - (http_timestamp(self.headers.get('date')) or self.stored_at))
+        return None
+
+    def age(self, now: float) -> float:
+        return self.initial_age + max(0.0, now - self.stored_at)
+
+    def size(self) -> int:
+        return len(self.head) + len(self.body)
+
+    def has_validators(self) -> bool:
+        return self.etag is not None or self.last_modified is not None
+
+    def response(self, now: float, head_only: bool = False) -> CachedResponse:
+        head = self.head[:-2] + b'Age: %d\r\n\r\n' % int(self.age(now))
+        return CachedResponse(head, b'' if head_only else self.body, self.status_code)
+
+    def not_modified_response(self, now: float) -> CachedResponse:
+        lines = [b'HTTP/1.1 304 Not Modified']
+        lines += [line for name, line in header_lines(self.head) if name in NOT_MODIFIED_HEADERS]
+        lines.append(b'Age: %d' % int(self.age(now)))
+        return CachedResponse(b'\r\n'.join(lines) + b'\r\n\r\n', b'', 304)
+
+    def revalidated(self, not_modified_headers: Dict[str, str], now: float) -> 'CacheEntry':
+        """
+        the entry with its headers updated from the 304 the backend answered a revalidation with.
+        """
+        updated_headers = {name.lower(): value for name, value in not_modified_headers.items()
+                           if name.lower() not in UNSTORED_HEADERS and name.lower() not in HEADERS_KEPT_ON_REVALIDATION}
+        status_line = self.head.split(b'\r\n', 1)[0]
+        lines = [status_line] + [line for name, line in header_lines(self.head) if name not in updated_headers]
+        lines += [f'{name}: {value}'.encode('latin-1') for name, value in not_modified_headers.items() if name.lower() in updated_headers]
+        age = next((value for name, value in not_modified_headers.items() if name.lower() == 'age'), '0')
+        return CacheEntry(self.key, self.status_code, b'\r\n'.join(lines) + b'\r\n\r\n', self.body, now, float(age) if age.isdigit() else 0.0)
+
+    def dump(self) -> bytes:
+        metadata = {'key': self.key, 'status_code': self.status_code, 'stored_at': self.stored_at,
+                    'initial_age': self.initial_age, 'head_length': len(self.head)}
+        return json.dumps(metadata).encode() + b'\n' + self.head + self.body
+
+    @classmethod
+    def load(cls, dumped_entry: bytes) -> 'CacheEntry':
+        metadata_line, _, response = dumped_entry.partition(b'\n')
+        metadata = json.loads(metadata_line)
+        (host, url), vary = metadata['key']
+        key = ((host, url), tuple((name, value) for name, value in vary))
+        head_length = metadata['head_length']
+        return cls(key, metadata['status_code'], response[:head_length], response[head_length:], metadata['stored_at'], metadata['initial_age'])
+
+    def __repr__(self) -> str:
+        return f'CacheEntry({self.key}, status={self.status_code}, size={self.size()}, fresh for {self.freshness_lifetime}s)'
+
+class DiskTier:
+    """
+    Entries pushed out of the memory tier, one file per entry in a directory of their own, bounded by the total size of
+    the files. The directory is made fresh for every cache (and every pre-fork worker) and isn't read back after a
+    restart, it's extra room rather than persistence.
+    """
+    def __init__(self, parent_directory: str, max_bytes: int):
+        os.makedirs(parent_directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix=f'pyrver-cache-{os.getpid()}-', dir=parent_directory)
+        atexit.register(shutil.rmtree, self.directory, True)
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        #cache key -> (file path, size)
+        self.files: 'OrderedDict[CacheKey, Tuple[str, int]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def path(self, key: CacheKey) -> str:
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest())
+
+    def put(self, entry: CacheEntry) -> None:
+        dumped_entry = entry.dump()
+        if len(dumped_entry) > self.max_bytes:
+            return
+        path = self.path(entry.key)
+        try:
+            with open(path, 'wb') as entry_file:
+                entry_file.write(dumped_entry)
+        except OSError:
+            return
+        with self.lock:
+            previous = self.files.pop(entry.key, None)
+            if previous is not None:
+                self.bytes_used -= previous[1]
+            self.files[entry.key] = (path, len(dumped_entry))
+            self.bytes_used += len(dumped_entry)
+            evicted_paths = []
+            while self.bytes_used > self.max_bytes:
+                _, (evicted_path, size) = self.files.popitem(last=False)
+                self.bytes_used -= size
+                evicted_paths.append(evicted_path)
+        for evicted_path in evicted_paths:
+            self.remove_file(evicted_path)
+
+    def take(self, key: CacheKey) -> Optional[CacheEntry]:
+        """
+        removes the entry from the disk tier and returns it, it goes back to the memory tier.
+        """
+        with self.lock:
+            stored_file = self.files.pop(key, None)
+            if stored_file is None:
+                return None
+            self.bytes_used -= stored_file[1]
+        try:
+            with open(stored_file[0], 'rb') as entry_file:
+                entry = CacheEntry.load(entry_file.read())
+        except (OSError, ValueError, KeyError):
+            entry = None
+        self.remove_file(stored_file[0])
+        return entry
+
+    def remove(self, primary_key: PrimaryKey) -> None:
+        with self.lock:
+            keys = [key for key in self.files if key[0] == primary_key]
+            paths = []
+            for key in keys:
+                path, size = self.files.pop(key)
+                self.bytes_used -= size
+                paths.append(path)
+        for path in paths:
+            self.remove_file(path)
+
+    def remove_file(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class CacheLookup:
+    """
+    What the cache can do for a request:
+    response: a response to send right away. When it's stale and has to be revalidated in the background
+    revalidate_in_background is set.
+    entry: the stored response the backend is asked about (upstream_request is conditional then) or None.
+    result: for the metrics, hit, stale, miss, revalidated, expired or bypass.
+    """
+    def __init__(self, upstream_request: HttpRequest, result: str, entry: Optional[CacheEntry] = None,
+                 response: Optional[HttpResponse] = None, revalidate_in_background: bool = False):
+        self.upstream_request = upstream_request
+        self.result = result
+        self.entry = entry
+        self.response = response
+        self.revalidate_in_background = revalidate_in_background
+
+class ResponseCache:
+    """
+    An HTTP cache (rfc 9111) in front of the backends of a reverse_proxy or load_balance task, configured by the "cache"
+    block of the task's context:
+    max_bytes: how much the memory tier holds (heads and bodies), least recently used entries are pushed out first.
+    max_entry_bytes: bigger responses aren't stored, they're relayed like without a cache.
+    disk_directory/disk_max_bytes: when a directory is given, entries pushed out of memory go to a disk tier instead of
+    being dropped.
+    stale_while_revalidate: seconds a stale response can still be sent while it's revalidated in the background, for
+    responses that don't say themselves (with the stale-while-revalidate directive).
+
+    Only GET responses are stored (HEAD requests are answered from them), responses are stored if the backend allows it
+    (Cache-Control, Expires, status code) and they are fresh for as long as the backend says (s-maxage, max-age,
+    Expires). A stale response with an ETag or Last-Modified is revalidated with a conditional request, a 304 refreshes
+    it without the body being sent again. Vary is honored by keying the stored responses by the values of the request
+    headers named in it. Responses that set cookies, requests with credentials and ranges are never cached.
+    """
+    def __init__(self, max_bytes: int = 1024 * 1024 * 64, max_entry_bytes: int = 1024 * 1024, stale_while_revalidate: float = 0,
+                 disk_directory: Optional[str] = None, disk_max_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.stale_while_revalidate = stale_while_revalidate
+        self.bytes_used = 0
+        self.entries: 'OrderedDict[CacheKey, CacheEntry]' = OrderedDict()
+        #the header names the latest response for a url varies on
+        self.vary: Dict[PrimaryKey, Tuple[str, ...]] = {}
+        self.revalidating = set()
+        self.disk_tier = DiskTier(disk_directory, disk_max_bytes) if disk_directory else None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_context(cls, context: Dict) -> Optional['ResponseCache']:
+        cache_settings = context.get('cache')
+        if cache_settings is None:
+            return None
+        return cls(**cache_settings)
+
+    def primary_key(self, http_request: HttpRequest) -> PrimaryKey:
+        return ((http_request.get_header('Host') or '').lower(), http_request.requested_url)
+
+    def key(self, http_request: HttpRequest, vary_names: Tuple[str, ...]) -> CacheKey:
+        return (self.primary_key(http_request), tuple((name, http_request.get_header(name)) for name in vary_names))
+
+    def get(self, http_request: HttpRequest) -> Optional[CacheEntry]:
+        primary_key = self.primary_key(http_request)
+        with self.lock:
+            vary_names = self.vary.get(primary_key)
+            if vary_names is None:
+                return None
+            key = self.key(http_request, vary_names)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.disk_tier is None:
+            return None
+        entry = self.disk_tier.take(key)
+        if entry is not None:
+            self.put(entry)
+        return entry
+
+    def put(self, entry: CacheEntry) -> None:
+        demoted_entries = []
+        with self.lock:
+            previous = self.entries.pop(entry.key, None)
+            if previous is not None:
+                self.bytes_used -= previous.size()
+            self.entries[entry.key] = entry
+            self.vary[entry.key[0]] = tuple(name for name, _ in entry.key[1])
+            self.bytes_used += entry.size()
+            while self.bytes_used > self.max_bytes:
+                _, least_recently_used = self.entries.popitem(last=False)
+                self.bytes_used -= least_recently_used.size()
+                demoted_entries.append(least_recently_used)
+        if self.disk_tier is not None:
+            for demoted_entry in demoted_entries:
+                self.disk_tier.put(demoted_entry)
+
+    def invalidate(self, http_request: HttpRequest) -> None:
+        """
+        a successful POST, PUT, DELETE... to a url makes whatever is stored for it stale (rfc 9111 section 4.4).
+        """
+        primary_key = self.primary_key(http_request)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == primary_key]:
+                self.bytes_used -= self.entries.pop(key).size()
+            self.vary.pop(primary_key, None)
+        if self.disk_tier is not None:
+            self.disk_tier.remove(primary_key)
+
+    def start_revalidation(self, entry: CacheEntry) -> bool:
+        """
+        only one background revalidation per entry at a time, False if one is already running.
+        """
+        with self.lock:
+            if entry.key in self.revalidating:
+                return False
+            self.revalidating.add(entry.key)
+            return True
+
+    def finish_revalidation(self, entry: CacheEntry) -> None:
+        with self.lock:
+            self.revalidating.discard(entry.key)
+
+    def lookup(self, http_request: HttpRequest) -> CacheLookup:
+        if http_request.request_type not in ('GET', 'HEAD'):
+            return CacheLookup(http_request, 'bypass')
+        request_directives = parse_cache_control(http_request.get_header('Cache-Control'))
+        if ('no-store' in request_directives or http_request.get_header('Authorization') is not None
+                or http_request.get_header('Range') is not None):
+            return CacheLookup(http_request, 'bypass')
+        entry = self.get(http_request)
+        if entry is None:
+            return CacheLookup(http_request, 'miss')
+
+        now = time.time()
+        age = entry.age(now)
+        max_age = seconds_directive(request_directives, 'max-age')
+        client_wants_revalidation = 'no-cache' in request_directives or (http_request.get_header('Pragma') or '').lower() == 'no-cache'
+        if age < entry.freshness_lifetime and not client_wants_revalidation and (max_age is None or age <= max_age):
+            return CacheLookup(http_request, 'hit', entry, self.response(http_request, entry, now))
+
+        stale_while_revalidate = entry.stale_while_revalidate if entry.stale_while_revalidate is not None else self.stale_while_revalidate
+        if (not client_wants_revalidation and not entry.must_revalidate and entry.has_validators()
+                and age < entry.freshness_lifetime + stale_while_revalidate):
+            revalidate_in_background = self.start_revalidation(entry)
+            return CacheLookup(self.conditional_request(http_request, entry), 'stale', entry, self.response(http_request, entry, now),
+                               revalidate_in_background)
+        if not entry.has_validators():
+            return CacheLookup(http_request, 'expired')
+        return CacheLookup(self.conditional_request(http_request, entry), 'revalidated', entry)
+
+    def response(self, http_request: HttpRequest, entry: CacheEntry, now: float) -> HttpResponse:
+        if entry.status_code == 200 and is_not_modified(http_request, entry.etag or '', entry.last_modified or float('inf')):
+            return entry.not_modified_response(now)
+        return entry.response(now, head_only=http_request.request_type == 'HEAD')
+
+    def conditional_request(self, http_request: HttpRequest, entry: CacheEntry) -> HttpRequest:
+        """
+        the client's request with the entry's validators instead of the client's own, a 304 for them is only useful to
+        us. The cache answers the client's conditionals itself.
+        """
+        raw_http_request = http_request.raw_http_request
+        head, body = raw_http_request[:http_request.head_length], raw_http_request[http_request.head_length + 4:]
+        request_line, *lines = head.split(b'\r\n')
+        lines = [line for line in lines if line.split(b':', 1)[0].strip().lower() not in (b'if-none-match', b'if-modified-since')]
+        if entry.etag is not None:
+            lines.append(f'If-None-Match: {entry.etag}'.encode('latin-1'))
+        if entry.last_modified is not None:
+            lines.append(f"If-Modified-Since: {entry.headers['last-modified']}".encode('latin-1'))
+        return HttpRequest.from_bytes(b'\r\n'.join([request_line, *lines]) + b'\r\n\r\n' + body)
+
+    def fetched(self, http_request: HttpRequest, lookup: CacheLookup, http_response: HttpResponse) -> HttpResponse:
+        """
+        What to send the client now that the backend answered lookup.upstream_request. A 304 for the stored response
+        refreshes it and the client gets the stored one, a storable response is stored once it has been relayed
+        (see ProxiedResponse.capture).
+        """
+        status_code = http_response.status_code
+        if lookup.result == 'bypass':
+            if http_request.request_type not in ('GET', 'HEAD') and 200 <= status_code < 400:
+                self.invalidate(http_request)
+            return http_response
+        if status_code == 304 and lookup.entry is not None:
+            if isinstance(http_response, ProxiedResponse):
+                http_response.release()
+            now = time.time()
+            entry = lookup.entry.revalidated(http_response.headers, now)
+            self.put(entry)
+            return self.response(http_request, entry, now)
+        if lookup.upstream_request.request_type == 'GET' and isinstance(http_response, ProxiedResponse):
+            vary_names = self.storable_vary_names(http_request, http_response)
+            if vary_names is not None:
+                key = self.key(http_request, vary_names)
+                http_response.capture(self.max_entry_bytes, lambda raw_http_response: self.store(key, status_code, raw_http_response))
+        return http_response
+
+    def storable_vary_names(self, http_request: HttpRequest, http_response: ProxiedResponse) -> Optional[Tuple[str, ...]]:
+        """
+        the names of the request headers the response varies on if the response can be stored, None if it can't.
+        """
+        headers = {name.lower(): value for name, value in http_response.headers.items()}
+        directives = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in directives or 'private' in directives or 'set-cookie' in headers or http_response.closes_client_connection:
+            return None
+        has_explicit_freshness = 's-maxage' in directives or 'max-age' in directives or 'expires' in headers
+        if http_response.status_code not in CACHEABLE_BY_DEFAULT and not has_explicit_freshness:
+            return None
+        if not has_explicit_freshness and 'etag' not in headers and 'last-modified' not in headers:
+            #it would be stale right away and couldn't be revalidated
+            return None
+        content_length = headers.get('content-length', '')
+        if content_length.isdigit() and int(content_length) > self.max_entry_bytes:
+            return None
+        vary_names = tuple(sorted({name.strip().lower() for name in headers.get('vary', '').split(',') if name.strip()}))
+        if '*' in vary_names:
+            return None
+        return vary_names
+
+    def store(self, key: CacheKey, status_code: int, raw_http_response: bytes) -> None:
+        head_end = raw_http_response.find(b'\r\n\r\n') + 4
+        head = raw_http_response[:head_end]
+        lines = header_lines(head)
+        age = next((line.split(b':', 1)[1].strip() for name, line in lines if name == 'age'), b'0')
+        stored_lines = [head.split(b'\r\n', 1)[0]] + [line for name, line in lines if name not in UNSTORED_HEADERS]
+        stored_head = b'\r\n'.join(stored_lines) + b'\r\n\r\n'
+        entry = CacheEntry(key, status_code, stored_head, raw_http_response[head_end:], time.time(), float(age) if age.isdigit() else 0.0)
+        if entry.size() <= self.max_entry_bytes:
+            self.put(entry)
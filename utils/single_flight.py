@@ -0,0 +1,121 @@
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+from .general_utils import HttpRequest, HttpResponse, CachedResponse, ProxiedResponse
+from .response_cache import parse_cache_control, header_lines
+
+#the request headers a backend's response can depend on, requests that differ in any of them are never coalesced
+FLIGHT_HEADERS = ('Accept', 'Accept-Encoding', 'Accept-Language', 'Authorization', 'Cookie', 'Range', 'If-None-Match', 'If-Modified-Since')
+#hop by hop, every client's connection says its own
+UNSHARED_HEADERS = {'connection', 'keep-alive'}
+
+FlightKey = Tuple[str, str, Tuple[Optional[str], ...]]
+
+class SharedResponse:
+    """
+    A backend's response (head and body, the body still framed the way the backend framed it) that every request
+    waiting on the same fetch gets a copy of.
+    """
+    __slots__ = ('head', 'body', 'status_code', 'headers')
+
+    def __init__(self, head: bytes, body: bytes, status_code: int, headers: Dict[str, str]):
+        self.head = head
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers
+
+    def response(self) -> CachedResponse:
+        http_response = CachedResponse(self.head, self.body, self.status_code)
+        #the proxy cache reads the headers of a 304
+        http_response.headers = dict(self.headers)
+        return http_response
+
+class SingleFlight:
+    """
+    Collapses identical GETs to the backends that are in flight at the same time into one: the first request (the
+    leader) is sent to the backend, the ones that come in while it's waiting for the response (the followers) wait
+    for it and get a copy of its response. When a popular url expires from the cache or a backend comes back up,
+    the backend gets one request instead of one per client. Configured by the "coalesce" block of a reverse_proxy or
+    load_balance task's context:
+    max_response_bytes: the leader reads the whole response before it's sent to anyone, bigger responses aren't
+    shared (the followers send their own request then).
+    wait_timeout: seconds a follower waits for the leader's response before it sends its own request.
+
+    Responses that set cookies or say no-store or private aren't shared, neither are responses that end when the
+    backend closes the connection. Requests are identical when they are for the same host and url and have the same
+    FLIGHT_HEADERS. The leader and the followers wait their own way (a future the threads block on, a FutureTask
+    for the PurelySync coroutines, an asyncio future), this only keeps track of the flights.
+    """
+    def __init__(self, max_response_bytes: int = 1024 * 1024, wait_timeout: float = 30.0):
+        self.max_response_bytes = max_response_bytes
+        self.wait_timeout = wait_timeout
+        self.flights: Dict[FlightKey, Any] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_context(cls, context: Dict) -> Optional['SingleFlight']:
+        coalesce_settings = context.get('coalesce')
+        if coalesce_settings is None:
+            return None
+        return cls(**coalesce_settings)
+
+    def key(self, http_request: HttpRequest) -> Optional[FlightKey]:
+        """
+        None for a request that can't be coalesced, anything but a GET without a body.
+        """
+        if http_request.request_type != 'GET' or len(http_request.raw_http_request) > http_request.head_length + 4:
+            return None
+        return ((http_request.get_header('Host') or '').lower(), http_request.requested_url,
+                tuple(http_request.get_header(name) for name in FLIGHT_HEADERS))
+
+    def join(self, key: FlightKey, new_future: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        the future of the flight for key and whether the caller is its leader (the future is new then).
+        """
+        with self.lock:
+            future = self.flights.get(key)
+            if future is not None:
+                return future, False
+            future = self.flights[key] = new_future()
+            return future, True
+
+    def finish(self, key: FlightKey, future) -> None:
+        """
+        requests that come in from now on start a new flight, called before the followers are given the response.
+        """
+        with self.lock:
+            if self.flights.get(key) is future:
+                del self.flights[key]
+
+    def wants_body(self, http_response: HttpResponse) -> bool:
+        """
+        whether the leader should read the rest of the response before sending it: it's a response from a backend that
+        can be shared and isn't too big for it.
+        """
+        return (isinstance(http_response, ProxiedResponse) and not http_response.complete and self.shareable(http_response)
+                and http_response.body_size() <= self.max_response_bytes)
+
+    def shareable(self, http_response: HttpResponse) -> bool:
+        headers = {name.lower(): value for name, value in http_response.headers.items()}
+        directives = parse_cache_control(headers.get('cache-control'))
+        if 'no-store' in directives or 'private' in directives or 'set-cookie' in headers:
+            return False
+        return not isinstance(http_response, ProxiedResponse) or not http_response.closes_client_connection
+
+    def share(self, http_response: HttpResponse) -> Optional[SharedResponse]:
+        """
+        what the followers get from the leader's response, None if they have to send their own request.
+        """
+        if isinstance(http_response, ProxiedResponse):
+            if not http_response.complete or len(http_response.received) > self.max_response_bytes:
+                return None
+            raw_http_response = http_response.received
+        else:
+            #a response made up by the handler, like a 502 when the backend can't be reached
+            raw_http_response = b''.join(http_response.buffers())
+        if not self.shareable(http_response):
+            return None
+        head_end = raw_http_response.find(b'\r\n\r\n') + 4
+        head = raw_http_response[:head_end]
+        shared_lines = [head.split(b'\r\n', 1)[0]] + [line for name, line in header_lines(head) if name not in UNSHARED_HEADERS]
+        return SharedResponse(b'\r\n'.join(shared_lines) + b'\r\n\r\n', bytes(raw_http_response[head_end:]),
+                              http_response.status_code, dict(http_response.headers))
@@ -0,0 +1,117 @@
+import os
+import ssl
+from typing import Dict, Optional, Tuple
+
+VERSIONS = {'TLSv1.2': ssl.TLSVersion.TLSv1_2, 'TLSv1.3': ssl.TLSVersion.TLSv1_3}
+
+class TlsTermination:
+    """
+    TLS for the client connections of every server type, configured by the "tls" block of the settings:
+    certificate/key: the certificate chain and its private key (pem files), for clients that don't ask for a host
+    with a certificate of its own.
+    session_tickets: returning clients resume their session from a ticket we gave them (the session's state encrypted
+    with a key only we have) instead of going through a full handshake again. TLS 1.2 and 1.3 clients both can.
+    False turns resumption off.
+    tickets_per_handshake: how many TLS 1.3 tickets a client gets after a full handshake, a ticket is good for
+    resuming one connection.
+    minimum_version: 'TLSv1.2' or 'TLSv1.3'.
+
+    A task can have a "tls" block with a certificate and key of its own in its context: clients whose SNI is one of
+    the hosts in the task's match criteria get that certificate (see select_certificate).
+
+    Tickets are our session cache: the ssl module runs OpenSSL with its server side session cache (session ids)
+    turned off and has no way to turn it on, and tickets don't need one since the client keeps its session. The
+    keys tickets are encrypted with belong to the default context. The pre-fork master makes the TlsTermination
+    before forking, so the workers inherit the same keys and a client resumes its session whichever worker its next
+    connection lands on.
+    """
+    def __init__(self, certificate: str, key: str, session_tickets: bool = True, tickets_per_handshake: int = 2,
+                 minimum_version: str = 'TLSv1.2', certificates_by_host: Optional[Dict[str, Tuple[str, str]]] = None):
+        self.session_tickets = session_tickets
+        self.tickets_per_handshake = tickets_per_handshake
+        self.minimum_version = VERSIONS[minimum_version]
+        self.default_context = self.create_context(certificate, key)
+        #one context per certificate, hosts that share a certificate share a context
+        contexts_by_certificate = {(certificate, key): self.default_context}
+        self.contexts = [self.default_context]
+        self.contexts_by_host: Dict[str, ssl.SSLContext] = {}
+        for host, host_certificate in (certificates_by_host or {}).items():
+            if host_certificate not in contexts_by_certificate:
+                contexts_by_certificate[host_certificate] = self.create_context(*host_certificate)
+                self.contexts.append(contexts_by_certificate[host_certificate])
+            self.contexts_by_host[host.lower()] = contexts_by_certificate[host_certificate]
+        if self.contexts_by_host:
+            self.default_context.sni_callback = self.select_certificate
+
+    @classmethod
+    def from_settings(cls, settings: Dict) -> Optional['TlsTermination']:
+        tls_settings = settings.get('tls')
+        if tls_settings is None:
+            return None
+        return cls(certificates_by_host=certificates_by_host(settings), **tls_settings)
+
+    def create_context(self, certificate: str, key: str) -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = self.minimum_version
+        context.load_cert_chain(certificate, key)
+        context.set_alpn_protocols(['http/1.1'])
+        if self.session_tickets:
+            context.num_tickets = self.tickets_per_handshake
+        else:
+            context.options |= ssl.OP_NO_TICKET
+            context.num_tickets = 0
+        return context
+
+    def select_certificate(self, ssl_socket, server_name: Optional[str], initial_context: ssl.SSLContext) -> None:
+        """
+        called by OpenSSL with the client's SNI in the middle of the handshake, switching the connection to another
+        context changes the certificate it gets. Sessions (and the keys tickets are encrypted with) stay those of the
+        default context, so a resumed session works whichever certificate it was made with.
+        """
+        if server_name is not None:
+            context = self.contexts_by_host.get(server_name.lower())
+            if context is not None:
+                ssl_socket.context = context
+
+    def wrap(self, client_socket):
+        """
+        the client's socket as a TLS socket. The handshake happens on the first read (or do_handshake), so wrapping
+        never blocks and a thread that accepts clients can do it.
+        """
+        return self.default_context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+
+    def handshake_counts(self) -> Dict[str, int]:
+        """
+        handshakes completed since the server started, by whether the session was resumed. OpenSSL counts some of it on
+        the context a connection started with and some on the one it ended up with, so they're added up over all of them.
+        """
+        completed = resumed = 0
+        for context in self.contexts:
+            session_stats = context.session_stats()
+            completed += session_stats['accept_good']
+            resumed += session_stats['hits']
+        return {'tls_full_handshakes': completed - resumed, 'tls_resumed_handshakes': resumed}
+
+def certificates_by_host(settings: Dict) -> Dict[str, Tuple[str, str]]:
+    """
+    the certificate and key of the tasks with a "tls" block of their own, for each host in their match criteria.
+    """
+    certificates = {}
+    for task_info in settings['tasks'].values():
+        task_tls_settings = task_info['context'].get('tls')
+        if task_tls_settings is not None:
+            for host in task_info['match_criteria'].get('host', []):
+                certificates[host] = (task_tls_settings['certificate'], task_tls_settings['key'])
+    return certificates
+
+def certificate_file_versions(settings: Dict) -> Dict[str, int]:
+    """
+    the modification time of every certificate and key file in the settings, renewing a certificate on disk changes it.
+    """
+    tls_settings = settings.get('tls')
+    if tls_settings is None:
+        return {}
+    paths = {tls_settings['certificate'], tls_settings['key']}
+    for certificate, key in certificates_by_host(settings).values():
+        paths.update((certificate, key))
+    return {path: os.stat(path).st_mtime_ns for path in paths}